@@ -30,6 +30,8 @@
 from __future__ import absolute_import, print_function, unicode_literals
 import logging
 
+import inventory
+
 
 LOG = logging.getLogger(__name__)
 
@@ -42,9 +44,11 @@ __func_alias__ = {
 # Define not exported variables from Salt, so this can be imported as
 # a normal module
 try:
+    __context__
     __grains__
     __salt__
 except NameError:
+    __context__ = {}
     __grains__ = {}
     __salt__ = {}
 
@@ -167,6 +171,7 @@ def wipe(device):
     # Remove the MBR information
     __salt__["disk.wipe"]("{}".format(device))
     __salt__["cmd.run"]("dd bs=512 count=1 if=/dev/zero of={}".format(device))
+    inventory.invalidate(__context__)
 
     return True
 
@@ -30,6 +30,8 @@
 from __future__ import absolute_import, print_function, unicode_literals
 import logging
 
+import inventory
+
 
 LOG = logging.getLogger(__name__)
 
@@ -39,21 +41,36 @@ __virtualname__ = "filters"
 # Define not exported variables from Salt, so this can be imported as
 # a normal module
 try:
+    __context__
     __pillar__
 except NameError:
+    __context__ = {}
     __pillar__ = {}
 
 
+def _device_type(device):
+    """Return the type of an existing device, or None"""
+    try:
+        return inventory.get(__context__).type(device)
+    except inventory.InventoryException:
+        return None
+
+
 def is_lvm(device):
     """Detect if a device name comes from a LVM volume."""
     devices = ["/dev/{}/".format(i) for i in __pillar__.get("lvm", {})]
     devices.extend(("/dev/mapper/", "/dev/dm-"))
-    return device.startswith(tuple(devices))
+    # The volumes that do not exist yet are detected by the name
+    return device.startswith(tuple(devices)) or _device_type(device) == "lvm"
 
 
 def is_raid(device):
     """Detect if a device name comes from a RAID array."""
-    return device.startswith("/dev/md")
+    if device.startswith("/dev/md"):
+        return True
+    # Arrays can also be addressed by a link, like /dev/disk/by-id/md-*
+    device_type = _device_type(device)
+    return bool(device_type) and device_type.startswith(("raid", "linear"))
 
 
 def is_not_raid(device):
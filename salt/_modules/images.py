@@ -28,13 +28,30 @@
 :platform:      Linux
 """
 from __future__ import absolute_import, print_function, unicode_literals
+import contextlib
+import functools
+import hashlib
+import json
 import logging
+import os
 import pathlib
+import tempfile
+import time
 import urllib.parse
 
 from salt.exceptions import SaltInvocationError, CommandExecutionError
 import salt.utils.args
 
+import blocktune
+import disk
+import downloads
+import imagecache
+import imagestream
+import inventory
+import multicast
+import superblock
+import swarm
+
 LOG = logging.getLogger(__name__)
 
 __virtualname__ = "images"
@@ -42,8 +59,10 @@ __virtualname__ = "images"
 # Define not exported variables from Salt, so this can be imported as
 # a normal module
 try:
+    __context__
     __salt__
 except NameError:
+    __context__ = {}
     __salt__ = {}
 
 
@@ -72,16 +91,44 @@ VALID_SCHEME = (
     "telnet",
     "tftp",
 )
-VALID_COMPRESSIONS = ("gz", "bz2", "xz")
+VALID_COMPRESSIONS = ("gz", "bz2", "xz", "zst", "lz4")
+# Images sent to a multicast group by the `images.multicast` runner
+MULTICAST_SCHEME = "multicast"
 VALID_CHECKSUMS = ("md5", "sha1", "sha224", "sha256", "sha384", "sha512")
 
+# Seconds waiting for a download slot (or for the slot service)
+SLOT_TIMEOUT = 3600
 
-def _checksum_url(url, checksum_type):
-    """Generate the URL for the checksum"""
+# Golden root archives, and the files that are specific of each node
+# and are not stored there
+GOLDEN_EXTENSION = ".tar.zst"
+GOLDEN_EXCLUDE = (
+    "./proc/*",
+    "./sys/*",
+    "./dev/*",
+    "./run/*",
+    "./tmp/*",
+    "./etc/fstab",
+    "./etc/machine-id",
+    "./etc/ssh/ssh_host_*",
+    "./etc/zypp/credentials.d/*",
+    "./etc/SUSEConnect",
+    "./var/lib/zypp/AnonymousUniqueId",
+    "./var/cache/zypp/*",
+    "./.snapshots",
+)
+
+# File systems mounted inside the root that are part of the golden
+# root, like the btrfs subvolumes of /var, /opt or /home
+GOLDEN_FILESYSTEMS = ("btrfs", "ext2", "ext3", "ext4", "xfs", "vfat")
+
+
+def _sidecar_url(url, extension):
+    """Generate the URL for a file that lives next to the image"""
     url_elements = urllib.parse.urlparse(url)
     path = url_elements.path
     suffix = pathlib.Path(path).suffix
-    new_suffix = ".{}".format(checksum_type)
+    new_suffix = ".{}".format(extension)
     if suffix[1:] in VALID_COMPRESSIONS:
         path = pathlib.Path(path).with_suffix(new_suffix)
     else:
@@ -89,6 +136,21 @@ def _checksum_url(url, checksum_type):
     return urllib.parse.urlunparse(url_elements._replace(path=str(path)))
 
 
+def _checksum_url(url, checksum_type):
+    """Generate the URL for the checksum"""
+    return _sidecar_url(url, checksum_type)
+
+
+def _bmap_url(url):
+    """Generate the URL for the bmap file"""
+    return _sidecar_url(url, "bmap")
+
+
+def _manifest_url(url):
+    """Generate the URL for the manifest with the hashes of the chunks"""
+    return _sidecar_url(url, "chunks")
+
+
 def _curl_cmd(url, **kwargs):
     """Return curl commmand line"""
     cmd = ["curl"]
@@ -114,12 +176,36 @@ def _fetch_file(url, **kwargs):
 
 
 def _find_filesystem(device):
-    """Use lsblk to find the filesystem of a partition."""
-    cmd = ["lsblk", "--noheadings", "--output", "FSTYPE", device]
-    return __salt__["cmd.run_stdout"](cmd)
+    """Probe the filesystem of a partition."""
+    return inventory.get(__context__).fstype(device)
 
 
-def fetch_checksum(url, checksum_type, **kwargs):
+def _cache(cache, cache_size):
+    """Return the local cache of images, if any"""
+    if not cache:
+        return None
+    max_size = int(cache_size * 1000**2) if cache_size else None
+    try:
+        return imagecache.Cache(cache, max_size)
+    except OSError as e:
+        raise CommandExecutionError("Cache {} cannot be used: {}".format(cache, e))
+
+
+def _fetch_cached(url, cache):
+    """Fetch a small file using the local cache"""
+    scheme = urllib.parse.urlparse(url).scheme
+    if scheme not in imagestream.NATIVE_SCHEME:
+        raise SaltInvocationError(
+            "Protocol {} not supported by the cache".format(scheme)
+        )
+    try:
+        return cache.fetch(url)
+    except imagestream.StreamException as e:
+        LOG.info("Error fetching %s: %s", url, e)
+        return None
+
+
+def fetch_checksum(url, checksum_type, cache=None, cache_size=None, **kwargs):
     """
     Fecht the checksum from an image URL
 
@@ -128,12 +214,21 @@ def fetch_checksum(url, checksum_type, **kwargs):
         curl. For example: http, https, scp, sftp, tftp or ftp.
 
         The image can be compressed, and the supported extensions are:
-        gz, bz2 and xz
+        gz, bz2, xz, zst and lz4
 
     checksum_type
         The type of checksum used to validate the image, possible
         values are 'md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512'.
 
+    cache
+        Directory of the local cache. If set, the checksum file is
+        stored there, and revalidated with the server using the ETag
+        and the Last-Modified date. Only the schemes http, https, ftp
+        and file are supported.
+
+    cache_size
+        Maximum size of the cache in MB
+
     Other paramaters send via kwargs will be used during the call for
     curl.
 
@@ -145,8 +240,16 @@ def fetch_checksum(url, checksum_type, **kwargs):
 
     """
 
+    return _fetch_checksum(url, checksum_type, _cache(cache, cache_size), **kwargs)
+
+
+def _fetch_checksum(url, checksum_type, cache, **kwargs):
+    """Fetch the checksum, using the local cache if any"""
     checksum_url = _checksum_url(url, checksum_type)
-    checksum = _fetch_file(checksum_url, **kwargs)
+    if cache:
+        checksum = _fetch_cached(checksum_url, cache)
+    else:
+        checksum = _fetch_file(checksum_url, **kwargs)
     if not checksum:
         raise CommandExecutionError(
             "Checksum file not found in {}".format(checksum_url)
@@ -156,7 +259,479 @@ def fetch_checksum(url, checksum_type, **kwargs):
     return checksum
 
 
-def dump(url, device, checksum_type=None, checksum=None, **kwargs):
+def _dump_curl(url, device, compression, checksum_type, **kwargs):
+    """Copy the image using a shell pipeline with curl"""
+    params = {
+        "fail": None,
+        "location": None,
+        "silent": None,
+    }
+    params.update(kwargs)
+
+    # If any element in the pipe fail, exit early
+    cmd = ["set -eo pipefail", ";"]
+    cmd.extend(_curl_cmd(url, **params))
+
+    if compression:
+        cmd.append("|")
+        cmd.extend(
+            {
+                "gz": ["gunzip"],
+                "bz2": ["bzip2", "-d"],
+                "xz": ["xz", "-d"],
+                "zst": ["zstd", "-d", "-c"],
+                "lz4": ["lz4", "-d", "-c"],
+            }[compression]
+        )
+
+    checksum_prg = "{}sum".format(checksum_type)
+    devices = [device] if isinstance(device, str) else device
+    cmd.extend(["|", "tee"] + devices + ["|", checksum_prg])
+    ret = __salt__["cmd.run_all"](" ".join(cmd), python_shell=True)
+    if ret["retcode"]:
+        raise CommandExecutionError(
+            "Error while fetching image {}: {}".format(url, ret["stderr"])
+        )
+
+    result = {"checksum": ret["stdout"].split()[0]}
+    result["checksums"] = {checksum_type: result["checksum"]}
+    if not isinstance(device, str):
+        result["devices"] = {
+            target: {"checksum": result["checksum"]} for target in devices
+        }
+    return result
+
+
+def _dump_native(
+    url,
+    device,
+    compression,
+    checksum_type,
+    direct=False,
+    sparse=None,
+    bmap=None,
+    cache=None,
+    checksum=None,
+    connections=None,
+    threads=None,
+    event_tag=None,
+    checksums=None,
+    verify=False,
+    peer=None,
+    rate=None,
+    adaptive=False,
+    **kwargs
+):
+    """Copy the image using the in-process streaming engine"""
+    scheme = urllib.parse.urlparse(url).scheme
+    opener = None
+    if peer:
+        opener = peer.open
+        # The rate limits the chunks fetched from the origin (see
+        # `_swarm_peer`), and not the reads from the spool
+        rate = None
+    elif scheme == MULTICAST_SCHEME:
+        # The image is spooled in the cache directory, if any
+        opener = functools.partial(
+            multicast.open_multicast, spool=cache.path if cache else None
+        )
+    elif scheme not in imagestream.NATIVE_SCHEME:
+        raise SaltInvocationError(
+            "Protocol {} not supported by the native engine".format(scheme)
+        )
+
+    if salt.utils.args.clean_kwargs(**kwargs):
+        raise SaltInvocationError("curl parameters are not valid for the native engine")
+
+    # If the checksum is known, the image in the cache is addressed by
+    # it, so there is no need to revalidate it with the server
+    cache_key = imagecache.image_key(checksum_type, checksum) if checksum else None
+
+    # All the checksums are calculated in the same pass
+    checksum_types = [checksum_type]
+    checksum_types.extend(t for t in checksums or [] if t != checksum_type)
+
+    progress = functools.partial(_send_progress, event_tag) if event_tag else None
+
+    try:
+        result = imagestream.copy(
+            url,
+            device,
+            compression,
+            checksum_types if len(checksum_types) > 1 else checksum_type,
+            direct=direct,
+            sparse=sparse,
+            bmap=bmap,
+            cache=cache,
+            cache_key=cache_key,
+            expected_checksum=checksum,
+            connections=connections,
+            threads=threads,
+            progress=progress,
+            verify=verify,
+            opener=opener,
+            rate=rate,
+            adaptive=adaptive,
+        )
+    except imagestream.StreamException as e:
+        raise CommandExecutionError("Error while fetching image {}: {}".format(url, e))
+
+    LOG.info(
+        "Image %s%s (%s) copied into %s: %s bytes (%s written) in %s seconds (%s MB/s)",
+        url,
+        " (cached)" if result.get("cached") else "",
+        result.get("compression") or "uncompressed",
+        device,
+        result["size"],
+        result["written"],
+        result["seconds"],
+        result["throughput"],
+    )
+    if verify:
+        LOG.info("Image %s verified in %s seconds", device, result["verify_seconds"])
+    if peer:
+        result["swarm"] = dict(peer.stats)
+        if peer.limiter:
+            result["rate"] = peer.limiter.as_dict()
+        LOG.info(
+            "Chunks of %s fetched from the origin: %s, from the peers: %s",
+            url,
+            result["swarm"]["origin"],
+            result["swarm"]["peers"],
+        )
+    return result
+
+
+def _send_progress(event_tag, report):
+    """Send an event with the progress of the copy"""
+    LOG.debug("Progress of %s: %s", event_tag, report)
+    try:
+        __salt__["event.send"]("{}/progress".format(event_tag), report)
+    except Exception:
+        # The copy cannot fail because of a monitoring issue
+        LOG.warning("Progress event for %s cannot be sent", event_tag)
+
+
+def _run_resize(device, cmd):
+    """Run a command of the resize of a device"""
+    ret = __salt__["cmd.run_all"](cmd)
+    if ret["retcode"]:
+        raise CommandExecutionError(
+            "Error while resizing the partition {}: {}".format(device, ret["stderr"])
+        )
+
+
+def _resize_mounted(device, grow_cmd):
+    """Grow a filesystem that needs to be mounted"""
+    mountpoint = tempfile.mkdtemp(prefix="yomi-resize-")
+    try:
+        _run_resize(device, ["mount", device, mountpoint])
+        try:
+            _run_resize(device, grow_cmd + [mountpoint])
+        finally:
+            _run_resize(device, ["umount", mountpoint])
+    finally:
+        os.rmdir(mountpoint)
+
+
+def _resize(device):
+    """Grow the filesystem of a device to the size of the partition
+
+    Returns a dictionary with the seconds spent in each phase.
+
+    """
+    timings = {}
+    start = time.monotonic()
+    info = superblock.read(device)
+    filesystem = info["type"] if info else _find_filesystem(device)
+
+    if filesystem in ("ext2", "ext3", "ext4"):
+        # resize2fs only asks for a forced check if the filesystem is
+        # not clean or was mounted after the last check, that is never
+        # the case for a well built image. A journal not replayed yet
+        # (needs_recovery) also leaves the state clean, and only
+        # e2fsck replays it before the resize.
+        clean = (
+            info
+            and info["clean"]
+            and not info["needs_recovery"]
+            and info["lastcheck"] >= info["mtime"]
+        )
+        if not clean:
+            ret = __salt__["cmd.run_all"](["e2fsck", "-f", "-y", device])
+            # 1 and 2 means that the errors were corrected
+            if ret["retcode"] >= 4:
+                raise CommandExecutionError(
+                    "Error while checking the partition {}: {}".format(
+                        device, ret["stderr"]
+                    )
+                )
+            timings["check"] = round(time.monotonic() - start, 3)
+            start = time.monotonic()
+        _run_resize(device, ["resize2fs", device])
+    elif filesystem == "btrfs":
+        _resize_mounted(device, ["btrfs", "filesystem", "resize", "max"])
+    elif filesystem == "xfs":
+        _resize_mounted(device, ["xfs_growfs"])
+    else:
+        raise CommandExecutionError(
+            "Filesystem {} cannot be resized.".format(filesystem)
+        )
+    timings["resize"] = round(time.monotonic() - start, 3)
+
+    # Flush only the device, and not all the file systems
+    start = time.monotonic()
+    __salt__["cmd.run"](["sync", device])
+    timings["sync"] = round(time.monotonic() - start, 3)
+
+    LOG.info("Filesystem %s in %s resized: %s", filesystem, device, timings)
+    return timings
+
+
+def _sectors(value):
+    """Convert a value from `partition.list` in sectors to a number"""
+    return int(disk.units(value)[0])
+
+
+def _receive(url, device, subvolume, compression, checksum_type, **kwargs):
+    """Receive a btrfs send stream in a new filesystem of the device
+
+    The received subvolume is moved to `subvolume` (or kept with the
+    name from the stream), made writable and set as the default one.
+
+    """
+    ret = __salt__["cmd.run_all"](["mkfs.btrfs", "--force", device])
+    if ret["retcode"]:
+        raise CommandExecutionError(
+            "Error while formatting {}: {}".format(device, ret["stderr"])
+        )
+
+    mountpoint = tempfile.mkdtemp(prefix="yomi-receive-")
+    try:
+        _run_receive(device, ["mount", device, mountpoint])
+        try:
+            # The stream is received in an empty directory, so we can
+            # find the name of the new subvolume
+            incoming = os.path.join(mountpoint, ".yomi-receive")
+            os.mkdir(incoming)
+            try:
+                writer = imagestream.PipeWriter(["btrfs", "receive", "-e", incoming])
+            except imagestream.StreamException as e:
+                raise CommandExecutionError(str(e))
+            try:
+                result = _dump_native(url, writer, compression, checksum_type, **kwargs)
+            finally:
+                # Stop the receiver if the copy was not started
+                try:
+                    writer.close()
+                except imagestream.StreamException:
+                    pass
+
+            received = os.listdir(incoming)
+            if len(received) != 1:
+                raise CommandExecutionError(
+                    "The send stream needs to contain one subvolume, "
+                    "found {}".format(len(received))
+                )
+            result["subvolume"] = subvolume or received[0]
+            path = os.path.join(mountpoint, result["subvolume"])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.rename(os.path.join(incoming, received[0]), path)
+            os.rmdir(incoming)
+
+            # A received subvolume is read-only
+            _run_receive(
+                device, ["btrfs", "property", "set", "-ts", path, "ro", "false"]
+            )
+            _run_receive(device, ["btrfs", "subvolume", "set-default", path])
+        finally:
+            _run_receive(device, ["umount", mountpoint])
+    finally:
+        os.rmdir(mountpoint)
+    return result
+
+
+def _run_receive(device, cmd):
+    """Run a command of the receive of a send stream"""
+    ret = __salt__["cmd.run_all"](cmd)
+    if ret["retcode"]:
+        raise CommandExecutionError(
+            "Error while receiving the image in {}: {}".format(device, ret["stderr"])
+        )
+
+
+def _grow_disk(device):
+    """Grow the last partition of a whole disk image and its filesystem
+
+    Returns the device of the last partition, and a dictionary with
+    the seconds spent in each phase.
+
+    """
+    start = time.monotonic()
+    table = __salt__["cmd.run_stdout"](
+        ["blkid", "--probe", "--output", "value", "--match-tag", "PTTYPE", device]
+    )
+    if table == "gpt":
+        # The image was smaller than the disk, so the backup GPT
+        # header is not at the end
+        _run_resize(device, ["sgdisk", "--move-second-header", device])
+    elif table != "dos":
+        raise CommandExecutionError(
+            "Partition table not found in the image in {}".format(device)
+        )
+    _run_resize(device, ["partprobe", device])
+
+    partitions = __salt__["partition.list"](device, unit="s")["partitions"]
+    if not partitions:
+        raise CommandExecutionError("Partitions not found in {}".format(device))
+    last = disk.last_partition(partitions)
+    grow = [last]
+    if table == "dos" and int(last) > 4:
+        # A logical partition lives inside the extended one, that
+        # needs to grow first
+        grow[:0] = [
+            number
+            for number, partition in partitions.items()
+            if int(number) <= 4
+            and _sectors(partition["end"]) >= _sectors(partitions[last]["end"])
+        ]
+    for number in grow:
+        _run_resize(
+            device, ["parted", "--script", device, "resizepart", number, "100%"]
+        )
+    _run_resize(device, ["partprobe", device])
+    __salt__["cmd.run"](["udevadm", "settle"])
+    inventory.invalidate(__context__)
+    timings = {"partition": round(time.monotonic() - start, 3)}
+
+    partition = disk.partition_device(device, last)
+    timings.update(_resize(partition))
+    return partition, timings
+
+
+def _fetch_manifest(url, cache=None, **kwargs):
+    """Fetch and parse the manifest with the hashes of the chunks"""
+    manifest_url = _manifest_url(url)
+    if cache:
+        content = _fetch_cached(manifest_url, cache)
+    else:
+        content = _fetch_file(manifest_url, **kwargs)
+    if not content:
+        raise CommandExecutionError("Manifest not found in {}".format(manifest_url))
+    try:
+        return swarm.parse_manifest(content)
+    except imagestream.StreamException as e:
+        raise CommandExecutionError("Error in manifest {}: {}".format(manifest_url, e))
+
+
+@contextlib.contextmanager
+def _download_slot(slots, timeout):
+    """Wait for a download slot of the slot service, if any"""
+    if not slots:
+        yield None
+        return
+
+    try:
+        with downloads.Slot(slots, timeout=timeout) as slot:
+            if slot.waited:
+                LOG.info("Download slot granted after %s seconds", slot.waited)
+            yield slot
+    except imagestream.StreamException as e:
+        raise CommandExecutionError("Error waiting for a download slot: {}".format(e))
+
+
+@contextlib.contextmanager
+def _tuned(device, tune):
+    """Tune the I/O of the devices during the copy, if requested"""
+    if not tune:
+        yield None
+        return
+
+    options = tune if isinstance(tune, dict) else None
+    with blocktune.Session(device, options) as session:
+        yield session
+
+
+@contextlib.contextmanager
+def _swarm_peer(
+    url, tracker, seed, checksum_type, checksum, cache, rate=None, adaptive=False
+):
+    """Join the swarm of the nodes that copy the same image
+
+    On success, the chunks are served to the other peers for `seed`
+    seconds more before leaving the swarm. If `rate` is set (in
+    bytes per second), the chunks fetched from the origin are limited
+    to this rate.
+
+    """
+    if not tracker:
+        yield None
+        return
+
+    manifest = _fetch_manifest(url, cache)
+    try:
+        peer = swarm.Peer(
+            imagecache.image_key(checksum_type, checksum),
+            manifest,
+            tracker,
+            spool=cache.path if cache else None,
+            limiter=imagestream.RateLimiter(rate, adaptive) if rate else None,
+        )
+    except OSError as e:
+        raise CommandExecutionError("Error joining the swarm: {}".format(e))
+    try:
+        yield peer
+        peer.seed(seed)
+    finally:
+        peer.close()
+
+
+def _fetch_bmap(url, bmap, cache=None, **kwargs):
+    """Fetch and parse the bmap file of an image"""
+    bmap_url = _bmap_url(url) if bmap is True else bmap
+    if cache:
+        content = _fetch_cached(bmap_url, cache)
+    else:
+        content = _fetch_file(bmap_url, **kwargs)
+    if not content:
+        raise CommandExecutionError("bmap file not found in {}".format(bmap_url))
+    try:
+        bmap = imagestream.parse_bmap(content)
+    except imagestream.StreamException as e:
+        raise CommandExecutionError("Error in bmap file {}: {}".format(bmap_url, e))
+    LOG.info("bmap %s maps %s of %s bytes", bmap_url, bmap.mapped, bmap.image_size)
+    return bmap
+
+
+def dump(
+    url,
+    device,
+    checksum_type=None,
+    checksum=None,
+    checksums=None,
+    native=False,
+    direct=False,
+    sparse=None,
+    bmap=None,
+    cache=None,
+    cache_size=None,
+    connections=None,
+    threads=None,
+    event_tag=None,
+    verify=False,
+    whole_disk=False,
+    send_stream=False,
+    subvolume=None,
+    tracker=None,
+    seed=0,
+    rate=None,
+    adaptive=False,
+    slots=None,
+    slot_timeout=None,
+    tune=False,
+    details=False,
+    **kwargs
+):
     """Download an image and copy it into a device
 
     url
@@ -164,10 +739,23 @@ def dump(url, device, checksum_type=None, checksum=None, **kwargs):
         curl. For example: http, https, scp, sftp, tftp or ftp.
 
         The image can be compressed, and the supported extensions are:
-        gz, bz2 and xz
+        gz, bz2, xz, zst and lz4
+
+        With the native engine, it can also be a multicast URL like
+        'multicast://239.255.42.1:9000', to receive the image sent to
+        this group by the `images.multicast` runner. The packets lost
+        are requested again to the sender, and the image is spooled
+        in the cache directory (or in the temporary directory) while
+        is received. The checksum needs to be provided, as there is
+        no checksum file to fetch. The address of the interface used
+        to join the group can be set with the 'interface' query
+        parameter.
 
     device
-        The device or partition where the image will be copied.
+        The device or partition where the image will be copied. It
+        can also be a list of devices: the image is fetched and
+        decompressed only once, and written in all the devices in
+        parallel.
 
     checksum_type
         The type of checksum used to validate the image, possible
@@ -178,11 +766,178 @@ def dump(url, device, checksum_type=None, checksum=None, **kwargs):
         it will try to download the checksum file from the same URL,
         replacing the extension with the `checksum_type`
 
+    checksums
+        When using the native engine, list of additional checksum
+        types that will be calculated in the same pass over the
+        image, each one in a different thread. It can also be a
+        dictionary with the expected value of each checksum type, and
+        the values that are not empty will be validated. The digests
+        are returned in the 'checksums' key of the details.
+
+    native
+        Use the in-process streaming engine instead of the curl
+        pipeline. The image is read in big chunks, decompressed,
+        hashed and written in parallel stages. Only the schemes
+        http, https, ftp and file are supported. Used blocks images
+        (see `images.create_used_blocks`) are detected, and only the
+        blocks used by the filesystem are written.
+
+    direct
+        When using the native engine, open the device with O_DIRECT,
+        bypassing the page cache.
+
+    sparse
+        When using the native engine, do not write the blocks of the
+        image that are full of zeros. Valid values are 'skip' (the
+        device is expected to be already zeroed or discarded),
+        'zeroout' (zero the ranges with BLKZEROOUT) and 'discard'
+        (discard the ranges with BLKDISCARD, only valid if the device
+        returns zeros for discarded blocks).
+
+    bmap
+        When using the native engine, write only the block ranges
+        mapped in a bmap file (as generated by bmaptool), and validate
+        the checksum of each range while is written. If True, the
+        bmap file is expected next to the image, replacing the
+        compression extension with 'bmap' (as is done for the checksum
+        file). It can also be the URL of the bmap file.
+
+    cache
+        When using the native engine, directory of a local cache of
+        images (like a RAM disk or a mounted caching node). The image
+        is stored there while is downloaded, and later copies of the
+        same image (addressed by the checksum) are read from the
+        cache. If the checksum is not known, the cached image is
+        revalidated with the server using the ETag and the
+        Last-Modified date. The checksum and bmap files are also
+        cached.
+
+    cache_size
+        Maximum size of the cache in MB. When the cache grows over
+        this size, the least recently used images are removed.
+
+    connections
+        When using the native engine, fetch HTTP and HTTPS images
+        with this number of concurrent Range requests. Each segment
+        of the image is retried and resumed from the last byte
+        received if the connection fails. If the server does not
+        support ranges, the image is fetched with a single request.
+
+    threads
+        When using the native engine, decompress the image with an
+        external multithreaded decompressor, if available: pigz for
+        gz, lbzip2 for bz2 and xz for multi-block xz images. A value
+        of 0 uses all the CPUs. The native engine also detects the
+        compression format from the magic bytes of the image, so the
+        extension of the URL is only a hint.
+
+    event_tag
+        When using the native engine, send an event with the tag
+        '<event_tag>/progress' every few seconds during the copy. The
+        event contains the bytes read (and the total if known), the
+        bytes decompressed and written, the throughput in MB/s and
+        the estimated seconds to finish (ETA).
+
+    verify
+        When using the native engine, hash every block while is
+        written, and read back the blocks from the device (with
+        O_DIRECT and several reads in parallel) once the image is
+        copied. This checks what really landed in the device, and
+        fails reporting the offset of the first block that does not
+        match.
+
+    whole_disk
+        The image is a full disk image (with a GPT or MBR partition
+        table and the partitions), and `device` is a disk. After the
+        copy the backup GPT header is moved to the end of the disk,
+        and the last partition and its filesystem are grown to fill
+        the disk. The device of this partition is returned in the
+        'partition' key of the details.
+
+    send_stream
+        When using the native engine, the image is a btrfs send stream
+        (optionally compressed). The device is formatted with btrfs,
+        and the stream is received directly from the URL, without
+        temporary files. The received subvolume is made writable and
+        set as the default subvolume. There is no resize step, as the
+        filesystem has the size of the device.
+
+    subvolume
+        Path of the received subvolume, like '@'. The parent
+        directories are created if needed. If not set, the name of
+        the subvolume in the send stream is used.
+
+    tracker
+        When using the native engine, URL of a swarm tracker (like the
+        one started with the `images.tracker` runner). The nodes that
+        copy the image with the same checksum share the chunks of the
+        image between them, so the image server only sends each chunk
+        a few times, independently of the number of nodes. Every
+        chunk is verified with a manifest fetched from the image
+        server, next to the image (replacing the compression
+        extension with 'chunks', as is done for the checksum
+        file). The manifest can be created with
+        `images.create_manifest`. The checksum type is required, and
+        the image is spooled in the cache directory (or in the
+        temporary directory).
+
+    seed
+        When using a tracker, seconds that the chunks are still served
+        to the other nodes once the image is copied and resized
+
+    rate
+        Maximum rate of the download in MB/s. With the curl pipeline
+        it is passed as the 'limit-rate' parameter. Reads from the
+        local cache are not limited. When using a tracker, only the
+        chunks fetched from the origin are limited.
+
+    adaptive
+        When using the native engine, treat `rate` as a ceiling, and
+        halve the rate when a request to the server takes much longer
+        than usual to answer, or when it fails. The rate recovers
+        slowly while the requests are fast again. The rate at
+        the end of the copy and the number of backoffs are returned
+        in the 'rate' key of the details.
+
+    slots
+        URL of a download slot service (like the one started with the
+        `images.slots` runner). The download starts only when the
+        service grants a slot, so only a limited number of nodes are
+        fetching images at the same time. The slot is held during the
+        transfer, and not during the resize of the filesystem.
+
+    slot_timeout
+        Seconds waiting for a download slot, or for the slot service
+        if it cannot be reached, before failing. By default, one hour.
+
+    tune
+        Tune the block devices during the copy: raise the maximum size
+        of the requests to the hardware limit and the read-ahead,
+        select a scheduler suited for sequential writes (none for
+        SSD, mq-deadline for rotational devices) and raise the
+        dirty-writeback limits of the kernel. The original values
+        are restored after the copy. It can also be a dictionary
+        with the values of 'max_sectors_kb', 'read_ahead_kb',
+        'scheduler', 'dirty_ratio' and 'dirty_background_ratio' (False
+        keeps the current value), and 'probe' to measure the read
+        throughput of the devices before and after the tuning with a
+        short read. The changes and the read throughput are returned
+        in the 'tune' key of the details.
+
+    details
+        Return a dictionary with the checksum and the statistics of
+        the copy (size, written and skipped bytes, seconds and
+        throughput), and the seconds spent in each phase of the resize
+        of the filesystem, instead of only the checksum.
+
     Other paramaters send via kwargs will be used during the call for
     curl.
 
     If succeed it will return the real checksum of the image. If
-    checksum_type is not specified, MD5 will be used.
+    checksum_type is not specified, MD5 will be used. If `device` is a
+    list, it will return a dictionary with the checksum for each
+    device, or None if the image cannot be written there. With
+    `details`, the per device results are under the 'devices' key.
 
     CLI Example:
 
@@ -190,13 +945,46 @@ def dump(url, device, checksum_type=None, checksum=None, **kwargs):
 
         salt '*' images.dump https://my.url/JeOS-btrfs.xz /dev/sda1
         salt '*' images.dump tftp://my.url/JeOS.xz /dev/sda1 checksum_type=md5
+        salt '*' images.dump https://my.url/JeOS.xz /dev/sda1 native=True
+        salt '*' images.dump https://my.url/JeOS.xz /dev/sda1 native=True sparse=zeroout
+        salt '*' images.dump https://my.url/JeOS.xz /dev/sda1 native=True bmap=True
+        salt '*' images.dump https://my.url/JeOS.xz /dev/sda1 checksum_type=md5 \
+            native=True cache=/dev/shm/images cache_size=4096
+        salt '*' images.dump https://my.url/JeOS.xz /dev/sda1 native=True connections=8
+        salt '*' images.dump https://my.url/JeOS.zst /dev/sda1 native=True threads=0
+        salt '*' images.dump https://my.url/JeOS.xz /dev/sda1 native=True \
+            event_tag=my/dump
+        salt '*' images.dump https://my.url/JeOS.xz /dev/sda1 checksum_type=sha256 \
+            native=True checksums='[md5, sha1]'
+        salt '*' images.dump https://my.url/JeOS.xz /dev/sda1 native=True verify=True
+        salt '*' images.dump https://my.url/JeOS-disk.xz /dev/sda whole_disk=True
+        salt '*' images.dump https://my.url/JeOS.btrfs.zst /dev/sda2 native=True \
+            send_stream=True subvolume=@
+        salt '*' images.dump https://my.url/JeOS.xz '[/dev/sda1, /dev/sdb1]' native=True
+        salt '*' images.dump multicast://239.255.42.1:9000 /dev/sda1 native=True
+        salt '*' images.dump https://my.url/JeOS.xz /dev/sda1 checksum_type=md5 \
+            native=True tracker=http://master:6969 seed=60
+        salt '*' images.dump https://my.url/JeOS.xz /dev/sda1 native=True \
+            rate=50 adaptive=True slots=http://master:6970
+        salt '*' images.dump https://my.url/JeOS.xz /dev/sda1 native=True tune=True
 
     """
 
     scheme, _, path, *_ = urllib.parse.urlparse(url)
-    if scheme not in VALID_SCHEME:
+    if scheme not in VALID_SCHEME + (MULTICAST_SCHEME,):
         raise SaltInvocationError("Protocol not valid for URL")
 
+    if scheme == MULTICAST_SCHEME:
+        if not native:
+            raise SaltInvocationError(
+                "Multicast images are only supported by the native engine"
+            )
+        # There is nothing else to fetch from a multicast group
+        if checksum_type and not checksum:
+            raise SaltInvocationError("Checksum of a multicast image not provided")
+        if bmap is True:
+            raise SaltInvocationError("URL of the bmap file not provided")
+
     # We cannot validate the compression extension, as we can have
     # non-restricted file names, like '/my-image.ext3' or
     # 'other-image.raw'.
@@ -207,64 +995,551 @@ def dump(url, device, checksum_type=None, checksum=None, **kwargs):
     if not checksum_type and checksum:
         raise SaltInvocationError("Checksum type not provided")
 
-    if checksum_type and not checksum:
-        checksum = fetch_checksum(url, checksum_type, **kwargs)
+    if not isinstance(checksums, dict):
+        checksums = {extra_type: None for extra_type in checksums or []}
+    if any(extra_type not in VALID_CHECKSUMS for extra_type in checksums):
+        raise SaltInvocationError("Checksum type not valid")
 
-    params = {
-        "fail": None,
-        "location": None,
-        "silent": None,
-    }
-    params.update(kwargs)
+    if sparse and sparse not in imagestream.SPARSE_MODES:
+        raise SaltInvocationError("Sparse mode not valid")
 
-    # If any element in the pipe fail, exit early
-    cmd = ["set -eo pipefail", ";"]
-    cmd.extend(_curl_cmd(url, **params))
+    if not native and (
+        direct
+        or sparse
+        or bmap
+        or cache
+        or connections
+        or threads is not None
+        or checksums
+        or verify
+        or send_stream
+        or tracker
+        or adaptive
+    ):
+        raise SaltInvocationError("Options only valid for the native engine")
+
+    if rate is not None and rate <= 0:
+        raise SaltInvocationError("Rate not valid")
+    if not isinstance(tune, (bool, dict)) or (
+        isinstance(tune, dict) and set(tune) - set(blocktune.OPTIONS)
+    ):
+        raise SaltInvocationError("Tuning options not valid")
+    if adaptive and not rate:
+        raise SaltInvocationError("Adaptive rate needs a maximum rate")
+
+    if tracker and (not checksum_type or scheme not in swarm.ORIGIN_SCHEME):
+        raise SaltInvocationError(
+            "A swarm needs the checksum type, and a http, https or file URL"
+        )
+
+    if send_stream and (
+        not isinstance(device, str) or direct or sparse or bmap or verify or whole_disk
+    ):
+        raise SaltInvocationError("Options not valid for a send stream")
+
+    cache = _cache(cache, cache_size)
+
+    if checksum_type and not checksum:
+        checksum = _fetch_checksum(url, checksum_type, cache, **kwargs)
 
     suffix = pathlib.Path(path).suffix[1:]
-    if suffix in VALID_COMPRESSIONS:
-        cmd.append("|")
-        cmd.extend(
-            {"gz": ["gunzip"], "bz2": ["bzip2", "-d"], "xz": ["xz", "-d"]}[suffix]
+    compression = suffix if suffix in VALID_COMPRESSIONS else None
+
+    # The chunks are served to the other nodes while the image is
+    # copied and resized
+    rate = rate * 1000**2 if rate else None
+    with _swarm_peer(
+        url, tracker, seed, checksum_type, checksum, cache, rate, adaptive
+    ) as peer:
+        # Only the transfer is done while the slot is held
+        slot_timeout = SLOT_TIMEOUT if slot_timeout is None else slot_timeout
+        with _download_slot(slots, slot_timeout), _tuned(device, tune) as session:
+            if native:
+                if bmap:
+                    bmap = _fetch_bmap(url, bmap, cache)
+                if send_stream:
+                    result = _receive(
+                        url,
+                        device,
+                        subvolume,
+                        compression,
+                        checksum_type or "md5",
+                        cache=cache,
+                        checksum=checksum,
+                        connections=connections,
+                        threads=threads,
+                        event_tag=event_tag,
+                        checksums=list(checksums),
+                        peer=peer,
+                        rate=rate,
+                        adaptive=adaptive,
+                        **kwargs
+                    )
+                else:
+                    result = _dump_native(
+                        url,
+                        device,
+                        compression,
+                        checksum_type or "md5",
+                        direct,
+                        sparse,
+                        bmap,
+                        cache,
+                        checksum,
+                        connections,
+                        threads,
+                        event_tag,
+                        list(checksums),
+                        verify,
+                        peer=peer,
+                        rate=rate,
+                        adaptive=adaptive,
+                        **kwargs
+                    )
+            else:
+                if rate:
+                    kwargs["limit-rate"] = str(int(rate))
+                result = _dump_curl(
+                    url, device, compression, checksum_type or "md5", **kwargs
+                )
+
+        if session:
+            result["tune"] = session.report
+
+        # The content of the devices is not the one probed before
+        for target in [device] if isinstance(device, str) else device:
+            inventory.invalidate(__context__, target)
+
+        new_checksum = result["checksum"]
+
+        if checksum_type and checksum != new_checksum:
+            raise CommandExecutionError(
+                "Checksum mismatch. "
+                "Expected {}, calculated {}".format(checksum, new_checksum)
+            )
+
+        for extra_type, extra_checksum in checksums.items():
+            new_extra_checksum = result["checksums"][extra_type]
+            if extra_checksum and extra_checksum != new_extra_checksum:
+                raise CommandExecutionError(
+                    "Checksum {} mismatch. "
+                    "Expected {}, calculated {}".format(
+                        extra_type, extra_checksum, new_extra_checksum
+                    )
+                )
+
+        if isinstance(device, str):
+            # A received send stream does not need to be resized
+            if whole_disk:
+                result["partition"], result["resize"] = _grow_disk(device)
+            elif not send_stream:
+                result["resize"] = _resize(device)
+            return result if details else new_checksum
+
+        # Only the devices where the image was written are resized
+        for target, target_result in result["devices"].items():
+            if "error" in target_result:
+                LOG.error(
+                    "Error writing image into %s: %s", target, target_result["error"]
+                )
+            elif whole_disk:
+                target_result["partition"], target_result["resize"] = _grow_disk(target)
+            else:
+                target_result["resize"] = _resize(target)
+
+        if details:
+            return result
+        return {
+            target: target_result.get("checksum")
+            for target, target_result in result["devices"].items()
+        }
+
+
+def _discard_free_space(image, filesystem):
+    """Punch holes in the free blocks of a filesystem image"""
+    if filesystem in ("ext2", "ext3", "ext4"):
+        # e2fsck can discard the free blocks without mounting
+        ret = __salt__["cmd.run_all"](["e2fsck", "-f", "-y", "-E", "discard", image])
+        if ret["retcode"] >= 4:
+            raise CommandExecutionError(
+                "Error while checking the image {}: {}".format(image, ret["stderr"])
+            )
+        return
+
+    mountpoint = tempfile.mkdtemp(prefix="yomi-image-")
+    try:
+        cmds = (
+            ["mount", "-o", "loop", image, mountpoint],
+            ["fstrim", mountpoint],
+            ["umount", mountpoint],
         )
+        for cmd in cmds:
+            ret = __salt__["cmd.run_all"](cmd)
+            if ret["retcode"]:
+                if cmd[0] == "fstrim":
+                    __salt__["cmd.run_all"](["umount", mountpoint])
+                raise CommandExecutionError(
+                    "Error while discarding the free space of {}: {}".format(
+                        image, ret["stderr"]
+                    )
+                )
+    finally:
+        os.rmdir(mountpoint)
 
-    checksum_prg = "{}sum".format(checksum_type) if checksum_type else "md5sum"
-    cmd.extend(["|", "tee", device, "|", checksum_prg])
-    ret = __salt__["cmd.run_all"](" ".join(cmd), python_shell=True)
-    if ret["retcode"]:
+
+def create_used_blocks(image, output, block_size=4096):
+    """
+    Create a used blocks image from a filesystem image
+
+    A used blocks image contains only the blocks allocated by the
+    filesystem, and a bitmap of them, so the free space is not
+    transferred nor written by `images.dump` (that detects the format
+    when using the native engine). The image can be compressed later.
+
+    image
+        Path of the filesystem image file. The free space of the
+        filesystem is discarded first (punching holes in the file),
+        with `e2fsck -E discard` for ext2, ext3 and ext4, or mounting
+        it with a loop device and calling `fstrim` for btrfs and xfs.
+
+    output
+        Path of the used blocks image
+
+    block_size
+        Size of the blocks of the bitmap. Default: 4096
+
+    Returns a dictionary with the size of the filesystem, and the
+    number of blocks and of used blocks.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' images.create_used_blocks /tmp/JeOS.ext4 /tmp/JeOS.ext4.ub
+
+    """
+    info = superblock.read(image)
+    filesystem = info["type"] if info else None
+    if filesystem not in ("ext2", "ext3", "ext4", "btrfs", "xfs"):
+        raise SaltInvocationError(
+            "Filesystem of {} not supported: {}".format(image, filesystem)
+        )
+    if block_size % 512:
+        raise SaltInvocationError("Block size needs to be a multiple of 512")
+
+    _discard_free_space(image, filesystem)
+    try:
+        result = imagestream.create_used_blocks(image, output, block_size)
+    except imagestream.StreamException as e:
         raise CommandExecutionError(
-            "Error while fetching image {}: {}".format(url, ret["stderr"])
+            "Error while creating the image {}: {}".format(output, e)
         )
+    LOG.info(
+        "Image %s created: %s of %s blocks used",
+        output,
+        result["used"],
+        result["blocks"],
+    )
+    return result
+
+
+def create_manifest(image, output=None, chunk_size=swarm.CHUNK_SIZE):
+    """
+    Create the manifest used to share an image between the nodes
+
+    The manifest contains the hash of every chunk of the image (as is
+    served, so compressed if the image is compressed), and is used by
+    `images.dump` to verify the chunks received from other nodes when
+    a tracker is used.
+
+    image
+        Path of the image file
+
+    output
+        Path of the manifest. By default, next to the image replacing
+        the compression extension with 'chunks'
+
+    chunk_size
+        Size of the chunks in bytes. Default: 4194304
+
+    Returns a dictionary with the size of the image, the size of the
+    chunks and the number of chunks.
+
+    CLI Example:
+
+    .. code-block:: bash
 
-    new_checksum = ret["stdout"].split()[0]
+        salt '*' images.create_manifest /srv/images/JeOS.xz
 
-    if checksum_type and checksum != new_checksum:
+    """
+    if chunk_size <= 0:
+        raise SaltInvocationError("Chunk size not valid")
+    if not output:
+        manifest_url = _manifest_url(pathlib.Path(image).absolute().as_uri())
+        output = urllib.parse.unquote(urllib.parse.urlparse(manifest_url).path)
+
+    try:
+        manifest = swarm.create_manifest(image, chunk_size)
+        with open(output, "w") as f:
+            json.dump(manifest, f)
+    except OSError as e:
         raise CommandExecutionError(
-            "Checksum mismatch. "
-            "Expected {}, calculated {}".format(checksum, new_checksum)
+            "Error while creating the manifest {}: {}".format(output, e)
         )
+    LOG.info("Manifest %s created with %s chunks", output, len(manifest["hashes"]))
+    return {
+        "size": manifest["size"],
+        "chunk_size": manifest["chunk_size"],
+        "chunks": len(manifest["hashes"]),
+    }
+
+
+def golden_key(pillar, grains=None):
+    """
+    Return the key of the golden root for an installation
+
+    The key is a hash of the parts of the pillar (and grains) that
+    decide the software installed in the root filesystem, including
+    the registered products, so nodes with the same software share
+    the same golden root.
+
+    pillar
+        Pillar of the installation
+
+    grains
+        Grains of the node. The architecture and the EFI grains are
+        used.
 
-    filesystem = _find_filesystem(device)
+    CLI Example:
+
+    .. code-block:: bash
 
-    resize_cmd = {
-        "ext2": "e2fsck -f -y {0}; resize2fs {0}".format(device),
-        "ext3": "e2fsck -f -y {0}; resize2fs {0}".format(device),
-        "ext4": "e2fsck -f -y {0}; resize2fs {0}".format(device),
-        "btrfs": "mount {} /mnt; btrfs filesystem resize max /mnt;"
-        " umount /mnt".format(device),
-        "xfs": "mount {} /mnt; xfs_growfs /mnt; umount /mnt".format(device),
+        salt '*' images.golden_key "{software: {packages: [vim]}}"
+
+    """
+    grains = grains or {}
+    software = {
+        key: value
+        for key, value in pillar.get("software", {}).items()
+        if key != "golden"
     }
-    if filesystem not in resize_cmd:
-        raise CommandExecutionError(
-            "Filesystem {} cannot be resized.".format(filesystem)
-        )
+    # The registration decides the repositories and the products of
+    # the root, but not the codes and the email used for it
+    suseconnect = pillar.get("suseconnect", {})
+    registration = {
+        "config": {
+            key: value
+            for key, value in suseconnect.get("config", {}).items()
+            if key not in ("regcode", "email")
+        },
+        "products": [
+            product.get("name") if isinstance(product, dict) else product
+            for product in suseconnect.get("products", [])
+        ],
+        "packages": suseconnect.get("packages", []),
+    }
+    filesystems = pillar.get("filesystems", {}).values()
+    data = {
+        "software": software,
+        "suseconnect": registration,
+        "bootloader": pillar.get("bootloader", {}),
+        "filesystems": sorted({info.get("filesystem", "") for info in filesystems}),
+        "lvm": bool(pillar.get("lvm")),
+        "raid": bool(pillar.get("raid")),
+        "snapper": bool(pillar.get("config", {}).get("snapper")),
+        "salt-minion": bool(pillar.get("salt-minion")),
+        "grains": {
+            grain: grains.get(grain) for grain in ("cpuarch", "efi", "efi-secure-boot")
+        },
+    }
+    digest = hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode())
+    return "golden-{}".format(digest.hexdigest())
+
+
+def _golden_path(store, key):
+    return os.path.join(store, key + GOLDEN_EXTENSION)
+
+
+def golden_exists(store, key):
+    """
+    Check if the golden root is present in the store
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' images.golden_exists /srv/golden golden-0123
+    """
+    return os.path.exists(_golden_path(store, key))
+
+
+def _golden_mounts(root):
+    """Return the file systems mounted inside the root to archive
+
+    tar runs with `--one-file-system`, so the pseudo file systems
+    (like /proc or /sys) are not archived, but neither are the btrfs
+    subvolumes and the partitions mounted inside the root. Those are
+    returned here, relative to the root, to be added explicitly.
+
+    """
+    root = os.path.normpath(root)
+    mounts = []
+    with open("/proc/self/mountinfo") as f:
+        for line in f:
+            fields = line.split()
+            mount_point = fields[4].encode().decode("unicode_escape")
+            fs_type = fields[fields.index("-") + 1]
+            relative = os.path.relpath(mount_point, root)
+            if (
+                fs_type in GOLDEN_FILESYSTEMS
+                and mount_point.startswith(root.rstrip("/") + "/")
+                and relative.split("/")[0] != ".snapshots"
+            ):
+                mounts.append("./{}".format(relative))
+    return sorted(set(mounts))
+
 
-    ret = __salt__["cmd.run_all"](resize_cmd[filesystem], python_shell=True)
+def golden_create(root, store, key):
+    """
+    Create the golden root archive from an installed root filesystem
+
+    The archive is a zstd compressed tarball (with the extended
+    attributes and the ACLs) created from `root`, without the files
+    specific of the node, like the fstab, the machine ID or the SSH
+    host keys. The archive is visible in the store only when complete.
+
+    The pseudo file systems and the snapper snapshots are not
+    archived, but the file systems mounted inside the root (like the
+    btrfs subvolumes) are.
+
+    root
+        Path where the root filesystem is mounted
+
+    store
+        Directory where the golden roots are stored. It is expected to
+        be shared by all the nodes, like a NFS mount.
+
+    key
+        Key of the golden root, from `images.golden_key`
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' images.golden_create /mnt /srv/golden golden-0123
+
+    """
+    os.makedirs(store, exist_ok=True)
+    path = _golden_path(store, key)
+    partial = os.path.join(store, ".partial-{}-{}".format(key, os.getpid()))
+
+    start = time.monotonic()
+    cmd = [
+        "tar",
+        "--create",
+        "--file",
+        partial,
+        "--use-compress-program",
+        "zstd -T0 -q",
+        "--xattrs",
+        "--xattrs-include=*",
+        "--acls",
+        "--numeric-owner",
+        "--sparse",
+        "--one-file-system",
+        "--anchored",
+    ]
+    cmd.extend("--exclude={}".format(exclude) for exclude in GOLDEN_EXCLUDE)
+    cmd.extend(["--directory", root, "."])
+    cmd.extend(_golden_mounts(root))
+    ret = __salt__["cmd.run_all"](cmd)
     if ret["retcode"]:
+        try:
+            os.unlink(partial)
+        except FileNotFoundError:
+            pass
         raise CommandExecutionError(
-            "Error while resizing the partition {}: {}".format(device, ret["stderr"])
+            "Error creating the golden root {}: {}".format(key, ret["stderr"])
         )
+    # If other node created the same golden root, this one replaces
+    # it atomically
+    os.replace(partial, path)
+    seconds = round(time.monotonic() - start, 3)
+    LOG.info("Golden root %s created in %s seconds", path, seconds)
+    return {"path": path, "seconds": seconds}
+
+
+def golden_apply(root, key, store=None, url=None, connections=None, threads=None):
+    """
+    Extract a golden root archive into the root filesystem
 
-    __salt__["cmd.run"]("sync")
+    The archive is streamed from the store (or the URL) into tar, and
+    decompressed in the same pipeline used by `images.dump` with the
+    native engine.
 
-    return new_checksum
+    root
+        Path where the root filesystem is mounted
+
+    key
+        Key of the golden root, from `images.golden_key`
+
+    store
+        Directory where the golden roots are stored
+
+    url
+        Base URL where the store is also served (http, https, ftp or
+        file). If set, the archive is fetched from there.
+
+    connections
+        Number of concurrent Range requests used to fetch the archive
+        from a HTTP or HTTPS URL
+
+    threads
+        Number of threads used to decompress the archive
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' images.golden_apply /mnt golden-0123 store=/srv/golden
+
+    """
+    if url:
+        archive_url = "{}/{}{}".format(url.rstrip("/"), key, GOLDEN_EXTENSION)
+    elif store:
+        archive_url = pathlib.Path(_golden_path(store, key)).absolute().as_uri()
+    else:
+        raise SaltInvocationError("Store or URL of the golden root are required")
+
+    cmd = [
+        "tar",
+        "--extract",
+        "--file",
+        "-",
+        "--xattrs",
+        "--xattrs-include=*",
+        "--acls",
+        "--numeric-owner",
+        "--directory",
+        root,
+    ]
+    try:
+        writer = imagestream.PipeWriter(cmd)
+        result = imagestream.copy(
+            archive_url,
+            writer,
+            "zst",
+            connections=connections,
+            threads=threads,
+        )
+    except imagestream.StreamException as e:
+        raise CommandExecutionError(
+            "Error applying the golden root {}: {}".format(archive_url, e)
+        )
+    LOG.info(
+        "Golden root %s applied in %s seconds (%s MB/s)",
+        archive_url,
+        result["seconds"],
+        result["throughput"],
+    )
+    return result
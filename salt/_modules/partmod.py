@@ -323,3 +323,20 @@ def prepare_partition_data(partitions):
             )
 
     return partitions_normalized
+
+
+def partition_owners(partitions):
+    """Helper function to map each device from the pillar to its disk.
+
+    The partitions declared in the `partitions` pillar are mapped to
+    the device that contains them, and each device is mapped to
+    itself. The storage states use it to know which partition layout
+    needs to be ready before a partition can be used.
+
+    """
+    owners = {}
+    for device, device_info in prepare_partition_data(partitions).items():
+        owners[device] = device
+        for partition in device_info["partitions"]:
+            owners[partition["part_id"]] = device
+    return owners
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Alberto Planas <aplanas@suse.com>
+#
+# Copyright 2019 SUSE LLC.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+"""
+:maintainer:    Alberto Planas <aplanas@suse.com>
+:maturity:      new
+:depends:       None
+:platform:      Linux
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import logging
+import time
+
+from salt.exceptions import SaltInvocationError, CommandExecutionError
+
+import downloads
+import imagestream
+import multicast
+import swarm
+
+LOG = logging.getLogger(__name__)
+
+__virtualname__ = "images"
+
+__func_alias__ = {
+    "multicast_": "multicast",
+}
+
+DEFAULT_GROUP = "239.255.42.1"
+DEFAULT_PORT = 9000
+
+# Default rate of the transmission, in MB/s
+DEFAULT_RATE = 100
+
+DEFAULT_TRACKER_PORT = 6969
+
+DEFAULT_SLOTS_PORT = 6970
+
+
+def multicast_(
+    image,
+    group=DEFAULT_GROUP,
+    port=DEFAULT_PORT,
+    receivers=None,
+    rate=DEFAULT_RATE,
+    packet_size=multicast.PACKET_SIZE,
+    ttl=1,
+    interface=None,
+    linger=multicast.LINGER,
+):
+    """Send an image to the minions using a multicast group
+
+    The image is sent only once, and all the minions that are applying
+    `images.dump` (or the `images.dumped` state) with the URL
+    'multicast://<group>:<port>' receive it at the same time. The
+    packets lost by any receiver are requested to the sender and sent
+    again to the group.
+
+    The receivers need to be waiting in the group before the image is
+    sent, so the runner is usually called once the installation was
+    started in the minions.
+
+    image
+        Local path of the image. The image is sent as it is, so it can
+        be compressed.
+
+    group
+        Multicast group address
+
+    port
+        UDP port of the group
+
+    receivers
+        Number of minions that will receive the image. The
+        transmission ends as soon as all of them have the full
+        image. If not set, it ends when no repair is requested in
+        `linger` seconds.
+
+    rate
+        Maximum rate of the transmission in MB/s. Multicast has no
+        congestion control, so a rate over the capacity of the network
+        or of the receivers only produces more repairs.
+
+    packet_size
+        Size of the data in each packet. The default fits in a
+        Ethernet frame, and a bigger one can be used with jumbo frames.
+
+    ttl
+        Time to live of the packets. The default value keeps the
+        packets in the local network.
+
+    interface
+        Address of the local interface used to send the packets
+
+    linger
+        Seconds that the sender waits for repair requests once the
+        image was sent
+
+    Returns a dictionary with the statistics of the transmission.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-run images.multicast /srv/images/JeOS.xz receivers=40
+        salt-run images.multicast /srv/images/JeOS.xz group=239.255.42.2 rate=50
+
+    """
+    if receivers is not None and receivers <= 0:
+        raise SaltInvocationError("Number of receivers not valid")
+    if rate is not None and rate <= 0:
+        raise SaltInvocationError("Rate not valid")
+
+    try:
+        result = multicast.send(
+            image,
+            group,
+            port,
+            packet_size=packet_size,
+            rate=rate * 1000**2 if rate else None,
+            ttl=ttl,
+            interface=interface,
+            receivers=receivers,
+            linger=linger,
+        )
+    except (imagestream.StreamException, OSError) as e:
+        raise CommandExecutionError("Error sending image {}: {}".format(image, e))
+
+    LOG.info(
+        "Image %s sent to %s:%s: %s packets (%s repaired) in %s seconds (%s MB/s)",
+        image,
+        group,
+        port,
+        result["sent"],
+        result["repaired"],
+        result["seconds"],
+        result["throughput"],
+    )
+    return result
+
+
+def tracker(address="", port=DEFAULT_TRACKER_PORT, duration=None):
+    """Run a tracker for the swarms of nodes that copy the same image
+
+    The minions that use `images.dump` with `tracker` announce
+    themselves here, and receive the list of the other nodes that are
+    copying the image with the same checksum, so they can share the
+    chunks of the image between them.
+
+    address
+        Address where the tracker listens. By default, all the
+        addresses of the master
+
+    port
+        TCP port of the tracker
+
+    duration
+        Seconds that the tracker is running. By default, it runs
+        until the runner is stopped
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-run images.tracker
+        salt-run images.tracker port=8000 duration=3600
+
+    """
+    try:
+        server = swarm.Tracker(address, port)
+    except OSError as e:
+        raise CommandExecutionError("Error starting the tracker: {}".format(e))
+
+    LOG.info("Tracker listening in port %s", server.port)
+    try:
+        if duration:
+            server.start()
+            time.sleep(duration)
+        else:
+            server.serve_forever()
+    finally:
+        server.close()
+    return {"port": server.port, "swarms": len(server.swarms)}
+
+
+def slots(budget, address="", port=DEFAULT_SLOTS_PORT, ttl=None, duration=None):
+    """Share a budget of concurrent image downloads between the minions
+
+    The minions that use `images.dump` with `slots` ask here for a
+    download slot before fetching the image, and wait in a queue (in
+    order of arrival) while `budget` downloads are running. This keeps
+    a big installation from saturating the image server or the network
+    link.
+
+    budget
+        Number of downloads that can run at the same time
+
+    address
+        Address where the service listens. By default, all the
+        addresses of the master
+
+    port
+        TCP port of the service
+
+    ttl
+        Seconds that a slot is kept if the minion stops renewing it
+        (for example, if it was rebooted during the download)
+
+    duration
+        Seconds that the service is running. By default, it runs
+        until the runner is stopped
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-run images.slots 10
+        salt-run images.slots 4 port=8000 duration=3600
+
+    """
+    if budget <= 0:
+        raise SaltInvocationError("Budget not valid")
+
+    try:
+        server = downloads.SlotServer(
+            budget, address, port, ttl=ttl or downloads.LEASE_TTL
+        )
+    except OSError as e:
+        raise CommandExecutionError("Error starting the slot service: {}".format(e))
+
+    LOG.info("Slot service for %s downloads listening in port %s", budget, server.port)
+    try:
+        if duration:
+            server.start()
+            time.sleep(duration)
+        else:
+            server.serve_forever()
+    finally:
+        server.close()
+    return {"port": server.port, "granted": server.granted}
@@ -28,9 +28,13 @@
 :platform:      Linux
 """
 from __future__ import absolute_import, print_function, unicode_literals
+import contextlib
 import logging
 import os.path
 
+import blocktune
+import inventory
+
 LOG = logging.getLogger(__name__)
 
 __virtualname__ = "formatted"
@@ -39,10 +43,12 @@ __virtualname__ = "formatted"
 # Define not exported variables from Salt, so this can be imported as
 # a normal module
 try:
+    __context__
     __opts__
     __salt__
     __states__
 except NameError:
+    __context__ = {}
     __opts__ = {}
     __salt__ = {}
     __states__ = {}
@@ -56,7 +62,7 @@ def __virtual__():
     return "blockdev.formatted" in __states__
 
 
-def formatted(name, fs_type="ext4", force=False, **kwargs):
+def formatted(name, fs_type="ext4", force=False, tune=False, **kwargs):
     """
     Manage filesystems of partitions.
 
@@ -73,6 +79,11 @@ def formatted(name, fs_type="ext4", force=False, **kwargs):
 
         This option is dangerous, use it with caution.
 
+    tune
+        Tune the I/O of the device while the filesystem is created, and
+        restore the original values later. It can be True, or a
+        dictionary with the tuning values (see `images.dump`)
+
     """
     ret = {
         "name": name,
@@ -83,7 +94,12 @@ def formatted(name, fs_type="ext4", force=False, **kwargs):
 
     fs_type = "swap" if fs_type == "linux-swap" else fs_type
     if fs_type != "swap":
-        ret = __states__["blockdev.formatted"](name, fs_type, force, **kwargs)
+        with _tuned(name, tune) as session:
+            ret = __states__["blockdev.formatted"](name, fs_type, force, **kwargs)
+        if ret["changes"]:
+            inventory.invalidate(__context__, name)
+        if session:
+            _append_comment(ret, blocktune.describe(session.report))
         return ret
 
     if not os.path.exists(name):
@@ -115,7 +131,11 @@ def formatted(name, fs_type="ext4", force=False, **kwargs):
             cmd.extend([parameter, kwargs.pop(argument)])
     cmd.append(name)
 
-    __salt__["cmd.run"](cmd)
+    with _tuned(name, tune) as session:
+        __salt__["cmd.run"](cmd)
+    inventory.invalidate(__context__, name)
+    if session:
+        ret["comment"].append(blocktune.describe(session.report))
 
     current_fs = _checkblk(name)
 
@@ -135,8 +155,25 @@ def _checkblk(name):
     """
     Check if the blk exists and return its fstype if ok
     """
+    return inventory.get(__context__).fstype(name)
+
+
+def _tuned(name, tune):
+    """
+    Return the I/O tuning session for the device, if requested
+    """
+    if not tune or __opts__["test"]:
+        return contextlib.nullcontext()
+    return blocktune.Session(name, tune if isinstance(tune, dict) else None)
+
 
-    blk = __salt__["cmd.run"](
-        "blkid -o value -s TYPE {0}".format(name), ignore_retcode=True
-    )
-    return "" if not blk else blk
+def _append_comment(ret, comment):
+    """
+    Add a comment in the result of a state from Salt
+    """
+    if isinstance(ret["comment"], list):
+        ret["comment"].append(comment)
+    elif ret["comment"]:
+        ret["comment"] = "{}. {}".format(ret["comment"], comment)
+    else:
+        ret["comment"] = comment
@@ -28,12 +28,19 @@
 :platform:      Linux
 """
 from __future__ import absolute_import, print_function, unicode_literals
+import json
 import logging
 import os
 import os.path
 import tempfile
 import urllib.parse
 
+from salt.exceptions import CommandExecutionError
+
+import blocktune
+import disk
+import superblock
+
 LOG = logging.getLogger(__name__)
 
 __virtualname__ = "images"
@@ -76,9 +83,22 @@ VALID_SCHEME = (
     "telnet",
     "tftp",
 )
-VALID_COMPRESSIONS = ("gz", "bz2", "xz")
+VALID_COMPRESSIONS = ("gz", "bz2", "xz", "zst", "lz4")
+MULTICAST_SCHEME = "multicast"
 VALID_CHECKSUMS = ("md5", "sha1", "sha224", "sha256", "sha384", "sha512")
 
+# The checksums of the image are also stored in a small record inside
+# the device, so we can check them without mounting it. The record
+# lives in the second sector of the boot area of the filesystem, that
+# is not used by ext2/3/4 (the superblock starts at 1024). For btrfs
+# this area is where GRUB2 embeds its core image, and for xfs there
+# is no such area, so for both the checksum is read from the mounted
+# file system.
+RECORD_MAGIC = b"YOMIIMG1"
+RECORD_OFFSET = 512
+RECORD_SIZE = 512
+RECORD_FILESYSTEMS = ("ext2", "ext3", "ext4")
+
 
 def __virtual__():
     """Images depends on images.dump module"""
@@ -127,8 +147,11 @@ def _read_current_checksum(device, checksum_type):
     return checksum
 
 
-def _save_current_checksum(device, checksum_type, checksum):
-    """Save the checksum of the current image"""
+def _save_current_checksum(device, checksum_type, checksum, checksums=None):
+    """Save the checksums of the current image"""
+    checksums = dict(checksums or {})
+    checksums[checksum_type] = checksum
+
     result = False
     mnt = _mount(device)
     if not mnt:
@@ -136,25 +159,187 @@ def _save_current_checksum(device, checksum_type, checksum):
 
     checksum_path = _checksum_path(mnt)
     os.makedirs(checksum_path, exist_ok=True)
-    checksum_file = os.path.join(checksum_path, "checksum.{}".format(checksum_type))
-    try:
-        checksum_file = open(checksum_file, "w")
-        checksum_file.write(checksum)
-        checksum_file.close()
-        result = True
-        LOG.info("Created checksum file %s content: %s", checksum_file, checksum)
-    except Exception:
-        LOG.error("Error writing checksum file %s", checksum_file)
+    result = True
+    for current_type, current_checksum in checksums.items():
+        checksum_file = os.path.join(checksum_path, "checksum.{}".format(current_type))
+        try:
+            with open(checksum_file, "w") as f:
+                f.write(current_checksum)
+            LOG.info(
+                "Created checksum file %s content: %s", checksum_file, current_checksum
+            )
+        except Exception:
+            LOG.error("Error writing checksum file %s", checksum_file)
+            result = False
+            break
 
     _umount(mnt)
+
+    if result:
+        # The main checksum goes first, so it is always in the record
+        record = {checksum_type: checksum}
+        record.update(checksums)
+        _write_device_record(device, record)
+
     return result
 
 
-def _is_dump_needed(device, checksum_type, checksum):
+def _read_device_record(device):
+    """Return the image record stored in the device, if any"""
+    info = superblock.read(device)
+    if not info or info["type"] not in RECORD_FILESYSTEMS:
+        return None
+
+    try:
+        fd = os.open(device, os.O_RDONLY)
+        try:
+            data = os.pread(fd, RECORD_SIZE, RECORD_OFFSET)
+        finally:
+            os.close(fd)
+    except OSError:
+        LOG.info("Record cannot be read from %s", device)
+        return None
+
+    if not data.startswith(RECORD_MAGIC):
+        return None
+    try:
+        record = json.loads(data[len(RECORD_MAGIC) :].rstrip(b"\0").decode())
+    except ValueError:
+        return None
+
+    # If the device was formatted or a different image was copied,
+    # the record is not valid anymore
+    if not isinstance(record, dict) or record.get("uuid") != info["uuid"]:
+        return None
+    return record
+
+
+def _write_device_record(device, checksums):
+    """Store the checksums of the current image in the device"""
+    info = superblock.read(device)
+    if not info or info["type"] not in RECORD_FILESYSTEMS:
+        return False
+
+    # If there are too many checksums, only the first ones that fit in
+    # the record are stored
+    record = {"uuid": info["uuid"], "checksums": {}}
+    for checksum_type, checksum in checksums.items():
+        record["checksums"][checksum_type] = checksum
+        data = RECORD_MAGIC + json.dumps(record).encode()
+        if len(data) > RECORD_SIZE:
+            LOG.warning("Checksum %s does not fit in the record", checksum_type)
+            del record["checksums"][checksum_type]
+    if not record["checksums"]:
+        LOG.error("Record for %s too big", device)
+        return False
+    data = RECORD_MAGIC + json.dumps(record).encode()
+
+    try:
+        fd = os.open(device, os.O_WRONLY)
+        try:
+            os.pwrite(fd, data.ljust(RECORD_SIZE, b"\0"), RECORD_OFFSET)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError:
+        LOG.error("Error writing the record in %s", device)
+        return False
+
+    LOG.info("Created record in %s content: %s", device, record)
     return True
 
 
-def dumped(name, device, checksum_type=None, checksum=None, **kwargs):
+def _is_dump_needed(device, checksum_type, checksum):
+    """
+    Check, without mounting the device, if the image needs to be
+    copied.
+
+    Returns a tri-state value:
+      - `True`: the image in the device is a different one
+      - `False`: the image in the device is the same
+      - `None`: there is not a valid record in the device
+    """
+    record = _read_device_record(device)
+    if not record:
+        return None
+    current_checksum = record.get("checksums", {}).get(checksum_type)
+    if not current_checksum:
+        return None
+    return current_checksum != checksum
+
+
+def _dump_needed(device, checksum_type, checksum):
+    """Check if the image needs to be copied into the device"""
+    # Only if the record in the device cannot be used, we mount it to
+    # read the checksum file
+    dump_needed = _is_dump_needed(device, checksum_type, checksum)
+    if dump_needed is None:
+        current_checksum = _read_current_checksum(device, checksum_type)
+        dump_needed = current_checksum != checksum
+    return dump_needed
+
+
+def _last_partition(device):
+    """Return the last partition of a disk, if any"""
+    try:
+        partitions = __salt__["partition.list"](device, unit="s")["partitions"]
+    except CommandExecutionError:
+        # The disk has no partition table yet
+        return None
+    if not partitions:
+        return None
+    return disk.partition_device(device, disk.last_partition(partitions))
+
+
+def _image_device(target, whole_disk):
+    """Return the device where the checksums of the image are stored"""
+    if not whole_disk:
+        return target
+    return _last_partition(target)
+
+
+def _device_changes(ret, device, target):
+    """Return the changes dictionary for one of the devices"""
+    if isinstance(device, str):
+        return ret["changes"]
+    return ret["changes"].setdefault(target, {})
+
+
+def _device_comment(device, target, comment):
+    """Add the name of the device in the comment if there are many"""
+    if isinstance(device, str):
+        return comment
+    return "{}: {}".format(target, comment)
+
+
+def dumped(
+    name,
+    device,
+    checksum_type=None,
+    checksum=None,
+    checksums=None,
+    native=False,
+    direct=False,
+    sparse=None,
+    bmap=None,
+    cache=None,
+    cache_size=None,
+    connections=None,
+    threads=None,
+    event_tag=None,
+    verify=False,
+    whole_disk=False,
+    send_stream=False,
+    subvolume=None,
+    tracker=None,
+    seed=0,
+    rate=None,
+    adaptive=False,
+    slots=None,
+    slot_timeout=None,
+    tune=False,
+    **kwargs
+):
     """
     Copy an image in the device.
 
@@ -163,10 +348,17 @@ def dumped(name, device, checksum_type=None, checksum=None, **kwargs):
         curl. For example: http, https, scp, sftp, tftp or ftp.
 
         The image can be compressed, and the supported extensions are:
-        gz, bz2 and xz
+        gz, bz2, xz, zst and lz4
+
+        With the native engine, it can also be a multicast URL like
+        'multicast://239.255.42.1:9000' (see `images.dump`). In this
+        case the checksum needs to be provided.
 
     device
-        The device or partition where the image will be copied.
+        The device or partition where the image will be copied. It
+        can also be a list of devices, and the image will be fetched
+        once and copied only in the devices that have a different
+        image. In this case the changes are reported per device.
 
     checksum_type
         The type of checksum used to validate the image, possible
@@ -177,6 +369,99 @@ def dumped(name, device, checksum_type=None, checksum=None, **kwargs):
         it will try to download the checksum file from the same URL,
         replacing the extension with the `checksum_type`
 
+    checksums
+        Dictionary with additional checksum types and their values
+        (that can be empty). All of them are calculated in the same
+        pass over the image, validated if a value is provided, and
+        stored with the image, so later runs can check any of them
+        (only for the native engine)
+
+    native
+        Use the in-process streaming engine instead of the curl
+        pipeline (see `images.dump`)
+
+    direct
+        Write the image using O_DIRECT (only for the native engine)
+
+    sparse
+        Do not write the blocks full of zeros, and 'skip', 'zeroout'
+        or 'discard' them (only for the native engine)
+
+    bmap
+        Write only the ranges mapped in the bmap file. If True the
+        bmap file is expected next to the image URL, but can also be
+        the URL of the file (only for the native engine)
+
+    cache
+        Directory of a local cache of images, used to avoid fetching
+        again the image from the server (only for the native engine)
+
+    cache_size
+        Maximum size of the cache in MB. The least recently used
+        images are evicted when the cache grows over this size
+
+    connections
+        Number of concurrent Range requests used to fetch HTTP and
+        HTTPS images (only for the native engine)
+
+    threads
+        Number of threads used to decompress the image, if a
+        multithreaded decompressor is available. 0 means all the CPUs
+        (only for the native engine)
+
+    event_tag
+        Send periodic '<event_tag>/progress' events with the progress
+        of the copy (only for the native engine)
+
+    verify
+        Read back the image from the device after the copy, and
+        compare it with the hashes of the blocks recorded while was
+        written (only for the native engine)
+
+    whole_disk
+        The image contains a partition table and the partitions, and
+        `device` is a disk. The last partition and its filesystem are
+        grown to fill the disk, and the checksums are stored in this
+        partition
+
+    send_stream
+        The image is a btrfs send stream. The device is formatted
+        with btrfs, and the stream is received directly from the URL
+        (only for the native engine)
+
+    subvolume
+        Path of the received subvolume (like '@'), that is set as the
+        default subvolume
+
+    tracker
+        URL of the swarm tracker, to share the chunks of the image
+        with the other nodes that copy the same image (only for the
+        native engine)
+
+    seed
+        Seconds that the chunks are still served to the other nodes
+        after the copy
+
+    rate
+        Maximum rate of the download in MB/s
+
+    adaptive
+        Reduce the rate when the image server gets slower or a request
+        fails (only for the native engine)
+
+    slots
+        URL of the download slot service, to limit the number of nodes
+        that fetch an image at the same time
+
+    slot_timeout
+        Seconds waiting for a download slot before failing (see
+        `images.dump`)
+
+    tune
+        Tune the I/O of the block devices during the copy. It can be
+        True, or a dictionary with the tuning values (see
+        `images.dump`)
+
     Other paramaters send via kwargs will be used during the call for
     curl.
 
@@ -189,7 +474,7 @@ def dumped(name, device, checksum_type=None, checksum=None, **kwargs):
     }
 
     scheme, _, path, *_ = urllib.parse.urlparse(name)
-    if scheme not in VALID_SCHEME:
+    if scheme not in VALID_SCHEME + (MULTICAST_SCHEME,):
         ret["comment"].append("Protocol not valid for URL")
         return ret
 
@@ -205,38 +490,236 @@ def dumped(name, device, checksum_type=None, checksum=None, **kwargs):
         ret["comment"].append("Checksum type not provided")
         return ret
 
+    if checksums and any(t not in VALID_CHECKSUMS for t in checksums):
+        ret["comment"].append("Checksum type not valid")
+        return ret
+
     if checksum_type and not checksum:
-        checksum = __salt__["images.fetch_checksum"](name, checksum_type, **kwargs)
+        if scheme == MULTICAST_SCHEME:
+            ret["comment"].append(
+                "The checksum of a multicast image cannot be fetched, "
+                "it needs to be provided"
+            )
+            return ret
+        try:
+            checksum = __salt__["images.fetch_checksum"](
+                name, checksum_type, cache=cache, cache_size=cache_size, **kwargs
+            )
+        except CommandExecutionError as e:
+            ret["comment"].append("Error fetching the checksum: {}".format(e))
+            return ret
         if not checksum:
             ret["comment"].append("Checksum no found")
             return ret
 
+    devices = [device] if isinstance(device, str) else device
     if checksum_type:
-        current_checksum = _read_current_checksum(device, checksum_type)
+        needed = []
+        for target in devices:
+            image_device = _image_device(target, whole_disk)
+            if not image_device or _dump_needed(image_device, checksum_type, checksum):
+                needed.append(target)
 
     if __opts__["test"]:
         ret["result"] = None
         if checksum_type:
-            ret["changes"]["image"] = current_checksum != checksum
-            ret["changes"]["checksum cache"] = ret["changes"]["image"]
+            for target in devices:
+                changes = _device_changes(ret, device, target)
+                changes["image"] = target in needed
+                changes["checksum cache"] = changes["image"]
         return ret
 
-    if checksum_type and current_checksum != checksum:
+    if checksum_type and needed:
         result = __salt__["images.dump"](
-            name, device, checksum_type, checksum, **kwargs
+            name,
+            device if isinstance(device, str) else needed,
+            checksum_type,
+            checksum,
+            checksums=checksums,
+            native=native,
+            direct=direct,
+            sparse=sparse,
+            bmap=bmap,
+            cache=cache,
+            cache_size=cache_size,
+            connections=connections,
+            threads=threads,
+            event_tag=event_tag,
+            verify=verify,
+            whole_disk=whole_disk,
+            send_stream=send_stream,
+            subvolume=subvolume,
+            tracker=tracker,
+            seed=seed,
+            rate=rate,
+            adaptive=adaptive,
+            slots=slots,
+            slot_timeout=slot_timeout,
+            tune=tune,
+            details=True,
+            **kwargs
         )
-        if result != checksum:
-            ret["comment"].append("Failed writing the image")
+        if "throughput" in result:
+            ret["comment"].append(
+                "Image written in {} seconds ({} MB/s), {} bytes written".format(
+                    result["seconds"], result["throughput"], result["written"]
+                )
+            )
+        if result.get("verified"):
+            ret["comment"].append(
+                "Image verified in {} seconds".format(result["verify_seconds"])
+            )
+        if "swarm" in result:
+            ret["comment"].append(
+                "Chunks fetched from the origin: {}, from other nodes: {}".format(
+                    result["swarm"]["origin"], result["swarm"]["peers"]
+                )
+            )
+        if "tune" in result:
+            ret["comment"].append(blocktune.describe(result["tune"]))
+        if result.get("rate", {}).get("backoffs"):
+            ret["comment"].append(
+                "Download rate reduced {} times, final rate {} MB/s".format(
+                    result["rate"]["backoffs"], result["rate"]["rate"]
+                )
+            )
+
+        results = {device: result} if isinstance(device, str) else result["devices"]
+        failed = False
+        for target in needed:
+            changes = _device_changes(ret, device, target)
+            if results[target].get("checksum") != checksum:
+                ret["comment"].append(
+                    _device_comment(device, target, "Failed writing the image")
+                )
+                failed = True
+                continue
+            changes["image"] = True
+
+            saved = _save_current_checksum(
+                results[target].get("partition", target),
+                checksum_type,
+                checksum,
+                results[target].get("checksums"),
+            )
+            if not saved:
+                ret["comment"].append(
+                    _device_comment(
+                        device, target, "Checksum failed to be saved in the cache"
+                    )
+                )
+                failed = True
+                continue
+            changes["checksum cache"] = True
+
+        if failed:
             return ret
-        else:
-            ret["changes"]["image"] = True
 
-        saved = _save_current_checksum(device, checksum_type, checksum)
-        if not saved:
-            ret["comment"].append("Checksum failed to be saved in the cache")
-            return ret
-        else:
-            ret["changes"]["checksum cache"] = True
+    ret["result"] = True
+    return ret
+
+
+def golden_created(name, key, store):
+    """
+    Store the root filesystem as a golden root, if is not present.
+
+    name
+        Path where the root filesystem is mounted
 
+    key
+        Key of the golden root (see `images.golden_key`)
+
+    store
+        Directory, shared by all the nodes, where the golden roots are
+        stored
+
+    """
+    ret = {
+        "name": name,
+        "result": False,
+        "changes": {},
+        "comment": [],
+    }
+
+    if __salt__["images.golden_exists"](store, key):
+        ret["result"] = True
+        ret["comment"].append("Golden root {} already present".format(key))
+        return ret
+
+    if __opts__["test"]:
+        ret["result"] = None
+        ret["changes"]["golden"] = key
+        return ret
+
+    try:
+        result = __salt__["images.golden_create"](name, store, key)
+    except CommandExecutionError as e:
+        ret["comment"].append(str(e))
+        return ret
+
+    ret["changes"]["golden"] = key
+    ret["comment"].append(
+        "Golden root {} created in {} seconds".format(key, result["seconds"])
+    )
+    ret["result"] = True
+    return ret
+
+
+def golden_applied(name, key, store=None, url=None, connections=None, threads=None):
+    """
+    Apply a golden root into the root filesystem.
+
+    name
+        Path where the root filesystem is mounted
+
+    key
+        Key of the golden root (see `images.golden_key`)
+
+    store
+        Directory where the golden roots are stored
+
+    url
+        Base URL where the store is also served. If set, the golden
+        root is fetched from there
+
+    connections
+        Number of concurrent Range requests used to fetch the golden
+        root from a HTTP or HTTPS URL
+
+    threads
+        Number of threads used to decompress the golden root
+
+    """
+    ret = {
+        "name": name,
+        "result": False,
+        "changes": {},
+        "comment": [],
+    }
+
+    if __opts__["test"]:
+        ret["result"] = None
+        ret["changes"]["golden"] = key
+        return ret
+
+    try:
+        result = __salt__["images.golden_apply"](
+            name,
+            key,
+            store=store,
+            url=url,
+            connections=connections,
+            threads=threads,
+        )
+    except CommandExecutionError as e:
+        ret["comment"].append(str(e))
+        return ret
+
+    ret["changes"]["golden"] = key
+    ret["comment"].append(
+        "Golden root {} applied in {} seconds ({} MB/s)".format(
+            key, result["seconds"], result["throughput"]
+        )
+    )
     ret["result"] = True
     return ret
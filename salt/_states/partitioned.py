@@ -26,10 +26,12 @@
 :depends:       None
 :platform:      Linux
 """
+import json
 import logging
 import re
 
 import disk
+import inventory
 from salt.exceptions import CommandExecutionError
 
 log = logging.getLogger(__name__)
@@ -39,10 +41,12 @@ __virtualname__ = "partitioned"
 # Define not exported variables from Salt, so this can be imported as
 # a normal module
 try:
+    __context__
     __grains__
     __opts__
     __salt__
 except NameError:
+    __context__ = {}
     __grains__ = {}
     __opts__ = {}
     __salt__ = {}
@@ -67,9 +71,7 @@ def _check_label(device, label):
 
     """
     label = {"dos": "msdos"}.get(label, label)
-    res = __salt__["cmd.run"](["parted", "--list", "--machine", "--script"])
-    line = "".join((line for line in res.splitlines() if line.startswith(device)))
-    return ":{}:".format(label) in line
+    return _get_snapshot(device)["label"] == label
 
 
 def labeled(name, label):
@@ -106,6 +108,7 @@ def labeled(name, label):
         return ret
 
     __salt__["partition.mklabel"](name, label)
+    _invalidate_snapshot(name)
 
     if _check_label(name, label):
         ret["result"] = True
@@ -118,85 +121,218 @@ def labeled(name, label):
     return ret
 
 
-def _get_partition_type(device):
+# Ids of the extended partitions in msdos labels
+EXTENDED_IDS = ("5", "f", "85")
+
+
+def _msdos_id(value):
     """
-    Get partition type of each partition
+    Normalize the id of a msdos partition ('05', '0x5', '5' -> '5')
+
+    """
+    value = value.lower()
+    value = value[2:] if value.startswith("0x") else value
+    return value.lstrip("0") or "0"
+
 
-    Return dictionary: {number: type, ...}
+def _flag_id(flags):
+    """
+    Return the msdos id from the 'type=' flag of parted, or None
 
     """
-    cmd = "parted -s {0} print".format(device)
-    out = __salt__["cmd.run_stdout"](cmd)
-    types = re.findall(r"\s*(\d+).*(primary|extended|logical).*", out)
-    return dict(types)
+    for flag in flags:
+        if flag.startswith("type="):
+            return _msdos_id(flag[5:])
+    return None
 
 
-def _get_cached_info(device):
+def _parse_parted(output, ids=None):
     """
-    Get the information of a device as a dictionary
+    Parse the output of `parted --machine print`, in sectors
+
+    The machine output do not have a column for the partition type.
+    In msdos the logical partitions start at 5, and the extended
+    partition is recognized by its id, that recent versions of parted
+    show as a 'type=' flag. `ids` can map the partition numbers to the
+    ids read by other means.
+
+    """
+    snapshot = {
+        "label": "unknown",
+        "sector_size": 512,
+        "sectors": 0,
+        "disk flags": [],
+        "partitions": {},
+    }
+    for line in output.splitlines():
+        fields = line.rstrip(";").split(":")
+        if len(fields) >= 8 and fields[0].startswith("/"):
+            snapshot["sectors"] = int(fields[1].rstrip("s"))
+            snapshot["sector_size"] = int(fields[3])
+            snapshot["label"] = fields[5]
+            snapshot["disk flags"] = [f for f in fields[7].split(", ") if f]
+        elif len(fields) >= 7 and fields[0].isdigit():
+            number, start, end, size, fs_type, name, flags = fields[:7]
+            snapshot["partitions"][number] = {
+                "number": number,
+                "start": int(start.rstrip("s")),
+                "end": int(end.rstrip("s")),
+                "size": int(size.rstrip("s")),
+                "file system": fs_type,
+                "name": name,
+                "flags": [f for f in flags.split(", ") if f],
+            }
+
+    ids = ids or {}
+    for number, partition in snapshot["partitions"].items():
+        if snapshot["label"] != "msdos":
+            partition["type"] = "primary"
+        elif int(number) > 4:
+            partition["type"] = "logical"
+        elif ids.get(number, _flag_id(partition["flags"])) in EXTENDED_IDS:
+            partition["type"] = "extended"
+        else:
+            partition["type"] = "primary"
+    return snapshot
+
+
+def _get_snapshot(device):
+    """
+    Get a snapshot of the partition table of a device
+
+    The label, disk flags and all the partitions (with the geometry in
+    sectors) are read from a single parted call, and cached until the
+    device is changed.
 
     """
-    if not hasattr(_get_cached_info, "info"):
-        _get_cached_info.info = {}
-    info = _get_cached_info.info
+    if not hasattr(_get_snapshot, "snapshots"):
+        _get_snapshot.snapshots = {}
+    snapshots = _get_snapshot.snapshots
+
+    if device not in snapshots:
+        # If the device do not have a label parted fails, but the
+        # device information is still printed
+        res = __salt__["cmd.run_all"](
+            ["parted", "--machine", "--script", device, "unit", "s", "print"]
+        )
+        snapshot = _parse_parted(res["stdout"])
+        if snapshot["label"] == "msdos" and any(
+            int(number) <= 4 and _flag_id(partition["flags"]) is None
+            for number, partition in snapshot["partitions"].items()
+        ):
+            # Old versions of parted do not show the id of the
+            # partitions, that is needed to find the extended one
+            table = _read_table(device) or {}
+            ids = {
+                str(_partition_number(partition["node"])): _msdos_id(partition["type"])
+                for partition in table.get("partitions", [])
+            }
+            snapshot = _parse_parted(res["stdout"], ids)
+        snapshots[device] = snapshot
+    return snapshots[device]
+
+
+def _invalidate_snapshot(device):
+    """
+    Invalidate the snapshot of the partition table of a device
+
+    The inventory of block devices is also invalidated, as the
+    partitions of the device changed.
 
-    if device not in info:
-        info[device] = __salt__["partition.list"](device)["info"]
-    return info[device]
+    """
+    if hasattr(_get_snapshot, "snapshots"):
+        _get_snapshot.snapshots.pop(device, None)
+    inventory.invalidate(__context__)
 
 
-def _invalidate_cached_info():
+def _get_cached_info(device):
     """
-    Invalidate the cached information about devices
+    Get the information of a device as a dictionary
 
     """
-    if hasattr(_get_cached_info, "info"):
-        delattr(_get_cached_info, "info")
+    snapshot = _get_snapshot(device)
+    return {
+        "partition table": snapshot["label"],
+        "disk flags": snapshot["disk flags"],
+        "logical sector": snapshot["sector_size"],
+    }
 
 
 def _get_cached_partitions(device, unit="s"):
     """
     Get the partitions as a dictionary
 
+    The geometry of the partitions is expressed in `unit`.
+
     """
-    # `partitions` will be used as a local cache, to avoid multiple
-    # request of the same partition with the same units. Is a
-    # dictionary where the key is the `unit`, as we will make request
-    # of all partitions under this unit. This potentially can low the
-    # complexity algorithm to amortized O(1).
-    if not hasattr(_get_cached_partitions, "partitions"):
-        _get_cached_partitions.partitions = {}
-        # There is a bug in `partition.list`, where `type` is storing
-        # the file system information, to workaround this we get the
-        # partition type using parted and attach it here.
-        _get_cached_partitions.types = _get_partition_type(device)
+    snapshot = _get_snapshot(device)
+    partitions = {}
+    for number, partition in snapshot["partitions"].items():
+        partition = dict(partition)
+        for field in ("start", "end", "size"):
+            value = disk.from_sectors(
+                partition[field], unit, snapshot["sector_size"], snapshot["sectors"]
+            )
+            partition[field] = "{:f}{}".format(value, unit)
+        partitions[number] = partition
+    return partitions
+
+
+OVERLAPPING_ERROR = 0.75
+
 
-    if device not in _get_cached_partitions.partitions:
-        _get_cached_partitions.partitions[device] = {}
-    partitions = _get_cached_partitions.partitions[device]
+def _get_index(device):
+    """
+    Get the index of the partitions of a device
 
-    if unit not in partitions:
-        partitions[unit] = __salt__["partition.list"](device, unit=unit)
-        # If the partition comes from a gpt disk, we assign the type
-        # as 'primary'
-        types = _get_cached_partitions.types
-        for number, partition in partitions[unit]["partitions"].items():
-            partition["type"] = types.get(number, "primary")
+    The geometry (in sectors) of the partitions is kept in a sorted
+    interval index, together with the used partition numbers. The
+    index is stored in the snapshot of the partition table, so it is
+    built once and invalidated with it.
 
-    return partitions[unit]["partitions"]
+    """
+    snapshot = _get_snapshot(device)
+    if "index" not in snapshot:
+        partitions = snapshot["partitions"].values()
+        snapshot["index"] = {
+            "intervals": disk.Intervals(
+                (p["start"], p["end"], p["number"]) for p in partitions
+            ),
+            "numbers": sorted(int(p["number"]) for p in partitions),
+            "extended": any(p["type"] == "extended" for p in partitions),
+            "last logical": max(
+                (int(p["number"]) for p in partitions if p["type"] == "logical"),
+                default=4,
+            ),
+        }
+    return snapshot["index"]
 
 
-def _invalidate_cached_partitions():
+def _to_sectors(device, value, unit):
     """
-    Invalidate the cached information about partitions
+    Convert a value expressed in `unit` into sectors of the device
 
     """
-    if hasattr(_get_cached_partitions, "partitions"):
-        delattr(_get_cached_partitions, "partitions")
-        delattr(_get_cached_partitions, "types")
+    snapshot = _get_snapshot(device)
+    return disk.to_sectors(value, unit, snapshot["sector_size"], snapshot["sectors"])
 
 
-OVERLAPPING_ERROR = 0.75
+def _first_free_number(numbers, limit):
+    """
+    Return the first partition number not in the sorted list of used
+    numbers, or None if all until `limit` are used.
+
+    """
+    # The number in the position `i` is `i + 1` until the first hole,
+    # so the hole can be found with a binary search
+    low, high = 0, len(numbers)
+    while low < high:
+        middle = (low + high) // 2
+        if numbers[middle] == middle + 1:
+            low = middle + 1
+        else:
+            high = middle
+    return str(low + 1) if low < limit else None
 
 
 def _check_partition(device, number, part_type, start, end):
@@ -210,33 +346,27 @@ def _check_partition(device, number, part_type, start, end):
     """
     # The `start` and `end` fields are expressed with units (the same
     # kind of units that `parted` allows). To make a fair comparison
-    # we need to normalize each field to the same units that we can
-    # use to read the current partitions. A good candidate is sector
-    # ('s'). The problem is that we need to reimplement the same
-    # conversion logic from `parted` here [1], as we need the same
-    # round logic when we convert from 'MiB' to 's', for example.
-    #
-    # To avoid this duplicity of code we can do a trick: for each
-    # field in the proposed partition we request a `partition.list`
-    # with the same unit. We make `parted` to make the conversion for
-    # us, in exchange for an slower algorithm.
-    #
-    # We can change it once we decide to take care of alignment.
+    # we convert the geometry of the current partition (read in
+    # sectors) into the same units of each field. The conversion do
+    # not follow the round logic of `parted` [1], but the difference
+    # is inside the OVERLAPPING_ERROR margin.
     #
     # [1] Check libparted/unit.c
 
     number = str(number)
-    partitions = _get_cached_partitions(device)
-    if number not in partitions:
+    snapshot = _get_snapshot(device)
+    partition = snapshot["partitions"].get(number)
+    if not partition:
         return None
 
-    if part_type != partitions[number]["type"]:
+    if part_type != partition["type"]:
         return False
 
     for value, name in ((start, "start"), (end, "end")):
         value, unit = disk.units(value)
-        p_value = _get_cached_partitions(device, unit)[number][name]
-        p_value = disk.units(p_value)[0]
+        p_value = disk.from_sectors(
+            partition[name], unit, snapshot["sector_size"], snapshot["sectors"]
+        )
         min_value = value - OVERLAPPING_ERROR
         max_value = value + OVERLAPPING_ERROR
         if not min_value <= p_value <= max_value:
@@ -251,21 +381,11 @@ def _get_first_overlapping_partition(device, start):
 
     """
     # Check if there is a partition in the system that start at
-    # specified point.
+    # specified point. If many contains it (like an extended and a
+    # logical partition), the one that start later is the one.
     value, unit = disk.units(start)
     value += OVERLAPPING_ERROR
-
-    partitions = _get_cached_partitions(device, unit)
-    partition_number = None
-    partition_start = 0
-    for number, partition in partitions.items():
-        p_start = disk.units(partition["start"])[0]
-        p_end = disk.units(partition["end"])[0]
-        if p_start <= value <= p_end:
-            if partition_number is None or partition_start < p_start:
-                partition_number = number
-                partition_start = p_start
-    return partition_number
+    return _get_index(device)["intervals"].find(_to_sectors(device, value, unit))
 
 
 def _get_partition_number(device, part_type, start, end):
@@ -282,8 +402,8 @@ def _get_partition_number(device, part_type, start, end):
 
     """
 
-    unit = disk.units(start)[1]
-    partitions = _get_cached_partitions(device, unit)
+    partitions = _get_snapshot(device)["partitions"]
+    index = _get_index(device)
 
     # Check if there is a partition in the system that start or
     # containst the start point
@@ -294,46 +414,29 @@ def _get_partition_number(device, part_type, start, end):
         elif not (partitions[number]["type"] == "extended" and part_type == "logical"):
             raise EnumerateException("Do not overlap partitions")
 
-    def __primary_partition_free_slot(partitions, label):
-        if label == "msdos":
-            max_primary = 4
-        else:
-            max_primary = 1024
-        for i in range(1, max_primary + 1):
-            i = str(i)
-            if i not in partitions:
-                return i
-
     # The partition is not already there, we guess the next number
     label = _get_cached_info(device)["partition table"]
+    max_primary = 4 if label == "msdos" else 1024
     if part_type == "primary":
-        candidate = __primary_partition_free_slot(partitions, label)
+        candidate = _first_free_number(index["numbers"], max_primary)
         if not candidate:
             raise EnumerateException("No free slot for primary partition")
         return candidate
     elif part_type == "extended":
         if label == "gpt":
             raise EnumerateException("Extended partitions not allowed in gpt")
-        if "extended" in (info["type"] for info in partitions.values()):
+        if index["extended"]:
             raise EnumerateException("Already found a extended partition")
-        candidate = __primary_partition_free_slot(partitions, label)
+        candidate = _first_free_number(index["numbers"], max_primary)
         if not candidate:
             raise EnumerateException("No free slot for extended partition")
         return candidate
     elif part_type == "logical":
         if label == "gpt":
             raise EnumerateException("Extended partitions not allowed in gpt")
-        if "extended" not in (part["type"] for part in partitions.values()):
+        if not index["extended"]:
             raise EnumerateException("Missing extended partition")
-        candidate = max(
-            (
-                int(part["number"])
-                for part in partitions.values()
-                if part["type"] == "logical"
-            ),
-            default=4,
-        )
-        return str(candidate + 1)
+        return str(index["last logical"] + 1)
 
 
 def _get_partition_flags(device, number):
@@ -349,13 +452,13 @@ def _get_partition_flags(device, number):
 
     result = []
     number = str(number)
-    partitions = __salt__["partition.list"](device)["partitions"]
+    partitions = _get_snapshot(device)["partitions"]
     if number in partitions:
         # In parted the field for flags is reused to mark other
         # situations, so we need to remove values that do not
         # represent flags
-        flags = partitions[number]["flags"].split(", ")
-        result = [flag for flag in flags if flag and _is_valid(flag)]
+        flags = partitions[number]["flags"]
+        result = [flag for flag in flags if _is_valid(flag)]
     return result
 
 
@@ -471,8 +574,7 @@ def mkparted(name, part_type, fs_type=None, start=None, end=None, flags=None):
         # force the mkfs state to happend.
         __salt__["disk.wipe"]("{}{}".format(device, number))
 
-        _invalidate_cached_info()
-        _invalidate_cached_partitions()
+        _invalidate_snapshot(device)
 
     # The first time that we create a partition we do not have a
     # partition number for it
@@ -519,6 +621,329 @@ def mkparted(name, part_type, fs_type=None, start=None, end=None, flags=None):
         else:
             ret["changes"][flag] = False
 
+    if flags_to_set or flags_to_unset:
+        _invalidate_snapshot(device)
+
+    return ret
+
+
+# Alignment of the start of the partitions created by `layout`, in
+# bytes (the same optimal alignment used by parted and sfdisk)
+ALIGNMENT = 1024 * 1024
+
+# Partition type used by sfdisk for each flag or parted file system,
+# for each label. None is the type used by default.
+PARTITION_TYPES = {
+    "gpt": {
+        "esp": "C12A7328-F81F-11D2-BA4B-00A0C93EC93B",
+        "bios_grub": "21686148-6449-6E6F-744E-656564454649",
+        "raid": "A19D880F-05FC-4D3B-A006-743F0F84911E",
+        "lvm": "E6D6D379-F507-44C2-A23C-238F2A3DF928",
+        "linux-swap": "0657FD6D-A4AB-43C4-84E5-0933C84B4F4F",
+        "fat16": "EBD0A0A2-B9E5-4433-87C0-68B6B72699C7",
+        "fat32": "EBD0A0A2-B9E5-4433-87C0-68B6B72699C7",
+        None: "0FC63DAF-8483-4772-8E79-3D69D8477DE4",
+    },
+    "msdos": {
+        "esp": "ef",
+        "raid": "fd",
+        "lvm": "8e",
+        "linux-swap": "82",
+        "fat16": "e",
+        "fat32": "c",
+        None: "83",
+    },
+}
+
+# Flags that are expressed as a partition type (or, for 'boot' in
+# msdos, as the bootable mark)
+TYPE_FLAGS = ("esp", "bios_grub", "raid", "lvm")
+
+
+def _partition_type(label, fs_type, flags):
+    """
+    Return the sfdisk partition type for a partition.
+
+    """
+    types = PARTITION_TYPES[label]
+    for flag in TYPE_FLAGS:
+        if flag in flags:
+            if flag not in types:
+                raise EnumerateException(
+                    "Flag {} not valid for {} labels".format(flag, label)
+                )
+            return types[flag]
+    return types.get(fs_type, types[None])
+
+
+def _same_type(label, type_a, type_b):
+    """
+    Compare two partition types, as sfdisk can print them differently.
+
+    """
+    if label == "msdos":
+        return int(type_a, 16) == int(type_b, 16)
+    return type_a.upper() == type_b.upper()
+
+
+def _read_table(device):
+    """
+    Return the partition table of a device as a dictionary, or None
+    if the device do not have one.
+
+    """
+    res = __salt__["cmd.run_all"](["sfdisk", "--json", device])
+    if res["retcode"]:
+        return None
+    table = json.loads(res["stdout"])["partitiontable"]
+    table["label"] = {"dos": "msdos"}.get(table["label"], table["label"])
+    return table
+
+
+def _get_geometry(device):
+    """
+    Return the sector size and the number of sectors of a device.
+
+    """
+    res = __salt__["cmd.run_all"](["blockdev", "--getss", "--getsize64", device])
+    if res["retcode"]:
+        raise EnumerateException(
+            "Cannot read the size of {}: {}".format(device, res["stderr"])
+        )
+    sector_size, size = (int(value) for value in res["stdout"].split())
+    return sector_size, size // sector_size
+
+
+def _partition_number(part_id):
+    """
+    Return the partition number of a partition device.
+
+    """
+    match = re.search(r"(\d+)$", part_id)
+    if not match:
+        raise EnumerateException("Partition number not found in {}".format(part_id))
+    return int(match.group(1))
+
+
+def _plan_layout(device, label, partitions):
+    """
+    Return the proposed partitions, with the position in sectors.
+
+    The start of each partition is aligned, and the end is adjusted to
+    the last usable sector of the device.
+
+    """
+    sector_size, total = _get_geometry(device)
+    align = max(ALIGNMENT // sector_size, 1)
+    # gpt reserves 33 sectors at each end of the device
+    first, last = (34, total - 34) if label == "gpt" else (1, total - 1)
+
+    proposal = []
+    for partition in partitions:
+        if partition.get("part_type", "primary") != "primary":
+            raise EnumerateException("Only primary partitions are supported")
+        start = disk.sectors(partition["start"], sector_size, total)
+        start = -(-max(start, first) // align) * align
+        if partition["end"] == "100%":
+            end = last
+        else:
+            end = min(disk.sectors(partition["end"], sector_size, total) - 1, last)
+        if end < start:
+            raise EnumerateException(
+                "No space for partition {}".format(partition["part_id"])
+            )
+        flags = partition.get("flags") or []
+        proposal.append(
+            {
+                "node": partition["part_id"],
+                "number": _partition_number(partition["part_id"]),
+                "start": start,
+                "end": end,
+                "type": _partition_type(label, partition.get("fs_type"), flags),
+                "bootable": label == "msdos" and "boot" in flags,
+                "align": align,
+            }
+        )
+
+    if label == "msdos" and len(proposal) > 4:
+        raise EnumerateException("No free slot for primary partition")
+    return proposal
+
+
+def _check_layout_partition(label, proposed, current):
+    """
+    Check if the proposed partition match the current one.
+
+    As the proposed partition can be aligned in a different way, the
+    position of the current partition can be off by the alignment.
+    """
+    current_end = current["start"] + current["size"] - 1
+    return (
+        abs(current["start"] - proposed["start"]) < proposed["align"]
+        and abs(current_end - proposed["end"]) < proposed["align"]
+        and _same_type(label, proposed["type"], current["type"])
+        and proposed["bootable"] == current.get("bootable", False)
+    )
+
+
+def _sfdisk_script(label, proposal, new_label):
+    """
+    Return the sfdisk script that creates the partitions.
+
+    """
+    lines = []
+    if new_label:
+        lines.extend(["label: {}".format({"msdos": "dos"}.get(label, label)), ""])
+    for partition in proposal:
+        line = "{} : start={}, size={}, type={}".format(
+            partition["node"],
+            partition["start"],
+            partition["end"] - partition["start"] + 1,
+            partition["type"],
+        )
+        if partition["bootable"]:
+            line += ", bootable"
+        lines.append(line)
+    return "\n".join(lines) + "\n"
+
+
+def layout(name, label, partitions=None, pmbr_boot=False):
+    """
+    Make sure that the partition table of a device is in place.
+
+    All the missing partitions (and the label, if needed) are created
+    with a single sfdisk call, so the kernel re-reads the partition
+    table only once. The new partitions are wiped, to remove old data
+    that was on the disk.
+
+    name
+        Device name (/dev/sda, /dev/disk/by-id/scsi-...)
+
+    label
+        Label of the partition table (usually 'gpt' or 'msdos'). If
+        the current label is different, a new partition table is
+        created, removing all the partitions.
+
+    partitions
+        List of partitions, as normalized by
+        ``partmod.prepare_partition_data``. Each partition is a
+        dictionary with the 'part_id', 'part_type', 'fs_type',
+        'start', 'end' and 'flags' keys. Only primary partitions are
+        supported, and the flags are expressed as the partition type.
+
+    pmbr_boot
+        Set the pmbr_boot flag in the disk (only for gpt)
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' state.single partitioned.layout /dev/sda label=gpt \\
+            partitions="[{part_id: /dev/sda1, start: 1MB, end: 100%}]"
+
+    """
+    ret = {
+        "name": name,
+        "result": False,
+        "changes": {},
+        "comment": [],
+    }
+
+    label = {"dos": "msdos"}.get(label, label)
+    if label not in PARTITION_TYPES:
+        ret["comment"].append("Label {} not supported".format(label))
+        return ret
+
+    try:
+        proposal = _plan_layout(name, label, partitions or [])
+    except (EnumerateException, disk.ParseException) as e:
+        ret["comment"].append(str(e))
+        return ret
+
+    table = _read_table(name)
+    new_label = not table or table["label"] != label
+    current = {}
+    if not new_label:
+        current = {
+            _partition_number(partition["node"]): partition
+            for partition in table.get("partitions", [])
+        }
+
+    missing = []
+    for partition in proposal:
+        if partition["number"] not in current:
+            missing.append(partition)
+        elif not _check_layout_partition(
+            label, partition, current[partition["number"]]
+        ):
+            ret["comment"].append(
+                "Partition {} cannot be replaced".format(partition["node"])
+            )
+    if ret["comment"]:
+        return ret
+
+    set_pmbr_boot = (
+        pmbr_boot
+        and label == "gpt"
+        and (new_label or not _check_disk_flags(name, "pmbr_boot"))
+    )
+
+    if not new_label and not missing and not set_pmbr_boot:
+        ret["result"] = True
+        ret["comment"].append("Partition table of {} already in place".format(name))
+        return ret
+
+    if new_label:
+        ret["changes"]["label"] = label
+    if missing:
+        ret["changes"]["partitions"] = [partition["node"] for partition in missing]
+    if set_pmbr_boot:
+        ret["changes"]["pmbr_boot"] = True
+
+    if __opts__["test"]:
+        ret["result"] = None
+        ret["comment"].append("Partition table of {} will be updated".format(name))
+        return ret
+
+    if new_label or missing:
+        cmd = ["sfdisk", "--wipe-partitions", "always"]
+        cmd.extend(["--wipe", "always"] if new_label else ["--append"])
+        cmd.append(name)
+        res = __salt__["cmd.run_all"](
+            cmd, stdin=_sfdisk_script(label, missing, new_label)
+        )
+        _invalidate_snapshot(name)
+        if res["retcode"]:
+            ret["changes"] = {}
+            ret["comment"].append(
+                "Failed to update the partition table of {}: {}".format(
+                    name, res["stderr"]
+                )
+            )
+            return ret
+        __salt__["cmd.run"](["udevadm", "settle"])
+
+        table = _read_table(name) or {}
+        current = {
+            _partition_number(partition["node"]): partition
+            for partition in table.get("partitions", [])
+        }
+        for partition in missing:
+            if partition["number"] not in current or not _check_layout_partition(
+                label, partition, current[partition["number"]]
+            ):
+                ret["comment"].append(
+                    "Partition {} fail to be created".format(partition["node"])
+                )
+        if ret["comment"]:
+            return ret
+
+    if set_pmbr_boot:
+        __salt__["partition.disk_set"](name, "pmbr_boot", "on")
+        _invalidate_snapshot(name)
+
+    ret["result"] = True
+    ret["comment"].append("Partition table of {} updated".format(name))
     return ret
 
 
@@ -587,8 +1012,7 @@ def named(name, device, partition=None):
         return ret
 
     changes = __salt__["partition.name"](device, partition, name)
-    _invalidate_cached_info()
-    _invalidate_cached_partitions()
+    _invalidate_snapshot(device)
 
     if _check_partition_name(device, partition, name):
         ret["result"] = True
@@ -604,8 +1028,7 @@ def _check_disk_flags(device, flag):
     """
     Return True if the flag for a device is already set.
     """
-    flags = __salt__["partition.list"](device)["info"]["disk flags"]
-    return flag in flags
+    return flag in _get_snapshot(device)["disk flags"]
 
 
 def disk_set(name, flag, enabled=True):
@@ -652,6 +1075,7 @@ def disk_set(name, flag, enabled=True):
         return ret
 
     __salt__["partition.disk_set"](name, flag, "on" if enabled else "off")
+    _invalidate_snapshot(name)
 
     is_flag = _check_disk_flags(name, flag)
     if enabled == is_flag:
@@ -678,7 +1102,7 @@ def _check_partition_flags(device, number, flag):
       - `None`: there is not such partition
     """
     number = str(number)
-    partitions = __salt__["partition.list"](device)["partitions"]
+    partitions = _get_snapshot(device)["partitions"]
     if number in partitions:
         return flag in partitions[number]["flags"]
 
@@ -743,6 +1167,7 @@ def partition_set(name, flag, partition=None, enabled=True):
         return ret
 
     __salt__["partition.set"](name, partition, flag, "on" if enabled else "off")
+    _invalidate_snapshot(name)
 
     is_flag = _check_partition_flags(name, partition, flag)
     if enabled == is_flag:
@@ -760,3 +1185,29 @@ def partition_set(name, flag, partition=None, enabled=True):
             )
         )
     return ret
+
+
+def refreshed(name):
+    """
+    Drop the cached partition tables and block devices.
+
+    The parallel states run in a forked process, so the changes done
+    there (like new partitions or file systems) are not seen in the
+    information cached by this process. Use this state after them.
+
+    name
+        Name of the state (not used)
+
+    """
+    ret = {
+        "name": name,
+        "result": True,
+        "changes": {},
+        "comment": [],
+    }
+
+    if hasattr(_get_snapshot, "snapshots"):
+        _get_snapshot.snapshots.clear()
+    inventory.invalidate(__context__)
+    ret["comment"].append("Cached partition tables and devices dropped")
+    return ret
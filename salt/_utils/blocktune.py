@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Alberto Planas <aplanas@suse.com>
+#
+# Copyright 2019 SUSE LLC.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import time
+
+LOG = logging.getLogger(__name__)
+
+SYSFS = "/sys"
+PROCFS = "/proc"
+
+# The values changed by the sessions are shared via this file, as the
+# sessions can run in different processes (like parallel states)
+RUNDIR = "/run"
+STATE_FILE = "yomi-blocktune.json"
+
+# Default values of the tuning session. `max_sectors_kb` is raised to
+# the hardware limit of the device (max_hw_sectors_kb), and the
+# scheduler is the first one available from the list (a different
+# one for SSD and for rotational devices)
+DEFAULTS = {
+    "max_sectors_kb": None,
+    "read_ahead_kb": 4096,
+    "scheduler": None,
+    "dirty_ratio": 40,
+    "dirty_background_ratio": 10,
+}
+# Besides the values, the `probe` option measures the read throughput
+# of the devices before and after the tuning
+OPTIONS = tuple(DEFAULTS) + ("probe",)
+SCHEDULERS = ("none", "noop", "mq-deadline", "deadline")
+ROTATIONAL_SCHEDULERS = ("mq-deadline", "deadline", "bfq")
+
+# Bytes read from each device to measure the throughput
+PROBE_SIZE = 32 * 1024 * 1024
+PROBE_BLOCK_SIZE = 1024 * 1024
+
+
+def _read(path):
+    with open(path) as f:
+        return f.read().strip()
+
+
+def _write(path, value):
+    with open(path, "w") as f:
+        f.write(str(value))
+
+
+def _current(path):
+    """Read a setting, the selected one if is a scheduler"""
+    value = _read(path)
+    if os.path.basename(path) == "scheduler":
+        value = _current_scheduler(value)
+    return value
+
+
+def _alive(pid):
+    """Check if a process is still running"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _drop_stale(state):
+    """Restore the values of the sessions that ended without restoring
+
+    A session killed during the copy (or the format) does not restore
+    its values, and the entries of its process are left in the state.
+    If no running process uses a value, it is restored now.
+
+    """
+    for path, entry in list(state.items()):
+        entry["pids"] = [pid for pid in entry.get("pids", []) if _alive(pid)]
+        if entry["pids"]:
+            continue
+        del state[path]
+        try:
+            if _current(path) == entry.get("new"):
+                LOG.info("Restoring %s of a session that did not end", path)
+                _write(path, entry["old"])
+        except (OSError, KeyError) as e:
+            LOG.warning("Cannot restore %s: %s", path, e)
+
+
+@contextlib.contextmanager
+def _shared_state():
+    """Lock and return the values changed by all the sessions
+
+    The state maps each path to the original value, the new value and
+    the list of the processes that are using it (one entry for each
+    session).
+
+    """
+    os.makedirs(RUNDIR, exist_ok=True)
+    with open(os.path.join(RUNDIR, STATE_FILE), "a+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            try:
+                state = json.loads(f.read() or "{}")
+            except ValueError:
+                LOG.warning("Tuning state not valid, ignored")
+                state = {}
+            _drop_stale(state)
+            yield state
+            f.seek(0)
+            f.truncate()
+            json.dump(state, f)
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def queue_path(device):
+    """Return the sysfs queue directory of a device
+
+    The partitions do not have a queue, so the one of the parent disk
+    is used.
+
+    """
+    name = os.path.basename(os.path.realpath(device))
+    block = os.path.realpath(os.path.join(SYSFS, "class", "block", name))
+    if not os.path.isdir(os.path.join(block, "queue")):
+        block = os.path.dirname(block)
+    queue = os.path.join(block, "queue")
+    return queue if os.path.isdir(queue) else None
+
+
+def _current_scheduler(value):
+    """Return the selected scheduler from the sysfs list"""
+    for scheduler in value.split():
+        if scheduler.startswith("["):
+            return scheduler.strip("[]")
+    return value
+
+
+def _scheduler(queue, requested):
+    """Choose the scheduler for a queue, None if there is no choice"""
+    available = _read(os.path.join(queue, "scheduler")).replace("[", "").split()
+    if requested:
+        return requested if requested in available else None
+    rotational = _read(os.path.join(queue, "rotational")) == "1"
+    for scheduler in ROTATIONAL_SCHEDULERS if rotational else SCHEDULERS:
+        if scheduler in available:
+            return scheduler
+    return None
+
+
+def probe(device, size=PROBE_SIZE):
+    """Measure the read throughput of a device in MB/s
+
+    The pages of the device are dropped from the page cache first, so
+    the data is read from the device. Return None if the device
+    cannot be read.
+
+    """
+    try:
+        fd = os.open(device, os.O_RDONLY)
+    except OSError as e:
+        LOG.info("Cannot read %s: %s", device, e)
+        return None
+    try:
+        os.posix_fadvise(fd, 0, size, os.POSIX_FADV_DONTNEED)
+        read = 0
+        start = time.monotonic()
+        while read < size:
+            data = os.read(fd, min(PROBE_BLOCK_SIZE, size - read))
+            if not data:
+                break
+            read += len(data)
+        seconds = time.monotonic() - start
+        os.posix_fadvise(fd, 0, size, os.POSIX_FADV_DONTNEED)
+    except OSError as e:
+        LOG.info("Cannot read %s: %s", device, e)
+        return None
+    finally:
+        os.close(fd)
+    return round(read / seconds / 1000**2, 2) if seconds and read else None
+
+
+class Session:
+    """Tune the block devices while they are written
+
+    The queues of the devices get a bigger request size and read-ahead
+    and a scheduler suited for long sequential writes, and the
+    dirty-writeback limits of the kernel are raised. The original
+    values are restored on exit.
+
+    Some values are shared by many sessions, like the queue of a disk
+    with many partitions or the limits of the kernel, and the sessions
+    can overlap (like the parallel states). A changed value is counted
+    in a state shared by all the sessions, so it is restored only when
+    the last session that uses it ends, and a session that starts
+    later keeps the value set by the first one. A value is not
+    restored if was changed by someone else during the sessions. The
+    values of the processes that ended without restoring them (like
+    a killed minion) are restored by the next session.
+
+    The values of `DEFAULTS` can be replaced with `options`. A value
+    of False disables the tuning of this parameter. If the settings
+    cannot be changed, the session does nothing.
+
+    If `measure` (or the `probe` option) is set, the read throughput
+    of the devices is measured with a short read before and after the
+    tuning. This is not the throughput of the real writes, and is only
+    an indication of the effect of the new read-ahead and request
+    size, so it is not done by default.
+
+    """
+
+    def __init__(self, devices, options=None, measure=False):
+        self.devices = [devices] if isinstance(devices, str) else list(devices)
+        self.options = dict(DEFAULTS)
+        self.options.update(options or {})
+        self.measure = self.options.pop("probe", measure)
+        # List of (path, original value, new value)
+        self.changes = []
+        self.read_throughput = {}
+
+    def _settings(self):
+        """Return the list of (path, value) to apply"""
+        settings = []
+        queues = []
+        for device in self.devices:
+            queue = queue_path(device)
+            if not queue:
+                LOG.info("No block queue for %s", device)
+            elif queue not in queues:
+                queues.append(queue)
+
+        for queue in queues:
+            try:
+                if self.options["max_sectors_kb"] is not False:
+                    value = self.options["max_sectors_kb"] or _read(
+                        os.path.join(queue, "max_hw_sectors_kb")
+                    )
+                    settings.append((os.path.join(queue, "max_sectors_kb"), value))
+                if self.options["read_ahead_kb"] is not False:
+                    settings.append(
+                        (
+                            os.path.join(queue, "read_ahead_kb"),
+                            self.options["read_ahead_kb"],
+                        )
+                    )
+                if self.options["scheduler"] is not False:
+                    scheduler = _scheduler(queue, self.options["scheduler"])
+                    if scheduler:
+                        settings.append((os.path.join(queue, "scheduler"), scheduler))
+            except OSError as e:
+                LOG.info("Cannot read the queue %s: %s", queue, e)
+
+        for option in ("dirty_ratio", "dirty_background_ratio"):
+            if self.options[option] is False:
+                continue
+            # If the limit is set in bytes, it was chosen by the
+            # administrator, and is kept
+            path = os.path.join(PROCFS, "sys", "vm", option.replace("ratio", "bytes"))
+            try:
+                if os.path.exists(path) and int(_read(path)):
+                    continue
+            except (OSError, ValueError):
+                continue
+            settings.append(
+                (os.path.join(PROCFS, "sys", "vm", option), self.options[option])
+            )
+        return settings
+
+    def _probe(self, key):
+        for device in self.devices:
+            self.read_throughput.setdefault(device, {})[key] = probe(device)
+
+    def apply(self):
+        if self.measure:
+            self._probe("before")
+        settings = self._settings()
+        pid = os.getpid()
+        with _shared_state() as state:
+            for path, value in settings:
+                entry = state.get(path)
+                if entry:
+                    try:
+                        current = _current(path)
+                    except OSError:
+                        current = None
+                    if current == entry["new"]:
+                        # Other session already changed it
+                        entry["pids"].append(pid)
+                        self.changes.append((path, entry["old"], entry["new"]))
+                        continue
+                    # Changed by someone else, so the entry is stale
+                    del state[path]
+                try:
+                    old = _current(path)
+                    if old == str(value):
+                        continue
+                    _write(path, value)
+                    new = _current(path)
+                except OSError as e:
+                    LOG.warning("Cannot tune %s: %s", path, e)
+                    continue
+                state[path] = {"old": old, "new": new, "pids": [pid]}
+                self.changes.append((path, old, new))
+        if self.measure:
+            self._probe("after")
+
+    def restore(self):
+        pid = os.getpid()
+        with _shared_state() as state:
+            for path, _, _ in reversed(self.changes):
+                entry = state.get(path)
+                if not entry or pid not in entry["pids"]:
+                    continue
+                entry["pids"].remove(pid)
+                if entry["pids"]:
+                    continue
+                del state[path]
+                try:
+                    if _current(path) != entry["new"]:
+                        LOG.info(
+                            "%s was changed during the session, not restored", path
+                        )
+                        continue
+                    _write(path, entry["old"])
+                except OSError as e:
+                    LOG.warning("Cannot restore %s: %s", path, e)
+
+    @property
+    def report(self):
+        """Return the changed values and the read throughput of the devices"""
+        return {
+            "settings": {
+                path: {"old": old, "new": new} for path, old, new in self.changes
+            },
+            "read_throughput": self.read_throughput,
+        }
+
+    def __enter__(self):
+        self.apply()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.restore()
+
+
+def describe(report):
+    """Return a human readable summary of the report of a session"""
+    throughput = ", ".join(
+        "{} {} -> {} MB/s".format(device, values.get("before"), values.get("after"))
+        for device, values in report["read_throughput"].items()
+    )
+    summary = "I/O tuning changed {} settings".format(len(report["settings"]))
+    if throughput:
+        summary += " (read throughput: {})".format(throughput)
+    return summary
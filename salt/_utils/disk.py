@@ -21,6 +21,7 @@
 # specific language governing permissions and limitations
 # under the License.
 
+import bisect
 import re
 
 
@@ -58,3 +59,142 @@ def units(value, default="MB"):
         else:
             raise ParseException("{} not recognized as a valid unit".format(unit))
     raise ParseException("{} cannot be parsed".format(value))
+
+
+# Size in bytes of the units that can be converted to sectors
+UNIT_BYTES = {
+    "B": 1,
+    "kB": 1000,
+    "MB": 1000**2,
+    "MiB": 1024**2,
+    "GB": 1000**3,
+    "GiB": 1024**3,
+    "TB": 1000**4,
+    "TiB": 1024**4,
+}
+
+
+def sectors(value, sector_size, total):
+    """
+    Convert a value expressed with units into a sector number.
+
+    `total` is the number of sectors of the device, used for the
+    values expressed in '%'.
+    """
+    value, unit = units(value)
+    if unit == "s":
+        return int(value)
+    return int(round(to_sectors(value, unit, sector_size, total)))
+
+
+def to_sectors(value, unit, sector_size, total):
+    """
+    Convert a value expressed in `unit` into a (fractional) number of
+    sectors.
+
+    `total` is the number of sectors of the device, used for the
+    values expressed in '%'.
+    """
+    if unit == "s":
+        return float(value)
+    if unit == "%":
+        return value * total / 100
+    if unit not in UNIT_BYTES:
+        raise ParseException("{} cannot be converted to sectors".format(unit))
+    return value * UNIT_BYTES[unit] / sector_size
+
+
+def from_sectors(value, unit, sector_size, total):
+    """
+    Convert a sector number into a value expressed in `unit`.
+
+    `total` is the number of sectors of the device, used for the
+    values expressed in '%'.
+    """
+    if unit == "s":
+        return float(value)
+    if unit == "%":
+        return value * 100 / total
+    if unit not in UNIT_BYTES:
+        raise ParseException("{} cannot be converted from sectors".format(unit))
+    return value * sector_size / UNIT_BYTES[unit]
+
+
+def partition_device(device, number):
+    """
+    Return the device of a partition.
+
+    Devices that end with a number (like nvme0n1, mmcblk0 or md0) use
+    a 'p' before the partition number.
+    """
+    return "{}{}{}".format(device, "p" if device[-1].isdigit() else "", number)
+
+
+class Intervals:
+    """
+    Sorted index of closed intervals, like the partitions of a device.
+
+    The intervals are tuples (start, end, key), and are expected to be
+    disjoint or nested (like the logical partitions inside an extended
+    one). The interval that contains a point is found with a binary
+    search over the starts, and a walk over the containers of the
+    candidate.
+    """
+
+    def __init__(self, intervals):
+        # The containers are placed before the intervals that start
+        # at the same point
+        self.intervals = sorted(intervals, key=lambda i: (i[0], -i[1]))
+        self.starts = [start for start, _, _ in self.intervals]
+        self.parents = []
+        containers = []
+        for index, (start, end, _) in enumerate(self.intervals):
+            while containers and self.intervals[containers[-1]][1] < start:
+                containers.pop()
+            self.parents.append(containers[-1] if containers else None)
+            containers.append(index)
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def find(self, point):
+        """
+        Return the key of the innermost interval that contains the
+        point, or None.
+        """
+        index = bisect.bisect_right(self.starts, point) - 1
+        while index is not None and index >= 0:
+            _, end, key = self.intervals[index]
+            if point <= end:
+                return key
+            index = self.parents[index]
+        return None
+
+
+def last_partition(partitions):
+    """
+    Return the number of the partition placed last in the disk.
+
+    `partitions` is the output of `partition.list` in sectors. The
+    numbers of the partitions do not need to follow the order in the
+    disk, and an extended partition is skipped in favor of the logical
+    partitions inside it.
+    """
+
+    def _sectors(value):
+        return units(value)[0]
+
+    logical = [p for n, p in partitions.items() if int(n) > 4]
+
+    def _is_extended(number, partition):
+        start, end = _sectors(partition["start"]), _sectors(partition["end"])
+        return int(number) <= 4 and any(
+            start <= _sectors(p["start"]) <= end for p in logical
+        )
+
+    candidates = [n for n, p in partitions.items() if not _is_extended(n, p)]
+    return max(
+        candidates,
+        key=lambda n: (_sectors(partitions[n]["end"]), int(n)),
+        default=None,
+    )
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Alberto Planas <aplanas@suse.com>
+#
+# Copyright 2019 SUSE LLC.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import collections
+import http.server
+import json
+import logging
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+import imagestream
+
+LOG = logging.getLogger(__name__)
+
+# Seconds that a slot is kept without a renewal, and that a client is
+# kept in the queue without asking again for a slot
+LEASE_TTL = 60
+
+# Seconds between two requests of a client waiting for a slot
+RETRY_INTERVAL = 2
+
+# Seconds between two checks of the requests of the server
+POLL_INTERVAL = 0.2
+
+TIMEOUT = 10
+
+
+class _SlotHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server.slots
+        actions = {
+            "/acquire": server.acquire,
+            "/renew": server.renew,
+            "/release": server.release,
+        }
+        if self.path not in actions:
+            self.send_error(404)
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            client = str(json.loads(self.rfile.read(length))["client"])
+        except (ValueError, KeyError, TypeError):
+            self.send_error(400)
+            return
+        body = json.dumps(actions[self.path](client)).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class SlotServer:
+    """Hand out a limited number of download slots
+
+    The clients ask for a slot, and wait in a queue (in order of
+    arrival) until one is free. A slot needs to be renewed before
+    `ttl` seconds, so the slots of the clients that die are recovered,
+    and the clients that stop asking are removed from the queue.
+
+    """
+
+    def __init__(self, budget, address="", port=0, ttl=LEASE_TTL):
+        self.budget = budget
+        self.ttl = ttl
+        self.holders = {}
+        self.waiting = collections.OrderedDict()
+        self.granted = 0
+        self.lock = threading.Lock()
+        self.server = http.server.ThreadingHTTPServer((address, port), _SlotHandler)
+        self.server.daemon_threads = True
+        self.server.slots = self
+        self.port = self.server.server_address[1]
+        self.thread = None
+
+    def _expire(self, now):
+        for client, expires in list(self.holders.items()):
+            if expires < now:
+                LOG.info("Slot of %s expired", client)
+                del self.holders[client]
+        for client, seen in list(self.waiting.items()):
+            if seen + self.ttl < now:
+                del self.waiting[client]
+
+    def acquire(self, client):
+        """Ask for a slot, returns if is granted and the queue position"""
+        now = time.monotonic()
+        with self.lock:
+            self._expire(now)
+            if client in self.holders:
+                self.holders[client] = now + self.ttl
+                return {"granted": True, "position": 0, "ttl": self.ttl}
+            self.waiting[client] = now
+            position = list(self.waiting).index(client)
+            if len(self.holders) + position < self.budget:
+                del self.waiting[client]
+                self.holders[client] = now + self.ttl
+                self.granted += 1
+                return {"granted": True, "position": 0, "ttl": self.ttl}
+            return {"granted": False, "position": position, "retry": RETRY_INTERVAL}
+
+    def renew(self, client):
+        now = time.monotonic()
+        with self.lock:
+            self._expire(now)
+            if client not in self.holders:
+                return {"renewed": False}
+            self.holders[client] = now + self.ttl
+            return {"renewed": True}
+
+    def release(self, client):
+        with self.lock:
+            self.holders.pop(client, None)
+            self.waiting.pop(client, None)
+            return {}
+
+    def serve_forever(self):
+        self.server.serve_forever(POLL_INTERVAL)
+
+    def start(self):
+        """Serve the requests in a background thread"""
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        if self.thread:
+            self.server.shutdown()
+            self.thread.join()
+        self.server.server_close()
+
+
+def _post(url, action, client, timeout=TIMEOUT):
+    """Send a request to the slot server, None if is not available"""
+    request = urllib.request.Request(
+        urllib.parse.urljoin(url, action),
+        data=json.dumps({"client": client}).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.loads(response.read())
+    except (urllib.error.URLError, OSError, ValueError) as e:
+        LOG.info("Error in the request to %s: %s", url, e)
+        return None
+
+
+class Slot:
+    """Download slot of a `SlotServer`, used as a context manager
+
+    The slot is renewed in the background while is held. If `timeout`
+    is set, waiting more than these seconds for a slot (or for the
+    server) is an error.
+
+    """
+
+    def __init__(self, url, timeout=None):
+        self.url = url
+        self.timeout = timeout
+        self.client = uuid.uuid4().hex
+        self.stop = threading.Event()
+        self.thread = None
+        self.waited = 0
+
+    def acquire(self):
+        start = time.monotonic()
+        while True:
+            response = _post(self.url, "/acquire", self.client)
+            if response and response.get("granted"):
+                break
+            elapsed = time.monotonic() - start
+            if self.timeout is not None and elapsed >= self.timeout:
+                # Leave the queue, so the next client is not delayed
+                _post(self.url, "/release", self.client)
+                raise imagestream.StreamException(
+                    "No download slot from {} in {} seconds".format(
+                        self.url, self.timeout
+                    )
+                )
+            if response:
+                LOG.info(
+                    "Waiting for a download slot, position %s", response["position"]
+                )
+            time.sleep(
+                response.get("retry", RETRY_INTERVAL) if response else RETRY_INTERVAL
+            )
+        self.waited = round(time.monotonic() - start, 3)
+
+        ttl = response["ttl"]
+        self.thread = threading.Thread(target=self._renew, args=(ttl,), daemon=True)
+        self.thread.start()
+
+    def _renew(self, ttl):
+        while not self.stop.wait(ttl / 3):
+            response = _post(self.url, "/renew", self.client)
+            if response is not None and not response.get("renewed"):
+                LOG.warning("Download slot from %s expired", self.url)
+
+    def release(self):
+        self.stop.set()
+        if self.thread:
+            self.thread.join()
+        _post(self.url, "/release", self.client)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Alberto Planas <aplanas@suse.com>
+#
+# Copyright 2019 SUSE LLC.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import hashlib
+import json
+import logging
+import os
+import os.path
+import tempfile
+
+import imagestream
+
+LOG = logging.getLogger(__name__)
+
+# Prefix of the entries that are still being written
+PARTIAL = ".partial-"
+METADATA = ".json"
+
+
+def image_key(checksum_type, checksum):
+    """Key of an image entry, addressed by its content"""
+    return "{}-{}".format(checksum_type, checksum)
+
+
+def url_key(url):
+    """Key of an entry addressed by its URL"""
+    return "url-{}".format(hashlib.sha256(url.encode()).hexdigest())
+
+
+class Entry:
+    """New entry of the cache, only visible once is committed"""
+
+    def __init__(self, cache, key, metadata):
+        self.cache = cache
+        self.key = key
+        self.metadata = metadata
+        fd, self.partial = tempfile.mkstemp(prefix=PARTIAL, dir=cache.path)
+        self.file = os.fdopen(fd, "wb")
+
+    def write(self, data):
+        self.file.write(data)
+
+    def commit(self):
+        """Make the entry visible and evict the old ones if needed"""
+        self.file.close()
+        path = self.cache.entry_path(self.key)
+        os.replace(self.partial, path)
+        with open(path + METADATA, "w") as f:
+            json.dump(self.metadata, f)
+        LOG.info("Entry %s stored in the cache", self.key)
+        self.cache.evict(keep=self.key)
+
+    def abort(self):
+        """Drop the partial content of the entry"""
+        self.file.close()
+        try:
+            os.unlink(self.partial)
+        except FileNotFoundError:
+            pass
+
+
+class Cache:
+    """Local cache of images and sidecar files
+
+    Every entry is a file in the cache directory, and the most
+    recently used entries are the ones with a newer modification
+    time. If `max_size` (in bytes) is set, the least recently used
+    entries are removed when the cache grows over this size.
+
+    """
+
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key)
+
+    def key(self, url, key=None):
+        """Return the key of the entry used for an URL"""
+        return key or url_key(url)
+
+    def get(self, key):
+        """Return the path of an entry, marking it as recently used"""
+        path = self.entry_path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def metadata(self, key):
+        """Return the metadata stored with an entry"""
+        try:
+            with open(self.entry_path(key) + METADATA) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def new(self, key, metadata=None):
+        """Create a new entry, that replaces the old one once committed"""
+        return Entry(self, key, metadata or {})
+
+    def remove(self, key):
+        """Remove an entry from the cache"""
+        for path in (self.entry_path(key), self.entry_path(key) + METADATA):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def entries(self):
+        """Return the entries as a list of (mtime, size, key), older first"""
+        entries = []
+        for name in os.listdir(self.path):
+            if name.startswith(PARTIAL) or name.endswith(METADATA):
+                continue
+            try:
+                st = os.stat(self.entry_path(name))
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        """Remove the least recently used entries until the cache fits"""
+        if self.max_size is None:
+            return
+        entries = self.entries()
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, key in entries:
+            if size <= self.max_size:
+                break
+            if key == keep:
+                continue
+            LOG.info("Evicting entry %s from the cache", key)
+            self.remove(key)
+            size -= entry_size
+
+        # An entry bigger than the cache is not kept
+        if size > self.max_size and keep:
+            LOG.info("Entry %s is bigger than the cache", keep)
+            self.remove(keep)
+
+    def open(self, url, key=None, opener=None):
+        """Open an URL using the cache
+
+        Returns a tuple with a file like object and a new `Entry` that
+        needs to be filled with the content read from the file. If
+        the cached entry is valid, the file is the local copy and the
+        entry is None.
+
+        If `key` is set (like the checksum of the content), a present
+        entry is always valid. If not, the entry is addressed by the
+        URL, and a conditional request is made with the ETag and the
+        Last-Modified date of the cached entry.
+
+        The URL is opened with `opener` (by default
+        `imagestream.open_url`), that returns None if the resource was
+        not modified.
+
+        """
+        revalidate = key is None
+        key = self.key(url, key)
+        path = self.get(key)
+        if path and not revalidate:
+            LOG.info("Entry %s for %s found in the cache", key, url)
+            return open(path, "rb"), None
+
+        headers = {}
+        if path:
+            metadata = self.metadata(key)
+            if metadata.get("etag"):
+                headers["If-None-Match"] = metadata["etag"]
+            if metadata.get("last-modified"):
+                headers["If-Modified-Since"] = metadata["last-modified"]
+
+        opener = opener or imagestream.open_url
+        fileobj = opener(url, headers=headers)
+        if fileobj is None:
+            LOG.info("Entry %s for %s not modified", key, url)
+            return open(path, "rb"), None
+
+        metadata = {
+            "url": url,
+            "etag": fileobj.headers.get("ETag"),
+            "last-modified": fileobj.headers.get("Last-Modified"),
+        }
+        return fileobj, self.new(key, metadata)
+
+    def fetch(self, url):
+        """Fetch the content of a small file, like the checksum file"""
+        fileobj, entry = self.open(url)
+        try:
+            content = fileobj.read()
+        except OSError as e:
+            if entry:
+                entry.abort()
+            raise imagestream.StreamException("Error reading {}: {}".format(url, e))
+        finally:
+            fileobj.close()
+        if entry:
+            entry.write(content)
+            entry.commit()
+        return content.decode()
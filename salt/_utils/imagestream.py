@@ -0,0 +1,1779 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Alberto Planas <aplanas@suse.com>
+#
+# Copyright 2019 SUSE LLC.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import bz2
+import collections
+import concurrent.futures
+import errno
+import fcntl
+import functools
+import hashlib
+import http.client
+import itertools
+import logging
+import lzma
+import mmap
+import os
+import queue
+import re
+import shutil
+import stat
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import xml.etree.ElementTree as ET
+import zlib
+
+LOG = logging.getLogger(__name__)
+
+# Size of the reads from the source, and of the writes into the
+# device. Big chunks amortize the cost of the Python loop and of the
+# syscalls.
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# O_DIRECT requires that the buffer address, the offset and the size
+# of each write are aligned to the logical block size of the device.
+ALIGNMENT = 4096
+
+# Number of chunks that can be waiting between two stages of the
+# pipeline
+QUEUE_DEPTH = 4
+
+# Valid modes for the zero blocks found in a sparse image. In "skip"
+# mode the blocks are not written, as the device is expected to be
+# already zeroed (or discarded). In "zeroout" and "discard" mode the
+# ranges are converted into BLKZEROOUT and BLKDISCARD requests.
+SPARSE_MODES = ("skip", "zeroout", "discard")
+
+# From linux/fs.h
+BLKDISCARD = 0x1277
+BLKZEROOUT = 0x127F
+
+# Kind of operations that can be send to the writer. SKIP is used to
+# jump over ranges that do not need to be written (like the unmapped
+# blocks of a bmap file), and ZERO for the ranges of zeros found in
+# the image.
+DATA = "data"
+ZERO = "zero"
+SKIP = "skip"
+
+# Supported compression formats, and the magic bytes at the start of
+# each one
+COMPRESSIONS = ("gz", "bz2", "xz", "zst", "lz4")
+MAGIC = {
+    b"\x1f\x8b": "gz",
+    b"BZh": "bz2",
+    b"\xfd7zXZ\x00": "xz",
+    b"\x28\xb5\x2f\xfd": "zst",
+    b"\x04\x22\x4d\x18": "lz4",
+}
+
+# External decompressors. zstd and lz4 are always decompressed by an
+# external process, the other formats only if threads are requested
+# (and the tool is available), as they can use many cores: pigz uses
+# separated threads for reading, writing and checking, lbzip2
+# decompress the bzip2 blocks in parallel, and xz the blocks of
+# multi-block images (like the ones created with `xz -T0`).
+DECOMPRESSORS = {
+    "gz": ["pigz", "-d", "-c", "-p", "{threads}"],
+    "bz2": ["lbzip2", "-d", "-c", "-n", "{threads}"],
+    "xz": ["xz", "-d", "-c", "-T", "{threads}"],
+    "zst": ["zstd", "-d", "-c", "-q"],
+    "lz4": ["lz4", "-d", "-c", "-q"],
+}
+
+# Used blocks images store only the blocks allocated by the
+# filesystem. The header (magic, block size, size of the filesystem,
+# number of blocks and number of used blocks) is followed by a bitmap
+# with one bit per block (least significant bit first), and by the
+# content of the used blocks.
+USED_BLOCKS_MAGIC = b"YOMIUB01"
+USED_BLOCKS_HEADER = struct.Struct("<8sI4xQQQ")
+
+# Schemes that can be opened by `urllib`
+NATIVE_SCHEME = ("file", "ftp", "http", "https")
+
+TIMEOUT = 60
+
+# Minimal number of seconds between two progress reports
+PROGRESS_INTERVAL = 5
+
+# Schemes that can be fetched with concurrent Range requests
+RANGED_SCHEME = ("http", "https")
+
+# Size of each Range request. Up to two segments per connection are
+# requested ahead, and kept in memory until they are consumed.
+SEGMENT_SIZE = 8 * 1024 * 1024
+
+# Consecutive failures allowed while fetching a segment, and seconds
+# to wait (multiplied by the number of failures) before resuming
+RETRIES = 5
+RETRY_DELAY = 1
+
+# Size of the blocks hashed while the image is written, and read back
+# from the device during the verification
+VERIFY_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Number of concurrent reads used to verify a device
+VERIFY_WORKERS = 4
+
+# In adaptive mode, a request to the server is slow if the time to
+# the first byte is LATENCY_FACTOR times the usual one (a moving
+# average with LATENCY_WEIGHT for the new requests), and is more
+# than MIN_LATENCY seconds. The rate is never reduced under the
+# maximum rate divided by MIN_RATE_DIVISOR. After each request that
+# is not slow, the rate grows by RATE_STEP times the maximum rate.
+LATENCY_FACTOR = 4
+LATENCY_WEIGHT = 0.2
+MIN_LATENCY = 0.05
+MIN_RATE_DIVISOR = 16
+RATE_STEP = 0.05
+
+
+class StreamException(Exception):
+    pass
+
+
+class _End:
+    """Mark the end of the data in a queue"""
+
+
+class _Error:
+    """Transport an exception from a stage to the next one"""
+
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def threaded(iterable, depth=QUEUE_DEPTH):
+    """Consume an iterable in a background thread.
+
+    This is the glue between the stages of the pipeline. The
+    compression modules, hashlib and the I/O syscalls release the GIL
+    for big buffers, so each stage can run in parallel.
+
+    """
+    items = queue.Queue(depth)
+    stop = threading.Event()
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run():
+        try:
+            for item in iterable:
+                if not _put(item):
+                    return
+        except Exception as e:
+            _put(_Error(e))
+        else:
+            _put(_End)
+        finally:
+            # Propagate the stop to the previous stages
+            if hasattr(iterable, "close"):
+                iterable.close()
+
+    thread = threading.Thread(target=_run, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _End:
+                break
+            if isinstance(item, _Error):
+                raise item.exception
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def open_url(url, timeout=TIMEOUT, headers=None, limiter=None):
+    """Open an URL for reading and return a file like object
+
+    If `headers` contains conditional headers (like If-None-Match)
+    and the resource was not modified, None is returned. The latency
+    of the request is reported to the `limiter`, if any.
+
+    """
+    request = urllib.request.Request(url, headers=headers or {})
+    start = time.monotonic()
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        if e.code == 304 and headers:
+            return None
+        if limiter:
+            limiter.backoff()
+        raise StreamException("Error opening {}: {}".format(url, e))
+    except (urllib.error.URLError, OSError) as e:
+        if limiter:
+            limiter.backoff()
+        raise StreamException("Error opening {}: {}".format(url, e))
+    if limiter:
+        limiter.observe(time.monotonic() - start)
+    return response
+
+
+class RateLimiter:
+    """Limit the rate of the reads from the source
+
+    In adaptive mode the rate is halved when a request is slow or
+    fails, as this is a signal of a busy server, and increased in
+    small steps up to the maximum rate when the requests are fast
+    again. Only the time to the first byte of each request is
+    observed, as the time of the reads depends on the buffers and on
+    the pacing of the limiter itself.
+
+    """
+
+    def __init__(self, rate, adaptive=False):
+        self.max_rate = rate
+        self.min_rate = rate / MIN_RATE_DIVISOR
+        self.rate = rate
+        self.adaptive = adaptive
+        self.backoffs = 0
+        self.latency = None
+        self.next_read = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        """Wait until `size` bytes can be read under the rate"""
+        with self.lock:
+            now = time.monotonic()
+            self.next_read = max(self.next_read, now)
+            delay = self.next_read - now
+            self.next_read += size / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+    def observe(self, seconds):
+        """Adapt the rate to the latency of a request to the server"""
+        if not self.adaptive:
+            return
+        with self.lock:
+            usual = self.latency
+            if usual is None:
+                self.latency = seconds
+                return
+            self.latency = usual + LATENCY_WEIGHT * (seconds - usual)
+            if seconds > LATENCY_FACTOR * max(usual, MIN_LATENCY):
+                self._backoff()
+            else:
+                self.rate = min(self.rate + self.max_rate * RATE_STEP, self.max_rate)
+
+    def _backoff(self):
+        self.rate = max(self.rate / 2, self.min_rate)
+        self.backoffs += 1
+        LOG.info("Reducing the rate to %s MB/s", round(self.rate / 1000**2, 2))
+
+    def backoff(self):
+        """Reduce the rate after an error"""
+        if self.adaptive:
+            with self.lock:
+                self._backoff()
+
+    def as_dict(self):
+        return {
+            "max_rate": round(self.max_rate / 1000**2, 2),
+            "rate": round(self.rate / 1000**2, 2),
+            "backoffs": self.backoffs,
+        }
+
+
+def read_chunks(fileobj, chunk_size=CHUNK_SIZE, stats=None, tee=None, limiter=None):
+    """Read a file like object in chunks
+
+    If `tee` is set, the chunks are also written there. If `limiter`
+    is set, the reads are paced by this `RateLimiter`.
+
+    """
+    try:
+        while True:
+            chunk = fileobj.read(chunk_size)
+            if not chunk:
+                break
+            if limiter:
+                limiter.consume(len(chunk))
+            if stats:
+                stats.read += len(chunk)
+            if tee:
+                tee.write(chunk)
+            yield chunk
+    except OSError as e:
+        raise StreamException("Error reading the image: {}".format(e))
+    finally:
+        fileobj.close()
+
+
+def _probe_ranges(url, timeout, headers, limiter=None):
+    """Check if the server supports Range requests
+
+    Returns a tuple with the response of the probe and the size of
+    the resource. If ranges are not supported, the response is the
+    full content of the resource and the size is None.
+
+    """
+    probe = dict(headers)
+    probe["Range"] = "bytes=0-0"
+    response = open_url(url, timeout, probe, limiter)
+    if response is None or response.status != 206:
+        return response, None
+    response.close()
+    size = response.headers.get("Content-Range", "").split("/")[-1]
+    if not size.isdigit() or not int(size):
+        # Unknown or empty size, read it again in full
+        return open_url(url, timeout, headers, limiter), None
+    return response, int(size)
+
+
+def fetch_range(url, start, end, timeout, validator=None, limiter=None):
+    """Fetch the bytes [start, end) of an URL
+
+    If the connection fails, the request is resumed from the last
+    byte received, as long as the server returns the same version of
+    the resource. The latency of every request and every failure are
+    reported to the `limiter`, if any.
+
+    """
+    data = bytearray()
+    failures = 0
+    while start + len(data) < end:
+        offset = start + len(data)
+        headers = {"Range": "bytes={}-{}".format(offset, end - 1)}
+        if validator:
+            headers["If-Range"] = validator
+        request = urllib.request.Request(url, headers=headers)
+        error = "connection closed"
+        try:
+            request_start = time.monotonic()
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                if limiter:
+                    limiter.observe(time.monotonic() - request_start)
+                content_range = response.headers.get("Content-Range", "")
+                if response.status != 206 or not content_range.startswith(
+                    "bytes {}-".format(offset)
+                ):
+                    raise StreamException(
+                        "Image {} changed during the download".format(url)
+                    )
+                while start + len(data) < end:
+                    piece = response.read(min(CHUNK_SIZE, end - start - len(data)))
+                    if not piece:
+                        break
+                    data += piece
+                    failures = 0
+        except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+            error = e
+
+        if start + len(data) < end:
+            failures += 1
+            if limiter:
+                limiter.backoff()
+            if failures > RETRIES:
+                raise StreamException(
+                    "Error fetching bytes {}-{} of {}: {}".format(
+                        start + len(data), end - 1, url, error
+                    )
+                )
+            time.sleep(RETRY_DELAY * failures)
+    return bytes(data)
+
+
+class RangedReader:
+    """File like object that fetch an URL with concurrent Range requests
+
+    The segments are requested in parallel by a pool of connections,
+    and are returned in order. Every segment is retried and resumed
+    independently, so a dropped connection does not restart the
+    download.
+
+    """
+
+    def __init__(self, url, size, connections, headers, timeout=TIMEOUT, limiter=None):
+        self.url = url
+        self.size = size
+        self.headers = headers
+        self.timeout = timeout
+        self.limiter = limiter
+        # The ETag (or the date) is used with If-Range, so all the
+        # segments are from the same version of the resource
+        self.validator = headers.get("ETag") or headers.get("Last-Modified")
+        self.segments = iter(range(0, size, SEGMENT_SIZE))
+        self.pool = concurrent.futures.ThreadPoolExecutor(connections)
+        self.pending = collections.deque()
+        for _ in range(2 * connections):
+            self._request()
+        self.buffer = b""
+        self.position = 0
+
+    def _request(self):
+        start = next(self.segments, None)
+        if start is not None:
+            end = min(start + SEGMENT_SIZE, self.size)
+            self.pending.append(
+                self.pool.submit(
+                    fetch_range,
+                    self.url,
+                    start,
+                    end,
+                    self.timeout,
+                    self.validator,
+                    self.limiter,
+                )
+            )
+
+    def read(self, size=-1):
+        if self.position == len(self.buffer):
+            if not self.pending:
+                return b""
+            self.buffer = self.pending.popleft().result()
+            self.position = 0
+            self._request()
+        if size < 0:
+            size = len(self.buffer)
+        data = self.buffer[self.position : self.position + size]
+        self.position += len(data)
+        return data
+
+    def close(self):
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.pool.shutdown(wait=False)
+
+
+def open_ranged(url, timeout=TIMEOUT, headers=None, connections=4, limiter=None):
+    """Open an URL for reading using concurrent Range requests
+
+    If the server does not support ranges, a normal response is
+    returned. As with `open_url`, None is returned if the resource
+    was not modified.
+
+    """
+    response, size = _probe_ranges(url, timeout, headers or {}, limiter)
+    if not size:
+        return response
+    return RangedReader(url, size, connections, response.headers, timeout, limiter)
+
+
+def _decompress_lzma_like(factory, chunks, chunk_size):
+    """Decompress a sequence of chunks using a lzma-like decompressor"""
+    decompressor = factory()
+    for chunk in chunks:
+        # Multiple concatenated streams are valid (pbzip2, pxz)
+        if decompressor.eof:
+            decompressor = factory()
+        while True:
+            data = decompressor.decompress(chunk, chunk_size)
+            chunk = b""
+            if data:
+                yield data
+            if decompressor.eof:
+                chunk = decompressor.unused_data
+                if not chunk:
+                    break
+                decompressor = factory()
+            elif decompressor.needs_input:
+                break
+    if not decompressor.eof:
+        raise StreamException("Compressed image is truncated")
+
+
+def _decompress_zlib(chunks, chunk_size):
+    """Decompress a sequence of chunks of a gzip stream"""
+
+    def _factory():
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    decompressor = _factory()
+    for chunk in chunks:
+        # Multiple concatenated members are valid (pigz)
+        if decompressor.eof:
+            decompressor = _factory()
+        while True:
+            data = decompressor.decompress(chunk, chunk_size)
+            chunk = decompressor.unconsumed_tail
+            if data:
+                yield data
+            if decompressor.eof:
+                chunk = decompressor.unused_data
+                if not chunk:
+                    break
+                decompressor = _factory()
+            elif not chunk and len(data) < chunk_size:
+                # If the output buffer was filled, zlib can still
+                # have pending data
+                break
+    if not decompressor.eof:
+        raise StreamException("Compressed image is truncated")
+
+
+def _decompress_external(cmd, chunks, chunk_size):
+    """Decompress a sequence of chunks using an external process"""
+    # stderr is a file, so the process cannot be blocked by it
+    with tempfile.TemporaryFile() as stderr:
+        try:
+            process = subprocess.Popen(
+                cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr
+            )
+        except OSError as e:
+            raise StreamException("Error running {}: {}".format(cmd[0], e))
+
+        def _feed():
+            try:
+                for chunk in chunks:
+                    process.stdin.write(chunk)
+            except (BrokenPipeError, ValueError):
+                # The process is dead, the error is reported later
+                pass
+            except Exception as e:
+                feed_error.append(e)
+            finally:
+                try:
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+
+        feed_error = []
+        feeder = threading.Thread(target=_feed, daemon=True)
+        feeder.start()
+        try:
+            while True:
+                data = process.stdout.read(chunk_size)
+                if not data:
+                    break
+                yield data
+            process.wait()
+            feeder.join()
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+
+        if feed_error:
+            raise feed_error[0]
+        if process.returncode:
+            stderr.seek(0)
+            raise StreamException(
+                "{} failed: {}".format(cmd[0], stderr.read().decode().strip())
+            )
+
+
+def external_decompressor(compression, threads=None):
+    """Return the command of the external decompressor, if available"""
+    cmd = DECOMPRESSORS.get(compression)
+    if not cmd or not shutil.which(cmd[0]):
+        return None
+    threads = str(threads or os.cpu_count() or 1)
+    return [arg.format(threads=threads) for arg in cmd]
+
+
+def detect_compression(data):
+    """Detect the compression format using the magic bytes"""
+    for magic, compression in MAGIC.items():
+        if data.startswith(magic):
+            return compression
+    return None
+
+
+def decompress(chunks, compression=None, chunk_size=CHUNK_SIZE, threads=None):
+    """Decompress a sequence of chunks
+
+    The size of each decompressed chunk is bounded by `chunk_size`,
+    so images full of zeros do not blow the memory.
+
+    If `threads` is set, a multithreaded external decompressor is
+    used when available. A value of 0 means all the CPUs.
+
+    """
+    if compression and compression not in COMPRESSIONS:
+        raise StreamException("Compression {} not supported".format(compression))
+
+    cmd = None
+    if compression in ("zst", "lz4") or (compression and threads is not None):
+        cmd = external_decompressor(compression, threads)
+        if not cmd and compression in ("zst", "lz4"):
+            raise StreamException("Decompressor for {} not found".format(compression))
+
+    try:
+        if not compression:
+            yield from chunks
+        elif cmd:
+            yield from _decompress_external(cmd, chunks, chunk_size)
+        elif compression == "gz":
+            yield from _decompress_zlib(chunks, chunk_size)
+        elif compression == "bz2":
+            yield from _decompress_lzma_like(bz2.BZ2Decompressor, chunks, chunk_size)
+        else:
+            yield from _decompress_lzma_like(lzma.LZMADecompressor, chunks, chunk_size)
+    except (zlib.error, lzma.LZMAError, OSError, EOFError) as e:
+        raise StreamException("Error decompressing the image: {}".format(e))
+
+
+class Digests:
+    """Compute several digests of a stream in a single pass
+
+    With more than one algorithm, each digest is updated in its own
+    thread from a bounded queue, as hashlib releases the GIL for big
+    buffers. The chunks are shared, not copied.
+
+    """
+
+    def __init__(self, checksum_types, depth=QUEUE_DEPTH):
+        try:
+            self.hashes = {
+                checksum_type: hashlib.new(checksum_type)
+                for checksum_type in checksum_types
+            }
+        except ValueError as e:
+            raise StreamException("Checksum not supported: {}".format(e))
+        self.queues = []
+        self.threads = []
+        if len(self.hashes) > 1:
+            for hash_ in self.hashes.values():
+                items = queue.Queue(depth)
+                thread = threading.Thread(
+                    target=self._run, args=(hash_, items), daemon=True
+                )
+                thread.start()
+                self.queues.append(items)
+                self.threads.append(thread)
+
+    @staticmethod
+    def _run(hash_, items):
+        for chunk in iter(items.get, _End):
+            hash_.update(chunk)
+
+    def update(self, chunk):
+        if self.queues:
+            for items in self.queues:
+                items.put(chunk)
+        else:
+            for hash_ in self.hashes.values():
+                hash_.update(chunk)
+
+    def close(self):
+        """Wait until all the pending chunks are hashed"""
+        for items in self.queues:
+            items.put(_End)
+        for thread in self.threads:
+            thread.join()
+        self.queues = []
+        self.threads = []
+
+    def hexdigests(self):
+        self.close()
+        return {
+            checksum_type: hash_.hexdigest()
+            for checksum_type, hash_ in self.hashes.items()
+        }
+
+
+class Stats:
+    """Counters of a streaming operation"""
+
+    def __init__(self):
+        self.read = 0
+        self.size = 0
+        self.written = 0
+        self.skipped = 0
+        # Expected size of the source, if known
+        self.total = None
+        self.start = time.monotonic()
+        self.end = None
+
+    def stop(self):
+        self.end = time.monotonic()
+
+    @property
+    def seconds(self):
+        return (self.end or time.monotonic()) - self.start
+
+    @property
+    def throughput(self):
+        """Throughput of the uncompressed stream in MB/s"""
+        seconds = self.seconds
+        return self.size / seconds / 1e6 if seconds else 0.0
+
+    @property
+    def eta(self):
+        """Estimated seconds until the full source is read"""
+        if not self.total or not self.read:
+            return None
+        return max(self.total - self.read, 0) * self.seconds / self.read
+
+    def progress(self):
+        """Report of a streaming operation still in progress"""
+        eta = self.eta
+        return {
+            "read": self.read,
+            "total": self.total,
+            "size": self.size,
+            "written": self.written,
+            "throughput": round(self.throughput, 2),
+            "eta": round(eta) if eta is not None else None,
+        }
+
+    def as_dict(self):
+        return {
+            "read": self.read,
+            "size": self.size,
+            "written": self.written,
+            "skipped": self.skipped,
+            "seconds": round(self.seconds, 3),
+            "throughput": round(self.throughput, 2),
+        }
+
+
+class Writer:
+    """Write a stream into a device using big aligned writes"""
+
+    def __init__(
+        self, path, direct=False, buffer_size=CHUNK_SIZE, stats=None, sparse=None
+    ):
+        if buffer_size % ALIGNMENT:
+            raise StreamException("Buffer size needs to be aligned")
+        if sparse and sparse not in SPARSE_MODES:
+            raise StreamException("Sparse mode {} not valid".format(sparse))
+        flags = os.O_WRONLY
+        if direct:
+            flags |= os.O_DIRECT
+        try:
+            self.fd = os.open(path, flags)
+        except OSError as e:
+            raise StreamException("Error opening {}: {}".format(path, e))
+        self.path = path
+        self.direct = direct
+        self.stats = stats
+        self.sparse = sparse
+        self.block = stat.S_ISBLK(os.fstat(self.fd).st_mode)
+        # An anonymous map is page aligned, as required by O_DIRECT
+        self.buffer = mmap.mmap(-1, buffer_size)
+        self.view = memoryview(self.buffer)
+        self.fill = 0
+        self.offset = 0
+
+    def _pwrite(self, view):
+        """Write the full view at the current offset"""
+        while view:
+            try:
+                size = os.pwrite(self.fd, view, self.offset)
+            except OSError as e:
+                raise StreamException("Error writing into {}: {}".format(self.path, e))
+            view = view[size:]
+            self.offset += size
+            if self.stats:
+                self.stats.written += size
+
+    def _flush(self):
+        if not self.fill:
+            return
+        if self.direct and self.fill % ALIGNMENT:
+            # The tail of the image can be unaligned, so we drop
+            # O_DIRECT for the last write
+            flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+            fcntl.fcntl(self.fd, fcntl.F_SETFL, flags & ~os.O_DIRECT)
+            self.direct = False
+        self._pwrite(self.view[: self.fill])
+        self.fill = 0
+
+    def write(self, data):
+        data = memoryview(data)
+        size = len(self.buffer)
+        while data:
+            length = min(len(data), size - self.fill)
+            self.view[self.fill : self.fill + length] = data[:length]
+            self.fill += length
+            data = data[length:]
+            if self.fill == size:
+                self._flush()
+
+    def _zero_file(self, length):
+        """Zero a range in a regular file"""
+        # Past the end of the file we can leave a hole, that will be
+        # created when the file is extended
+        size = os.fstat(self.fd).st_size
+        length = min(length, size - self.offset)
+        offset = self.offset
+        zeros = bytes(min(length, len(self.buffer))) if length > 0 else b""
+        while length > 0:
+            view = memoryview(zeros)[:length]
+            size = os.pwrite(self.fd, view, offset)
+            offset += size
+            length -= size
+            if self.stats:
+                self.stats.written += size
+
+    def skip(self, length):
+        """Advance the device without writing"""
+        self._flush()
+        self.offset += length
+        if self.stats:
+            self.stats.skipped += length
+
+    def zero(self, length):
+        """Advance the device over a range of zeros"""
+        self._flush()
+        if self.sparse in ("zeroout", "discard"):
+            try:
+                if self.block:
+                    request = BLKZEROOUT if self.sparse == "zeroout" else BLKDISCARD
+                    fcntl.ioctl(
+                        self.fd, request, struct.pack("QQ", self.offset, length)
+                    )
+                else:
+                    self._zero_file(length)
+            except OSError as e:
+                raise StreamException(
+                    "Error in {} of a range in {}: {}".format(self.sparse, self.path, e)
+                )
+        self.skip(length)
+
+    def close(self):
+        if self.fd is None:
+            return
+        try:
+            self._flush()
+            if not self.block and os.fstat(self.fd).st_size < self.offset:
+                # Materialize the final range of zeros as a hole
+                os.ftruncate(self.fd, self.offset)
+            os.fsync(self.fd)
+        except OSError as e:
+            raise StreamException("Error syncing {}: {}".format(self.path, e))
+        finally:
+            self.view.release()
+            self.buffer.close()
+            os.close(self.fd)
+            self.fd = None
+
+
+class PipeWriter:
+    """Write a stream into the standard input of a process
+
+    Used for the formats that are restored by a tool, like a btrfs
+    send stream. The stream cannot have holes, so it cannot be used
+    with a bmap or in sparse mode.
+
+    """
+
+    def __init__(self, cmd, stats=None):
+        self.cmd = cmd
+        self.path = cmd[0]
+        self.stats = stats
+        # stderr is a file, so the process cannot be blocked by it
+        self.stderr = tempfile.TemporaryFile()
+        try:
+            self.process = subprocess.Popen(
+                cmd,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=self.stderr,
+            )
+        except OSError as e:
+            self.stderr.close()
+            raise StreamException("Error running {}: {}".format(cmd[0], e))
+
+    def __str__(self):
+        return " ".join(self.cmd)
+
+    def _error(self):
+        self.stderr.seek(0)
+        return StreamException(
+            "{} failed: {}".format(self.path, self.stderr.read().decode().strip())
+        )
+
+    def write(self, data):
+        try:
+            self.process.stdin.write(data)
+        except BrokenPipeError:
+            self.process.wait()
+            raise self._error()
+        if self.stats:
+            self.stats.written += len(data)
+
+    def skip(self, length):
+        raise StreamException("A range cannot be skipped in {}".format(self.path))
+
+    zero = skip
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.process.wait()
+        try:
+            if self.process.returncode:
+                raise self._error()
+        finally:
+            self.stderr.close()
+            self.process = None
+
+
+def find_zeros(operations, block_size=ALIGNMENT):
+    """Split the data operations in data and zero ranges
+
+    Yields the operations (DATA, data) and (ZERO, length), and any
+    other operation as it is. Only full blocks that are aligned to
+    `block_size` (from the start of the stream) are considered for
+    the zero ranges, and consecutive ranges are merged.
+
+    """
+    zero_block = bytes(block_size)
+    offset = 0
+    zeros = 0
+    for operation, chunk in operations:
+        if operation != DATA:
+            if zeros:
+                yield ZERO, zeros
+                zeros = 0
+            yield operation, chunk
+            offset += chunk
+            continue
+
+        view = memoryview(chunk)
+        size = len(chunk)
+        data_start = 0
+        # Skip the first partial block
+        index = min(-offset % block_size, size)
+        while index + block_size <= size:
+            if not chunk.startswith(zero_block, index):
+                index += block_size
+                continue
+            end = index + block_size
+            while end + block_size <= size and chunk.startswith(zero_block, end):
+                end += block_size
+            if index > data_start:
+                if zeros:
+                    yield ZERO, zeros
+                    zeros = 0
+                yield DATA, view[data_start:index]
+            zeros += end - index
+            data_start = index = end
+        if data_start < size:
+            if zeros:
+                yield ZERO, zeros
+                zeros = 0
+            yield DATA, view[data_start:]
+        offset += size
+    if zeros:
+        yield ZERO, zeros
+
+
+class Bmap:
+    """Block map of an image, as generated by bmaptool"""
+
+    def __init__(self, image_size, block_size, checksum_type, ranges):
+        self.image_size = image_size
+        self.block_size = block_size
+        self.checksum_type = checksum_type
+        # List of tuples (first block, last block, checksum)
+        self.ranges = ranges
+
+    @property
+    def mapped(self):
+        """Number of mapped bytes"""
+        return sum(
+            min((last + 1) * self.block_size, self.image_size) - first * self.block_size
+            for first, last, _ in self.ranges
+        )
+
+
+def _bmap_text(root, tag, default=None):
+    element = root.find(tag)
+    if element is None or element.text is None:
+        if default is None:
+            raise StreamException("Element {} not found in bmap".format(tag))
+        return default
+    return element.text.strip()
+
+
+def parse_bmap(content):
+    """Parse the content of a bmap file
+
+    The versions 1.x and 2.x of the format are supported. If the file
+    contains its own checksum, it will be validated.
+
+    """
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    try:
+        root = ET.fromstring(content)
+    except ET.ParseError as e:
+        raise StreamException("Error parsing the bmap file: {}".format(e))
+
+    if root.tag != "bmap":
+        raise StreamException("Not a bmap file")
+    version = root.get("version", "1.0").strip()
+    major = version.split(".")[0]
+    if major not in ("1", "2"):
+        raise StreamException("bmap version {} not supported".format(version))
+
+    if major == "1":
+        checksum_type = "sha1"
+        file_checksum_tag = "BmapFileSHA1"
+        range_checksum_attr = "sha1"
+    else:
+        checksum_type = _bmap_text(root, "ChecksumType")
+        file_checksum_tag = "BmapFileChecksum"
+        range_checksum_attr = "chksum"
+
+    if checksum_type not in hashlib.algorithms_available:
+        raise StreamException("bmap checksum {} not supported".format(checksum_type))
+
+    file_checksum = _bmap_text(root, file_checksum_tag, "")
+    if file_checksum:
+        # The checksum was calculated with the field full of zeros
+        data = content.replace(file_checksum.encode(), b"0" * len(file_checksum))
+        if hashlib.new(checksum_type, data).hexdigest() != file_checksum:
+            raise StreamException("bmap file checksum mismatch")
+
+    try:
+        image_size = int(_bmap_text(root, "ImageSize"))
+        block_size = int(_bmap_text(root, "BlockSize"))
+        ranges = []
+        for element in root.iterfind("BlockMap/Range"):
+            first, _, last = element.text.strip().partition("-")
+            last = last if last else first
+            ranges.append((int(first), int(last), element.get(range_checksum_attr)))
+    except ValueError as e:
+        raise StreamException("Error parsing the bmap file: {}".format(e))
+
+    ranges.sort()
+    for (_, last, _), (first, _, _) in zip(ranges, ranges[1:]):
+        if first <= last:
+            raise StreamException("Overlapping ranges in the bmap file")
+
+    return Bmap(image_size, block_size, checksum_type, ranges)
+
+
+def bmap_filter(chunks, bmap):
+    """Filter a sequence of chunks, using a bmap
+
+    Yields the operations (DATA, data) for the mapped ranges, and
+    (SKIP, length) for the unmapped ones. The checksum of each range
+    is validated as soon as the range is complete.
+
+    """
+    # The last block of the image can be partial
+    ranges = [
+        (
+            first * bmap.block_size,
+            min((last + 1) * bmap.block_size, bmap.image_size),
+            checksum,
+        )
+        for first, last, checksum in bmap.ranges
+    ]
+    ranges.append((bmap.image_size, bmap.image_size, None))
+    ranges = iter(ranges)
+    start, end, checksum = next(ranges)
+    range_hash = hashlib.new(bmap.checksum_type)
+
+    offset = 0
+    for chunk in chunks:
+        size = len(chunk)
+        index = 0
+        while index < size:
+            position = offset + index
+            if position < start:
+                length = min(start - position, size - index)
+                yield SKIP, length
+            elif position >= end:
+                # Past the size of the image
+                length = size - index
+                yield SKIP, length
+            else:
+                length = min(end - position, size - index)
+                data = chunk[index : index + length]
+                range_hash.update(data)
+                yield DATA, data
+            index += length
+
+            if offset + index == end:
+                if checksum and range_hash.hexdigest() != checksum:
+                    raise StreamException(
+                        "Checksum mismatch in the block range {}-{}".format(
+                            start // bmap.block_size, (end - 1) // bmap.block_size
+                        )
+                    )
+                start, end, checksum = next(ranges, (end, end, None))
+                range_hash = hashlib.new(bmap.checksum_type)
+        offset += size
+
+    if offset != bmap.image_size:
+        raise StreamException(
+            "Image size {} do not match the bmap size {}".format(
+                offset, bmap.image_size
+            )
+        )
+
+
+# Runs of bytes of a bitmap with all the bits set or cleared, or a
+# single byte with mixed bits
+_BITMAP_RUNS = re.compile(rb"\x00+|\xff+|[^\x00\xff]")
+
+
+def _bitmap_pieces(bitmap):
+    for match in _BITMAP_RUNS.finditer(bitmap):
+        piece = match.group()
+        if piece[0] in (0x00, 0xFF):
+            yield piece[0] == 0xFF, 8 * len(piece)
+        else:
+            for bit in range(8):
+                yield bool(piece[0] >> bit & 1), 1
+
+
+def bitmap_runs(bitmap, blocks):
+    """Yields (used, first block, number of blocks) for each run of bits"""
+    block = 0
+    for used, pieces in itertools.groupby(_bitmap_pieces(bitmap), lambda p: p[0]):
+        count = min(sum(piece[1] for piece in pieces), blocks - block)
+        if count <= 0:
+            break
+        yield used, block, count
+        block += count
+
+
+def _set_bits(bitmap, start, end):
+    """Set the bits of the blocks in the range [start, end)"""
+    while start < end and start % 8:
+        bitmap[start // 8] |= 1 << start % 8
+        start += 1
+    full = (end - start) // 8
+    bitmap[start // 8 : start // 8 + full] = b"\xff" * full
+    start += 8 * full
+    while start < end:
+        bitmap[start // 8] |= 1 << start % 8
+        start += 1
+
+
+class _ChunkReader:
+    """Read exact lengths from a sequence of chunks"""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.chunk = b""
+        self.index = 0
+
+    def read(self, length):
+        """Yields the pieces of data, up to `length` bytes"""
+        while length:
+            if self.index == len(self.chunk):
+                self.chunk = next(self.chunks, None)
+                self.index = 0
+                if self.chunk is None:
+                    raise StreamException("Used blocks image truncated")
+            # A full chunk is not copied
+            data = self.chunk[self.index : self.index + length]
+            self.index += len(data)
+            length -= len(data)
+            yield data
+
+    def at_end(self):
+        if self.index < len(self.chunk):
+            return False
+        return not any(len(chunk) for chunk in self.chunks)
+
+
+def used_blocks_filter(chunks):
+    """Convert a used blocks image into operations
+
+    Yields the operations (DATA, data) for the used blocks, and (SKIP,
+    length) for the blocks that are not used by the filesystem.
+
+    """
+    reader = _ChunkReader(chunks)
+    header = b"".join(reader.read(USED_BLOCKS_HEADER.size))
+    magic, block_size, size, blocks, used = USED_BLOCKS_HEADER.unpack(header)
+    if magic != USED_BLOCKS_MAGIC:
+        raise StreamException("Not a used blocks image")
+    if not block_size or blocks != -(-size // block_size):
+        raise StreamException("Header of the used blocks image not valid")
+    bitmap = b"".join(reader.read(-(-blocks // 8)))
+
+    stored = 0
+    for used_run, first, count in bitmap_runs(bitmap, blocks):
+        # The last block can be partial
+        length = min(count * block_size, size - first * block_size)
+        if used_run:
+            stored += count
+            for data in reader.read(length):
+                yield DATA, data
+        else:
+            yield SKIP, length
+
+    if stored != used or not reader.at_end():
+        raise StreamException("Size of the used blocks image not valid")
+
+
+def _data_extents(fd, size):
+    """Yields the ranges (start, end) with data in a sparse file"""
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # Only a hole until the end of the file
+                break
+            raise
+        offset = os.lseek(fd, start, os.SEEK_HOLE)
+        yield start, min(offset, size)
+
+
+def create_used_blocks(image, output, block_size=ALIGNMENT):
+    """Create a used blocks image from a filesystem image
+
+    A block is used if is allocated in the image file, so the free
+    space of the filesystem needs to be discarded before (that for a
+    file means punching holes in it).
+
+    Returns a dictionary with the size of the filesystem, the number of
+    blocks and the number of used blocks.
+
+    """
+    try:
+        fd = os.open(image, os.O_RDONLY)
+    except OSError as e:
+        raise StreamException("Error opening {}: {}".format(image, e))
+
+    try:
+        size = os.fstat(fd).st_size
+        blocks = -(-size // block_size)
+        bitmap = bytearray(-(-blocks // 8))
+        for start, end in _data_extents(fd, size):
+            _set_bits(bitmap, start // block_size, -(-end // block_size))
+        runs = [run for run in bitmap_runs(bitmap, blocks) if run[0]]
+        used = sum(count for _, _, count in runs)
+
+        with open(output, "wb") as f:
+            f.write(
+                USED_BLOCKS_HEADER.pack(
+                    USED_BLOCKS_MAGIC, block_size, size, blocks, used
+                )
+            )
+            f.write(bitmap)
+            for _, first, count in runs:
+                offset = first * block_size
+                end = min((first + count) * block_size, size)
+                while offset < end:
+                    data = os.pread(fd, min(CHUNK_SIZE, end - offset), offset)
+                    if not data:
+                        raise StreamException("Image {} truncated".format(image))
+                    f.write(data)
+                    offset += len(data)
+    except OSError as e:
+        raise StreamException("Error creating {}: {}".format(output, e))
+    finally:
+        os.close(fd)
+
+    return {"size": size, "blocks": blocks, "used": used}
+
+
+def source_size(fileobj):
+    """Return the size of a file like object, if known"""
+    if isinstance(fileobj, RangedReader):
+        return fileobj.size
+    headers = getattr(fileobj, "headers", None)
+    if headers is not None:
+        length = headers.get("Content-Length")
+        return int(length) if length and length.isdigit() else None
+    try:
+        return os.fstat(fileobj.fileno()).st_size
+    except (AttributeError, OSError):
+        return None
+
+
+def dispatch(operations, writer):
+    """Send the operations of the stream to a writer"""
+    for operation, value in operations:
+        if operation == DATA:
+            writer.write(value)
+        elif operation == ZERO:
+            writer.zero(value)
+        else:
+            writer.skip(value)
+
+
+def fan_out(operations, writers, depth=QUEUE_DEPTH):
+    """Send the same operations to several writers in parallel
+
+    Every writer consumes the operations from its own queue in a
+    different thread, and is closed at the end. The data of the
+    operations is shared, not copied.
+
+    A failing writer does not stop the others. Returns a dictionary
+    with the exception of each writer that failed.
+
+    """
+    errors = {}
+
+    def _run(writer, items):
+        try:
+            dispatch(iter(items.get, _End), writer)
+        except Exception as e:
+            errors[writer] = e
+            # Keep consuming, so the other writers are not blocked
+            while items.get() is not _End:
+                pass
+        finally:
+            try:
+                writer.close()
+            except Exception as e:
+                errors.setdefault(writer, e)
+
+    queues = []
+    threads = []
+    for writer in writers:
+        items = queue.Queue(depth)
+        thread = threading.Thread(target=_run, args=(writer, items), daemon=True)
+        thread.start()
+        queues.append(items)
+        threads.append(thread)
+
+    try:
+        for operation in operations:
+            if len(errors) == len(queues):
+                # All the writers failed, there is no need to continue
+                break
+            for items in queues:
+                items.put(operation)
+    finally:
+        for items in queues:
+            items.put(_End)
+        for thread in threads:
+            thread.join()
+    return errors
+
+
+class BlockHashes:
+    """Hashes of the blocks sent to the devices
+
+    The written ranges are split in blocks aligned to `block_size`
+    (from the start of the stream), and each block is recorded as a
+    tuple (offset, length, digest). The ranges of zeros are recorded
+    without digest, and the skipped ranges are not recorded.
+
+    """
+
+    def __init__(self, block_size=VERIFY_BLOCK_SIZE):
+        self.block_size = block_size
+        self.blocks = []
+        self.offset = 0
+        self._start = None
+        self._hash = None
+
+    def _close_block(self):
+        if self._hash:
+            length = self.offset - self._start
+            self.blocks.append((self._start, length, self._hash.digest()))
+            self._hash = None
+
+    def _data(self, data):
+        view = memoryview(data)
+        while view:
+            if not self._hash:
+                self._start = self.offset
+                self._hash = hashlib.blake2b(digest_size=16)
+            length = min(len(view), self.block_size - self.offset % self.block_size)
+            self._hash.update(view[:length])
+            self.offset += length
+            view = view[length:]
+            if not self.offset % self.block_size:
+                self._close_block()
+
+    def record(self, operations):
+        """Record the operations while they are sent to the writers"""
+        for operation, value in operations:
+            if operation == DATA:
+                self._data(value)
+            else:
+                self._close_block()
+                if operation == ZERO:
+                    self.blocks.append((self.offset, value, None))
+                self.offset += value
+            yield operation, value
+        self._close_block()
+
+
+@functools.lru_cache(maxsize=8)
+def _zero_digest(length):
+    return hashlib.blake2b(bytes(length), digest_size=16).digest()
+
+
+def _split_blocks(blocks, block_size):
+    """Split the ranges of zeros in aligned blocks"""
+    for offset, length, digest in blocks:
+        if digest is not None:
+            yield offset, length, digest
+            continue
+        end = offset + length
+        while offset < end:
+            length = min(end - offset, block_size - offset % block_size)
+            yield offset, length, _zero_digest(length)
+            offset += length
+
+
+def _read_block(fd, view, offset, length):
+    """Read a range using aligned reads, returns the hash of the data"""
+    start = offset - offset % ALIGNMENT
+    end = offset + length
+    end += -end % ALIGNMENT
+    read = 0
+    while start + read < end:
+        size = os.preadv(fd, [view[read : end - start]], start + read)
+        if not size:
+            break
+        read += size
+    if read < offset - start + length:
+        # The device is shorter than the image
+        return None
+    return hashlib.blake2b(
+        view[offset - start : offset - start + length], digest_size=16
+    ).digest()
+
+
+def read_back(path, blocks, block_size=VERIFY_BLOCK_SIZE, workers=VERIFY_WORKERS):
+    """Read back from a device the blocks recorded by `BlockHashes`
+
+    The blocks are read with O_DIRECT (or after dropping the page
+    cache of the device, if O_DIRECT is not supported) by several
+    workers in parallel.
+
+    Returns the offset of the first block that does not match, or
+    None if all the blocks are valid.
+
+    """
+    try:
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_DIRECT)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            fd = os.open(path, os.O_RDONLY)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    except OSError as e:
+        raise StreamException("Error opening {}: {}".format(path, e))
+
+    tasks = _split_blocks(blocks, block_size)
+    lock = threading.Lock()
+    bad = []
+
+    def _worker():
+        # The blocks can start in the middle of an aligned block
+        buffer = mmap.mmap(-1, block_size + 2 * ALIGNMENT)
+        view = memoryview(buffer)
+        try:
+            while True:
+                with lock:
+                    # The tasks are sorted by offset, so after a
+                    # failure the next ones are not needed
+                    task = None if bad else next(tasks, None)
+                if not task:
+                    break
+                offset, length, digest = task
+                try:
+                    valid = _read_block(fd, view, offset, length) == digest
+                except OSError as e:
+                    LOG.error("Error reading %s at offset %s: %s", path, offset, e)
+                    valid = False
+                if not valid:
+                    with lock:
+                        bad.append(offset)
+        finally:
+            view.release()
+            buffer.close()
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            for future in [executor.submit(_worker) for _ in range(workers)]:
+                future.result()
+    finally:
+        os.close(fd)
+    return min(bad) if bad else None
+
+
+def _raise_errors(writers, errors):
+    """Fail if none of the writers succeeded"""
+    if len(errors) == len(writers):
+        raise StreamException(
+            "; ".join(
+                "{}: {}".format(path, errors[writer])
+                for path, writer in writers.items()
+            )
+        )
+
+
+def copy(
+    url,
+    device,
+    compression=None,
+    checksum_type="md5",
+    chunk_size=CHUNK_SIZE,
+    direct=False,
+    sparse=None,
+    bmap=None,
+    cache=None,
+    cache_key=None,
+    expected_checksum=None,
+    connections=None,
+    threads=None,
+    progress=None,
+    verify=False,
+    opener=None,
+    rate=None,
+    adaptive=False,
+):
+    """Stream an image from an URL into a device
+
+    The image is read in chunks, decompressed, hashed and written in
+    a pipeline of threads.
+
+    Returns a dictionary with the checksum of the (uncompressed)
+    image and the statistics of the copy.
+
+    `checksum_type` can also be a list of algorithms, and all the
+    digests are computed in the same pass and returned in the
+    "checksums" dictionary. The first one is the main "checksum".
+
+    `device` can also be a `PipeWriter`, or a list of devices. The
+    image is fetched and decompressed once, and written in all the
+    devices in parallel. The result contains a "devices" dictionary
+    with the statistics and the checksum (or the error) for each
+    device.
+
+    If `sparse` is set, the blocks full of zeros are not written, but
+    skipped or converted into discard / zero out requests.
+
+    If a `Bmap` is provided, only the mapped ranges are written and
+    validated.
+
+    Used blocks images (see `create_used_blocks`) are detected from the
+    magic bytes, and only the used blocks are written.
+
+    If a `Cache` is provided, the image is read from there if is
+    present, or stored while is downloaded. If `cache_key` is not
+    set, the entry is addressed by the URL and revalidated with the
+    server. The new entry is only stored if the image matches the
+    `expected_checksum`, if any, and a cached image that does not
+    match it is removed from the cache.
+
+    If `connections` is set, HTTP and HTTPS images are fetched with
+    this number of concurrent Range requests.
+
+    The compression format is detected from the magic bytes of the
+    image, and `compression` is only used if the format is not
+    recognized. If `threads` is set, a multithreaded decompressor is
+    used if available.
+
+    If `progress` is set, it is called every PROGRESS_INTERVAL seconds
+    with a dictionary that reports the progress of the copy.
+
+    If `verify` is set, the hash of every block is recorded while is
+    written, and the blocks are read back from the device at the end
+    of the copy. A block that does not match fails the device.
+
+    `opener` is used to open the URL instead of `open_url`, like
+    `multicast.open_multicast` for multicast URLs.
+
+    If `rate` is set, the image is read at most at this rate (in
+    bytes per second). With `adaptive`, the rate is reduced when the
+    reads are slow or the requests fail (see `RateLimiter`). An image
+    read from the cache is not limited.
+
+    """
+    stats = Stats()
+    if isinstance(checksum_type, str):
+        checksum_type = [checksum_type]
+    digests = Digests(checksum_type)
+    single = not isinstance(device, list)
+    writers = {}
+    try:
+        for path in [device] if single else device:
+            if isinstance(path, PipeWriter):
+                if path.stats is None:
+                    path.stats = stats if single else Stats()
+                writers[path] = path
+                continue
+            writers[path] = Writer(
+                path, direct, chunk_size, stats if single else Stats(), sparse
+            )
+    except StreamException:
+        for writer in writers.values():
+            writer.close()
+        raise
+
+    limiter = RateLimiter(rate, adaptive) if rate else None
+
+    if opener is None:
+        opener = functools.partial(open_url, limiter=limiter)
+        if connections and urllib.parse.urlparse(url).scheme in RANGED_SCHEME:
+            opener = functools.partial(
+                open_ranged, connections=connections, limiter=limiter
+            )
+
+    entry = None
+    hexdigest = None
+    try:
+        if cache:
+            fileobj, entry = cache.open(url, cache_key, opener)
+        else:
+            fileobj = opener(url)
+        stats.total = source_size(fileobj)
+        if cache and not entry:
+            limiter = None
+        source = threaded(read_chunks(fileobj, chunk_size, stats, entry, limiter))
+
+        # Peek the first chunk to detect the compression format
+        first = next(source, b"")
+        compression = detect_compression(first) or compression
+        source = itertools.chain([first], source)
+        chunks = threaded(decompress(source, compression, chunk_size, threads))
+
+        def _report():
+            report = stats.progress()
+            if not single:
+                report["written"] = sum(w.stats.written for w in writers.values())
+            progress(report)
+
+        def _hashed(chunks):
+            last_report = time.monotonic()
+            for chunk in chunks:
+                stats.size += len(chunk)
+                digests.update(chunk)
+                if progress and time.monotonic() - last_report >= PROGRESS_INTERVAL:
+                    _report()
+                    last_report = time.monotonic()
+                yield chunk
+
+        chunks = _hashed(chunks)
+        # Peek the first chunk to detect the format of the image
+        first = next(chunks, b"")
+        chunks = itertools.chain([first], chunks)
+        used_blocks = bytes(first[: len(USED_BLOCKS_MAGIC)]) == USED_BLOCKS_MAGIC
+        if used_blocks:
+            if bmap:
+                raise StreamException("A bmap cannot be used with a used blocks image")
+            operations = used_blocks_filter(chunks)
+        elif bmap:
+            operations = bmap_filter(chunks, bmap)
+        else:
+            operations = ((DATA, chunk) for chunk in chunks)
+        if sparse:
+            operations = find_zeros(operations)
+        if verify:
+            hashes = BlockHashes()
+            operations = threaded(hashes.record(operations))
+
+        if single:
+            try:
+                dispatch(operations, writers[device])
+            finally:
+                writers[device].close()
+        else:
+            errors = fan_out(operations, writers.values())
+            _raise_errors(writers, errors)
+        checksums = digests.hexdigests()
+        hexdigest = checksums[checksum_type[0]]
+    finally:
+        digests.close()
+        if hexdigest is None:
+            for writer in writers.values():
+                try:
+                    writer.close()
+                except StreamException:
+                    pass
+        if entry:
+            valid = not expected_checksum or hexdigest == expected_checksum
+            if hexdigest and valid:
+                entry.commit()
+            else:
+                entry.abort()
+        elif cache and hexdigest and expected_checksum:
+            # A cached image that does not match is corrupted, and
+            # needs to be fetched again the next time
+            if hexdigest != expected_checksum:
+                LOG.warning("Cached image for %s does not match, evicting", url)
+                cache.remove(cache.key(url, cache_key))
+    stats.stop()
+
+    if verify:
+        start = time.monotonic()
+        for path, writer in writers.items():
+            if not single and writer in errors:
+                continue
+            offset = read_back(path, hashes.blocks)
+            if offset is None:
+                continue
+            error = StreamException(
+                "Verification of {} failed at offset {}".format(path, offset)
+            )
+            if single:
+                raise error
+            errors[writer] = error
+        if not single:
+            _raise_errors(writers, errors)
+        verify_seconds = time.monotonic() - start
+
+    result = stats.as_dict()
+    result["checksum"] = hexdigest
+    result["checksums"] = checksums
+    result["cached"] = bool(cache) and not entry
+    result["compression"] = compression
+    result["format"] = "used-blocks" if used_blocks else "raw"
+    if limiter:
+        result["rate"] = limiter.as_dict()
+    if verify:
+        result["verified"] = True
+        result["verify_seconds"] = round(verify_seconds, 3)
+    if not single:
+        result["devices"] = {}
+        for path, writer in writers.items():
+            result["written"] += writer.stats.written
+            result["skipped"] += writer.stats.skipped
+            device_result = {
+                "written": writer.stats.written,
+                "skipped": writer.stats.skipped,
+            }
+            if writer in errors:
+                device_result["error"] = str(errors[writer])
+            else:
+                device_result["checksum"] = hexdigest
+                device_result["checksums"] = checksums
+            result["devices"][path] = device_result
+    return result
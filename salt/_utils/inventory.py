@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Alberto Planas <aplanas@suse.com>
+#
+# Copyright 2019 SUSE LLC.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import json
+import logging
+import os.path
+import subprocess
+
+LOG = logging.getLogger(__name__)
+
+# Key of the inventory in the `__context__` of Salt, that lives during
+# a state run
+CONTEXT_KEY = "yomi.inventory"
+
+
+class InventoryException(Exception):
+    pass
+
+
+def _run(cmd):
+    """Run a command and return the exit code and the output"""
+    try:
+        process = subprocess.run(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False
+        )
+    except OSError as e:
+        raise InventoryException("Error running {}: {}".format(cmd[0], e))
+    return process.returncode, process.stdout.decode("utf-8", "replace")
+
+
+def _path(device):
+    """Return the path of a device from lsblk"""
+    # Old versions of lsblk do not have the PATH column
+    return device.get("path") or "/dev/{}".format(device["name"])
+
+
+def _flatten(devices, parent=None):
+    """Yield all the devices of the lsblk tree, with the parent path"""
+    for device in devices:
+        device = dict(device)
+        children = device.pop("children", [])
+        device["path"] = _path(device)
+        device["parent"] = parent
+        device["children"] = [_path(child) for child in children]
+        yield device
+        yield from _flatten(children, device["path"])
+
+
+class Inventory:
+    """Index of the block devices of the system
+
+    The devices are read with a single lsblk call, done when the first
+    question about them is asked. The content of each device (file
+    system, partition table, UUID, ...) is probed directly with blkid
+    on request, as the udev database used by lsblk can be outdated
+    just after a change. The probes are kept until the device is
+    invalidated.
+
+    """
+
+    def __init__(self, blockdevices=None):
+        self._devices = None
+        self._names = {}
+        self.probes = {}
+        if blockdevices is not None:
+            self._index(blockdevices)
+
+    def _index(self, blockdevices):
+        self._devices = {}
+        for device in _flatten(blockdevices):
+            path = device["path"]
+            # The same device can be listed many times (like a RAID
+            # member of two arrays), so the first entry wins
+            self._devices.setdefault(path, device)
+            if device.get("kname"):
+                self._names.setdefault("/dev/{}".format(device["kname"]), path)
+
+    @property
+    def devices(self):
+        if self._devices is None:
+            retcode, output = _run(["lsblk", "--json", "--bytes", "--output-all"])
+            if retcode:
+                raise InventoryException("Error listing the block devices")
+            self._index(json.loads(output).get("blockdevices", []))
+        return self._devices
+
+    def _path(self, device):
+        """Return the path used in the index for a device, or None"""
+        if device in self.devices:
+            return device
+        # Links like /dev/disk/by-id/... or /dev/mapper/... are
+        # resolved to the kernel name
+        real = os.path.realpath(device)
+        return real if real in self.devices else self._names.get(real)
+
+    def get(self, device):
+        """Return the lsblk information of a device, or None"""
+        path = self._path(device)
+        return self.devices[path] if path else None
+
+    def type(self, device):
+        """Return the type of device ('disk', 'part', 'lvm', 'raid1', ...)"""
+        info = self.get(device)
+        return info.get("type") if info else None
+
+    def children(self, device):
+        info = self.get(device)
+        return info["children"] if info else []
+
+    def disks(self):
+        return [path for path, info in self.devices.items() if info["type"] == "disk"]
+
+    def probe(self, device):
+        """Return the blkid information of the content of a device"""
+        # The probes are stored by kernel name, so a device is probed
+        # (and invalidated) once for all the links to it
+        device = os.path.realpath(device)
+        if device not in self.probes:
+            retcode, output = _run(["blkid", "--probe", "--output", "export", device])
+            # blkid returns 2 if nothing was found in the device
+            if retcode not in (0, 2):
+                LOG.info("Cannot probe %s", device)
+            self.probes[device] = dict(
+                line.split("=", 1) for line in output.splitlines() if "=" in line
+            )
+        return self.probes[device]
+
+    def fstype(self, device):
+        """Return the type of file system of a device, or ''"""
+        return self.probe(device).get("TYPE", "")
+
+    def pttype(self, device):
+        """Return the type of partition table of a device, or ''"""
+        return self.probe(device).get("PTTYPE", "")
+
+    def invalidate(self, device):
+        """Drop the probes of a device and of the devices inside it"""
+        if self._devices is None:
+            # Without the tree the devices inside are not known
+            self.probes.clear()
+            return
+        pending = [device]
+        while pending:
+            device = pending.pop()
+            self.probes.pop(os.path.realpath(device), None)
+            pending.extend(self.children(device))
+
+
+def get(context=None):
+    """Return the inventory of the block devices
+
+    The inventory is stored in `context` (the `__context__` of Salt),
+    so it is built only once during a state run.
+
+    """
+    if context is None:
+        return Inventory()
+    if CONTEXT_KEY not in context:
+        context[CONTEXT_KEY] = Inventory()
+    return context[CONTEXT_KEY]
+
+
+def invalidate(context, device=None):
+    """Invalidate the inventory after a change in the devices
+
+    If `device` is set, only the content of this device (and of the
+    devices inside it) changed, like after creating a file system.
+    Otherwise the devices changed (like after creating partitions),
+    and the inventory is read again on the next request.
+
+    """
+    if not context or CONTEXT_KEY not in context:
+        return
+    if device:
+        context[CONTEXT_KEY].invalidate(device)
+    else:
+        del context[CONTEXT_KEY]
@@ -0,0 +1,512 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Alberto Planas <aplanas@suse.com>
+#
+# Copyright 2019 SUSE LLC.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import collections
+import logging
+import os
+import select
+import socket
+import struct
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import imagestream
+
+LOG = logging.getLogger(__name__)
+
+# Every packet starts with a header with the magic, the kind of
+# packet, the size of the payload of the data packets, the session
+# (random for each transmission), the sequence number and the size of
+# the image. The sender knows the size of the image from the start,
+# so a receiver can join the session with any packet.
+MAGIC = b"YMC1"
+HEADER = struct.Struct("<4sBxHIQQ")
+
+# Kind of packets. DATA and END are sent to the group by the sender,
+# NAK and DONE are sent by the receivers to the sender. END is sent
+# periodically once all the data was sent, so the receivers can
+# request the lost packets at the tail of the image. The payload of
+# DONE is a random identifier of the receiver, as many receivers can
+# share the same address.
+DATA = 1
+END = 2
+NAK = 3
+DONE = 4
+
+# A NAK contains a list of ranges (first sequence and number of
+# packets) that are missing in the receiver
+NAK_RANGE = struct.Struct("<QI")
+MAX_NAK_RANGES = 64
+
+# Payload of the data packets. The default fits in a Ethernet frame
+# with the IP, UDP and Yomi headers.
+PACKET_SIZE = 1400
+MAX_PACKET_SIZE = 65000
+
+# Seconds between two NAKs of a receiver, and between two END
+# packets of the sender
+NAK_INTERVAL = 0.1
+END_INTERVAL = 0.2
+
+# Seconds that the sender waits for NAKs after the last repair
+LINGER = 10
+
+# Seconds without packets before a receiver gives up
+TIMEOUT = 60
+
+# Requested size of the socket buffer of the receivers, to absorb the
+# bursts while the receiver thread is writing in the spool file
+RCVBUF = 16 * 1024 * 1024
+
+
+def parse_url(url):
+    """Parse a multicast://group:port URL
+
+    An `interface` query parameter can be used to select the address
+    of the local interface used to join the group.
+
+    """
+    elements = urllib.parse.urlparse(url)
+    if elements.scheme != "multicast" or not elements.hostname or not elements.port:
+        raise imagestream.StreamException("Multicast URL {} not valid".format(url))
+    query = urllib.parse.parse_qs(elements.query)
+    interface = query.get("interface", [None])[0]
+    return elements.hostname, elements.port, interface
+
+
+def _packets(size, packet_size):
+    return (size + packet_size - 1) // packet_size
+
+
+class Sender:
+    """Send a file to a multicast group, repairing the lost packets
+
+    The data packets are sent in order, and the repairs requested by
+    the receivers (NAK) are sent to the group as soon as they arrive,
+    before the new data. A packet lost by many receivers is repaired
+    only once.
+
+    """
+
+    def __init__(
+        self,
+        path,
+        group,
+        port,
+        packet_size=PACKET_SIZE,
+        rate=None,
+        ttl=1,
+        interface=None,
+    ):
+        if not 0 < packet_size <= MAX_PACKET_SIZE:
+            raise imagestream.StreamException(
+                "Packet size needs to be between 1 and {}".format(MAX_PACKET_SIZE)
+            )
+        self.address = (group, port)
+        self.packet_size = packet_size
+        self.rate = rate
+        self.fd = os.open(path, os.O_RDONLY)
+        self.size = os.fstat(self.fd).st_size
+        self.total = _packets(self.size, packet_size)
+        self.session = struct.unpack("<I", os.urandom(4))[0]
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        if interface:
+            self.sock.setsockopt(
+                socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface)
+            )
+        self.sock.setblocking(False)
+
+        self.repairs = collections.deque()
+        self.requested = set()
+        self.done = set()
+        self.sent = 0
+        self.repaired = 0
+        self.naks = 0
+        self.next_send = time.monotonic()
+
+    def close(self):
+        self.sock.close()
+        os.close(self.fd)
+
+    def _send(self, kind, seq, payload=b""):
+        header = HEADER.pack(
+            MAGIC, kind, self.packet_size, self.session, seq, self.size
+        )
+        if self.rate:
+            delay = self.next_send - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.next_send = max(self.next_send, time.monotonic())
+            self.next_send += (len(header) + len(payload)) / self.rate
+        while True:
+            try:
+                self.sock.sendto(header + payload, self.address)
+                return
+            except BlockingIOError:
+                select.select([], [self.sock], [], 1)
+
+    def _send_data(self, seq):
+        offset = seq * self.packet_size
+        self._send(DATA, seq, os.pread(self.fd, self.packet_size, offset))
+
+    def _control(self):
+        """Process the NAK and DONE packets, returns True if any"""
+        activity = False
+        while True:
+            try:
+                data, address = self.sock.recvfrom(MAX_PACKET_SIZE)
+            except BlockingIOError:
+                return activity
+            if len(data) < HEADER.size:
+                continue
+            magic, kind, _, session, _, _ = HEADER.unpack_from(data)
+            if magic != MAGIC or session != self.session:
+                continue
+            if kind == DONE:
+                receiver = (address, data[HEADER.size :])
+                if receiver not in self.done:
+                    LOG.info("Receiver %s:%s completed", *address)
+                    self.done.add(receiver)
+                    activity = True
+            elif kind == NAK:
+                if (len(data) - HEADER.size) % NAK_RANGE.size:
+                    LOG.info("NAK from %s:%s not valid", *address)
+                    continue
+                self.naks += 1
+                activity = True
+                for offset in range(HEADER.size, len(data), NAK_RANGE.size):
+                    first, count = NAK_RANGE.unpack_from(data, offset)
+                    for repair in range(first, min(first + count, self.total)):
+                        if repair not in self.requested:
+                            self.requested.add(repair)
+                            self.repairs.append(repair)
+
+    def _repair(self):
+        repair = self.repairs.popleft()
+        self.requested.discard(repair)
+        self._send_data(repair)
+        self.repaired += 1
+
+    def run(self, receivers=None, linger=LINGER):
+        """Send the file and serve the repairs
+
+        If `receivers` is set, the transmission ends when this number
+        of receivers report that they have the full image. In any case
+        it ends when no repair is requested in `linger` seconds after
+        the data was sent.
+
+        """
+        start = time.monotonic()
+        seq = 0
+        while seq < self.total:
+            self._control()
+            if self.repairs:
+                self._repair()
+            else:
+                self._send_data(seq)
+                self.sent += 1
+                seq += 1
+
+        last_activity = last_end = time.monotonic()
+        self._send(END, self.total)
+        while not receivers or len(self.done) < receivers:
+            if self._control():
+                last_activity = time.monotonic()
+            if self.repairs:
+                self._repair()
+                continue
+            now = time.monotonic()
+            if now - last_activity >= linger:
+                break
+            if now - last_end >= END_INTERVAL:
+                self._send(END, self.total)
+                last_end = now
+            select.select([self.sock], [], [], END_INTERVAL)
+
+        seconds = time.monotonic() - start
+        if receivers and len(self.done) < receivers:
+            LOG.warning(
+                "Only %s of %s receivers completed the image", len(self.done), receivers
+            )
+        return {
+            "size": self.size,
+            "packets": self.total,
+            "sent": self.sent,
+            "repaired": self.repaired,
+            "naks": self.naks,
+            "receivers": len(self.done),
+            "seconds": round(seconds, 3),
+            "throughput": round(self.size / seconds / 1000**2, 3) if seconds else 0,
+        }
+
+
+def send(
+    path,
+    group,
+    port,
+    packet_size=PACKET_SIZE,
+    rate=None,
+    ttl=1,
+    interface=None,
+    receivers=None,
+    linger=LINGER,
+):
+    """Send a file (like a compressed image) to a multicast group
+
+    `rate` is the maximum rate in bytes per second. Multicast has no
+    congestion control, so sending faster than the slowest receiver
+    can store the data only produces more repairs.
+
+    Returns a dictionary with the statistics of the transmission.
+
+    """
+    sender = Sender(path, group, port, packet_size, rate, ttl, interface)
+    try:
+        LOG.info(
+            "Sending %s (%s bytes) to %s:%s in session %s",
+            path,
+            sender.size,
+            group,
+            port,
+            sender.session,
+        )
+        return sender.run(receivers, linger)
+    finally:
+        sender.close()
+
+
+class MulticastReader:
+    """File like object that receives an image from a multicast group
+
+    The packets are stored in a spool file in their position, so the
+    repairs can arrive in any order, and the data is returned in order
+    as soon as there are no gaps. The missing packets are requested
+    to the sender every NAK_INTERVAL seconds.
+
+    The spool file grows up to the size of the image, so the spool
+    directory needs this free space. It is checked once the size of
+    the image is known.
+
+    """
+
+    def __init__(self, group, port, interface=None, spool=None, timeout=TIMEOUT):
+        self.timeout = timeout
+        self.id = os.urandom(8)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Many receivers can share the port in the same host
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF)
+            self.sock.bind((group, port))
+            self.sock.setsockopt(
+                socket.IPPROTO_IP,
+                socket.IP_ADD_MEMBERSHIP,
+                socket.inet_aton(group) + socket.inet_aton(interface or "0.0.0.0"),
+            )
+        except OSError as e:
+            self.sock.close()
+            raise imagestream.StreamException(
+                "Error joining {}:{}: {}".format(group, port, e)
+            )
+        self.sock.settimeout(NAK_INTERVAL)
+        self.spool = tempfile.TemporaryFile(dir=spool)
+
+        self.condition = threading.Condition()
+        self.session = None
+        self.sender = None
+        self.size = None
+        self.packet_size = None
+        self.total = None
+        self.received = None
+        self.contiguous = 0
+        self.highest = 0
+        self.end = False
+        self.error = None
+        self.closed = False
+        self.position = 0
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.session is not None or self.error, timeout
+            )
+            error = self.error
+            if self.session is None and not error:
+                error = imagestream.StreamException(
+                    "No multicast session found in {}:{}".format(group, port)
+                )
+        if not error:
+            error = self._check_spool()
+        if error:
+            self.close()
+            raise error
+        self.headers = {"Content-Length": str(self.size)}
+
+    def _check_spool(self):
+        """Return an error if the image does not fit in the spool"""
+        stat = os.fstatvfs(self.spool.fileno())
+        available = stat.f_bavail * stat.f_frsize
+        if available < self.size:
+            return imagestream.StreamException(
+                "Not enough space to spool the image: {} bytes needed, "
+                "{} available".format(self.size, available)
+            )
+        return None
+
+    def _start(self, session, packet_size, size, address):
+        LOG.info("Receiving session %s from %s:%s", session, *address)
+        self.session = session
+        self.sender = address
+        self.size = size
+        self.packet_size = packet_size
+        self.total = _packets(size, packet_size)
+        self.received = bytearray(self.total)
+
+    def _send(self, kind, seq, payload=b""):
+        header = HEADER.pack(
+            MAGIC, kind, self.packet_size, self.session, seq, self.size
+        )
+        try:
+            self.sock.sendto(header + payload, self.sender)
+        except OSError as e:
+            LOG.info("Error sending control packet: %s", e)
+
+    def _complete(self):
+        return self.contiguous == self.total
+
+    def _packet(self, data, address):
+        """Process a packet from the group"""
+        if len(data) < HEADER.size:
+            return
+        magic, kind, packet_size, session, seq, size = HEADER.unpack_from(data)
+        if magic != MAGIC or kind not in (DATA, END):
+            return
+        with self.condition:
+            if self.session is None:
+                self._start(session, packet_size, size, address)
+                self.condition.notify_all()
+            elif session != self.session:
+                return
+
+            if kind == END:
+                self.end = True
+                if self._complete():
+                    self._send(DONE, self.total, self.id)
+                return
+
+            if seq >= self.total or self.received[seq]:
+                return
+            os.pwrite(self.spool.fileno(), data[HEADER.size :], seq * packet_size)
+            self.received[seq] = 1
+            self.highest = max(self.highest, seq + 1)
+            if seq == self.contiguous:
+                while self.contiguous < self.total and self.received[self.contiguous]:
+                    self.contiguous += 1
+                self.condition.notify_all()
+                if self._complete():
+                    self._send(DONE, self.total, self.id)
+
+    def _nak(self):
+        """Request the missing packets to the sender"""
+        with self.condition:
+            if self.session is None or self._complete():
+                return
+            limit = self.total if self.end else self.highest
+            ranges = []
+            start = self.contiguous
+            while len(ranges) < MAX_NAK_RANGES and start < limit:
+                first = self.received.find(0, start, limit)
+                if first < 0:
+                    break
+                last = self.received.find(1, first, limit)
+                if last < 0:
+                    last = limit
+                ranges.append(NAK_RANGE.pack(first, last - first))
+                start = last
+            if ranges:
+                self._send(NAK, self.contiguous, b"".join(ranges))
+
+    def _run(self):
+        last_packet = last_nak = time.monotonic()
+        try:
+            while not self.closed:
+                try:
+                    data, address = self.sock.recvfrom(MAX_PACKET_SIZE)
+                    self._packet(data, address)
+                    last_packet = time.monotonic()
+                except socket.timeout:
+                    pass
+                now = time.monotonic()
+                if now - last_nak >= NAK_INTERVAL:
+                    self._nak()
+                    last_nak = now
+                if self.session is not None and now - last_packet >= self.timeout:
+                    with self.condition:
+                        if not self._complete():
+                            raise imagestream.StreamException(
+                                "Multicast session {} timed out".format(self.session)
+                            )
+        except Exception as e:
+            with self.condition:
+                self.error = e
+                self.condition.notify_all()
+
+    def read(self, size=-1):
+        with self.condition:
+            while True:
+                if self.error:
+                    raise self.error
+                end = min(self.contiguous * self.packet_size, self.size)
+                if end > self.position or self.position >= self.size:
+                    break
+                self.condition.wait()
+        length = end - self.position
+        if size >= 0:
+            length = min(length, size)
+        data = os.pread(self.spool.fileno(), length, self.position)
+        self.position += len(data)
+        return data
+
+    def close(self):
+        self.closed = True
+        if threading.current_thread() is not self.thread:
+            self.thread.join()
+        self.sock.close()
+        self.spool.close()
+
+
+def open_multicast(url, timeout=TIMEOUT, headers=None, spool=None):
+    """Join the multicast group of the URL and wait for a session
+
+    `headers` is ignored, as a multicast image cannot be
+    revalidated.
+
+    """
+    group, port, interface = parse_url(url)
+    return MulticastReader(group, port, interface, spool, timeout)
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Alberto Planas <aplanas@suse.com>
+#
+# Copyright 2019 SUSE LLC.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import os
+import struct
+import uuid
+
+# ext2/3/4 superblock (see include/linux/ext2_fs.h in e2fsprogs)
+EXT_OFFSET = 1024
+EXT_MAGIC = 0xEF53
+EXT_VALID_FS = 0x0001
+EXT_ERROR_FS = 0x0002
+EXT_COMPAT_HAS_JOURNAL = 0x0004
+EXT_INCOMPAT_RECOVER = 0x0004
+EXT_INCOMPAT_EXT4 = 0x0040 | 0x0080 | 0x0200  # extents, 64bit, flex_bg
+
+# btrfs superblock (see fs/btrfs/ctree.h)
+BTRFS_OFFSET = 0x10000
+BTRFS_MAGIC = b"_BHRfS_M"
+
+# xfs superblock (see fs/xfs/libxfs/xfs_format.h)
+XFS_MAGIC = b"XFSB"
+
+
+def _pread(device, size, offset):
+    """Read a block of data from a device"""
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        return os.pread(fd, size, offset)
+    finally:
+        os.close(fd)
+
+
+def _ext(data):
+    """Parse the relevant fields of a ext2/3/4 superblock"""
+    if len(data) < 264:
+        return None
+    magic, state = struct.unpack_from("<HH", data, 56)
+    if magic != EXT_MAGIC:
+        return None
+    (mtime, wtime) = struct.unpack_from("<II", data, 44)
+    (lastcheck,) = struct.unpack_from("<I", data, 64)
+    compat, incompat = struct.unpack_from("<II", data, 92)
+    if incompat & EXT_INCOMPAT_EXT4:
+        fs_type = "ext4"
+    elif compat & EXT_COMPAT_HAS_JOURNAL:
+        fs_type = "ext3"
+    else:
+        fs_type = "ext2"
+    return {
+        "type": fs_type,
+        "uuid": str(uuid.UUID(bytes=data[104:120])),
+        "clean": bool(state & EXT_VALID_FS) and not state & EXT_ERROR_FS,
+        "needs_recovery": bool(incompat & EXT_INCOMPAT_RECOVER),
+        "mtime": mtime,
+        "wtime": wtime,
+        "lastcheck": lastcheck,
+    }
+
+
+def _btrfs(data):
+    """Parse the relevant fields of a btrfs superblock"""
+    if len(data) < 72 or data[64:72] != BTRFS_MAGIC:
+        return None
+    return {
+        "type": "btrfs",
+        "uuid": str(uuid.UUID(bytes=data[32:48])),
+    }
+
+
+def _xfs(data):
+    """Parse the relevant fields of a xfs superblock"""
+    if len(data) < 48 or data[:4] != XFS_MAGIC:
+        return None
+    return {
+        "type": "xfs",
+        "uuid": str(uuid.UUID(bytes=data[32:48])),
+    }
+
+
+def read(device):
+    """Read the superblock of the filesystem of a device
+
+    Returns a dictionary with, at least, the `type` and the `uuid`
+    of the filesystem, or None if the filesystem is not recognized.
+    This is a cheap alternative to `blkid` or `lsblk` for the
+    filesystems that Yomi can resize.
+
+    """
+    try:
+        info = _xfs(_pread(device, 512, 0))
+        if not info:
+            info = _ext(_pread(device, 1024, EXT_OFFSET))
+        if not info:
+            info = _btrfs(_pread(device, 4096, BTRFS_OFFSET))
+    except OSError:
+        info = None
+    return info
@@ -0,0 +1,518 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Alberto Planas <aplanas@suse.com>
+#
+# Copyright 2019 SUSE LLC.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import hashlib
+import http.server
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import imagestream
+
+LOG = logging.getLogger(__name__)
+
+# Size of the pieces of the image that are verified and shared
+# between the peers
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# State of each chunk in a peer. The pending chunks are the ones that
+# are being fetched, so the other peers can wait for them instead of
+# fetching them from the origin.
+MISSING = 0
+PENDING = 1
+PRESENT = 2
+
+# Schemes of the origin, that need to support reading a range
+ORIGIN_SCHEME = ("file", "http", "https")
+
+# Number of chunks fetched in parallel by each peer
+WORKERS = 4
+
+# Seconds between two announces to the tracker, and between two
+# updates of the chunks present in the other peers
+ANNOUNCE_INTERVAL = 5
+REFRESH_INTERVAL = 1
+
+# Number of peers asked for their chunks in each update, so the
+# requests do not grow with the square of the size of the swarm
+REFRESH_PEERS = 8
+
+# Seconds before the tracker forgets a peer that is not announced
+PEER_TTL = 3 * ANNOUNCE_INTERVAL
+
+# Seconds that a peer waits for a chunk that other peer is fetching,
+# before fetching it from the origin
+PEER_WAIT = 30
+
+# Seconds between two checks of a worker without chunks to fetch
+POLL_INTERVAL = 0.2
+
+TIMEOUT = 10
+
+
+def create_manifest(path, chunk_size=CHUNK_SIZE):
+    """Calculate the hash of every chunk of an image
+
+    The manifest lives next to the image, and it is used to verify
+    the chunks received from the other peers.
+
+    """
+    hashes = []
+    size = 0
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            size += len(chunk)
+            hashes.append(hashlib.sha256(chunk).hexdigest())
+    return {"size": size, "chunk_size": chunk_size, "hashes": hashes}
+
+
+def parse_manifest(content):
+    """Parse and validate the content of a manifest"""
+    try:
+        manifest = json.loads(content)
+        size = int(manifest["size"])
+        chunk_size = int(manifest["chunk_size"])
+        hashes = list(manifest["hashes"])
+    except (ValueError, KeyError, TypeError) as e:
+        raise imagestream.StreamException("Manifest not valid: {}".format(e))
+    if chunk_size <= 0 or len(hashes) != (size + chunk_size - 1) // chunk_size:
+        raise imagestream.StreamException("Manifest not valid: wrong number of chunks")
+    return {"size": size, "chunk_size": chunk_size, "hashes": hashes}
+
+
+def _get(url, timeout=TIMEOUT):
+    """GET a small resource from a peer, or None if not available"""
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            return response.read()
+    except (urllib.error.URLError, OSError) as e:
+        LOG.debug("Error fetching %s: %s", url, e)
+        return None
+
+
+def announce(tracker, key, port, leave=False, timeout=TIMEOUT):
+    """Announce a peer in the tracker, and return the other peers"""
+    body = json.dumps({"swarm": key, "port": port, "leave": leave}).encode()
+    request = urllib.request.Request(
+        urllib.parse.urljoin(tracker, "/announce"),
+        data=body,
+        headers={"Content-Type": "application/json"},
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.loads(response.read())["peers"]
+    except (urllib.error.URLError, OSError, ValueError, KeyError) as e:
+        LOG.info("Error announcing in the tracker %s: %s", tracker, e)
+        return None
+
+
+class _TrackerHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != "/announce":
+            self.send_error(404)
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            key, port = str(request["swarm"]), int(request["port"])
+        except (ValueError, KeyError, TypeError):
+            self.send_error(400)
+            return
+        # The peer is reachable in the address used to connect
+        peer = "http://{}:{}".format(self.client_address[0], port)
+        peers = self.server.tracker.announce(key, peer, request.get("leave"))
+        body = json.dumps({"peers": peers}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Tracker:
+    """Tracker of the peers of every swarm
+
+    The peers announce themselves periodically, and receive the list
+    of the other peers of the same swarm. The peers that are not
+    announced in `ttl` seconds are forgotten.
+
+    """
+
+    def __init__(self, address="", port=0, ttl=PEER_TTL):
+        self.ttl = ttl
+        self.swarms = {}
+        self.lock = threading.Lock()
+        self.server = http.server.ThreadingHTTPServer((address, port), _TrackerHandler)
+        self.server.daemon_threads = True
+        self.server.tracker = self
+        self.port = self.server.server_address[1]
+        self.thread = None
+
+    def announce(self, key, peer, leave=False):
+        now = time.monotonic()
+        with self.lock:
+            peers = self.swarms.setdefault(key, {})
+            for other, seen in list(peers.items()):
+                if now - seen > self.ttl:
+                    del peers[other]
+            if leave:
+                peers.pop(peer, None)
+            else:
+                peers[peer] = now
+            if not peers:
+                del self.swarms[key]
+            return sorted(other for other in peers if other != peer)
+
+    def serve_forever(self):
+        self.server.serve_forever(POLL_INTERVAL)
+
+    def start(self):
+        """Serve the requests in a background thread"""
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        if self.thread:
+            self.server.shutdown()
+            self.thread.join()
+        self.server.server_close()
+
+
+class _PeerHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        peer = self.server.peer
+        parts = self.path.strip("/").split("/")
+        body = None
+        if len(parts) == 2 and parts[0] == peer.key:
+            if parts[1] == "have":
+                body = peer.have()
+            elif parts[1].isdigit():
+                body = peer.chunk(int(parts[1]))
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Peer:
+    """Member of the swarm of the nodes that copy the same image
+
+    The image is split in chunks, and the hash of every chunk is
+    listed in a manifest. Each chunk is fetched from a peer that
+    already has it, or from the origin if no peer has it, and is
+    verified with the manifest before it is stored in the spool file
+    and offered to the other peers.
+
+    The next chunk in order is always fetched first, as the image is
+    read in order. To keep the load of the origin low, the rest of
+    the chunks are fetched from the origin starting in a random
+    position, and every peer waits up to PEER_WAIT seconds for the
+    chunks that other peer is fetching.
+
+    The chunks present in the other peers are updated every
+    REFRESH_INTERVAL seconds, asking a random sample of REFRESH_PEERS
+    peers each time.
+
+    If `limiter` (a `imagestream.RateLimiter`) is set, the chunks
+    fetched from the origin are paced by it. The chunks from other
+    peers are not limited.
+
+    """
+
+    def __init__(
+        self,
+        key,
+        manifest,
+        tracker,
+        spool=None,
+        port=0,
+        workers=WORKERS,
+        limiter=None,
+    ):
+        self.key = key
+        self.tracker = tracker
+        self.size = manifest["size"]
+        self.chunk_size = manifest["chunk_size"]
+        self.hashes = manifest["hashes"]
+        self.workers = workers
+        self.limiter = limiter
+        self.state = bytearray(len(self.hashes))
+        self.offset = random.randrange(len(self.hashes)) if self.hashes else 0
+        self.waiting = {}
+        self.peers = {}
+        self.stats = {"origin": 0, "peers": 0, "served": 0}
+        self.url = None
+        self.error = None
+        self.closed = False
+        self.condition = threading.Condition()
+        self.stop = threading.Event()
+        self.ready = threading.Event()
+        self.threads = []
+        self.spool = tempfile.TemporaryFile(dir=spool)
+
+        self.server = http.server.ThreadingHTTPServer(("", port), _PeerHandler)
+        self.server.daemon_threads = True
+        self.server.peer = self
+        self.port = self.server.server_address[1]
+        self.server_thread = threading.Thread(
+            target=self.server.serve_forever, args=(POLL_INTERVAL,), daemon=True
+        )
+        self.server_thread.start()
+        self._start(self._refresh)
+
+    def _start(self, target):
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def have(self):
+        """Return the state of every chunk"""
+        with self.condition:
+            return bytes(self.state)
+
+    def chunk(self, index):
+        """Return the content of a verified chunk, if present"""
+        with self.condition:
+            if not 0 <= index < len(self.state) or self.state[index] != PRESENT:
+                return None
+            self.stats["served"] += 1
+        return os.pread(self.spool.fileno(), self.chunk_size, index * self.chunk_size)
+
+    def _refresh(self):
+        """Update the list of peers, and the chunks present in each one"""
+        last_announce = None
+        while not self.stop.is_set():
+            now = time.monotonic()
+            if last_announce is None or now - last_announce >= ANNOUNCE_INTERVAL:
+                peers = announce(self.tracker, self.key, self.port)
+                if peers is not None:
+                    with self.condition:
+                        self.peers = {peer: self.peers.get(peer, b"") for peer in peers}
+                    last_announce = now
+            for peer in self._sample():
+                have = _get("{}/{}/have".format(peer, self.key)) or b""
+                with self.condition:
+                    if peer in self.peers:
+                        self.peers[peer] = have
+                    self.condition.notify_all()
+            self.ready.set()
+            self.stop.wait(REFRESH_INTERVAL)
+
+    def _sample(self):
+        """Return the peers that are asked for their chunks"""
+        with self.condition:
+            peers = list(self.peers)
+        return random.sample(peers, min(len(peers), REFRESH_PEERS))
+
+    def _next(self):
+        """Select the next chunk to fetch, and the peers that have it"""
+        missing = [index for index, state in enumerate(self.state) if state == MISSING]
+        peers = list(self.peers.items())
+
+        def _peers_with(index, state):
+            return [
+                peer
+                for peer, have in peers
+                if index < len(have) and have[index] == state
+            ]
+
+        if not missing:
+            return None
+        now = time.monotonic()
+
+        # The first chunk not present is the next one needed by the
+        # reader, so it is not delayed by the random position
+        head = next(i for i, state in enumerate(self.state) if state != PRESENT)
+        if self.state[head] == MISSING:
+            present = _peers_with(head, PRESENT)
+            if present:
+                random.shuffle(present)
+                return head, present
+            if not _peers_with(head, PENDING):
+                return head, []
+            if now - self.waiting.setdefault(head, now) >= PEER_WAIT:
+                return head, []
+
+        for index in missing:
+            present = _peers_with(index, PRESENT)
+            if present:
+                random.shuffle(present)
+                return index, present
+
+        chunks = len(self.state)
+        for index in sorted(missing, key=lambda i: (i - self.offset) % chunks):
+            if not _peers_with(index, PENDING):
+                return index, []
+            if now - self.waiting.setdefault(index, now) >= PEER_WAIT:
+                return index, []
+        return None
+
+    def _verify(self, index, data):
+        return hashlib.sha256(data).hexdigest() == self.hashes[index]
+
+    def _from_peer(self, peer, index):
+        data = _get("{}/{}/{}".format(peer, self.key, index))
+        if data is None or not self._verify(index, data):
+            LOG.info("Chunk %s not valid in peer %s", index, peer)
+            return None
+        return data
+
+    def _from_origin(self, index):
+        start = index * self.chunk_size
+        end = min(start + self.chunk_size, self.size)
+        if self.limiter:
+            self.limiter.consume(end - start)
+        scheme, _, path, *_ = urllib.parse.urlparse(self.url)
+        if scheme == "file":
+            with open(urllib.parse.unquote(path), "rb") as f:
+                data = os.pread(f.fileno(), end - start, start)
+        else:
+            data = imagestream.fetch_range(
+                self.url, start, end, imagestream.TIMEOUT, limiter=self.limiter
+            )
+        if not self._verify(index, data):
+            raise imagestream.StreamException(
+                "Chunk {} of {} does not match the manifest".format(index, self.url)
+            )
+        return data
+
+    def _work(self):
+        try:
+            while True:
+                with self.condition:
+                    while True:
+                        if self.closed or self.error:
+                            return
+                        task = self._next()
+                        if task:
+                            break
+                        if MISSING not in self.state:
+                            return
+                        self.condition.wait(POLL_INTERVAL)
+                    index, peers = task
+                    self.state[index] = PENDING
+
+                data = None
+                for peer in peers:
+                    data = self._from_peer(peer, index)
+                    if data is not None:
+                        break
+                source = "peers" if data is not None else "origin"
+                if data is None:
+                    data = self._from_origin(index)
+                os.pwrite(self.spool.fileno(), data, index * self.chunk_size)
+
+                with self.condition:
+                    self.state[index] = PRESENT
+                    self.stats[source] += 1
+                    self.condition.notify_all()
+        except Exception as e:
+            with self.condition:
+                self.error = e
+                self.condition.notify_all()
+
+    def open(self, url, headers=None):
+        """Start fetching the image from the swarm and the origin
+
+        Returns a file like object that reads the image in
+        order. `headers` is ignored, as the chunks are validated with
+        the manifest.
+
+        """
+        self.url = url
+        # Learn what the other peers have before going to the origin
+        self.ready.wait(TIMEOUT)
+        for _ in range(self.workers):
+            self._start(self._work)
+        return SwarmReader(self)
+
+    def seed(self, seconds):
+        """Keep serving the chunks to the other peers for a while"""
+        if seconds:
+            LOG.info("Seeding %s for %s seconds", self.key, seconds)
+            self.stop.wait(seconds)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.stop.set()
+        for thread in self.threads:
+            thread.join()
+        announce(self.tracker, self.key, self.port, leave=True)
+        self.server.shutdown()
+        self.server_thread.join()
+        self.server.server_close()
+        self.spool.close()
+
+
+class SwarmReader:
+    """File like object that reads in order the chunks of a `Peer`"""
+
+    def __init__(self, peer):
+        self.peer = peer
+        self.position = 0
+        self.headers = {"Content-Length": str(peer.size)}
+
+    def read(self, size=-1):
+        peer = self.peer
+        if self.position >= peer.size:
+            return b""
+        index = self.position // peer.chunk_size
+        with peer.condition:
+            while peer.state[index] != PRESENT:
+                if peer.error:
+                    raise peer.error
+                if peer.closed:
+                    raise imagestream.StreamException("Swarm closed")
+                peer.condition.wait()
+        length = min((index + 1) * peer.chunk_size, peer.size) - self.position
+        if size >= 0:
+            length = min(length, size)
+        data = os.pread(peer.spool.fileno(), length, self.position)
+        self.position += len(data)
+        return data
+
+    def close(self):
+        # The peer keeps serving the chunks until is closed
+        pass
@@ -37,7 +37,7 @@ trap tear_down EXIT
 # Create the temporary Python modules, that once added in the
 # PYTHON_PATH can be found and imported
 touch "$test_env"/__init__.py
-for module in modules states grains utils; do
+for module in modules states grains runners utils; do
     mkdir "$test_env"/"$module"
     touch "$test_env"/"$module"/__init__.py
     [ "$(ls -A ../salt/_"$module")" ] && ln -sr ../salt/_"$module"/* "$test_env"/"$module"/
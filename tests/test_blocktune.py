@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Alberto Planas <aplanas@suse.com>
+#
+# Copyright 2019 SUSE LLC.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import json
+import os
+import pathlib
+import subprocess
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from utils import blocktune
+
+
+class BlocktuneTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.root = pathlib.Path(self.tmpdir.name)
+
+        # sysfs layout of a disk with one partition
+        disk = self.root / "sys/devices/pci0000:00/block/sda"
+        self.queue = disk / "queue"
+        self.queue.mkdir(parents=True)
+        (disk / "sda1").mkdir()
+        for name, value in (
+            ("max_hw_sectors_kb", "2048"),
+            ("max_sectors_kb", "1280"),
+            ("read_ahead_kb", "128"),
+            ("scheduler", "[mq-deadline] kyber none"),
+            ("rotational", "0"),
+        ):
+            (self.queue / name).write_text(value + "\n")
+        block = self.root / "sys/class/block"
+        block.mkdir(parents=True)
+        (block / "sda").symlink_to(disk)
+        (block / "sda1").symlink_to(disk / "sda1")
+
+        self.vm = self.root / "proc/sys/vm"
+        self.vm.mkdir(parents=True)
+        for name, value in (
+            ("dirty_ratio", "20"),
+            ("dirty_background_ratio", "10"),
+            ("dirty_bytes", "0"),
+            ("dirty_background_bytes", "0"),
+        ):
+            (self.vm / name).write_text(value + "\n")
+
+        # The partition device is a link to a regular file
+        self.device = self.root / "dev/sda1"
+        self.device.parent.mkdir()
+        (self.root / "sda1").write_bytes(b"\0" * 4096)
+        self.device.symlink_to(self.root / "sda1")
+
+        for patcher in (
+            patch("utils.blocktune.SYSFS", str(self.root / "sys")),
+            patch("utils.blocktune.PROCFS", str(self.root / "proc")),
+            patch("utils.blocktune.RUNDIR", str(self.root / "run")),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _values(self):
+        return {
+            path.name: path.read_text().strip()
+            for path in list(self.queue.iterdir()) + list(self.vm.iterdir())
+        }
+
+    def test_queue_path(self):
+        """Test blocktune.queue_path function"""
+        self.assertEqual(blocktune.queue_path(str(self.device)), str(self.queue))
+        self.assertEqual(blocktune.queue_path("/dev/missing"), None)
+
+    def test_session(self):
+        """Test blocktune.Session applying and restoring the values"""
+        original = self._values()
+        with blocktune.Session(str(self.device), {"probe": True}) as session:
+            values = self._values()
+            self.assertEqual(values["max_sectors_kb"], "2048")
+            self.assertEqual(values["read_ahead_kb"], "4096")
+            self.assertEqual(values["scheduler"], "none")
+            self.assertEqual(values["dirty_ratio"], "40")
+            # The value did not change, so it is not in the report
+            self.assertNotIn(
+                str(self.vm / "dirty_background_ratio"), session.report["settings"]
+            )
+        self.assertEqual(len(session.report["settings"]), 4)
+        self.assertEqual(
+            session.report["settings"][str(self.queue / "read_ahead_kb")],
+            {"old": "128", "new": "4096"},
+        )
+        self.assertEqual(
+            list(session.report["read_throughput"][str(self.device)]),
+            ["before", "after"],
+        )
+
+        # A fake sysfs does not keep the brackets of the scheduler
+        original["scheduler"] = "mq-deadline"
+        self.assertEqual(self._values(), original)
+
+    def test_session_options(self):
+        """Test blocktune.Session with custom options"""
+        (self.queue / "rotational").write_text("1\n")
+        (self.vm / "dirty_bytes").write_text("1000000\n")
+        options = {"max_sectors_kb": False, "read_ahead_kb": 8192}
+        with blocktune.Session([str(self.device)], options) as session:
+            values = self._values()
+            self.assertEqual(values["max_sectors_kb"], "1280")
+            self.assertEqual(values["read_ahead_kb"], "8192")
+            self.assertEqual(values["scheduler"], "[mq-deadline] kyber none")
+            # The limit set in bytes is kept
+            self.assertEqual(values["dirty_ratio"], "20")
+        self.assertEqual(session.report["read_throughput"], {})
+
+    def test_session_changed(self):
+        """Test blocktune.Session when a value changes during the session"""
+        with blocktune.Session(str(self.device)):
+            (self.queue / "read_ahead_kb").write_text("256\n")
+        self.assertEqual(self._values()["read_ahead_kb"], "256")
+        self.assertEqual(self._values()["max_sectors_kb"], "1280")
+
+    def test_session_overlap(self):
+        """Test blocktune.Session with overlapping sessions"""
+        first = blocktune.Session(str(self.device))
+        second = blocktune.Session(str(self.device), {"read_ahead_kb": 8192})
+        first.apply()
+        second.apply()
+        # The second session keeps the values of the first one
+        self.assertEqual(self._values()["read_ahead_kb"], "4096")
+        self.assertEqual(
+            second.report["settings"][str(self.vm / "dirty_ratio")],
+            {"old": "20", "new": "40"},
+        )
+
+        # The shared values are restored by the last session
+        first.restore()
+        self.assertEqual(self._values()["dirty_ratio"], "40")
+        self.assertEqual(self._values()["read_ahead_kb"], "4096")
+        second.restore()
+        self.assertEqual(self._values()["dirty_ratio"], "20")
+        self.assertEqual(self._values()["read_ahead_kb"], "128")
+        self.assertEqual(
+            json.loads((self.root / "run" / blocktune.STATE_FILE).read_text()), {}
+        )
+
+    def test_session_stale(self):
+        """Test blocktune.Session with the state of a killed session"""
+        process = subprocess.Popen(["true"])
+        process.wait()
+        read_ahead_kb = str(self.queue / "read_ahead_kb")
+        max_sectors_kb = str(self.queue / "max_sectors_kb")
+        (self.queue / "read_ahead_kb").write_text("4096\n")
+        (self.root / "run").mkdir()
+        (self.root / "run" / blocktune.STATE_FILE).write_text(
+            json.dumps(
+                {
+                    read_ahead_kb: {
+                        "old": "128",
+                        "new": "4096",
+                        "pids": [process.pid],
+                    },
+                    # Changed since the session that is still running
+                    max_sectors_kb: {
+                        "old": "1",
+                        "new": "2",
+                        "pids": [os.getpid()],
+                    },
+                }
+            )
+        )
+
+        with blocktune.Session(str(self.device), {"read_ahead_kb": 8192}) as session:
+            self.assertEqual(self._values()["read_ahead_kb"], "8192")
+            self.assertEqual(self._values()["max_sectors_kb"], "2048")
+        self.assertEqual(
+            session.report["settings"][read_ahead_kb], {"old": "128", "new": "8192"}
+        )
+        self.assertEqual(self._values()["read_ahead_kb"], "128")
+        self.assertEqual(self._values()["max_sectors_kb"], "1280")
+        self.assertEqual(
+            json.loads((self.root / "run" / blocktune.STATE_FILE).read_text()), {}
+        )
+
+    def test_session_no_queue(self):
+        """Test blocktune.Session for a device without queue"""
+        with blocktune.Session("/dev/missing", measure=True) as session:
+            pass
+        self.assertEqual(len(session.report["settings"]), 1)
+        self.assertEqual(
+            session.report["read_throughput"],
+            {"/dev/missing": {"before": None, "after": None}},
+        )
+
+    def test_probe(self):
+        """Test blocktune.probe function"""
+        self.assertGreater(blocktune.probe(str(self.device)), 0)
+        self.assertIsNone(blocktune.probe("/dev/missing"))
+
+    def test_describe(self):
+        """Test blocktune.describe function"""
+        report = {
+            "settings": {"read_ahead_kb": {"old": "128", "new": "4096"}},
+            "read_throughput": {"/dev/sda1": {"before": 100.0, "after": 150.0}},
+        }
+        self.assertEqual(
+            blocktune.describe(report),
+            "I/O tuning changed 1 settings "
+            "(read throughput: /dev/sda1 100.0 -> 150.0 MB/s)",
+        )
@@ -34,3 +34,74 @@ class DiskTestCase(unittest.TestCase):
         self.assertEqual(disk.units("1s"), (1, "s"))
         self.assertEqual(disk.units("1.1s"), (1.1, "s"))
         self.assertRaises(disk.ParseException, disk.units, "s1")
+
+    def test_sectors(self):
+        self.assertEqual(disk.sectors("2048s", 512, 1000), 2048)
+        self.assertEqual(disk.sectors("1MiB", 512, 1000), 2048)
+        self.assertEqual(disk.sectors("1MiB", 4096, 1000), 256)
+        self.assertEqual(disk.sectors("100MB", 512, 1000), 195312)
+        self.assertEqual(disk.sectors(1, 512, 1000), 1953)
+        self.assertEqual(disk.sectors("50%", 512, 1000), 500)
+        with self.assertRaises(disk.ParseException):
+            disk.sectors("1cyl", 512, 1000)
+
+    def test_from_sectors(self):
+        self.assertEqual(disk.from_sectors(2048, "s", 512, 1000), 2048)
+        self.assertEqual(disk.from_sectors(2048, "MiB", 512, 1000), 1)
+        self.assertEqual(disk.from_sectors(250, "%", 512, 1000), 25)
+        with self.assertRaises(disk.ParseException):
+            disk.from_sectors(1, "chs", 512, 1000)
+
+    def test_to_sectors(self):
+        self.assertEqual(disk.to_sectors(2048, "s", 512, 1000), 2048)
+        self.assertEqual(disk.to_sectors(1, "kB", 512, 1000), 1000 / 512)
+        self.assertEqual(disk.to_sectors(25, "%", 512, 1000), 250)
+        with self.assertRaises(disk.ParseException):
+            disk.to_sectors(1, "chs", 512, 1000)
+
+    def test_intervals(self):
+        intervals = disk.Intervals([])
+        self.assertEqual(len(intervals), 0)
+        self.assertEqual(intervals.find(0), None)
+
+        intervals = disk.Intervals(
+            [(20, 30, "2"), (0, 10, "1"), (40, 100, "3"), (41, 50, "5"), (51, 60, "6")]
+        )
+        self.assertEqual(len(intervals), 5)
+        self.assertEqual(intervals.find(0), "1")
+        self.assertEqual(intervals.find(10), "1")
+        self.assertEqual(intervals.find(10.5), None)
+        self.assertEqual(intervals.find(25), "2")
+        self.assertEqual(intervals.find(40), "3")
+        self.assertEqual(intervals.find(45), "5")
+        self.assertEqual(intervals.find(50.5), "3")
+        self.assertEqual(intervals.find(55), "6")
+        self.assertEqual(intervals.find(70), "3")
+        self.assertEqual(intervals.find(101), None)
+
+        # The container wins only if the inner interval do not match
+        intervals = disk.Intervals([(0, 5, "5"), (0, 10, "1")])
+        self.assertEqual(intervals.find(0), "5")
+        self.assertEqual(intervals.find(6), "1")
+
+    def test_last_partition(self):
+        self.assertEqual(disk.last_partition({}), None)
+        partitions = {
+            "1": {"start": "1054720s", "end": "4194270s"},
+            "2": {"start": "2048s", "end": "4095s"},
+            "3": {"start": "4096s", "end": "1054719s"},
+        }
+        self.assertEqual(disk.last_partition(partitions), "1")
+
+        # The extended partition ends after the last logical one
+        partitions = {
+            "1": {"start": "2048s", "end": "1050623s"},
+            "2": {"start": "1050624s", "end": "4194303s"},
+            "5": {"start": "1052672s", "end": "2097151s"},
+        }
+        self.assertEqual(disk.last_partition(partitions), "5")
+
+    def test_partition_device(self):
+        self.assertEqual(disk.partition_device("/dev/sda", 1), "/dev/sda1")
+        self.assertEqual(disk.partition_device("/dev/nvme0n1", 2), "/dev/nvme0n1p2")
+        self.assertEqual(disk.partition_device("/dev/md0", "3"), "/dev/md0p3")
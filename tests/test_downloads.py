@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Alberto Planas <aplanas@suse.com>
+#
+# Copyright 2019 SUSE LLC.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import unittest
+from unittest.mock import patch
+
+from utils import downloads
+
+
+class DownloadsTestCase(unittest.TestCase):
+    def test_slot_server(self):
+        """Test downloads.SlotServer fairness"""
+        server = downloads.SlotServer(2)
+        self.addCleanup(server.close)
+        self.assertTrue(server.acquire("a")["granted"])
+        self.assertTrue(server.acquire("b")["granted"])
+        self.assertEqual(
+            server.acquire("c"), {"granted": False, "position": 0, "retry": 2}
+        )
+        self.assertEqual(server.acquire("d")["position"], 1)
+
+        # A slot is not given to a later client while others wait
+        server.release("a")
+        self.assertFalse(server.acquire("d")["granted"])
+        self.assertTrue(server.acquire("c")["granted"])
+        self.assertTrue(server.acquire("c")["granted"])
+        self.assertEqual(server.granted, 3)
+
+        self.assertTrue(server.renew("b")["renewed"])
+        self.assertFalse(server.renew("d")["renewed"])
+
+    @patch("utils.downloads.time.monotonic")
+    def test_slot_server_expire(self, monotonic):
+        """Test downloads.SlotServer recovering the slots not renewed"""
+        server = downloads.SlotServer(1, ttl=10)
+        self.addCleanup(server.close)
+        monotonic.return_value = 100
+        self.assertTrue(server.acquire("a")["granted"])
+        self.assertFalse(server.acquire("b")["granted"])
+        monotonic.return_value = 111
+        self.assertTrue(server.acquire("b")["granted"])
+        self.assertFalse(server.renew("a")["renewed"])
+
+    def test_slot(self):
+        """Test downloads.Slot against a local server"""
+        server = downloads.SlotServer(1, "127.0.0.1")
+        server.start()
+        self.addCleanup(server.close)
+        url = "http://127.0.0.1:{}".format(server.port)
+
+        with downloads.Slot(url) as slot:
+            self.assertIn(slot.client, server.holders)
+            with self.assertRaises(downloads.imagestream.StreamException):
+                downloads.Slot(url, timeout=0).acquire()
+        self.assertEqual(server.holders, {})
+        self.assertEqual(server.waiting, {})
+        self.assertEqual(server.granted, 1)
+
+    @patch("utils.downloads.RETRY_INTERVAL", 0)
+    def test_slot_server_unavailable(self):
+        """Test downloads.Slot without a server"""
+        with self.assertRaises(downloads.imagestream.StreamException):
+            downloads.Slot("http://127.0.0.1:1", timeout=0).acquire()
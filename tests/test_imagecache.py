@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Alberto Planas <aplanas@suse.com>
+#
+# Copyright 2019 SUSE LLC.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import io
+import os
+import pathlib
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from utils import imagecache
+
+
+class _Response(io.BytesIO):
+    """Minimal HTTP response"""
+
+    def __init__(self, data, headers):
+        super().__init__(data)
+        self.headers = headers
+
+
+class ImageCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self.tmpdir.name)
+        self.cache = imagecache.Cache(str(self.path / "cache"))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _store(self, key, data, mtime=None):
+        entry = self.cache.new(key, {"url": key})
+        entry.write(data)
+        entry.commit()
+        if mtime:
+            os.utime(self.cache.entry_path(key), (mtime, mtime))
+
+    def test_keys(self):
+        """Test imagecache keys"""
+        self.assertEqual(imagecache.image_key("md5", "abc"), "md5-abc")
+        self.assertTrue(imagecache.url_key("http://url/image").startswith("url-"))
+        self.assertNotEqual(
+            imagecache.url_key("http://url/a"), imagecache.url_key("http://url/b")
+        )
+
+    def test_entry(self):
+        """Test imagecache.Entry commit and abort"""
+        self.assertIsNone(self.cache.get("key"))
+        self._store("key", b"data")
+        self.assertEqual(pathlib.Path(self.cache.get("key")).read_bytes(), b"data")
+        self.assertEqual(self.cache.metadata("key"), {"url": "key"})
+
+        entry = self.cache.new("other")
+        entry.write(b"data")
+        entry.abort()
+        self.assertIsNone(self.cache.get("other"))
+        self.assertEqual([e[2] for e in self.cache.entries()], ["key"])
+
+    def test_evict(self):
+        """Test imagecache.Cache LRU eviction"""
+        self.cache.max_size = 10
+        self._store("a", b"1234", mtime=1000)
+        self._store("b", b"1234", mtime=2000)
+        # Using "a" makes "b" the least recently used entry
+        self.cache.get("a")
+        self._store("c", b"1234")
+        self.assertIsNone(self.cache.get("b"))
+        self.assertIsNotNone(self.cache.get("a"))
+        self.assertIsNotNone(self.cache.get("c"))
+
+    def test_evict_too_big(self):
+        """Test imagecache.Cache with an entry bigger than the cache"""
+        self.cache.max_size = 10
+        self._store("a", b"1234")
+        self._store("b", b"12345678901")
+        self.assertIsNone(self.cache.get("b"))
+        self.assertIsNone(self.cache.get("a"))
+
+    def test_open_key(self):
+        """Test imagecache.Cache.open with a content key"""
+        image = self.path / "image"
+        image.write_bytes(b"data")
+
+        fileobj, entry = self.cache.open(image.as_uri(), "md5-abc")
+        self.assertIsNotNone(entry)
+        entry.write(fileobj.read())
+        fileobj.close()
+        entry.commit()
+
+        image.unlink()
+        fileobj, entry = self.cache.open(image.as_uri(), "md5-abc")
+        self.assertIsNone(entry)
+        self.assertEqual(fileobj.read(), b"data")
+        fileobj.close()
+
+    @patch("utils.imagecache.imagestream.open_url")
+    def test_open_revalidate(self, open_url):
+        """Test imagecache.Cache.open revalidation"""
+        url = "http://url/image.md5"
+        open_url.return_value = _Response(
+            b"checksum", {"ETag": '"1"', "Last-Modified": "date"}
+        )
+        self.assertEqual(self.cache.fetch(url), "checksum")
+        open_url.assert_called_with(url, headers={})
+
+        # Not modified
+        open_url.return_value = None
+        self.assertEqual(self.cache.fetch(url), "checksum")
+        open_url.assert_called_with(
+            url, headers={"If-None-Match": '"1"', "If-Modified-Since": "date"}
+        )
+
+        # Modified
+        open_url.return_value = _Response(b"new", {"ETag": '"2"'})
+        self.assertEqual(self.cache.fetch(url), "new")
+        self.assertEqual(self.cache.metadata(imagecache.url_key(url))["etag"], '"2"')
@@ -21,8 +21,11 @@
 # specific language governing permissions and limitations
 # under the License.
 
+import json
+import os
+import tempfile
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, mock_open, MagicMock
 
 from salt.exceptions import SaltInvocationError, CommandExecutionError
 
@@ -30,6 +33,14 @@ from modules import images
 
 
 class ImagesTestCase(unittest.TestCase):
+    def setUp(self):
+        # The inventory lives in the context of the state run
+        images.__context__.clear()
+        patcher = patch("modules.images.inventory._run")
+        self.blkid = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.blkid.return_value = (0, "TYPE=ext4\n")
+
     def test__checksum_url(self):
         """Test images._checksum_url function"""
         self.assertEqual(
@@ -41,6 +52,17 @@ class ImagesTestCase(unittest.TestCase):
             "http://example.com/image.ext4.md5",
         )
 
+    def test__bmap_url(self):
+        """Test images._bmap_url function"""
+        self.assertEqual(
+            images._bmap_url("http://example.com/image.xz"),
+            "http://example.com/image.bmap",
+        )
+        self.assertEqual(
+            images._bmap_url("http://example.com/image.ext4"),
+            "http://example.com/image.ext4.bmap",
+        )
+
     def test__curl_cmd(self):
         """Test images._curl_cmd function"""
         self.assertEqual(
@@ -84,15 +106,11 @@ class ImagesTestCase(unittest.TestCase):
 
     def test__find_filesystem(self):
         """Test images._find_filesystem function"""
-        salt_mock = {
-            "cmd.run_stdout": MagicMock(return_value="ext4"),
-        }
-
-        with patch.dict(images.__salt__, salt_mock):
-            self.assertEqual(images._find_filesystem("/dev/sda1"), "ext4")
-            salt_mock["cmd.run_stdout"].assert_called_with(
-                ["lsblk", "--noheadings", "--output", "FSTYPE", "/dev/sda1"]
-            )
+        self.assertEqual(images._find_filesystem("/dev/sda1"), "ext4")
+        self.assertEqual(images._find_filesystem("/dev/sda1"), "ext4")
+        self.blkid.assert_called_once_with(
+            ["blkid", "--probe", "--output", "export", "/dev/sda1"]
+        )
 
     def test_fetch_checksum(self):
         """Test images.fetch_checksum function"""
@@ -245,15 +263,39 @@ class ImagesTestCase(unittest.TestCase):
     def test_dump_resize_fail_extx(self):
         """Test images.dump function when resize fails (extx)"""
         salt_mock = {
-            "cmd.run_stdout": MagicMock(return_value="ext4"),
             "cmd.run_all": MagicMock(
                 side_effect=[
                     {"retcode": 0, "stdout": "checksum"},
+                    {"retcode": 1},
                     {"retcode": 1, "stderr": "error"},
                 ]
             ),
         }
 
+        with patch.dict(images.__salt__, salt_mock):
+            with self.assertRaises(CommandExecutionError):
+                images.dump(
+                    "http://example.org/image.ext4",
+                    "/dev/sda1",
+                    checksum_type="md5",
+                    checksum="checksum",
+                )
+            salt_mock["cmd.run_all"].assert_any_call(
+                ["e2fsck", "-f", "-y", "/dev/sda1"]
+            )
+            salt_mock["cmd.run_all"].assert_called_with(["resize2fs", "/dev/sda1"])
+
+    def test_dump_check_fail_extx(self):
+        """Test images.dump function when e2fsck fails (extx)"""
+        salt_mock = {
+            "cmd.run_all": MagicMock(
+                side_effect=[
+                    {"retcode": 0, "stdout": "checksum"},
+                    {"retcode": 4, "stderr": "error"},
+                ]
+            ),
+        }
+
         with patch.dict(images.__salt__, salt_mock):
             with self.assertRaises(CommandExecutionError):
                 images.dump(
@@ -263,17 +305,22 @@ class ImagesTestCase(unittest.TestCase):
                     checksum="checksum",
                 )
             salt_mock["cmd.run_all"].assert_called_with(
-                "e2fsck -f -y /dev/sda1; resize2fs /dev/sda1", python_shell=True
+                ["e2fsck", "-f", "-y", "/dev/sda1"]
             )
 
-    def test_dump_resize_fail_btrfs(self):
+    @patch("modules.images.os.rmdir")
+    @patch("modules.images.tempfile.mkdtemp")
+    def test_dump_resize_fail_btrfs(self, mkdtemp, rmdir):
         """Test images.dump function when resize fails (btrfs)"""
+        mkdtemp.return_value = "/tmp/yomi-resize-xxx"
+        self.blkid.return_value = (0, "TYPE=btrfs\n")
         salt_mock = {
-            "cmd.run_stdout": MagicMock(return_value="btrfs"),
             "cmd.run_all": MagicMock(
                 side_effect=[
                     {"retcode": 0, "stdout": "checksum"},
+                    {"retcode": 0},
                     {"retcode": 1, "stderr": "error"},
+                    {"retcode": 0},
                 ]
             ),
         }
@@ -286,16 +333,24 @@ class ImagesTestCase(unittest.TestCase):
                     checksum_type="md5",
                     checksum="checksum",
                 )
+            salt_mock["cmd.run_all"].assert_any_call(
+                ["mount", "/dev/sda1", "/tmp/yomi-resize-xxx"]
+            )
+            salt_mock["cmd.run_all"].assert_any_call(
+                ["btrfs", "filesystem", "resize", "max", "/tmp/yomi-resize-xxx"]
+            )
             salt_mock["cmd.run_all"].assert_called_with(
-                "mount /dev/sda1 /mnt; btrfs filesystem resize max /mnt; "
-                "umount /mnt",
-                python_shell=True,
+                ["umount", "/tmp/yomi-resize-xxx"]
             )
+            rmdir.assert_called_with("/tmp/yomi-resize-xxx")
 
-    def test_dump_resize_fail_xfs(self):
+    @patch("modules.images.os.rmdir")
+    @patch("modules.images.tempfile.mkdtemp")
+    def test_dump_resize_fail_xfs(self, mkdtemp, rmdir):
         """Test images.dump function when resize fails (xfs)"""
+        mkdtemp.return_value = "/tmp/yomi-resize-xxx"
+        self.blkid.return_value = (0, "TYPE=xfs\n")
         salt_mock = {
-            "cmd.run_stdout": MagicMock(return_value="xfs"),
             "cmd.run_all": MagicMock(
                 side_effect=[
                     {"retcode": 0, "stdout": "checksum"},
@@ -313,27 +368,1234 @@ class ImagesTestCase(unittest.TestCase):
                     checksum="checksum",
                 )
             salt_mock["cmd.run_all"].assert_called_with(
-                "mount /dev/sda1 /mnt; xfs_growfs /mnt; umount /mnt", python_shell=True
+                ["mount", "/dev/sda1", "/tmp/yomi-resize-xxx"]
             )
+            rmdir.assert_called_with("/tmp/yomi-resize-xxx")
 
     def test_dump_resize(self):
         """Test images.dump function"""
         salt_mock = {
-            "cmd.run_stdout": MagicMock(return_value="ext4"),
+            "cmd.run_all": MagicMock(
+                side_effect=[
+                    {"retcode": 0, "stdout": "checksum"},
+                    {"retcode": 0},
+                    {"retcode": 0},
+                ]
+            ),
+            "cmd.run": MagicMock(return_value=""),
+        }
+
+        with patch.dict(images.__salt__, salt_mock):
+            result = images.dump(
+                "http://example.org/image.ext4",
+                "/dev/sda1",
+                checksum_type="md5",
+                checksum="checksum",
+                details=True,
+            )
+            self.assertEqual(result["checksum"], "checksum")
+            self.assertEqual(sorted(result["resize"]), ["check", "resize", "sync"])
+            salt_mock["cmd.run"].assert_called_with(["sync", "/dev/sda1"])
+
+    @patch("modules.images.superblock.read")
+    def test_dump_resize_clean(self, read):
+        """Test images.dump function with a clean ext4 image"""
+        read.return_value = {
+            "type": "ext4",
+            "clean": True,
+            "needs_recovery": False,
+            "mtime": 0,
+            "lastcheck": 1000,
+        }
+        salt_mock = {
             "cmd.run_all": MagicMock(
                 side_effect=[{"retcode": 0, "stdout": "checksum"}, {"retcode": 0}]
             ),
             "cmd.run": MagicMock(return_value=""),
         }
 
+        with patch.dict(images.__salt__, salt_mock):
+            result = images.dump(
+                "http://example.org/image.ext4",
+                "/dev/sda1",
+                checksum_type="md5",
+                checksum="checksum",
+                details=True,
+            )
+            self.assertEqual(sorted(result["resize"]), ["resize", "sync"])
+            salt_mock["cmd.run_all"].assert_called_with(["resize2fs", "/dev/sda1"])
+
+    @patch("modules.images.superblock.read")
+    def test_dump_resize_needs_recovery(self, read):
+        """Test images.dump function with a clean ext4 image with journal"""
+        read.return_value = {
+            "type": "ext4",
+            "clean": True,
+            "needs_recovery": True,
+            "mtime": 0,
+            "lastcheck": 1000,
+        }
+        salt_mock = {
+            "cmd.run_all": MagicMock(
+                side_effect=[
+                    {"retcode": 0, "stdout": "checksum"},
+                    {"retcode": 1},
+                    {"retcode": 0},
+                ]
+            ),
+            "cmd.run": MagicMock(return_value=""),
+        }
+
+        with patch.dict(images.__salt__, salt_mock):
+            result = images.dump(
+                "http://example.org/image.ext4",
+                "/dev/sda1",
+                checksum_type="md5",
+                checksum="checksum",
+                details=True,
+            )
+            self.assertEqual(sorted(result["resize"]), ["check", "resize", "sync"])
+            salt_mock["cmd.run_all"].assert_any_call(
+                ["e2fsck", "-f", "-y", "/dev/sda1"]
+            )
+
+    def test_dump_devices(self):
+        """Test images.dump function with many devices"""
+        salt_mock = {
+            "cmd.run_all": MagicMock(
+                side_effect=[
+                    {"retcode": 0, "stdout": "checksum"},
+                    {"retcode": 0},
+                    {"retcode": 0},
+                    {"retcode": 0},
+                    {"retcode": 0},
+                ]
+            ),
+            "cmd.run": MagicMock(return_value=""),
+        }
+
+        with patch.dict(images.__salt__, salt_mock):
+            self.assertEqual(
+                images.dump(
+                    "http://example.org/image.ext4",
+                    ["/dev/sda1", "/dev/sdb1"],
+                    checksum_type="md5",
+                    checksum="checksum",
+                ),
+                {"/dev/sda1": "checksum", "/dev/sdb1": "checksum"},
+            )
+            salt_mock["cmd.run_all"].assert_any_call(
+                "set -eo pipefail ; curl --fail --location --silent "
+                "http://example.org/image.ext4 | tee /dev/sda1 /dev/sdb1 | md5sum",
+                python_shell=True,
+            )
+            salt_mock["cmd.run_all"].assert_called_with(["resize2fs", "/dev/sdb1"])
+
+    def test_dump_whole_disk(self):
+        """Test images.dump function with a whole disk image"""
+        salt_mock = {
+            "cmd.run_stdout": MagicMock(return_value="gpt"),
+            "cmd.run_all": MagicMock(return_value={"retcode": 0, "stdout": "checksum"}),
+            "cmd.run": MagicMock(return_value=""),
+            "partition.list": MagicMock(
+                return_value={
+                    "partitions": {
+                        "1": {"start": "2048s", "end": "4095s"},
+                        "2": {"start": "4096s", "end": "1052671s"},
+                        "3": {"start": "1052672s", "end": "4194270s"},
+                    }
+                }
+            ),
+        }
+
+        with patch.dict(images.__salt__, salt_mock):
+            result = images.dump(
+                "http://example.org/image.raw",
+                "/dev/sda",
+                checksum_type="md5",
+                checksum="checksum",
+                whole_disk=True,
+                details=True,
+            )
+            self.assertEqual(result["partition"], "/dev/sda3")
+            self.assertIn("partition", result["resize"])
+            salt_mock["cmd.run_all"].assert_any_call(
+                ["sgdisk", "--move-second-header", "/dev/sda"]
+            )
+            salt_mock["cmd.run_all"].assert_any_call(
+                ["parted", "--script", "/dev/sda", "resizepart", "3", "100%"]
+            )
+            salt_mock["cmd.run_all"].assert_called_with(["resize2fs", "/dev/sda3"])
+            salt_mock["cmd.run"].assert_called_with(["sync", "/dev/sda3"])
+
+    def test_dump_whole_disk_unordered(self):
+        """Test images.dump function with the first partition at the end"""
+        salt_mock = {
+            "cmd.run_stdout": MagicMock(return_value="gpt"),
+            "cmd.run_all": MagicMock(return_value={"retcode": 0, "stdout": "checksum"}),
+            "cmd.run": MagicMock(return_value=""),
+            "partition.list": MagicMock(
+                return_value={
+                    "partitions": {
+                        "1": {"start": "1054720s", "end": "4194270s"},
+                        "2": {"start": "2048s", "end": "4095s"},
+                        "3": {"start": "4096s", "end": "1054719s"},
+                    }
+                }
+            ),
+        }
+
+        with patch.dict(images.__salt__, salt_mock):
+            result = images.dump(
+                "http://example.org/image.raw",
+                "/dev/sda",
+                checksum_type="md5",
+                checksum="checksum",
+                whole_disk=True,
+                details=True,
+            )
+            self.assertEqual(result["partition"], "/dev/sda1")
+            salt_mock["cmd.run_all"].assert_any_call(
+                ["parted", "--script", "/dev/sda", "resizepart", "1", "100%"]
+            )
+            salt_mock["cmd.run_all"].assert_called_with(["resize2fs", "/dev/sda1"])
+
+    def test_dump_whole_disk_logical(self):
+        """Test images.dump function with a whole disk image and MBR"""
+        salt_mock = {
+            "cmd.run_stdout": MagicMock(return_value="dos"),
+            "cmd.run_all": MagicMock(return_value={"retcode": 0, "stdout": "checksum"}),
+            "cmd.run": MagicMock(return_value=""),
+            "partition.list": MagicMock(
+                return_value={
+                    "partitions": {
+                        "1": {"start": "2048s", "end": "1050623s"},
+                        "2": {"start": "1050624s", "end": "4194303s"},
+                        "5": {"start": "1052672s", "end": "4194303s"},
+                    }
+                }
+            ),
+        }
+
+        with patch.dict(images.__salt__, salt_mock):
+            self.assertEqual(
+                images.dump(
+                    "http://example.org/image.raw",
+                    "/dev/nvme0n1",
+                    checksum_type="md5",
+                    checksum="checksum",
+                    whole_disk=True,
+                ),
+                "checksum",
+            )
+            resizepart = [
+                c[0][0][4]
+                for c in salt_mock["cmd.run_all"].call_args_list
+                if "resizepart" in c[0][0]
+            ]
+            self.assertEqual(resizepart, ["2", "5"])
+            salt_mock["cmd.run_all"].assert_called_with(["resize2fs", "/dev/nvme0n1p5"])
+
+    def test_dump_whole_disk_no_table(self):
+        """Test images.dump function with a whole disk image without table"""
+        salt_mock = {
+            "cmd.run_stdout": MagicMock(return_value=""),
+            "cmd.run_all": MagicMock(return_value={"retcode": 0, "stdout": "checksum"}),
+        }
+
+        with patch.dict(images.__salt__, salt_mock):
+            with self.assertRaises(CommandExecutionError):
+                images.dump(
+                    "http://example.org/image.raw",
+                    "/dev/sda",
+                    checksum_type="md5",
+                    checksum="checksum",
+                    whole_disk=True,
+                )
+
+    @patch("modules.images.imagestream.copy")
+    def test_dump_native_devices(self, copy):
+        """Test images.dump function with many devices and one failing"""
+        copy.return_value = {
+            "checksum": "checksum",
+            "size": 8,
+            "written": 8,
+            "seconds": 1.0,
+            "throughput": 8e-6,
+            "devices": {
+                "/dev/sda1": {"written": 8, "skipped": 0, "checksum": "checksum"},
+                "/dev/sdb1": {"written": 0, "skipped": 0, "error": "error"},
+            },
+        }
+        salt_mock = {
+            "cmd.run_all": MagicMock(return_value={"retcode": 0}),
+            "cmd.run": MagicMock(return_value=""),
+        }
+
+        with patch.dict(images.__salt__, salt_mock):
+            self.assertEqual(
+                images.dump(
+                    "http://example.org/image.ext4",
+                    ["/dev/sda1", "/dev/sdb1"],
+                    native=True,
+                ),
+                {"/dev/sda1": "checksum", "/dev/sdb1": None},
+            )
+            salt_mock["cmd.run_all"].assert_any_call(
+                ["e2fsck", "-f", "-y", "/dev/sda1"]
+            )
+            salt_mock["cmd.run_all"].assert_called_with(["resize2fs", "/dev/sda1"])
+            salt_mock["cmd.run"].assert_called_once_with(["sync", "/dev/sda1"])
+
+    def test_dump_native_invalid_scheme(self):
+        """Test images.dump function with the native engine and tftp"""
+        with self.assertRaises(SaltInvocationError):
+            images.dump("tftp://example.org/image.xz", "/dev/sda1", native=True)
+
+    def test_dump_native_curl_params(self):
+        """Test images.dump function with the native engine and curl params"""
+        with self.assertRaises(SaltInvocationError):
+            images.dump(
+                "http://example.org/image.xz", "/dev/sda1", native=True, insecure=None
+            )
+
+    def test_dump_sparse_invalid(self):
+        """Test images.dump function with an invalid sparse mode"""
+        with self.assertRaises(SaltInvocationError):
+            images.dump("http://example.org/image.xz", "/dev/sda1", sparse="trim")
+
+    def test_dump_sparse_not_native(self):
+        """Test images.dump function with sparse mode and curl"""
+        with self.assertRaises(SaltInvocationError):
+            images.dump("http://example.org/image.xz", "/dev/sda1", sparse="skip")
+
+    @patch("modules.images.imagestream.copy")
+    def test_dump_native_fail(self, copy):
+        """Test images.dump function when the native engine fails"""
+        copy.side_effect = images.imagestream.StreamException("error")
+        with self.assertRaises(CommandExecutionError):
+            images.dump("http://example.org/image.xz", "/dev/sda1", native=True)
+        copy.assert_called_with(
+            "http://example.org/image.xz",
+            "/dev/sda1",
+            "xz",
+            "md5",
+            direct=False,
+            sparse=None,
+            bmap=None,
+            cache=None,
+            cache_key=None,
+            expected_checksum=None,
+            connections=None,
+            threads=None,
+            progress=None,
+            verify=False,
+            opener=None,
+            rate=None,
+            adaptive=False,
+        )
+
+    @patch("modules.images.imagestream.copy")
+    def test_dump_native(self, copy):
+        """Test images.dump function with the native engine"""
+        result = {
+            "checksum": "checksum",
+            "read": 10,
+            "size": 20,
+            "written": 20,
+            "seconds": 1.0,
+            "throughput": 20e-6,
+        }
+        copy.return_value = result
+        salt_mock = {
+            "cmd.run_all": MagicMock(return_value={"retcode": 0}),
+            "cmd.run": MagicMock(return_value=""),
+        }
+
         with patch.dict(images.__salt__, salt_mock):
             self.assertEqual(
                 images.dump(
                     "http://example.org/image.ext4",
                     "/dev/sda1",
+                    checksum_type="sha1",
+                    checksum="checksum",
+                    native=True,
+                    direct=True,
+                    sparse="zeroout",
+                ),
+                "checksum",
+            )
+            copy.assert_called_with(
+                "http://example.org/image.ext4",
+                "/dev/sda1",
+                None,
+                "sha1",
+                direct=True,
+                sparse="zeroout",
+                bmap=None,
+                cache=None,
+                cache_key="sha1-checksum",
+                expected_checksum="checksum",
+                connections=None,
+                threads=None,
+                progress=None,
+                verify=False,
+                opener=None,
+                rate=None,
+                adaptive=False,
+            )
+
+            self.assertEqual(
+                images.dump(
+                    "http://example.org/image.ext4",
+                    "/dev/sda1",
+                    checksum_type="sha1",
+                    checksum="checksum",
+                    native=True,
+                    details=True,
+                ),
+                result,
+            )
+
+    def test_dump_cache_not_native(self):
+        """Test images.dump function with cache and curl"""
+        with self.assertRaises(SaltInvocationError):
+            images.dump("http://example.org/image.xz", "/dev/sda1", cache="/tmp")
+
+    @patch("modules.images.imagecache.Cache")
+    @patch("modules.images.imagestream.copy")
+    def test_dump_cache(self, copy, Cache):
+        """Test images.dump function with a cache"""
+        cache = Cache.return_value
+        cache.fetch.return_value = "checksum -"
+        copy.return_value = {
+            "checksum": "checksum",
+            "size": 8,
+            "written": 8,
+            "seconds": 1.0,
+            "throughput": 8e-6,
+            "cached": True,
+        }
+        salt_mock = {
+            "cmd.run_all": MagicMock(return_value={"retcode": 0}),
+            "cmd.run": MagicMock(return_value=""),
+        }
+
+        with patch.dict(images.__salt__, salt_mock):
+            self.assertEqual(
+                images.dump(
+                    "http://example.org/image.xz",
+                    "/dev/sda1",
                     checksum_type="md5",
+                    native=True,
+                    cache="/dev/shm/images",
+                    cache_size=100,
+                ),
+                "checksum",
+            )
+            Cache.assert_called_with("/dev/shm/images", 100000000)
+            cache.fetch.assert_called_with("http://example.org/image.md5")
+            copy.assert_called_with(
+                "http://example.org/image.xz",
+                "/dev/sda1",
+                "xz",
+                "md5",
+                direct=False,
+                sparse=None,
+                bmap=None,
+                cache=cache,
+                cache_key="md5-checksum",
+                expected_checksum="checksum",
+                connections=None,
+                threads=None,
+                progress=None,
+                verify=False,
+                opener=None,
+                rate=None,
+                adaptive=False,
+            )
+
+    @patch("modules.images.imagecache.Cache")
+    def test_fetch_checksum_cache(self, Cache):
+        """Test images.fetch_checksum function with a cache"""
+        cache = Cache.return_value
+        cache.fetch.side_effect = images.imagestream.StreamException("error")
+        with self.assertRaises(CommandExecutionError):
+            images.fetch_checksum("http://url/image.xz", "md5", cache="/tmp")
+
+        with self.assertRaises(SaltInvocationError):
+            images.fetch_checksum("tftp://url/image.xz", "md5", cache="/tmp")
+
+        cache.fetch.side_effect = None
+        cache.fetch.return_value = "mychecksum -"
+        self.assertEqual(
+            images.fetch_checksum("http://url/image.xz", "md5", cache="/tmp"),
+            "mychecksum",
+        )
+        Cache.assert_called_with("/tmp", None)
+
+    @patch("modules.images.imagestream.copy")
+    def test_dump_progress(self, copy):
+        """Test images.dump function sending progress events"""
+        report = {"read": 1, "total": 2, "written": 2, "throughput": 1.0, "eta": 1}
+
+        def _copy(*args, **kwargs):
+            kwargs["progress"](report)
+            return {
+                "checksum": "checksum",
+                "size": 2,
+                "written": 2,
+                "seconds": 1.0,
+                "throughput": 2e-6,
+            }
+
+        copy.side_effect = _copy
+        salt_mock = {
+            "cmd.run_all": MagicMock(return_value={"retcode": 0}),
+            "cmd.run": MagicMock(return_value=""),
+            "event.send": MagicMock(side_effect=Exception()),
+        }
+
+        with patch.dict(images.__salt__, salt_mock):
+            self.assertEqual(
+                images.dump(
+                    "http://example.org/image.ext4",
+                    "/dev/sda1",
+                    native=True,
+                    event_tag="yomi/dump_image_into_/dev/sda1",
+                ),
+                "checksum",
+            )
+            salt_mock["event.send"].assert_called_with(
+                "yomi/dump_image_into_/dev/sda1/progress", report
+            )
+
+    def test_dump_verify_not_native(self):
+        """Test images.dump function with verification and curl"""
+        with self.assertRaises(SaltInvocationError):
+            images.dump("http://example.org/image.xz", "/dev/sda1", verify=True)
+
+    def test_dump_multicast_invalid(self):
+        """Test images.dump function with invalid multicast parameters"""
+        url = "multicast://239.255.42.1:9000"
+        with self.assertRaises(SaltInvocationError):
+            images.dump(url, "/dev/sda1")
+        with self.assertRaises(SaltInvocationError):
+            images.dump(url, "/dev/sda1", checksum_type="md5", native=True)
+        with self.assertRaises(SaltInvocationError):
+            images.dump(url, "/dev/sda1", native=True, bmap=True)
+
+    @patch("modules.images._resize")
+    @patch("modules.images.imagestream.copy")
+    def test_dump_multicast(self, copy, _resize):
+        """Test images.dump function with a multicast URL"""
+        copy.return_value = {
+            "checksum": "checksum",
+            "checksums": {"md5": "checksum"},
+            "size": 1,
+            "written": 1,
+            "seconds": 1,
+            "throughput": 1,
+        }
+        url = "multicast://239.255.42.1:9000"
+        self.assertEqual(
+            images.dump(
+                url, "/dev/sda1", checksum_type="md5", checksum="checksum", native=True
+            ),
+            "checksum",
+        )
+        opener = copy.call_args[1]["opener"]
+        self.assertEqual(opener.func, images.multicast.open_multicast)
+        self.assertEqual(opener.keywords, {"spool": None})
+
+    def test_dump_tracker_invalid(self):
+        """Test images.dump function with invalid swarm parameters"""
+        tracker = "http://master:6969"
+        with self.assertRaises(SaltInvocationError):
+            images.dump("http://example.org/image.xz", "/dev/sda1", tracker=tracker)
+        with self.assertRaises(SaltInvocationError):
+            images.dump(
+                "http://example.org/image.xz", "/dev/sda1", native=True, tracker=tracker
+            )
+        with self.assertRaises(SaltInvocationError):
+            images.dump(
+                "ftp://example.org/image.xz",
+                "/dev/sda1",
+                checksum_type="md5",
+                checksum="checksum",
+                native=True,
+                tracker=tracker,
+            )
+
+    @patch("modules.images._resize")
+    @patch("modules.images._fetch_file")
+    @patch("modules.images.swarm.Peer")
+    @patch("modules.images.imagestream.copy")
+    def test_dump_tracker(self, copy, Peer, _fetch_file, _resize):
+        """Test images.dump function sharing the image with a swarm"""
+        copy.return_value = {
+            "checksum": "checksum",
+            "checksums": {"md5": "checksum"},
+            "size": 1,
+            "written": 1,
+            "seconds": 1,
+            "throughput": 1,
+        }
+        _fetch_file.return_value = '{"size": 1, "chunk_size": 4, "hashes": ["h"]}'
+        peer = Peer.return_value
+        peer.stats = {"origin": 1, "peers": 0, "served": 0}
+
+        result = images.dump(
+            "http://example.org/image.xz",
+            "/dev/sda1",
+            checksum_type="md5",
+            checksum="checksum",
+            native=True,
+            tracker="http://master:6969",
+            seed=60,
+            details=True,
+        )
+        self.assertEqual(result["swarm"], {"origin": 1, "peers": 0, "served": 0})
+        _fetch_file.assert_called_with("http://example.org/image.chunks")
+        Peer.assert_called_with(
+            "md5-checksum",
+            {"size": 1, "chunk_size": 4, "hashes": ["h"]},
+            "http://master:6969",
+            spool=None,
+            limiter=None,
+        )
+        self.assertEqual(copy.call_args[1]["opener"], peer.open)
+        peer.seed.assert_called_with(60)
+        peer.close.assert_called_once()
+
+    @patch("modules.images._resize")
+    @patch("modules.images._fetch_file")
+    @patch("modules.images.swarm.Peer")
+    @patch("modules.images.imagestream.copy")
+    def test_dump_tracker_rate(self, copy, Peer, _fetch_file, _resize):
+        """Test images.dump function limiting the origin of a swarm"""
+        copy.return_value = {
+            "checksum": "checksum",
+            "checksums": {"md5": "checksum"},
+            "size": 1,
+            "written": 1,
+            "seconds": 1,
+            "throughput": 1,
+        }
+        _fetch_file.return_value = '{"size": 1, "chunk_size": 4, "hashes": ["h"]}'
+        peer = Peer.return_value
+        peer.stats = {"origin": 1, "peers": 0, "served": 0}
+        peer.limiter.as_dict.return_value = {"max_rate": 2.5}
+
+        result = images.dump(
+            "http://example.org/image.xz",
+            "/dev/sda1",
+            checksum_type="md5",
+            checksum="checksum",
+            native=True,
+            tracker="http://master:6969",
+            rate=2.5,
+            adaptive=True,
+            details=True,
+        )
+        limiter = Peer.call_args[1]["limiter"]
+        self.assertEqual(limiter.max_rate, 2500000)
+        self.assertTrue(limiter.adaptive)
+        # The reads from the spool are not limited
+        self.assertIsNone(copy.call_args[1]["rate"])
+        self.assertEqual(result["rate"], {"max_rate": 2.5})
+
+    @patch("modules.images._fetch_file")
+    @patch("modules.images.swarm.Peer")
+    @patch("modules.images.imagestream.copy")
+    def test_dump_tracker_fail(self, copy, Peer, _fetch_file):
+        """Test images.dump function when the copy from a swarm fails"""
+        copy.side_effect = images.imagestream.StreamException("error")
+        _fetch_file.return_value = '{"size": 1, "chunk_size": 4, "hashes": ["h"]}'
+
+        with self.assertRaises(CommandExecutionError):
+            images.dump(
+                "http://example.org/image.xz",
+                "/dev/sda1",
+                checksum_type="md5",
+                checksum="checksum",
+                native=True,
+                tracker="http://master:6969",
+                seed=60,
+            )
+        Peer.return_value.seed.assert_not_called()
+        Peer.return_value.close.assert_called_once()
+
+    @patch("modules.images._fetch_file")
+    def test_dump_tracker_no_manifest(self, _fetch_file):
+        """Test images.dump function when the manifest is missing"""
+        _fetch_file.return_value = ""
+        with self.assertRaises(CommandExecutionError):
+            images.dump(
+                "http://example.org/image.xz",
+                "/dev/sda1",
+                checksum_type="md5",
+                checksum="checksum",
+                native=True,
+                tracker="http://master:6969",
+            )
+
+    def test_dump_rate_invalid(self):
+        """Test images.dump function with an invalid rate"""
+        url = "http://example.org/image.xz"
+        with self.assertRaises(SaltInvocationError):
+            images.dump(url, "/dev/sda1", rate=0)
+        with self.assertRaises(SaltInvocationError):
+            images.dump(url, "/dev/sda1", rate=10, adaptive=True)
+        with self.assertRaises(SaltInvocationError):
+            images.dump(url, "/dev/sda1", native=True, adaptive=True)
+
+    def test_dump_rate_curl(self):
+        """Test images.dump function with a rate limit and curl"""
+        salt_mock = {
+            "cmd.run_all": MagicMock(return_value={"retcode": 1, "stderr": "error"}),
+        }
+
+        with patch.dict(images.__salt__, salt_mock):
+            with self.assertRaises(CommandExecutionError):
+                images.dump("http://example.org/image.ext4", "/dev/sda1", rate=2.5)
+            salt_mock["cmd.run_all"].assert_called_with(
+                "set -eo pipefail ; curl --fail --location --silent "
+                "--limit-rate 2500000 http://example.org/image.ext4 | tee /dev/sda1 "
+                "| md5sum",
+                python_shell=True,
+            )
+
+    @patch("modules.images._resize")
+    @patch("modules.images.downloads.Slot")
+    @patch("modules.images.imagestream.copy")
+    def test_dump_rate_slots(self, copy, Slot, _resize):
+        """Test images.dump function with a rate limit and a slot"""
+        copy.return_value = {
+            "checksum": "checksum",
+            "checksums": {"md5": "checksum"},
+            "size": 1,
+            "written": 1,
+            "seconds": 1,
+            "throughput": 1,
+            "rate": {"max_rate": 50, "rate": 25, "backoffs": 1},
+        }
+        slot = Slot.return_value.__enter__.return_value
+        slot.waited = 10
+        _resize.side_effect = lambda device: Slot.return_value.__exit__.assert_called()
+
+        self.assertEqual(
+            images.dump(
+                "http://example.org/image.xz",
+                "/dev/sda1",
+                native=True,
+                rate=50,
+                adaptive=True,
+                slots="http://master:6970",
+            ),
+            "checksum",
+        )
+        self.assertEqual(copy.call_args[1]["rate"], 50 * 1000**2)
+        self.assertTrue(copy.call_args[1]["adaptive"])
+        Slot.assert_called_with("http://master:6970", timeout=images.SLOT_TIMEOUT)
+        _resize.assert_called_with("/dev/sda1")
+
+    @patch("modules.images._resize")
+    @patch("modules.images.downloads.Slot")
+    @patch("modules.images.imagestream.copy")
+    def test_dump_slot_timeout(self, copy, Slot, _resize):
+        """Test images.dump function with a timeout for the slot"""
+        copy.return_value = {
+            "checksum": "checksum",
+            "size": 1,
+            "written": 1,
+            "seconds": 1,
+            "throughput": 1,
+        }
+        Slot.return_value.__enter__.return_value.waited = 0
+        images.dump(
+            "http://example.org/image.xz",
+            "/dev/sda1",
+            native=True,
+            slots="http://master:6970",
+            slot_timeout=60,
+        )
+        Slot.assert_called_with("http://master:6970", timeout=60)
+
+    @patch("modules.images.downloads.Slot")
+    def test_dump_slots_fail(self, Slot):
+        """Test images.dump function when there is no slot"""
+        Slot.return_value.__enter__.side_effect = images.imagestream.StreamException(
+            "error"
+        )
+        with self.assertRaises(CommandExecutionError):
+            images.dump(
+                "http://example.org/image.xz",
+                "/dev/sda1",
+                native=True,
+                slots="http://master:6970",
+            )
+
+    def test_dump_tune_invalid(self):
+        """Test images.dump function with invalid tuning options"""
+        url = "http://example.org/image.xz"
+        with self.assertRaises(SaltInvocationError):
+            images.dump(url, "/dev/sda1", tune="yes")
+        with self.assertRaises(SaltInvocationError):
+            images.dump(url, "/dev/sda1", tune={"nr_requests": 1024})
+
+    @patch("modules.images._resize")
+    @patch("modules.images.blocktune.Session")
+    @patch("modules.images.imagestream.copy")
+    def test_dump_tune(self, copy, Session, _resize):
+        """Test images.dump function tuning the device"""
+        copy.return_value = {
+            "checksum": "checksum",
+            "checksums": {"md5": "checksum"},
+            "size": 1,
+            "written": 1,
+            "seconds": 1,
+            "throughput": 1,
+        }
+        session = Session.return_value.__enter__.return_value
+        session.report = {"settings": {}, "read_throughput": {}}
+        _resize.side_effect = (
+            lambda device: Session.return_value.__exit__.assert_called()
+        )
+
+        result = images.dump(
+            "http://example.org/image.xz",
+            "/dev/sda1",
+            native=True,
+            tune={"read_ahead_kb": 8192, "probe": True},
+            details=True,
+        )
+        self.assertEqual(result["tune"], {"settings": {}, "read_throughput": {}})
+        Session.assert_called_with("/dev/sda1", {"read_ahead_kb": 8192, "probe": True})
+
+    @patch("modules.images.imagestream.copy")
+    def test_dump_verify_fail(self, copy):
+        """Test images.dump function when the verification fails"""
+        copy.side_effect = images.imagestream.StreamException(
+            "Verification of /dev/sda1 failed at offset 4096"
+        )
+        with self.assertRaisesRegex(CommandExecutionError, "offset 4096"):
+            images.dump(
+                "http://example.org/image.xz", "/dev/sda1", native=True, verify=True
+            )
+        self.assertTrue(copy.call_args[1]["verify"])
+
+    def test_dump_checksums_not_native(self):
+        """Test images.dump function with many checksums and curl"""
+        with self.assertRaises(SaltInvocationError):
+            images.dump("http://example.org/image.xz", "/dev/sda1", checksums=["md5"])
+
+    def test_dump_checksums_invalid(self):
+        """Test images.dump function with an invalid checksum type"""
+        with self.assertRaises(SaltInvocationError):
+            images.dump(
+                "http://example.org/image.xz",
+                "/dev/sda1",
+                native=True,
+                checksums=["crc32"],
+            )
+
+    @patch("modules.images.imagestream.copy")
+    def test_dump_checksums(self, copy):
+        """Test images.dump function with many checksums"""
+        result = {
+            "checksum": "checksum",
+            "checksums": {"sha256": "checksum", "md5": "md5", "sha1": "sha1"},
+            "size": 8,
+            "written": 8,
+            "seconds": 1.0,
+            "throughput": 8e-6,
+        }
+        copy.return_value = result
+        salt_mock = {
+            "cmd.run_all": MagicMock(return_value={"retcode": 0}),
+            "cmd.run": MagicMock(return_value=""),
+        }
+
+        with patch.dict(images.__salt__, salt_mock):
+            self.assertEqual(
+                images.dump(
+                    "http://example.org/image.ext4",
+                    "/dev/sda1",
+                    checksum_type="sha256",
                     checksum="checksum",
+                    checksums={"md5": "md5", "sha1": None, "sha256": None},
+                    native=True,
+                    details=True,
+                ),
+                result,
+            )
+            self.assertEqual(copy.call_args[0][3], ["sha256", "md5", "sha1"])
+
+            with self.assertRaises(CommandExecutionError):
+                images.dump(
+                    "http://example.org/image.ext4",
+                    "/dev/sda1",
+                    checksum_type="sha256",
+                    checksum="checksum",
+                    checksums={"md5": "other"},
+                    native=True,
+                )
+
+    def test_dump_bmap_not_native(self):
+        """Test images.dump function with bmap and curl"""
+        with self.assertRaises(SaltInvocationError):
+            images.dump("http://example.org/image.xz", "/dev/sda1", bmap=True)
+
+    def test_dump_bmap_not_found(self):
+        """Test images.dump function when the bmap file is missing"""
+        salt_mock = {
+            "cmd.run_stdout": MagicMock(return_value=""),
+        }
+
+        with patch.dict(images.__salt__, salt_mock):
+            with self.assertRaises(CommandExecutionError):
+                images.dump(
+                    "http://example.org/image.xz", "/dev/sda1", native=True, bmap=True
+                )
+            salt_mock["cmd.run_stdout"].assert_called_with(
+                ["curl", "--silent", "--location", "http://example.org/image.bmap"]
+            )
+
+    @patch("modules.images.imagestream.copy")
+    def test_dump_bmap(self, copy):
+        """Test images.dump function with bmap"""
+        bmap = (
+            '<bmap version="2.0"><ImageSize>8</ImageSize>'
+            "<BlockSize>4</BlockSize><ChecksumType>sha256</ChecksumType>"
+            "<BlockMap><Range>0</Range></BlockMap></bmap>"
+        )
+        copy.return_value = {
+            "checksum": "checksum",
+            "size": 8,
+            "written": 4,
+            "seconds": 1.0,
+            "throughput": 8e-6,
+        }
+        salt_mock = {
+            "cmd.run_stdout": MagicMock(return_value=bmap),
+            "cmd.run_all": MagicMock(return_value={"retcode": 0}),
+            "cmd.run": MagicMock(return_value=""),
+        }
+
+        with patch.dict(images.__salt__, salt_mock):
+            self.assertEqual(
+                images.dump(
+                    "http://example.org/image.ext4",
+                    "/dev/sda1",
+                    native=True,
+                    bmap="http://example.org/other.bmap",
                 ),
                 "checksum",
             )
-            salt_mock["cmd.run"].assert_called_with("sync")
+            salt_mock["cmd.run_stdout"].assert_any_call(
+                ["curl", "--silent", "--location", "http://example.org/other.bmap"]
+            )
+            bmap = copy.call_args[1]["bmap"]
+            self.assertEqual(bmap.ranges, [(0, 0, None)])
+
+    @patch("modules.images.imagestream.create_used_blocks")
+    @patch("modules.images.superblock.read")
+    def test_create_used_blocks_ext4(self, read, create_used_blocks):
+        """Test images.create_used_blocks function with ext4"""
+        read.return_value = {"type": "ext4"}
+        create_used_blocks.return_value = {"size": 8192, "blocks": 2, "used": 1}
+        salt_mock = {
+            "cmd.run_all": MagicMock(return_value={"retcode": 1}),
+        }
+
+        with patch.dict(images.__salt__, salt_mock):
+            self.assertEqual(
+                images.create_used_blocks("/tmp/image.ext4", "/tmp/image.ub"),
+                {"size": 8192, "blocks": 2, "used": 1},
+            )
+            salt_mock["cmd.run_all"].assert_called_once_with(
+                ["e2fsck", "-f", "-y", "-E", "discard", "/tmp/image.ext4"]
+            )
+            create_used_blocks.assert_called_with(
+                "/tmp/image.ext4", "/tmp/image.ub", 4096
+            )
+
+    @patch("modules.images.os.rmdir")
+    @patch("modules.images.tempfile.mkdtemp")
+    @patch("modules.images.imagestream.create_used_blocks")
+    @patch("modules.images.superblock.read")
+    def test_create_used_blocks_xfs(self, read, create_used_blocks, mkdtemp, rmdir):
+        """Test images.create_used_blocks function with xfs"""
+        read.return_value = {"type": "xfs"}
+        mkdtemp.return_value = "/tmp/yomi-image-xxx"
+        salt_mock = {
+            "cmd.run_all": MagicMock(
+                side_effect=[
+                    {"retcode": 0},
+                    {"retcode": 1, "stderr": "error"},
+                    {"retcode": 0},
+                ]
+            ),
+        }
+
+        with patch.dict(images.__salt__, salt_mock):
+            with self.assertRaises(CommandExecutionError):
+                images.create_used_blocks("/tmp/image.xfs", "/tmp/image.ub")
+            salt_mock["cmd.run_all"].assert_any_call(
+                ["mount", "-o", "loop", "/tmp/image.xfs", "/tmp/yomi-image-xxx"]
+            )
+            salt_mock["cmd.run_all"].assert_called_with(
+                ["umount", "/tmp/yomi-image-xxx"]
+            )
+            rmdir.assert_called_with("/tmp/yomi-image-xxx")
+            create_used_blocks.assert_not_called()
+
+    @patch("modules.images.superblock.read")
+    def test_create_used_blocks_invalid(self, read):
+        """Test images.create_used_blocks function with an unknown filesystem"""
+        read.return_value = None
+        with self.assertRaises(SaltInvocationError):
+            images.create_used_blocks("/tmp/image.raw", "/tmp/image.ub")
+
+    def test_dump_send_stream_invalid(self):
+        """Test images.dump function with a send stream and invalid options"""
+        with self.assertRaises(SaltInvocationError):
+            images.dump("http://example.org/image.btrfs", "/dev/sda1", send_stream=True)
+        with self.assertRaises(SaltInvocationError):
+            images.dump(
+                "http://example.org/image.btrfs",
+                "/dev/sda1",
+                native=True,
+                send_stream=True,
+                sparse="skip",
+            )
+
+    @patch("modules.images.os")
+    @patch("modules.images.tempfile.mkdtemp")
+    @patch("modules.images.imagestream.PipeWriter")
+    @patch("modules.images.imagestream.copy")
+    def test_dump_send_stream(self, copy, PipeWriter, mkdtemp, os_):
+        """Test images.dump function with a btrfs send stream"""
+        copy.return_value = {
+            "checksum": "checksum",
+            "size": 8,
+            "written": 8,
+            "seconds": 1.0,
+            "throughput": 8e-6,
+        }
+        mkdtemp.return_value = "/tmp/yomi-receive-xxx"
+        os_.path = os.path
+        os_.listdir.return_value = ["snapshot"]
+        salt_mock = {
+            "cmd.run_all": MagicMock(return_value={"retcode": 0}),
+            "cmd.run": MagicMock(return_value=""),
+        }
+
+        with patch.dict(images.__salt__, salt_mock):
+            result = images.dump(
+                "http://example.org/image.btrfs.zst",
+                "/dev/sda1",
+                checksum_type="md5",
+                checksum="checksum",
+                native=True,
+                send_stream=True,
+                subvolume="@",
+                details=True,
+            )
+            self.assertEqual(result["subvolume"], "@")
+            self.assertNotIn("resize", result)
+            PipeWriter.assert_called_with(
+                ["btrfs", "receive", "-e", "/tmp/yomi-receive-xxx/.yomi-receive"]
+            )
+            self.assertEqual(copy.call_args[0][1], PipeWriter.return_value)
+            os_.rename.assert_called_with(
+                "/tmp/yomi-receive-xxx/.yomi-receive/snapshot",
+                "/tmp/yomi-receive-xxx/@",
+            )
+            for cmd in (
+                ["mkfs.btrfs", "--force", "/dev/sda1"],
+                ["btrfs", "property", "set", "-ts", "/tmp/yomi-receive-xxx/@"]
+                + ["ro", "false"],
+                ["btrfs", "subvolume", "set-default", "/tmp/yomi-receive-xxx/@"],
+            ):
+                salt_mock["cmd.run_all"].assert_any_call(cmd)
+            salt_mock["cmd.run_all"].assert_called_with(
+                ["umount", "/tmp/yomi-receive-xxx"]
+            )
+            os_.rmdir.assert_called_with("/tmp/yomi-receive-xxx")
+
+    @patch("modules.images.os")
+    @patch("modules.images.tempfile.mkdtemp")
+    @patch("modules.images.imagestream.PipeWriter")
+    @patch("modules.images.imagestream.copy")
+    def test_dump_send_stream_many(self, copy, PipeWriter, mkdtemp, os_):
+        """Test images.dump function with a send stream of many subvolumes"""
+        copy.return_value = {
+            "checksum": "checksum",
+            "size": 8,
+            "written": 8,
+            "seconds": 1.0,
+            "throughput": 8e-6,
+        }
+        mkdtemp.return_value = "/tmp/yomi-receive-xxx"
+        os_.path = os.path
+        os_.listdir.return_value = ["a", "b"]
+        salt_mock = {
+            "cmd.run_all": MagicMock(return_value={"retcode": 0}),
+        }
+
+        with patch.dict(images.__salt__, salt_mock):
+            with self.assertRaises(CommandExecutionError):
+                images.dump(
+                    "http://example.org/image.btrfs",
+                    "/dev/sda1",
+                    native=True,
+                    send_stream=True,
+                )
+            salt_mock["cmd.run_all"].assert_called_with(
+                ["umount", "/tmp/yomi-receive-xxx"]
+            )
+
+    def test_golden_key(self):
+        """Test images.golden_key function"""
+        pillar = {
+            "software": {"packages": ["vim"], "golden": {"store": "/srv/golden"}},
+            "filesystems": {"/dev/sda1": {"filesystem": "btrfs"}},
+        }
+        key = images.golden_key(pillar, {"cpuarch": "x86_64"})
+        self.assertTrue(key.startswith("golden-"))
+
+        # The store is not part of the key
+        pillar["software"]["golden"]["store"] = "/srv/other"
+        self.assertEqual(images.golden_key(pillar, {"cpuarch": "x86_64"}), key)
+
+        pillar["software"]["packages"].append("emacs")
+        self.assertNotEqual(images.golden_key(pillar, {"cpuarch": "x86_64"}), key)
+        pillar["software"]["packages"].remove("emacs")
+        self.assertNotEqual(images.golden_key(pillar, {"cpuarch": "aarch64"}), key)
+
+    def test_golden_key_suseconnect(self):
+        """Test images.golden_key function with a registration"""
+        pillar = {
+            "software": {"packages": ["vim"]},
+            "suseconnect": {
+                "config": {"regcode": "SECRET-CODE"},
+                "products": ["sle-module-basesystem/15.2/x86_64"],
+            },
+        }
+        key = images.golden_key(pillar)
+        self.assertNotEqual(images.golden_key({"software": pillar["software"]}), key)
+
+        # The codes used for the registration are not part of the key
+        pillar["suseconnect"]["config"]["regcode"] = "OTHER-CODE"
+        pillar["suseconnect"]["config"]["email"] = "admin@example.org"
+        self.assertEqual(images.golden_key(pillar), key)
+
+        # Different modules are a different golden root
+        pillar["suseconnect"]["products"].append(
+            {"name": "sle-module-live-patching/15.2/x86_64", "regcode": "CODE"}
+        )
+        other = images.golden_key(pillar)
+        self.assertNotEqual(other, key)
+        pillar["suseconnect"]["products"][1]["regcode"] = "OTHER"
+        self.assertEqual(images.golden_key(pillar), other)
+
+    @patch("modules.images._golden_mounts")
+    @patch("modules.images.os.replace")
+    @patch("modules.images.os.makedirs")
+    def test_golden_create(self, makedirs, replace, _golden_mounts):
+        """Test images.golden_create function"""
+        _golden_mounts.return_value = ["./home", "./var"]
+        salt_mock = {
+            "cmd.run_all": MagicMock(return_value={"retcode": 0}),
+        }
+
+        with patch.dict(images.__salt__, salt_mock):
+            result = images.golden_create("/mnt", "/srv/golden", "golden-key")
+            self.assertEqual(result["path"], "/srv/golden/golden-key.tar.zst")
+            cmd = salt_mock["cmd.run_all"].call_args[0][0]
+            self.assertEqual(cmd[:2], ["tar", "--create"])
+            self.assertIn("--exclude=./etc/fstab", cmd)
+            self.assertIn("--exclude=./.snapshots", cmd)
+            self.assertIn("--one-file-system", cmd)
+            self.assertEqual(cmd[-5:], ["--directory", "/mnt", ".", "./home", "./var"])
+            replace.assert_called_with(cmd[3], "/srv/golden/golden-key.tar.zst")
+            _golden_mounts.assert_called_with("/mnt")
+
+    def test_golden_mounts(self):
+        """Test images._golden_mounts function"""
+        mountinfo = (
+            "22 1 0:21 / / rw - btrfs /dev/sda2 rw\n"
+            "60 22 0:40 /@/.snapshots/1/snapshot /mnt rw - btrfs /dev/sdb2 rw\n"
+            "61 60 0:40 /@/var /mnt/var rw - btrfs /dev/sdb2 rw\n"
+            "62 60 0:40 /@/home /mnt/home rw - btrfs /dev/sdb2 rw\n"
+            "63 60 0:40 /@/.snapshots /mnt/.snapshots rw - btrfs /dev/sdb2 rw\n"
+            "64 60 8:17 / /mnt/boot/efi rw - vfat /dev/sdb1 rw\n"
+            "65 60 0:5 / /mnt/proc rw - proc proc rw\n"
+            "66 60 0:6 / /mnt/dev rw - devtmpfs devtmpfs rw\n"
+            "67 60 0:41 / /mnt/my\\040data rw - xfs /dev/sdc1 rw\n"
+            "68 22 0:42 / /mnt2/var rw - ext4 /dev/sdd1 rw\n"
+        )
+        with patch("modules.images.open", mock_open(read_data=mountinfo), create=True):
+            self.assertEqual(
+                images._golden_mounts("/mnt/"),
+                ["./boot/efi", "./home", "./my data", "./var"],
+            )
+
+    @patch("modules.images.os.unlink")
+    @patch("modules.images.os.makedirs")
+    def test_golden_create_fail(self, makedirs, unlink):
+        """Test images.golden_create function when tar fails"""
+        salt_mock = {
+            "cmd.run_all": MagicMock(return_value={"retcode": 2, "stderr": "error"}),
+        }
+
+        with patch.dict(images.__salt__, salt_mock):
+            with self.assertRaises(CommandExecutionError):
+                images.golden_create("/mnt", "/srv/golden", "golden-key")
+            unlink.assert_called_with(salt_mock["cmd.run_all"].call_args[0][0][3])
+
+    @patch("modules.images.imagestream.PipeWriter")
+    @patch("modules.images.imagestream.copy")
+    def test_golden_apply(self, copy, PipeWriter):
+        """Test images.golden_apply function"""
+        copy.return_value = {"seconds": 1.0, "throughput": 1.0}
+
+        images.golden_apply("/mnt", "golden-key", url="http://example.org/golden/")
+        copy.assert_called_with(
+            "http://example.org/golden/golden-key.tar.zst",
+            PipeWriter.return_value,
+            "zst",
+            connections=None,
+            threads=None,
+        )
+        self.assertEqual(PipeWriter.call_args[0][0][-2:], ["--directory", "/mnt"])
+
+        images.golden_apply("/mnt", "golden-key", store="/srv/golden")
+        self.assertEqual(copy.call_args[0][0], "file:///srv/golden/golden-key.tar.zst")
+
+        copy.side_effect = images.imagestream.StreamException("error")
+        with self.assertRaises(CommandExecutionError):
+            images.golden_apply("/mnt", "golden-key", store="/srv/golden")
+
+        with self.assertRaises(SaltInvocationError):
+            images.golden_apply("/mnt", "golden-key")
+
+    def test_create_manifest(self):
+        """Test images.create_manifest function"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            image = os.path.join(tmpdir, "image.xz")
+            with open(image, "wb") as f:
+                f.write(b"x" * 10)
+
+            self.assertEqual(
+                images.create_manifest(image, chunk_size=4),
+                {"size": 10, "chunk_size": 4, "chunks": 3},
+            )
+            with open(os.path.join(tmpdir, "image.chunks")) as f:
+                manifest = json.load(f)
+            self.assertEqual(len(manifest["hashes"]), 3)
+
+            with self.assertRaises(SaltInvocationError):
+                images.create_manifest(image, chunk_size=0)
@@ -0,0 +1,968 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Alberto Planas <aplanas@suse.com>
+#
+# Copyright 2019 SUSE LLC.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import bz2
+import gzip
+import hashlib
+import http.server
+import io
+import lzma
+import os
+import pathlib
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from utils import imagecache
+from utils import imagestream
+
+
+def _chunks(data, size):
+    """Split data in chunks of a fixed size"""
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+class _RangeHandler(http.server.BaseHTTPRequestHandler):
+    """HTTP handler with support for Range requests
+
+    The server can be configured to cut the connection of some
+    responses after sending a part of the body, to emulate a network
+    failure.
+
+    """
+
+    def do_GET(self):
+        data = self.server.data
+        request_range = self.headers.get("Range")
+        if request_range and self.server.ranges:
+            start, end = request_range[len("bytes=") :].split("-")
+            start, end = int(start), int(end) if end else len(data) - 1
+            body = data[start : end + 1]
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", "bytes {}-{}/{}".format(start, end, len(data))
+            )
+        else:
+            body = data
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", '"1"')
+        self.end_headers()
+
+        with self.server.lock:
+            fail = self.server.failures and len(body) > 1
+            if fail:
+                self.server.failures -= 1
+        if fail:
+            body = body[: int(len(body) * self.server.partial)]
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ImageStreamTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self.tmpdir.name)
+        # Some compressible data, with a non aligned size
+        self.data = b"".join(bytes([i % 251]) * 1000 for i in range(3000))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _device(self, size=0):
+        device = self.path / "device"
+        device.write_bytes(b"\xff" * size)
+        return str(device)
+
+    def test_threaded(self):
+        """Test imagestream.threaded function"""
+        self.assertEqual(list(imagestream.threaded(iter(range(100)))), list(range(100)))
+
+        def _fail():
+            yield 1
+            raise imagestream.StreamException("error")
+
+        with self.assertRaises(imagestream.StreamException):
+            list(imagestream.threaded(_fail()))
+
+    def test_decompress(self):
+        """Test imagestream.decompress function"""
+        for compression, compress in (
+            (None, lambda data: data),
+            ("gz", gzip.compress),
+            ("bz2", bz2.compress),
+            ("xz", lzma.compress),
+        ):
+            compressed = compress(self.data)
+            chunks = list(
+                imagestream.decompress(_chunks(compressed, 1000), compression, 4096)
+            )
+            self.assertEqual(b"".join(chunks), self.data)
+            self.assertTrue(all(len(chunk) <= 4096 for chunk in chunks[1:]))
+
+    def test_decompress_multistream(self):
+        """Test imagestream.decompress function with concatenated streams"""
+        for compression, compress in (
+            ("gz", gzip.compress),
+            ("bz2", bz2.compress),
+            ("xz", lzma.compress),
+        ):
+            compressed = compress(self.data) + compress(self.data)
+            chunks = imagestream.decompress(_chunks(compressed, 777), compression)
+            self.assertEqual(b"".join(chunks), self.data * 2)
+
+    def test_decompress_truncated(self):
+        """Test imagestream.decompress function with a truncated stream"""
+        for compression, compress in (
+            ("gz", gzip.compress),
+            ("bz2", bz2.compress),
+            ("xz", lzma.compress),
+        ):
+            compressed = compress(self.data)[:-20]
+            with self.assertRaises(imagestream.StreamException):
+                list(imagestream.decompress([compressed], compression))
+
+    def test_decompress_invalid(self):
+        """Test imagestream.decompress function with invalid data"""
+        with self.assertRaises(imagestream.StreamException):
+            list(imagestream.decompress([b"invalid"], "xz"))
+        with self.assertRaises(imagestream.StreamException):
+            list(imagestream.decompress([b"invalid"], "rar"))
+
+    def test_detect_compression(self):
+        """Test imagestream.detect_compression function"""
+        for compression, compress in (
+            ("gz", gzip.compress),
+            ("bz2", bz2.compress),
+            ("xz", lzma.compress),
+        ):
+            self.assertEqual(
+                imagestream.detect_compression(compress(b"data")), compression
+            )
+        self.assertEqual(imagestream.detect_compression(b"\x28\xb5\x2f\xfd"), "zst")
+        self.assertEqual(imagestream.detect_compression(b"\x04\x22\x4d\x18"), "lz4")
+        self.assertIsNone(imagestream.detect_compression(bytes(512)))
+        self.assertIsNone(imagestream.detect_compression(b""))
+
+    def _compress_external(self, cmd, data):
+        return subprocess.run(
+            cmd, input=data, stdout=subprocess.PIPE, check=True
+        ).stdout
+
+    @unittest.skipUnless(shutil.which("zstd") and shutil.which("lz4"), "Requires zstd")
+    def test_decompress_external(self):
+        """Test imagestream.decompress function with zstd and lz4"""
+        for compression, cmd in (("zst", ["zstd", "-c"]), ("lz4", ["lz4", "-c"])):
+            compressed = self._compress_external(cmd, self.data)
+            compressed += self._compress_external(cmd, self.data)
+            chunks = list(
+                imagestream.decompress(_chunks(compressed, 1000), compression, 4096)
+            )
+            self.assertEqual(b"".join(chunks), self.data * 2)
+            self.assertTrue(all(len(chunk) <= 4096 for chunk in chunks))
+
+            with self.assertRaises(imagestream.StreamException):
+                list(imagestream.decompress([compressed[:-20]], compression))
+
+    @unittest.skipUnless(shutil.which("xz"), "Requires xz")
+    def test_decompress_threads(self):
+        """Test imagestream.decompress function with threads"""
+        compressed = lzma.compress(self.data)
+        self.assertEqual(
+            imagestream.external_decompressor("xz", 4), ["xz", "-d", "-c", "-T", "4"]
+        )
+        chunks = imagestream.decompress(_chunks(compressed, 1000), "xz", threads=0)
+        self.assertEqual(b"".join(chunks), self.data)
+
+        with self.assertRaises(imagestream.StreamException):
+            list(imagestream.decompress([b"invalid"], "xz", threads=0))
+
+    def test_decompress_external_missing(self):
+        """Test imagestream.decompress function without the external tool"""
+        with patch.dict(imagestream.DECOMPRESSORS, {"zst": ["missing-zstd"]}):
+            with self.assertRaises(imagestream.StreamException):
+                list(imagestream.decompress([b"data"], "zst"))
+
+        # Without the multithreaded tool, the internal decompressor is used
+        with patch.dict(imagestream.DECOMPRESSORS, {"gz": ["missing-pigz"]}):
+            chunks = imagestream.decompress([gzip.compress(self.data)], "gz", threads=0)
+            self.assertEqual(b"".join(chunks), self.data)
+
+    def test_digests(self):
+        """Test imagestream.Digests class"""
+        for checksum_types in (["sha256"], ["sha256", "md5", "sha1"]):
+            digests = imagestream.Digests(checksum_types)
+            for chunk in _chunks(self.data, 10000):
+                digests.update(chunk)
+            self.assertEqual(
+                digests.hexdigests(),
+                {t: hashlib.new(t, self.data).hexdigest() for t in checksum_types},
+            )
+
+        with self.assertRaises(imagestream.StreamException):
+            imagestream.Digests(["invalid"])
+
+    def test_writer(self):
+        """Test imagestream.Writer class"""
+        device = self._device(len(self.data) + 10)
+        stats = imagestream.Stats()
+        writer = imagestream.Writer(device, buffer_size=8192, stats=stats)
+        for chunk in _chunks(self.data, 1000):
+            writer.write(chunk)
+        writer.close()
+        content = pathlib.Path(device).read_bytes()
+        self.assertEqual(content[: len(self.data)], self.data)
+        self.assertEqual(content[len(self.data) :], b"\xff" * 10)
+        self.assertEqual(stats.written, len(self.data))
+
+    def test_writer_unaligned_buffer(self):
+        """Test imagestream.Writer class with an unaligned buffer"""
+        with self.assertRaises(imagestream.StreamException):
+            imagestream.Writer(self._device(), buffer_size=1000)
+
+    def test_writer_missing_device(self):
+        """Test imagestream.Writer class with a missing device"""
+        with self.assertRaises(imagestream.StreamException):
+            imagestream.Writer(str(self.path / "missing"))
+
+    def test_find_zeros(self):
+        """Test imagestream.find_zeros function"""
+        zero, data = bytes(8), b"\1" * 8
+        D, Z = imagestream.DATA, imagestream.ZERO
+
+        def _find_zeros(chunks):
+            operations = ((D, chunk) for chunk in chunks)
+            return [
+                (op, bytes(value) if op == D else value)
+                for op, value in imagestream.find_zeros(operations, 4)
+            ]
+
+        self.assertEqual(_find_zeros([]), [])
+        self.assertEqual(_find_zeros([data]), [(D, data)])
+        self.assertEqual(_find_zeros([zero]), [(Z, 8)])
+        self.assertEqual(_find_zeros([zero, zero]), [(Z, 16)])
+        self.assertEqual(
+            _find_zeros([data + zero + data]), [(D, data), (Z, 8), (D, data)]
+        )
+        self.assertEqual(
+            _find_zeros([data + zero, zero + data]), [(D, data), (Z, 16), (D, data)]
+        )
+        # Unaligned zeros are data
+        self.assertEqual(_find_zeros([b"\1" + bytes(6)]), [(D, b"\1" + bytes(6))])
+        self.assertEqual(
+            _find_zeros([b"\1\1", bytes(10)]),
+            [(D, b"\1\1"), (D, bytes(2)), (Z, 8)],
+        )
+
+        # Other operations are not modified
+        operations = [(D, zero), (imagestream.SKIP, 2), (D, bytes(6))]
+        self.assertEqual(
+            list(imagestream.find_zeros(operations, 4)),
+            [(Z, 8), (imagestream.SKIP, 2), (D, bytes(2)), (Z, 4)],
+        )
+
+    def test_writer_zero(self):
+        """Test imagestream.Writer.zero method"""
+        device = self._device(4096 * 3)
+        stats = imagestream.Stats()
+        writer = imagestream.Writer(device, stats=stats, sparse="skip")
+        writer.write(b"\1" * 4096)
+        writer.zero(4096 * 3)
+        writer.write(b"\1" * 10)
+        writer.close()
+        content = pathlib.Path(device).read_bytes()
+        # The skipped range keeps the old content, and past the end of
+        # the file is a hole
+        self.assertEqual(
+            content, b"\1" * 4096 + b"\xff" * 8192 + bytes(4096) + b"\1" * 10
+        )
+        self.assertEqual(stats.written, 4096 + 10)
+        self.assertEqual(stats.skipped, 4096 * 3)
+
+        device = self._device(4096 * 3)
+        writer = imagestream.Writer(device, sparse="zeroout")
+        writer.write(b"\1" * 4096)
+        writer.zero(4096 * 4)
+        writer.close()
+        content = pathlib.Path(device).read_bytes()
+        self.assertEqual(content, b"\1" * 4096 + bytes(4096 * 4))
+
+    @patch("utils.imagestream.fcntl.ioctl")
+    def test_writer_zero_block(self, ioctl):
+        """Test imagestream.Writer.zero method in a block device"""
+        for sparse, request in (
+            ("zeroout", imagestream.BLKZEROOUT),
+            ("discard", imagestream.BLKDISCARD),
+        ):
+            writer = imagestream.Writer(self._device(), sparse=sparse)
+            writer.block = True
+            writer.write(b"\1" * 4096)
+            writer.zero(8192)
+            ioctl.assert_called_with(writer.fd, request, struct.pack("QQ", 4096, 8192))
+            writer.close()
+
+            ioctl.side_effect = OSError("error")
+            writer = imagestream.Writer(self._device(), sparse=sparse)
+            writer.block = True
+            with self.assertRaises(imagestream.StreamException):
+                writer.zero(8192)
+            writer.close()
+            ioctl.side_effect = None
+
+    def test_writer_sparse_invalid(self):
+        """Test imagestream.Writer class with an invalid sparse mode"""
+        with self.assertRaises(imagestream.StreamException):
+            imagestream.Writer(self._device(), sparse="trim")
+
+    def test_copy_sparse(self):
+        """Test imagestream.copy function with sparse mode"""
+        data = b"\1" * 4096 + bytes(4096 * 10) + b"\1" * 100
+        image = self.path / "image.gz"
+        image.write_bytes(gzip.compress(data))
+        device = self._device()
+
+        result = imagestream.copy(image.as_uri(), device, "gz", sparse="skip")
+        self.assertEqual(result["checksum"], hashlib.md5(data).hexdigest())
+        self.assertEqual(result["size"], len(data))
+        self.assertEqual(result["written"], 4096 + 100)
+        self.assertEqual(result["skipped"], 4096 * 10)
+        self.assertEqual(pathlib.Path(device).read_bytes(), data)
+
+    def _bmap(self, data, ranges, block_size=4, version="2.0", file_checksum=True):
+        """Generate a bmap file for some data"""
+        checksum_type = "sha256" if version.startswith("2") else "sha1"
+        attr = "chksum" if version.startswith("2") else "sha1"
+        elements = []
+        for first, last in ranges:
+            chunk = data[first * block_size : (last + 1) * block_size]
+            checksum = hashlib.new(checksum_type, chunk).hexdigest()
+            elements.append(
+                '<Range {}="{}"> {}-{} </Range>'.format(attr, checksum, first, last)
+            )
+        file_tag = "BmapFileChecksum" if version.startswith("2") else "BmapFileSHA1"
+        empty = "0" * hashlib.new(checksum_type).digest_size * 2
+        bmap = (
+            '<?xml version="1.0" ?>\n'
+            '<bmap version="{}">\n'
+            "<ImageSize> {} </ImageSize>\n"
+            "<BlockSize> {} </BlockSize>\n"
+            "<ChecksumType> {} </ChecksumType>\n"
+            "<{}> {} </{}>\n"
+            "<BlockMap>{}</BlockMap>\n"
+            "</bmap>\n"
+        ).format(
+            version,
+            len(data),
+            block_size,
+            checksum_type,
+            file_tag,
+            empty if file_checksum else "",
+            file_tag,
+            "".join(elements),
+        )
+        if file_checksum:
+            checksum = hashlib.new(checksum_type, bmap.encode()).hexdigest()
+            bmap = bmap.replace(empty, checksum)
+        return bmap
+
+    def test_parse_bmap(self):
+        """Test imagestream.parse_bmap function"""
+        data = b"\1" * 4 + bytes(8) + b"\1" * 6
+        for version in ("1.4", "2.0"):
+            bmap = imagestream.parse_bmap(
+                self._bmap(data, [(0, 0), (3, 4)], 4, version)
+            )
+            self.assertEqual(bmap.image_size, 18)
+            self.assertEqual(bmap.block_size, 4)
+            self.assertEqual([r[:2] for r in bmap.ranges], [(0, 0), (3, 4)])
+            self.assertEqual(bmap.mapped, 10)
+
+        bmap = self._bmap(data, [(0, 0)], file_checksum=False)
+        self.assertEqual(imagestream.parse_bmap(bmap).ranges[0][:2], (0, 0))
+
+    def test_parse_bmap_invalid(self):
+        """Test imagestream.parse_bmap function with invalid files"""
+        data = b"\1" * 8
+        bmap = self._bmap(data, [(0, 1)])
+        for content in (
+            "invalid",
+            "<other/>",
+            '<bmap version="3.0"/>',
+            # Bad file checksum
+            bmap.replace("<ImageSize> 8 ", "<ImageSize> 9 "),
+            # Overlapping ranges
+            self._bmap(data, [(0, 1), (1, 1)]),
+        ):
+            with self.assertRaises(imagestream.StreamException):
+                imagestream.parse_bmap(content)
+
+    def test_bmap_filter(self):
+        """Test imagestream.bmap_filter function"""
+        data = b"\1" * 4 + bytes(8) + b"\1" * 6
+        bmap = imagestream.parse_bmap(self._bmap(data, [(0, 0), (3, 4)]))
+        operations = [
+            (op, bytes(value) if op == imagestream.DATA else value)
+            for op, value in imagestream.bmap_filter(_chunks(data, 5), bmap)
+        ]
+        self.assertEqual(
+            operations,
+            [
+                (imagestream.DATA, b"\1" * 4),
+                (imagestream.SKIP, 1),
+                (imagestream.SKIP, 5),
+                (imagestream.SKIP, 2),
+                (imagestream.DATA, b"\1" * 3),
+                (imagestream.DATA, b"\1" * 3),
+            ],
+        )
+
+        # Checksum mismatch in the second range
+        bad_data = data[:-1] + b"\2"
+        with self.assertRaises(imagestream.StreamException):
+            list(imagestream.bmap_filter([bad_data], bmap))
+
+        # Size mismatch
+        with self.assertRaises(imagestream.StreamException):
+            list(imagestream.bmap_filter([data + b"\1"], bmap))
+
+    def test_copy_bmap(self):
+        """Test imagestream.copy function with a bmap"""
+        data = b"\1" * 4096 + bytes(4096 * 10) + b"\1" * 100
+        bmap = imagestream.parse_bmap(self._bmap(data, [(0, 0), (11, 11)], 4096))
+        image = self.path / "image.xz"
+        image.write_bytes(lzma.compress(data))
+        device = self._device(len(data))
+
+        result = imagestream.copy(image.as_uri(), device, "xz", bmap=bmap)
+        self.assertEqual(result["checksum"], hashlib.md5(data).hexdigest())
+        self.assertEqual(result["written"], 4096 + 100)
+        self.assertEqual(result["skipped"], 4096 * 10)
+        content = pathlib.Path(device).read_bytes()
+        self.assertEqual(content, b"\1" * 4096 + b"\xff" * 4096 * 10 + b"\1" * 100)
+
+    def test_copy(self):
+        """Test imagestream.copy function"""
+        image = self.path / "image.xz"
+        image.write_bytes(lzma.compress(self.data))
+        device = self._device()
+
+        result = imagestream.copy(
+            image.as_uri(), device, "xz", "sha256", chunk_size=8192
+        )
+        self.assertEqual(result["checksum"], hashlib.sha256(self.data).hexdigest())
+        self.assertEqual(result["read"], os.path.getsize(image))
+        self.assertEqual(result["size"], len(self.data))
+        self.assertEqual(result["written"], len(self.data))
+        self.assertIn("throughput", result)
+        self.assertEqual(pathlib.Path(device).read_bytes(), self.data)
+
+    def test_copy_cache(self):
+        """Test imagestream.copy function with a cache"""
+        image = self.path / "image.xz"
+        image.write_bytes(lzma.compress(self.data))
+        checksum = hashlib.md5(self.data).hexdigest()
+        cache = imagecache.Cache(str(self.path / "cache"))
+        key = imagecache.image_key("md5", checksum)
+
+        # A wrong image is not stored in the cache
+        imagestream.copy(
+            image.as_uri(),
+            self._device(),
+            "xz",
+            cache=cache,
+            cache_key=key,
+            expected_checksum="other",
+        )
+        self.assertEqual(cache.entries(), [])
+
+        result = imagestream.copy(
+            image.as_uri(), self._device(), "xz", cache=cache, cache_key=key
+        )
+        self.assertFalse(result["cached"])
+        self.assertIsNotNone(cache.get(key))
+
+        image.unlink()
+        device = self._device()
+        result = imagestream.copy(
+            image.as_uri(), device, "xz", cache=cache, cache_key=key
+        )
+        self.assertTrue(result["cached"])
+        self.assertEqual(result["checksum"], checksum)
+        self.assertEqual(pathlib.Path(device).read_bytes(), self.data)
+
+        # A corrupted entry is evicted
+        pathlib.Path(cache.get(key)).write_bytes(lzma.compress(b"other"))
+        result = imagestream.copy(
+            image.as_uri(),
+            self._device(),
+            "xz",
+            cache=cache,
+            cache_key=key,
+            expected_checksum=checksum,
+        )
+        self.assertTrue(result["cached"])
+        self.assertNotEqual(result["checksum"], checksum)
+        self.assertIsNone(cache.get(key))
+
+    def _server(self, data, ranges=True, failures=0, partial=0.5):
+        """Start a local HTTP server that serves data"""
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _RangeHandler)
+        server.data = data
+        server.ranges = ranges
+        server.failures = failures
+        server.partial = partial
+        server.lock = threading.Lock()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return "http://127.0.0.1:{}/image".format(server.server_address[1])
+
+    @patch("utils.imagestream.RETRY_DELAY", 0)
+    @patch("utils.imagestream.SEGMENT_SIZE", 10000)
+    def test_open_ranged(self):
+        """Test imagestream.open_ranged function"""
+        url = self._server(self.data, failures=5)
+        fileobj = imagestream.open_ranged(url, connections=3)
+        self.assertIsInstance(fileobj, imagestream.RangedReader)
+        self.assertEqual(fileobj.headers["ETag"], '"1"')
+        content = b"".join(imagestream.read_chunks(fileobj, 4096))
+        self.assertEqual(content, self.data)
+
+    def test_open_ranged_not_supported(self):
+        """Test imagestream.open_ranged function without range support"""
+        url = self._server(self.data, ranges=False)
+        fileobj = imagestream.open_ranged(url, connections=3)
+        self.assertNotIsInstance(fileobj, imagestream.RangedReader)
+        self.assertEqual(fileobj.read(), self.data)
+        fileobj.close()
+
+    @patch("utils.imagestream.RETRY_DELAY", 0)
+    @patch("utils.imagestream.RETRIES", 2)
+    @patch("utils.imagestream.SEGMENT_SIZE", 10000)
+    def test_open_ranged_failure(self):
+        """Test imagestream.open_ranged function when the retries fail"""
+        url = self._server(self.data, failures=1000, partial=0)
+        fileobj = imagestream.open_ranged(url, connections=2)
+        with self.assertRaises(imagestream.StreamException):
+            fileobj.read()
+        fileobj.close()
+
+    @patch("utils.imagestream.SEGMENT_SIZE", 10000)
+    def test_copy_ranged(self):
+        """Test imagestream.copy function with concurrent connections"""
+        image = lzma.compress(self.data)
+        url = self._server(image)
+        device = self._device()
+
+        result = imagestream.copy(url, device, "xz", connections=4)
+        self.assertEqual(result["checksum"], hashlib.md5(self.data).hexdigest())
+        self.assertEqual(result["read"], len(image))
+        self.assertEqual(pathlib.Path(device).read_bytes(), self.data)
+
+    @patch("utils.imagestream.time.sleep")
+    def test_rate_limiter(self, sleep):
+        """Test imagestream.RateLimiter pacing of the reads"""
+        limiter = imagestream.RateLimiter(1000)
+        limiter.consume(500)
+        sleep.assert_not_called()
+        limiter.consume(500)
+        self.assertAlmostEqual(sleep.call_args[0][0], 0.5, places=1)
+
+    def test_rate_limiter_adaptive(self):
+        """Test imagestream.RateLimiter backoff and recovery"""
+        limiter = imagestream.RateLimiter(1600, adaptive=True)
+        limiter.observe(0.1)
+        limiter.observe(0.1)
+        self.assertEqual(limiter.rate, 1600)
+
+        # A request much slower than the usual ones halves the rate
+        limiter.observe(1)
+        self.assertEqual(limiter.rate, 800)
+        self.assertEqual(limiter.backoffs, 1)
+
+        # The rate grows in small steps when the requests are fast again
+        limiter.observe(0.1)
+        self.assertEqual(limiter.rate, 880)
+
+        # Small changes of a very low latency are not slow requests
+        limiter = imagestream.RateLimiter(1600, adaptive=True)
+        limiter.observe(0.0001)
+        limiter.observe(0.01)
+        self.assertEqual(limiter.backoffs, 0)
+
+        # The rate is never under the minimum
+        for _ in range(10):
+            limiter.backoff()
+        self.assertEqual(limiter.rate, 100)
+        self.assertEqual(limiter.backoffs, 10)
+
+    def test_read_chunks_buffered(self):
+        """Test imagestream.read_chunks mixing buffered and network reads"""
+
+        class _Source(io.BytesIO):
+            def read(self, size=-1):
+                # Every other read waits for the network
+                if self.tell() % 2000:
+                    time.sleep(0.01)
+                return super().read(size)
+
+        data = self.data[:100000]
+        limiter = imagestream.RateLimiter(1000**3, adaptive=True)
+        chunks = imagestream.read_chunks(_Source(data), 1000, limiter=limiter)
+        self.assertEqual(b"".join(chunks), data)
+        self.assertEqual(limiter.backoffs, 0)
+        self.assertEqual(limiter.rate, 1000**3)
+
+    def test_rate_limiter_not_adaptive(self):
+        """Test imagestream.RateLimiter without adaptive mode"""
+        limiter = imagestream.RateLimiter(1600)
+        limiter.observe(0.1)
+        limiter.observe(1)
+        limiter.backoff()
+        self.assertEqual(limiter.rate, 1600)
+        self.assertEqual(limiter.backoffs, 0)
+
+    @patch("utils.imagestream.RETRY_DELAY", 0)
+    @patch("utils.imagestream.SEGMENT_SIZE", 10000)
+    def test_open_ranged_limiter(self):
+        """Test imagestream.open_ranged function reporting the failures"""
+        url = self._server(self.data, failures=2)
+        limiter = imagestream.RateLimiter(1000**3, adaptive=True)
+        fileobj = imagestream.open_ranged(url, connections=2, limiter=limiter)
+        content = b"".join(imagestream.read_chunks(fileobj, 4096, limiter=limiter))
+        self.assertEqual(content, self.data)
+        self.assertGreaterEqual(limiter.backoffs, 1)
+
+    @patch("utils.imagestream.SEGMENT_SIZE", 10000)
+    def test_open_ranged_buffered(self):
+        """Test imagestream.open_ranged function with buffered reads"""
+        url = self._server(self.data)
+        limiter = imagestream.RateLimiter(1000**3, adaptive=True)
+        fileobj = imagestream.open_ranged(url, connections=4, limiter=limiter)
+        content = b"".join(imagestream.read_chunks(fileobj, 100, limiter=limiter))
+        self.assertEqual(content, self.data)
+        # Only the requests are observed, and not the reads served
+        # from the segments in memory
+        self.assertIsNotNone(limiter.latency)
+        self.assertEqual(limiter.backoffs, 0)
+
+    def test_copy_rate(self):
+        """Test imagestream.copy function with a rate limit"""
+        image = self.path / "image"
+        image.write_bytes(self.data)
+        device = self._device()
+
+        result = imagestream.copy(
+            "file://{}".format(image), device, None, rate=1000**3, adaptive=True
+        )
+        self.assertEqual(pathlib.Path(device).read_bytes(), self.data)
+        self.assertEqual(result["rate"]["max_rate"], 1000)
+
+    def test_fan_out(self):
+        """Test imagestream.fan_out function with a failing writer"""
+
+        class _Writer:
+            def __init__(self, fail=False):
+                self.data = b""
+                self.fail = fail
+                self.closed = False
+
+            def write(self, data):
+                if self.fail:
+                    raise imagestream.StreamException("error")
+                self.data += data
+
+            def close(self):
+                self.closed = True
+
+        writers = [_Writer(), _Writer(fail=True), _Writer()]
+        operations = ((imagestream.DATA, chunk) for chunk in _chunks(self.data, 1000))
+        errors = imagestream.fan_out(operations, writers)
+        self.assertEqual(list(errors), [writers[1]])
+        self.assertEqual(writers[0].data, self.data)
+        self.assertEqual(writers[2].data, self.data)
+        self.assertTrue(all(writer.closed for writer in writers))
+
+    def test_copy_devices(self):
+        """Test imagestream.copy function with many devices"""
+        image = self.path / "image.gz"
+        image.write_bytes(gzip.compress(self.data))
+        devices = [str(self.path / "device-a"), str(self.path / "device-b")]
+        for device in devices:
+            pathlib.Path(device).write_bytes(b"")
+
+        result = imagestream.copy(image.as_uri(), devices, "gz", sparse="zeroout")
+        checksum = hashlib.md5(self.data).hexdigest()
+        self.assertEqual(result["checksum"], checksum)
+        self.assertEqual(result["size"], len(self.data))
+        self.assertEqual(result["written"], 2 * len(self.data))
+        for device in devices:
+            self.assertEqual(result["devices"][device]["checksum"], checksum)
+            self.assertEqual(pathlib.Path(device).read_bytes(), self.data)
+
+    def test_copy_devices_missing(self):
+        """Test imagestream.copy function with a missing device"""
+        image = self.path / "image"
+        image.write_bytes(self.data)
+        devices = [self._device(), str(self.path / "missing" / "device")]
+        with self.assertRaises(imagestream.StreamException):
+            imagestream.copy(image.as_uri(), devices)
+
+    @patch("utils.imagestream.PROGRESS_INTERVAL", 0)
+    def test_copy_progress(self):
+        """Test imagestream.copy function with progress reports"""
+        image = self.path / "image"
+        image.write_bytes(self.data)
+        reports = []
+
+        imagestream.copy(
+            image.as_uri(), self._device(), chunk_size=65536, progress=reports.append
+        )
+        self.assertTrue(reports)
+        self.assertTrue(all(r["total"] == len(self.data) for r in reports))
+        self.assertEqual(
+            sorted(reports[0]),
+            ["eta", "read", "size", "throughput", "total", "written"],
+        )
+        self.assertTrue(reports[-1]["read"] >= reports[0]["read"])
+
+    def test_stats_eta(self):
+        """Test imagestream.Stats.eta property"""
+        stats = imagestream.Stats()
+        self.assertIsNone(stats.eta)
+        stats.start -= 10
+        stats.read = 100
+        stats.total = 400
+        self.assertAlmostEqual(stats.eta, 30, delta=1)
+
+    def test_copy_detect_compression(self):
+        """Test imagestream.copy function with an unknown extension"""
+        image = self.path / "image.raw"
+        image.write_bytes(bz2.compress(self.data))
+        device = self._device()
+
+        result = imagestream.copy(image.as_uri(), device)
+        self.assertEqual(result["compression"], "bz2")
+        self.assertEqual(pathlib.Path(device).read_bytes(), self.data)
+
+    def test_copy_checksums(self):
+        """Test imagestream.copy function with many checksums"""
+        image = self.path / "image.xz"
+        image.write_bytes(lzma.compress(self.data))
+
+        result = imagestream.copy(
+            image.as_uri(), self._device(), "xz", ["sha256", "md5"]
+        )
+        self.assertEqual(result["checksum"], hashlib.sha256(self.data).hexdigest())
+        self.assertEqual(
+            result["checksums"],
+            {
+                "sha256": hashlib.sha256(self.data).hexdigest(),
+                "md5": hashlib.md5(self.data).hexdigest(),
+            },
+        )
+
+    def test_copy_missing_image(self):
+        """Test imagestream.copy function with a missing image"""
+        with self.assertRaises(imagestream.StreamException):
+            imagestream.copy((self.path / "missing").as_uri(), self._device())
+
+    def test_block_hashes(self):
+        """Test imagestream.BlockHashes class"""
+        hashes = imagestream.BlockHashes(block_size=8)
+        operations = [
+            (imagestream.DATA, b"0123"),
+            (imagestream.DATA, b"456789"),
+            (imagestream.ZERO, 6),
+            (imagestream.SKIP, 4),
+            (imagestream.DATA, b"ab"),
+        ]
+        self.assertEqual(list(hashes.record(iter(operations))), operations)
+
+        def _digest(data):
+            return hashlib.blake2b(data, digest_size=16).digest()
+
+        self.assertEqual(
+            hashes.blocks,
+            [
+                (0, 8, _digest(b"01234567")),
+                (8, 2, _digest(b"89")),
+                (10, 6, None),
+                (20, 2, _digest(b"ab")),
+            ],
+        )
+
+    def test_read_back(self):
+        """Test imagestream.read_back function"""
+        data = self.data + bytes(20000)
+        device = pathlib.Path(self._device())
+        device.write_bytes(data)
+        hashes = imagestream.BlockHashes(block_size=8192)
+        operations = [
+            (imagestream.DATA, self.data[:5000]),
+            (imagestream.SKIP, 3000),
+            (imagestream.DATA, self.data[8000:]),
+            (imagestream.ZERO, 20000),
+        ]
+        list(hashes.record(iter(operations)))
+
+        self.assertIsNone(imagestream.read_back(str(device), hashes.blocks, 8192))
+
+        # The skipped range is not verified
+        corrupted = bytearray(data)
+        corrupted[6000] ^= 0xFF
+        device.write_bytes(corrupted)
+        self.assertIsNone(imagestream.read_back(str(device), hashes.blocks, 8192))
+
+        # The first bad block is reported
+        corrupted[100000] ^= 0xFF
+        corrupted[len(self.data) + 10000] = 1
+        device.write_bytes(corrupted)
+        self.assertEqual(imagestream.read_back(str(device), hashes.blocks, 8192), 98304)
+
+        # A short device is also detected
+        device.write_bytes(data[:50000])
+        self.assertEqual(imagestream.read_back(str(device), hashes.blocks, 8192), 49152)
+
+    def test_copy_verify(self):
+        """Test imagestream.copy function with verification"""
+        image = self.path / "image.gz"
+        image.write_bytes(gzip.compress(self.data))
+        device = self._device()
+
+        result = imagestream.copy(image.as_uri(), device, "gz", verify=True)
+        self.assertTrue(result["verified"])
+        self.assertIn("verify_seconds", result)
+
+        with patch("utils.imagestream.read_back") as read_back:
+            read_back.return_value = 4096
+            with self.assertRaisesRegex(
+                imagestream.StreamException, "failed at offset 4096"
+            ):
+                imagestream.copy(image.as_uri(), device, "gz", verify=True)
+
+    def test_copy_devices_verify(self):
+        """Test imagestream.copy function verifying many devices"""
+        image = self.path / "image"
+        image.write_bytes(self.data)
+        devices = [str(self.path / "device-a"), str(self.path / "device-b")]
+        for device in devices:
+            pathlib.Path(device).write_bytes(b"")
+
+        with patch("utils.imagestream.read_back") as read_back:
+            read_back.side_effect = [None, 4096]
+            result = imagestream.copy(image.as_uri(), devices, verify=True)
+        self.assertNotIn("error", result["devices"][devices[0]])
+        self.assertIn("offset 4096", result["devices"][devices[1]]["error"])
+
+    def test_bitmap_runs(self):
+        """Test imagestream.bitmap_runs function"""
+        self.assertEqual(
+            list(imagestream.bitmap_runs(b"\xff\xff\x0f\x00\x00\x81", 44)),
+            [(True, 0, 20), (False, 20, 20), (True, 40, 1), (False, 41, 3)],
+        )
+        self.assertEqual(list(imagestream.bitmap_runs(b"\x00", 3)), [(False, 0, 3)])
+
+    def test_used_blocks(self):
+        """Test imagestream.create_used_blocks and used_blocks_filter"""
+        image = self.path / "image.ext4"
+        block = 65536
+        with image.open("wb") as f:
+            f.truncate(10 * block + 100)
+            f.seek(block)
+            f.write(self.data[:block])
+            f.seek(4 * block)
+            f.write(self.data[: 2 * block])
+            f.seek(10 * block)
+            f.write(self.data[:100])
+
+        output = self.path / "image.ub"
+        result = imagestream.create_used_blocks(str(image), str(output), block)
+        self.assertEqual(result["size"], 10 * block + 100)
+        self.assertEqual(result["blocks"], 11)
+        self.assertEqual(result["used"], 4)
+
+        operations = list(
+            imagestream.used_blocks_filter(_chunks(output.read_bytes(), 10000))
+        )
+        self.assertEqual(
+            [value for op, value in operations if op == imagestream.SKIP],
+            [block, 2 * block, 4 * block],
+        )
+        data = b"".join(value for op, value in operations if op == imagestream.DATA)
+        self.assertEqual(
+            data, self.data[:block] + self.data[: 2 * block] + self.data[:100]
+        )
+
+        # The image is detected and restored
+        compressed = self.path / "image.ub.gz"
+        compressed.write_bytes(gzip.compress(output.read_bytes()))
+        device = self._device()
+        result = imagestream.copy(compressed.as_uri(), device, sparse="zeroout")
+        self.assertEqual(result["format"], "used-blocks")
+        self.assertEqual(pathlib.Path(device).read_bytes(), image.read_bytes())
+
+    def test_used_blocks_truncated(self):
+        """Test imagestream.used_blocks_filter with a truncated image"""
+        image = self.path / "image"
+        image.write_bytes(self.data)
+        output = self.path / "image.ub"
+        imagestream.create_used_blocks(str(image), str(output))
+        content = output.read_bytes()
+
+        with self.assertRaises(imagestream.StreamException):
+            list(imagestream.used_blocks_filter([content[:-1]]))
+        with self.assertRaises(imagestream.StreamException):
+            list(imagestream.used_blocks_filter([content + b"\0"]))
+        with self.assertRaises(imagestream.StreamException):
+            list(imagestream.used_blocks_filter([b"\0" * len(content)]))
+
+    def test_pipe_writer(self):
+        """Test imagestream.copy function with a PipeWriter"""
+        image = self.path / "image.xz"
+        image.write_bytes(lzma.compress(self.data))
+        output = self.path / "output"
+
+        writer = imagestream.PipeWriter(["sh", "-c", "cat > {}".format(output)])
+        result = imagestream.copy(image.as_uri(), writer, "xz")
+        self.assertEqual(result["written"], len(self.data))
+        self.assertEqual(output.read_bytes(), self.data)
+
+    def test_pipe_writer_fail(self):
+        """Test imagestream.PipeWriter class with a failing process"""
+        image = self.path / "image"
+        image.write_bytes(self.data)
+
+        writer = imagestream.PipeWriter(["sh", "-c", "echo error >&2; exit 1"])
+        with self.assertRaisesRegex(imagestream.StreamException, "sh failed: error"):
+            imagestream.copy(image.as_uri(), writer)
+
+        with self.assertRaises(imagestream.StreamException):
+            imagestream.PipeWriter(["missing-tool"])
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Alberto Planas <aplanas@suse.com>
+#
+# Copyright 2019 SUSE LLC.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import json
+import unittest
+from unittest.mock import patch
+
+from utils import inventory
+
+LSBLK = {
+    "blockdevices": [
+        {
+            "name": "sda",
+            "kname": "sda",
+            "path": "/dev/sda",
+            "type": "disk",
+            "size": 21474836480,
+            "children": [
+                {
+                    "name": "sda1",
+                    "kname": "sda1",
+                    "path": "/dev/sda1",
+                    "type": "part",
+                    "children": [
+                        {
+                            "name": "md0",
+                            "kname": "md0",
+                            "path": "/dev/md0",
+                            "type": "raid1",
+                        }
+                    ],
+                },
+                {
+                    "name": "sda2",
+                    "kname": "sda2",
+                    "path": "/dev/sda2",
+                    "type": "part",
+                    "children": [
+                        {
+                            "name": "system-root",
+                            "kname": "dm-0",
+                            "path": "/dev/mapper/system-root",
+                            "type": "lvm",
+                        }
+                    ],
+                },
+            ],
+        },
+        {"name": "sdb", "kname": "sdb", "type": "disk"},
+    ]
+}
+
+
+class InventoryTestCase(unittest.TestCase):
+    def _run(self, cmd):
+        self.calls.append(cmd)
+        if cmd[0] == "lsblk":
+            return 0, json.dumps(LSBLK)
+        device = cmd[-1]
+        if device == "/dev/sda":
+            return 0, "PTUUID=1234\nPTTYPE=gpt\n"
+        if device == "/dev/sda1":
+            return 0, "UUID=abcd\nTYPE=ext4\n"
+        return 2, ""
+
+    def setUp(self):
+        self.calls = []
+        patcher = patch("utils.inventory._run", side_effect=self._run)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_inventory(self):
+        """Test inventory.Inventory index of devices"""
+        devices = inventory.get()
+        self.assertEqual(devices.type("/dev/sda"), "disk")
+        self.assertEqual(devices.type("/dev/md0"), "raid1")
+        self.assertEqual(devices.type("/dev/dm-0"), "lvm")
+        self.assertEqual(devices.type("/dev/sdc"), None)
+        self.assertEqual(devices.get("/dev/sdb")["path"], "/dev/sdb")
+        self.assertEqual(devices.get("/dev/md0")["parent"], "/dev/sda1")
+        self.assertEqual(devices.children("/dev/sda"), ["/dev/sda1", "/dev/sda2"])
+        self.assertEqual(devices.disks(), ["/dev/sda", "/dev/sdb"])
+        self.assertEqual(len(self.calls), 1)
+
+    def test_probe(self):
+        """Test inventory.Inventory probes of the devices"""
+        devices = inventory.get()
+        self.assertEqual(devices.pttype("/dev/sda"), "gpt")
+        self.assertEqual(devices.fstype("/dev/sda"), "")
+        self.assertEqual(devices.fstype("/dev/sda1"), "ext4")
+        self.assertEqual(devices.fstype("/dev/sdb"), "")
+        self.assertEqual(
+            self.calls,
+            [
+                ["blkid", "--probe", "--output", "export", "/dev/sda"],
+                ["blkid", "--probe", "--output", "export", "/dev/sda1"],
+                ["blkid", "--probe", "--output", "export", "/dev/sdb"],
+            ],
+        )
+
+    def test_context(self):
+        """Test inventory.get and inventory.invalidate with a context"""
+        context = {}
+        devices = inventory.get(context)
+        self.assertIs(inventory.get(context), devices)
+        devices.fstype("/dev/sda1")
+        devices.fstype("/dev/sdb")
+
+        # Without the tree of devices all the probes are dropped
+        inventory.invalidate(context, "/dev/sda")
+        self.assertEqual(devices.probes, {})
+
+        devices.disks()
+        devices.fstype("/dev/sda1")
+        devices.fstype("/dev/sdb")
+
+        # Only the probes of the device (and the devices inside) are
+        # dropped
+        inventory.invalidate(context, "/dev/sda")
+        self.assertEqual(list(devices.probes), ["/dev/sdb"])
+
+        inventory.invalidate(context)
+        self.assertIsNot(inventory.get(context), devices)
+        inventory.invalidate({})
+
+    @patch("utils.inventory.os.path.realpath")
+    def test_links(self, realpath):
+        """Test inventory.Inventory probes of links to the devices"""
+        links = {
+            "/dev/disk/by-uuid/abcd": "/dev/sda1",
+            "/dev/mapper/system-root": "/dev/dm-0",
+        }
+        realpath.side_effect = lambda path: links.get(path, path)
+        context = {}
+        devices = inventory.get(context)
+        self.assertEqual(devices.fstype("/dev/disk/by-uuid/abcd"), "ext4")
+        self.assertEqual(devices.fstype("/dev/sda1"), "ext4")
+        devices.fstype("/dev/dm-0")
+        self.assertEqual(
+            self.calls,
+            [
+                ["blkid", "--probe", "--output", "export", "/dev/sda1"],
+                ["blkid", "--probe", "--output", "export", "/dev/dm-0"],
+            ],
+        )
+
+        # The probes are dropped using any name of the device
+        devices.disks()
+        inventory.invalidate(context, "/dev/disk/by-uuid/abcd")
+        inventory.invalidate(context, "/dev/mapper/system-root")
+        self.assertEqual(devices.probes, {})
+
+    def test_scan_fail(self):
+        """Test inventory.Inventory when lsblk fails"""
+        with patch("utils.inventory._run", return_value=(1, "")):
+            with self.assertRaises(inventory.InventoryException):
+                inventory.get().type("/dev/sda")
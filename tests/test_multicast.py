@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Alberto Planas <aplanas@suse.com>
+#
+# Copyright 2019 SUSE LLC.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import hashlib
+import lzma
+import os
+import pathlib
+import select
+import socket
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+from utils import imagestream
+from utils import multicast
+
+GROUP = "239.255.42.99"
+
+
+class _LossyReader(multicast.MulticastReader):
+    """Receiver that drops the first copy of some packets"""
+
+    def __init__(self, *args, lost=(), **kwargs):
+        self.lost = set(lost)
+        super().__init__(*args, **kwargs)
+
+    def _packet(self, data, address):
+        seq = multicast.HEADER.unpack_from(data)[4]
+        if seq in self.lost and data[4] == multicast.DATA:
+            self.lost.discard(seq)
+            return
+        super()._packet(data, address)
+
+
+class MulticastTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _receive(self, port, results, reader_class=multicast.MulticastReader, **kwargs):
+        """Start a receiver in a thread, that stores the image in results"""
+
+        def _run():
+            try:
+                reader = reader_class(GROUP, port, "127.0.0.1", timeout=10, **kwargs)
+                try:
+                    results.append(b"".join(imagestream.read_chunks(reader, 4096)))
+                finally:
+                    reader.close()
+            except Exception as e:
+                results.append(e)
+
+        thread = threading.Thread(target=_run, daemon=True)
+        thread.start()
+        return thread
+
+    def _send(self, image, port, receivers, **kwargs):
+        # Wait until the receivers have joined the group
+        threading.Event().wait(0.3)
+        return multicast.send(
+            str(image),
+            GROUP,
+            port,
+            rate=20 * 1000**2,
+            interface="127.0.0.1",
+            receivers=receivers,
+            linger=5,
+            **kwargs
+        )
+
+    def test_parse_url(self):
+        """Test multicast.parse_url"""
+        self.assertEqual(
+            multicast.parse_url("multicast://239.255.42.1:9000"),
+            ("239.255.42.1", 9000, None),
+        )
+        self.assertEqual(
+            multicast.parse_url("multicast://239.255.42.1:9000?interface=10.0.0.1"),
+            ("239.255.42.1", 9000, "10.0.0.1"),
+        )
+        with self.assertRaises(multicast.imagestream.StreamException):
+            multicast.parse_url("multicast://239.255.42.1")
+        with self.assertRaises(multicast.imagestream.StreamException):
+            multicast.parse_url("http://239.255.42.1:9000")
+
+    def test_send(self):
+        """Test multicast.send with many receivers in the loopback"""
+        data = os.urandom(256 * 1024 + 17)
+        image = self.path / "image"
+        image.write_bytes(data)
+
+        results = []
+        threads = [self._receive(45301, results) for _ in range(3)]
+        result = self._send(image, 45301, 3)
+        for thread in threads:
+            thread.join(10)
+
+        self.assertEqual(results, [data] * 3)
+        self.assertEqual(result["size"], len(data))
+        self.assertEqual(result["sent"], result["packets"])
+        self.assertEqual(result["receivers"], 3)
+
+    def test_send_repair(self):
+        """Test multicast.send when the receivers lose packets"""
+        data = os.urandom(128 * 1024)
+        image = self.path / "image"
+        image.write_bytes(data)
+        packets = multicast._packets(len(data), 1024)
+
+        results = []
+        threads = [
+            # Packets lost in the middle, and at the tail of the image
+            self._receive(45302, results, _LossyReader, lost=range(10, 40, 3)),
+            self._receive(45302, results, _LossyReader, lost=[packets - 1]),
+            self._receive(45302, results),
+        ]
+        result = self._send(image, 45302, 3, packet_size=1024)
+        for thread in threads:
+            thread.join(10)
+
+        self.assertEqual(results, [data] * 3)
+        self.assertEqual(result["sent"], packets)
+        self.assertGreaterEqual(result["repaired"], 11)
+        self.assertEqual(result["receivers"], 3)
+
+    def test_send_bad_nak(self):
+        """Test multicast.Sender with a NAK that is not valid"""
+        image = self.path / "image"
+        image.write_bytes(os.urandom(4096))
+        sender = multicast.Sender(str(image), GROUP, 45304, packet_size=1024)
+        self.addCleanup(sender.close)
+        sender.sock.bind(("127.0.0.1", 0))
+
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(client.close)
+        header = multicast.HEADER.pack(
+            multicast.MAGIC, multicast.NAK, 1024, sender.session, 0, 4096
+        )
+        client.sendto(header + b"\0" * 5, sender.sock.getsockname())
+        select.select([sender.sock], [], [], 1)
+        self.assertFalse(sender._control())
+        self.assertEqual(sender.naks, 0)
+
+        client.sendto(
+            header + multicast.NAK_RANGE.pack(1, 2), sender.sock.getsockname()
+        )
+        select.select([sender.sock], [], [], 1)
+        self.assertTrue(sender._control())
+        self.assertEqual(list(sender.repairs), [1, 2])
+
+    @patch("utils.multicast.os.fstatvfs")
+    def test_spool_full(self, fstatvfs):
+        """Test multicast.MulticastReader without space in the spool"""
+        fstatvfs.return_value = os.statvfs_result(
+            (4096, 4096, 0, 0, 1, 0, 0, 0, 0, 255)
+        )
+        data = os.urandom(64 * 1024)
+        image = self.path / "image"
+        image.write_bytes(data)
+
+        results = []
+        thread = self._receive(45305, results)
+        threading.Event().wait(0.3)
+        multicast.send(str(image), GROUP, 45305, interface="127.0.0.1", linger=0.5)
+        thread.join(10)
+        self.assertIsInstance(results[0], multicast.imagestream.StreamException)
+        self.assertIn("Not enough space", str(results[0]))
+
+    def test_no_session(self):
+        """Test multicast.MulticastReader without a sender"""
+        with self.assertRaises(multicast.imagestream.StreamException):
+            multicast.MulticastReader(GROUP, 45303, "127.0.0.1", timeout=0.3)
+
+    def test_copy(self):
+        """Test imagestream.copy from a multicast group"""
+        data = os.urandom(64 * 1024) * 8
+        image = self.path / "image.xz"
+        image.write_bytes(lzma.compress(data))
+        device = self.path / "device"
+        device.write_bytes(b"")
+
+        results = []
+
+        def _run():
+            results.append(
+                imagestream.copy(
+                    "multicast://{}:45304?interface=127.0.0.1".format(GROUP),
+                    str(device),
+                    opener=multicast.open_multicast,
+                )
+            )
+
+        thread = threading.Thread(target=_run, daemon=True)
+        thread.start()
+        self._send(image, 45304, 1)
+        thread.join(10)
+
+        self.assertEqual(results[0]["checksum"], hashlib.md5(data).hexdigest())
+        self.assertEqual(results[0]["compression"], "xz")
+        self.assertEqual(device.read_bytes(), data)
@@ -21,156 +21,268 @@
 # specific language governing permissions and limitations
 # under the License.
 
+import json
 import unittest
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
 from states import partitioned
 
 
 class PartitionedTestCase(unittest.TestCase):
-    @patch("states.partitioned.__salt__")
-    def test_check_label(self, __salt__):
-        fdisk_output = """Error: /dev/sda: unrecognised disk label
-BYT;
-/dev/sda:25.8GB:scsi:512:512:unknown:ATA QEMU HARDDISK:;
+    def setUp(self):
+        if hasattr(partitioned._get_snapshot, "snapshots"):
+            del partitioned._get_snapshot.snapshots
 
-Error: /dev/sdb: unrecognised disk label
-BYT;
-/dev/sdb:25.8GB:scsi:512:512:unknown:ATA QEMU HARDDISK:;
+    def _parted(self, output):
+        """Return a mock for cmd.run_all that emulates parted"""
+        return MagicMock(return_value={"retcode": 0, "stdout": output, "stderr": ""})
 
+    def test_check_label(self):
+        parted_output = """BYT;
+/dev/sda:50331648s:scsi:512:512:unknown:ATA QEMU HARDDISK:;
 """
-        __salt__.__getitem__.return_value = lambda _: fdisk_output
-        self.assertFalse(partitioned._check_label("/dev/sda", "msdos"))
-        self.assertFalse(partitioned._check_label("/dev/sda", "dos"))
-        self.assertFalse(partitioned._check_label("/dev/sda", "gpt"))
-
-        fdisk_output = """BYT;
-/dev/sda:25.8GB:scsi:512:512:msdos:ATA QEMU HARDDISK:;
-
-Error: /dev/sdb: unrecognised disk label
-BYT;
-/dev/sdb:25.8GB:scsi:512:512:unknown:ATA QEMU HARDDISK:;
+        salt_mock = {"cmd.run_all": self._parted(parted_output)}
+        with patch.dict(partitioned.__salt__, salt_mock):
+            self.assertFalse(partitioned._check_label("/dev/sda", "msdos"))
+            self.assertFalse(partitioned._check_label("/dev/sda", "dos"))
+            self.assertFalse(partitioned._check_label("/dev/sda", "gpt"))
+        partitioned._invalidate_snapshot("/dev/sda")
+
+        parted_output = """BYT;
+/dev/sda:50331648s:scsi:512:512:msdos:ATA QEMU HARDDISK:;
 """
-        __salt__.__getitem__.return_value = lambda _: fdisk_output
-        self.assertTrue(partitioned._check_label("/dev/sda", "msdos"))
-        self.assertTrue(partitioned._check_label("/dev/sda", "dos"))
-        self.assertFalse(partitioned._check_label("/dev/sda", "gpt"))
-
-        fdisk_output = """BYT;
-/dev/sda:500GB:scsi:512:512:gpt:ATA ST3500413AS:pmbr_boot;
-1:1049kB:9437kB:8389kB:::bios_grub;
-2:9437kB:498GB:498GB:btrfs::legacy_boot;
-3:498GB:500GB:2147MB:linux-swap(v1)::swap;
-
-BYT;
-/dev/sdb:2000GB:scsi:512:4096:msdos:ATA ST2000DM001-1CH1:;
-1:1049kB:2000GB:2000GB:ext4::type=83;
+        salt_mock = {"cmd.run_all": self._parted(parted_output)}
+        with patch.dict(partitioned.__salt__, salt_mock):
+            self.assertTrue(partitioned._check_label("/dev/sda", "msdos"))
+            self.assertTrue(partitioned._check_label("/dev/sda", "dos"))
+            self.assertFalse(partitioned._check_label("/dev/sda", "gpt"))
+        # The snapshot is read only once
+        salt_mock["cmd.run_all"].assert_called_once_with(
+            ["parted", "--machine", "--script", "/dev/sda", "unit", "s", "print"]
+        )
 
+    @patch("states.partitioned.__opts__", {"test": False})
+    def test_labeled(self):
+        salt_mock = {
+            "cmd.run_all": self._parted(
+                "BYT;\n/dev/sda:50331648s:scsi:512:512:msdos:ATA QEMU HARDDISK:;\n"
+            ),
+        }
+        with patch.dict(partitioned.__salt__, salt_mock):
+            self.assertEqual(
+                partitioned.labeled("/dev/sda", "msdos"),
+                {
+                    "name": "/dev/sda",
+                    "result": True,
+                    "changes": {},
+                    "comment": ["Label already set to msdos"],
+                },
+            )
+        partitioned._invalidate_snapshot("/dev/sda")
+
+        salt_mock = {
+            "cmd.run_all": MagicMock(
+                side_effect=[
+                    {
+                        "retcode": 1,
+                        "stdout": "BYT;\n/dev/sda:50331648s:scsi:512:512:unknown::;",
+                    },
+                    {
+                        "retcode": 0,
+                        "stdout": "BYT;\n/dev/sda:50331648s:scsi:512:512:msdos::;",
+                    },
+                ]
+            ),
+            "partition.mklabel": MagicMock(),
+        }
+        with patch.dict(partitioned.__salt__, salt_mock):
+            self.assertEqual(
+                partitioned.labeled("/dev/sda", "msdos"),
+                {
+                    "name": "/dev/sda",
+                    "result": True,
+                    "changes": {"label": "Label set to msdos in /dev/sda"},
+                    "comment": ["Label set to msdos in /dev/sda"],
+                },
+            )
+        salt_mock["partition.mklabel"].assert_called_with("/dev/sda", "msdos")
+
+    def test_parse_parted(self):
+        parted_output = """BYT;
+/dev/sda:976773168s:scsi:512:512:gpt:ATA ST3500413AS:pmbr_boot;
+1:2048s:18431s:16384s::bios:bios_grub;
+2:18432s:972578815s:972560384s:btrfs::legacy_boot;
+3:972578816s:976773119s:4194304s:linux-swap(v1)::swap;
 """
-        __salt__.__getitem__.return_value = lambda _: fdisk_output
-        self.assertFalse(partitioned._check_label("/dev/sda", "msdos"))
-        self.assertFalse(partitioned._check_label("/dev/sda", "dos"))
-        self.assertTrue(partitioned._check_label("/dev/sda", "gpt"))
-
-    @patch("states.partitioned.__opts__")
-    @patch("states.partitioned.__salt__")
-    def test_labeled(self, __salt__, __opts__):
-        __opts__.__getitem__.return_value = False
-
-        __salt__.__getitem__.return_value = lambda _: "/dev/sda:msdos:"
+        snapshot = partitioned._parse_parted(parted_output)
+        self.assertEqual(snapshot["label"], "gpt")
+        self.assertEqual(snapshot["sectors"], 976773168)
+        self.assertEqual(snapshot["disk flags"], ["pmbr_boot"])
         self.assertEqual(
-            partitioned.labeled("/dev/sda", "msdos"),
+            snapshot["partitions"]["1"],
             {
-                "name": "/dev/sda",
-                "result": True,
-                "changes": {},
-                "comment": ["Label already set to msdos"],
+                "number": "1",
+                "start": 2048,
+                "end": 18431,
+                "size": 16384,
+                "file system": "",
+                "name": "bios",
+                "flags": ["bios_grub"],
+                "type": "primary",
             },
         )
+        self.assertEqual(snapshot["partitions"]["3"]["flags"], ["swap"])
 
-        __salt__.__getitem__.side_effect = (
-            lambda _: "",
-            lambda _a, _b: True,
-            lambda _: "/dev/sda:msdos:",
-        )
+        parted_output = """BYT;
+/dev/sda:50331648s:scsi:512:512:msdos:ATA QEMU HARDDISK:;
+1:2048s:22527s:20480s:::lba, type=05;
+5:4096s:10239s:6144s:ext2::type=83;
+3:22528s:43007s:20480s:::type=83;
+"""
+        snapshot = partitioned._parse_parted(parted_output)
         self.assertEqual(
-            partitioned.labeled("/dev/sda", "msdos"),
             {
-                "name": "/dev/sda",
-                "result": True,
-                "changes": {"label": "Label set to msdos in /dev/sda"},
-                "comment": ["Label set to msdos in /dev/sda"],
+                number: partition["type"]
+                for number, partition in snapshot["partitions"].items()
             },
-        )
-
-    @patch("states.partitioned.__salt__")
-    def test_get_partition_type(self, __salt__):
-        __salt__.__getitem__.return_value = (
-            lambda _: """
-Model: ATA ST2000DM001-9YN1 (scsi)
-Disk /dev/sda: 2000GB
-Sector size (logical/physical): 512B/4096B
-Partition Table: msdos
-Disk Flags:
-
-Number  Start   End     Size    Type     File system     Flags
- 1      1049kB  2155MB  2154MB  primary  linux-swap(v1)  type=82
- 2      2155MB  45.1GB  43.0GB  primary  btrfs           boot, type=83
- 3      45.1GB  2000GB  1955GB  primary  xfs             type=83
-        """
-        )
-        self.assertEqual(
-            partitioned._get_partition_type("/dev/sda"),
-            {"1": "primary", "2": "primary", "3": "primary"},
-        )
-
-        __salt__.__getitem__.return_value = (
-            lambda _: """
-Model: ATA QEMU HARDDISK (scsi)
-Disk /dev/sda: 25.8GB
-Sector size (logical/physical): 512B/512B
-Partition Table: msdos
-Disk Flags:
-
-Number  Start   End     Size    Type      File system  Flags
- 1      1049kB  11.5MB  10.5MB  extended               type=05
- 5      2097kB  5243kB  3146kB  logical                type=83
- 3      11.5GB  22.0MB  10.5MB  primary                type=83
-        """
-        )
-        self.assertEqual(
-            partitioned._get_partition_type("/dev/sda"),
             {"1": "extended", "5": "logical", "3": "primary"},
         )
 
-    @patch("states.partitioned.__salt__")
-    def test_get_cached_partitions(self, __salt__):
-        __salt__.__getitem__.side_effect = [
-            lambda _: "1 extended",
-            lambda _, unit: {"info": None, "partitions": {"1": {}}},
-        ]
-
-        self.assertEqual(
-            partitioned._get_cached_partitions("/dev/sda", "s"),
-            {"1": {"type": "extended"}},
-        )
-        partitioned._invalidate_cached_partitions()
-
-        __salt__.__getitem__.side_effect = [
-            lambda _: "",
-            lambda _, unit: {"info": None, "partitions": {"1": {}}},
-        ]
-
-        self.assertEqual(
-            partitioned._get_cached_partitions("/dev/sda", "s"),
-            {"1": {"type": "primary"}},
-        )
-
-    @patch("states.partitioned._get_cached_partitions")
-    def test_check_partition(self, _get_cached_partitions):
-        _get_cached_partitions.return_value = {
-            "1": {"type": "primary", "size": "10s", "start": "0s", "end": "10s"}
+        # An extended partition without logical partitions
+        parted_output = """BYT;
+/dev/sda:20971520s:scsi:512:512:msdos:ATA QEMU HARDDISK:;
+1:2048s:1026047s:1024000s:ext2::boot, type=83;
+2:1026048s:20971519s:19945472s:::lba, type=0f;
+"""
+        snapshot = partitioned._parse_parted(parted_output)
+        self.assertEqual(snapshot["partitions"]["1"]["type"], "primary")
+        self.assertEqual(snapshot["partitions"]["2"]["type"], "extended")
+
+    def test_get_snapshot_msdos_ids(self):
+        # Old versions of parted do not show the partition ids, so
+        # they are read with sfdisk
+        parted_output = """BYT;
+/dev/sda:20971520s:scsi:512:512:msdos:ATA QEMU HARDDISK:;
+1:2048s:1026047s:1024000s:ext2::boot;
+2:1026048s:20971519s:19945472s:::lba;
+"""
+        sfdisk_output = {
+            "partitiontable": {
+                "label": "dos",
+                "partitions": [
+                    {"node": "/dev/sda1", "start": 2048, "size": 1024000, "type": "83"},
+                    {
+                        "node": "/dev/sda2",
+                        "start": 1026048,
+                        "size": 19945472,
+                        "type": "5",
+                    },
+                ],
+            }
+        }
+        salt_mock = {
+            "cmd.run_all": MagicMock(
+                side_effect=[
+                    {"retcode": 0, "stdout": parted_output, "stderr": ""},
+                    {"retcode": 0, "stdout": json.dumps(sfdisk_output), "stderr": ""},
+                ]
+            )
+        }
+        with patch.dict(partitioned.__salt__, salt_mock):
+            partitions = partitioned._get_snapshot("/dev/sda")["partitions"]
+            self.assertEqual(partitions["1"]["type"], "primary")
+            self.assertEqual(partitions["2"]["type"], "extended")
+            self.assertTrue(
+                partitioned._check_partition(
+                    "/dev/sda", "2", "extended", "1026048s", "20971519s"
+                )
+            )
+            self.assertEqual(
+                partitioned._get_partition_number(
+                    "/dev/sda", "logical", "1028096s", "2000000s"
+                ),
+                "5",
+            )
+        salt_mock["cmd.run_all"].assert_called_with(["sfdisk", "--json", "/dev/sda"])
+
+    def test_get_cached_partitions(self):
+        parted_output = """BYT;
+/dev/sda:409600s:scsi:512:512:msdos:ATA QEMU HARDDISK:;
+1:2048s:206847s:204800s:ext2::boot, type=83;
+"""
+        salt_mock = {"cmd.run_all": self._parted(parted_output)}
+        with patch.dict(partitioned.__salt__, salt_mock):
+            self.assertEqual(
+                partitioned._get_cached_partitions("/dev/sda", "s")["1"]["start"],
+                "2048.000000s",
+            )
+            partition = partitioned._get_cached_partitions("/dev/sda", "MiB")["1"]
+            self.assertEqual(partition["start"], "1.000000MiB")
+            self.assertEqual(partition["size"], "100.000000MiB")
+            self.assertEqual(partition["type"], "primary")
+            self.assertEqual(
+                partitioned._get_cached_partitions("/dev/sda", "%")["1"]["end"],
+                "50.499756%",
+            )
+            self.assertEqual(partitioned._get_partition_flags("/dev/sda", 1), ["boot"])
+            self.assertTrue(partitioned._check_partition_flags("/dev/sda", 1, "boot"))
+            self.assertFalse(partitioned._check_disk_flags("/dev/sda", "pmbr_boot"))
+        salt_mock["cmd.run_all"].assert_called_once()
+
+        # Invalidating a device do not affect the others
+        partitioned._get_snapshot.snapshots["/dev/sdb"] = {}
+        partitioned._invalidate_snapshot("/dev/sda")
+        self.assertEqual(list(partitioned._get_snapshot.snapshots), ["/dev/sdb"])
+
+    def test_refreshed(self):
+        """Test partitioned.refreshed after a parallel layout"""
+        # Snapshot and inventory cached before the parallel states
+        self._snapshot("gpt", [])
+        context = {partitioned.inventory.CONTEXT_KEY: partitioned.inventory.Inventory()}
+        parted_output = """BYT;
+/dev/sda:409600s:scsi:512:512:gpt:ATA QEMU HARDDISK:;
+1:2048s:206847s:204800s:ext4::;
+"""
+        salt_mock = {
+            "cmd.run_all": MagicMock(
+                return_value={"retcode": 0, "stdout": parted_output, "stderr": ""}
+            )
+        }
+        with patch.dict(partitioned.__context__, context), patch.dict(
+            partitioned.__salt__, salt_mock
+        ):
+            self.assertEqual(partitioned._get_snapshot("/dev/sda")["partitions"], {})
+            ret = partitioned.refreshed("wait_for_storage")
+            self.assertTrue(ret["result"])
+            self.assertNotIn(partitioned.inventory.CONTEXT_KEY, partitioned.__context__)
+            self.assertEqual(
+                list(partitioned._get_snapshot("/dev/sda")["partitions"]), ["1"]
+            )
+
+    def _snapshot(self, label, partitions, sector_size=512, sectors=409600):
+        """Set the snapshot of /dev/sda, with the partitions in sectors"""
+        partitioned._get_snapshot.snapshots = {
+            "/dev/sda": {
+                "label": label,
+                "sector_size": sector_size,
+                "sectors": sectors,
+                "disk flags": [],
+                "partitions": {
+                    number: {
+                        "number": number,
+                        "type": part_type,
+                        "start": start,
+                        "end": end,
+                        "size": end - start,
+                        "flags": [],
+                    }
+                    for number, part_type, start, end in partitions
+                },
+            }
         }
+
+    def test_check_partition(self):
+        self._snapshot("msdos", [("1", "primary", 0, 10)])
         self.assertTrue(
             partitioned._check_partition("/dev/sda", 1, "primary", "0s", "10s")
         )
@@ -180,13 +292,15 @@ Number  Start   End     Size    Type      File system  Flags
         self.assertFalse(
             partitioned._check_partition("/dev/sda", "1", "primary", "10s", "20s")
         )
+        self.assertFalse(
+            partitioned._check_partition("/dev/sda", "1", "logical", "0s", "10s")
+        )
         self.assertEqual(
             partitioned._check_partition("/dev/sda", "2", "primary", "10s", "20s"), None
         )
 
-        _get_cached_partitions.return_value = {
-            "1": {"type": "primary", "size": "100kB", "start": "0.5kB", "end": "100kB"}
-        }
+        # Sectors of 10 bytes, the partition is [0.5kB, 100kB]
+        self._snapshot("msdos", [("1", "primary", 50, 10000)], sector_size=10)
         self.assertTrue(
             partitioned._check_partition("/dev/sda", "1", "primary", "0kB", "100kB")
         )
@@ -197,94 +311,88 @@ Number  Start   End     Size    Type      File system  Flags
             partitioned._check_partition("/dev/sda", "1", "primary", "1.5kB", "100kB")
         )
 
-    @patch("states.partitioned._get_cached_partitions")
-    def test_get_first_overlapping_partition(self, _get_cached_partitions):
-        _get_cached_partitions.return_value = {}
+    def test_get_first_overlapping_partition(self):
+        self._snapshot("msdos", [])
         self.assertEqual(
             partitioned._get_first_overlapping_partition("/dev/sda", "0s"), None
         )
 
-        _get_cached_partitions.return_value = {
-            "1": {
-                "number": "1",
-                "type": "primary",
-                "size": "10s",
-                "start": "0s",
-                "end": "10s",
-            }
-        }
+        self._snapshot("msdos", [("1", "primary", 0, 10)])
         self.assertEqual(
             partitioned._get_first_overlapping_partition("/dev/sda", "0s"), "1"
         )
+        self.assertEqual(
+            partitioned._get_first_overlapping_partition("/dev/sda", "11s"), None
+        )
 
-        _get_cached_partitions.return_value = {
-            "1": {
-                "number": "1",
-                "type": "primary",
-                "size": "100kB",
-                "start": "0.51kB",
-                "end": "100kB",
-            }
-        }
+        # Sectors of 10 bytes, the partition is [0.51kB, 100kB]
+        self._snapshot("msdos", [("1", "primary", 51, 10000)], sector_size=10)
         self.assertEqual(
             partitioned._get_first_overlapping_partition("/dev/sda", "0kB"), "1"
         )
 
-        _get_cached_partitions.return_value = {
-            "1": {
-                "number": "1",
-                "type": "extended",
-                "size": "10s",
-                "start": "0s",
-                "end": "10s",
-            },
-            "5": {
-                "number": "5",
-                "type": "logical",
-                "size": "4s",
-                "start": "1s",
-                "end": "5s",
-            },
-        }
+        self._snapshot("msdos", [("1", "extended", 0, 10), ("5", "logical", 1, 5)])
         self.assertEqual(
             partitioned._get_first_overlapping_partition("/dev/sda", "0s"), "1"
         )
-
         self.assertEqual(
             partitioned._get_first_overlapping_partition("/dev/sda", "1s"), "5"
         )
+        # After the logical partition, but still inside the extended
+        self.assertEqual(
+            partitioned._get_first_overlapping_partition("/dev/sda", "6s"), "1"
+        )
+
+    def test_get_first_overlapping_partition_gpt(self):
+        self._snapshot(
+            "gpt",
+            [(str(i), "primary", i * 2048, i * 2048 + 2047) for i in range(1, 129)],
+        )
+        self.assertEqual(
+            partitioned._get_first_overlapping_partition("/dev/sda", "0s"), None
+        )
+        self.assertEqual(
+            partitioned._get_first_overlapping_partition("/dev/sda", "2048s"), "1"
+        )
+        self.assertEqual(
+            partitioned._get_first_overlapping_partition("/dev/sda", "64MiB"), "64"
+        )
+        self.assertEqual(
+            partitioned._get_first_overlapping_partition("/dev/sda", "264190s"),
+            "128",
+        )
+        self.assertEqual(
+            partitioned._get_first_overlapping_partition("/dev/sda", "264192s"), None
+        )
 
-    @patch("states.partitioned._get_cached_info")
-    @patch("states.partitioned._get_cached_partitions")
-    def test_get_partition_number_primary(
-        self, _get_cached_partitions, _get_cached_info
-    ):
-        _get_cached_info.return_value = {"partition table": "msdos"}
-        _get_cached_partitions.return_value = {}
+    def test_first_free_number(self):
+        self.assertEqual(partitioned._first_free_number([], 4), "1")
+        self.assertEqual(partitioned._first_free_number([1, 2, 4], 4), "3")
+        self.assertEqual(partitioned._first_free_number([2, 3], 4), "1")
+        self.assertEqual(partitioned._first_free_number([1, 2, 3, 4, 5], 4), None)
+        self.assertEqual(
+            partitioned._first_free_number(list(range(1, 129)), 1024), "129"
+        )
+
+    def test_get_partition_number_primary(self):
+        self._snapshot("msdos", [])
 
         partition_data = ("/dev/sda", "primary", "0s", "10s")
         self.assertEqual(partitioned._get_partition_number(*partition_data), "1")
 
-        _get_cached_partitions.return_value = {
-            "1": {
-                "number": "1",
-                "type": "primary",
-                "size": "10s",
-                "start": "0s",
-                "end": "10s",
-            }
-        }
+        self._snapshot("msdos", [("1", "primary", 0, 10)])
         self.assertEqual(partitioned._get_partition_number(*partition_data), "1")
 
         partition_data = ("/dev/sda", "primary", "0s", "10s")
         self.assertEqual(partitioned._get_partition_number(*partition_data), "1")
 
-        _get_cached_partitions.return_value = {
-            "1": {"number": "1", "type": "primary", "start": "0s", "end": "10s"},
-            "2": {"number": "2", "type": "primary", "start": "11s", "end": "20s"},
-            "3": {"number": "3", "type": "primary", "start": "21s", "end": "30s"},
-            "4": {"number": "4", "type": "primary", "start": "31s", "end": "40s"},
-        }
+        partitions = [
+            ("1", "primary", 0, 10),
+            ("2", "primary", 11, 20),
+            ("3", "primary", 21, 30),
+            ("4", "primary", 31, 40),
+        ]
+        self._snapshot("msdos", partitions)
 
         partition_data = ("/dev/sda", "primary", "41s", "50s")
         self.assertRaises(
@@ -293,42 +401,35 @@ Number  Start   End     Size    Type      File system  Flags
             *partition_data
         )
 
-        _get_cached_info.return_value = {"partition table": "gpt"}
+        self._snapshot("gpt", partitions)
         partition_data = ("/dev/sda", "primary", "41s", "50s")
         self.assertEqual(partitioned._get_partition_number(*partition_data), "5")
 
-    @patch("states.partitioned._get_cached_info")
-    @patch("states.partitioned._get_cached_partitions")
-    def test_get_partition_number_extended(
-        self, _get_cached_partitions, _get_cached_info
-    ):
-        _get_cached_info.return_value = {"partition table": "msdos"}
-        _get_cached_partitions.return_value = {}
+    def test_get_partition_number_extended(self):
+        self._snapshot("msdos", [])
         partition_data = ("/dev/sda", "extended", "0s", "10s")
         self.assertEqual(partitioned._get_partition_number(*partition_data), "1")
 
-        _get_cached_partitions.return_value = {
-            "1": {"number": "1", "type": "primary", "start": "0s", "end": "10s"},
-        }
+        self._snapshot("msdos", [("1", "primary", 0, 10)])
         partition_data = ("/dev/sda", "extended", "21s", "30s")
         self.assertEqual(partitioned._get_partition_number(*partition_data), "2")
 
-        _get_cached_partitions.return_value = {
-            "1": {"number": "1", "type": "primary", "start": "0s", "end": "10s"},
-            "2": {"number": "2", "type": "extended", "start": "11s", "end": "20s"},
-        }
+        self._snapshot("msdos", [("1", "primary", 0, 10), ("2", "extended", 11, 20)])
         self.assertRaises(
             partitioned.EnumerateException,
             partitioned._get_partition_number,
             *partition_data
         )
 
-        _get_cached_partitions.return_value = {
-            "1": {"number": "1", "type": "primary", "start": "0s", "end": "10s"},
-            "2": {"number": "2", "type": "primary", "start": "11s", "end": "20s"},
-            "3": {"number": "3", "type": "primary", "start": "21s", "end": "30s"},
-            "4": {"number": "4", "type": "primary", "start": "31s", "end": "40s"},
-        }
+        self._snapshot(
+            "msdos",
+            [
+                ("1", "primary", 0, 10),
+                ("2", "primary", 11, 20),
+                ("3", "primary", 21, 30),
+                ("4", "primary", 31, 40),
+            ],
+        )
         partition_data = ("/dev/sda", "extended", "41s", "50s")
         self.assertRaises(
             partitioned.EnumerateException,
@@ -336,21 +437,15 @@ Number  Start   End     Size    Type      File system  Flags
             *partition_data
         )
 
-        _get_cached_info.return_value = {"partition table": "gpt"}
-        _get_cached_partitions.return_value = {}
+        self._snapshot("gpt", [])
         self.assertRaises(
             partitioned.EnumerateException,
             partitioned._get_partition_number,
             *partition_data
         )
 
-    @patch("states.partitioned._get_cached_info")
-    @patch("states.partitioned._get_cached_partitions")
-    def test_get_partition_number_logial(
-        self, _get_cached_partitions, _get_cached_info
-    ):
-        _get_cached_info.return_value = {"partition table": "msdos"}
-        _get_cached_partitions.return_value = {}
+    def test_get_partition_number_logial(self):
+        self._snapshot("msdos", [])
         partition_data = ("/dev/sda", "logical", "0s", "10s")
         self.assertRaises(
             partitioned.EnumerateException,
@@ -358,9 +453,7 @@ Number  Start   End     Size    Type      File system  Flags
             *partition_data
         )
 
-        _get_cached_partitions.return_value = {
-            "1": {"number": "1", "type": "primary", "start": "0s", "end": "10s"},
-        }
+        self._snapshot("msdos", [("1", "primary", 0, 10)])
         partition_data = ("/dev/sda", "logical", "12s", "15s")
         self.assertRaises(
             partitioned.EnumerateException,
@@ -368,17 +461,17 @@ Number  Start   End     Size    Type      File system  Flags
             *partition_data
         )
 
-        _get_cached_partitions.return_value = {
-            "1": {"number": "1", "type": "primary", "start": "0s", "end": "10s"},
-            "2": {"number": "2", "type": "extended", "start": "11s", "end": "20s"},
-        }
+        self._snapshot("msdos", [("1", "primary", 0, 10), ("2", "extended", 11, 20)])
         self.assertEqual(partitioned._get_partition_number(*partition_data), "5")
 
-        _get_cached_partitions.return_value = {
-            "1": {"number": "1", "type": "primary", "start": "0s", "end": "10s"},
-            "2": {"number": "2", "type": "extended", "start": "11s", "end": "20s"},
-            "5": {"number": "5", "type": "logical", "start": "12s", "end": "15s"},
-        }
+        self._snapshot(
+            "msdos",
+            [
+                ("1", "primary", 0, 10),
+                ("2", "extended", 11, 20),
+                ("5", "logical", 12, 15),
+            ],
+        )
         self.assertEqual(partitioned._get_partition_number(*partition_data), "5")
 
         partition_data = ("/dev/sda", "logical", "16s", "19s")
@@ -389,6 +482,189 @@ Number  Start   End     Size    Type      File system  Flags
     def test_mkparted(self, __salt__, _get_partition_number):
         pass
 
+    def _sfdisk(self, table):
+        """Return a mock for cmd.run_all that emulates sfdisk"""
+        calls = []
+
+        def run_all(cmd, stdin=None):
+            calls.append((cmd, stdin))
+            if cmd[0] == "blockdev":
+                return {"retcode": 0, "stdout": "512\n10737418240\n"}
+            if cmd[1] == "--json":
+                if not table:
+                    return {"retcode": 1, "stdout": "", "stderr": "no table"}
+                return {"retcode": 0, "stdout": json.dumps({"partitiontable": table})}
+            # Emulate the creation of the partitions
+            if "--append" not in cmd:
+                table.clear()
+                table.update({"label": "gpt", "partitions": []})
+            for line in stdin.splitlines():
+                if " : " in line:
+                    node, fields = line.split(" : ")
+                    partition = dict(field.split("=") for field in fields.split(", "))
+                    table["partitions"].append(
+                        {
+                            "node": node,
+                            "start": int(partition["start"]),
+                            "size": int(partition["size"]),
+                            "type": partition["type"],
+                        }
+                    )
+            return {"retcode": 0, "stdout": "", "stderr": ""}
+
+        return run_all, calls
+
+    def _partitions(self):
+        return [
+            {
+                "part_id": "/dev/sda1",
+                "part_type": "primary",
+                "fs_type": "ext2",
+                "start": "0MB",
+                "end": "8MB",
+                "flags": ["bios_grub"],
+            },
+            {
+                "part_id": "/dev/sda2",
+                "part_type": "primary",
+                "fs_type": "ext2",
+                "start": "8MB",
+                "end": "100%",
+                "flags": None,
+            },
+        ]
+
+    @patch("states.partitioned.__opts__", {"test": False})
+    def test_layout(self):
+        """Test partitioned.layout creating the full table"""
+        run_all, calls = self._sfdisk({})
+        salt_mock = {
+            "cmd.run_all": run_all,
+            "cmd.run": MagicMock(),
+            "partition.disk_set": MagicMock(),
+        }
+        with patch.dict(partitioned.__salt__, salt_mock):
+            self.assertEqual(
+                partitioned.layout(
+                    "/dev/sda", "gpt", self._partitions(), pmbr_boot=True
+                ),
+                {
+                    "name": "/dev/sda",
+                    "result": True,
+                    "changes": {
+                        "label": "gpt",
+                        "partitions": ["/dev/sda1", "/dev/sda2"],
+                        "pmbr_boot": True,
+                    },
+                    "comment": ["Partition table of /dev/sda updated"],
+                },
+            )
+        sfdisk_calls = [call for call in calls if call[1]]
+        self.assertEqual(len(sfdisk_calls), 1)
+        self.assertEqual(
+            sfdisk_calls[0],
+            (
+                [
+                    "sfdisk",
+                    "--wipe-partitions",
+                    "always",
+                    "--wipe",
+                    "always",
+                    "/dev/sda",
+                ],
+                "label: gpt\n"
+                "\n"
+                "/dev/sda1 : start=2048, size=13577, "
+                "type=21686148-6449-6E6F-744E-656564454649\n"
+                "/dev/sda2 : start=16384, size=20955103, "
+                "type=0FC63DAF-8483-4772-8E79-3D69D8477DE4\n",
+            ),
+        )
+        salt_mock["cmd.run"].assert_called_once_with(["udevadm", "settle"])
+        salt_mock["partition.disk_set"].assert_called_with(
+            "/dev/sda", "pmbr_boot", "on"
+        )
+
+    @patch("states.partitioned.__opts__", {"test": False})
+    def test_layout_append(self):
+        """Test partitioned.layout adding the missing partitions"""
+        table = {
+            "label": "gpt",
+            "partitions": [
+                {
+                    "node": "/dev/sda1",
+                    "start": 2048,
+                    "size": 13500,
+                    "type": "21686148-6449-6e6f-744e-656564454649",
+                }
+            ],
+        }
+        run_all, calls = self._sfdisk(table)
+        salt_mock = {"cmd.run_all": run_all, "cmd.run": MagicMock()}
+        with patch.dict(partitioned.__salt__, salt_mock):
+            result = partitioned.layout("/dev/sda", "gpt", self._partitions())
+            self.assertTrue(result["result"])
+            self.assertEqual(result["changes"], {"partitions": ["/dev/sda2"]})
+            self.assertIn("--append", calls[-2][0])
+
+            # Once the table is complete there is nothing to do
+            self.assertEqual(
+                partitioned.layout("/dev/sda", "gpt", self._partitions()),
+                {
+                    "name": "/dev/sda",
+                    "result": True,
+                    "changes": {},
+                    "comment": ["Partition table of /dev/sda already in place"],
+                },
+            )
+
+    @patch("states.partitioned.__opts__", {"test": False})
+    def test_layout_conflict(self):
+        """Test partitioned.layout when a partition is different"""
+        table = {
+            "label": "gpt",
+            "partitions": [
+                {"node": "/dev/sda1", "start": 2048, "size": 100, "type": "EF00"}
+            ],
+        }
+        run_all, calls = self._sfdisk(table)
+        with patch.dict(partitioned.__salt__, {"cmd.run_all": run_all}):
+            self.assertEqual(
+                partitioned.layout("/dev/sda", "gpt", self._partitions()),
+                {
+                    "name": "/dev/sda",
+                    "result": False,
+                    "changes": {},
+                    "comment": ["Partition /dev/sda1 cannot be replaced"],
+                },
+            )
+        self.assertFalse(any(call[1] for call in calls))
+
+    @patch("states.partitioned.__opts__", {"test": True})
+    def test_layout_test(self):
+        """Test partitioned.layout in test mode"""
+        run_all, calls = self._sfdisk({})
+        with patch.dict(partitioned.__salt__, {"cmd.run_all": run_all}):
+            result = partitioned.layout("/dev/sda", "msdos", self._partitions()[1:])
+        self.assertIsNone(result["result"])
+        self.assertEqual(
+            result["changes"], {"label": "msdos", "partitions": ["/dev/sda2"]}
+        )
+        self.assertFalse(any(call[1] for call in calls))
+
+    def test_layout_invalid(self):
+        """Test partitioned.layout with invalid partitions"""
+        run_all, _ = self._sfdisk({})
+        with patch.dict(partitioned.__salt__, {"cmd.run_all": run_all}):
+            self.assertEqual(
+                partitioned.layout("/dev/sda", "msdos", self._partitions())["comment"],
+                ["Flag bios_grub not valid for msdos labels"],
+            )
+            self.assertEqual(
+                partitioned.layout("/dev/sda", "sun", [])["comment"],
+                ["Label sun not supported"],
+            )
+
 
 if __name__ == "__main__":
     unittest.main()
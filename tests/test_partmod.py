@@ -678,6 +678,37 @@ class PartmodTestCase(unittest.TestCase):
             },
         )
 
+    @patch("modules.partmod.__grains__")
+    @patch("modules.partmod.__salt__")
+    def test_partition_owners(self, __salt__, __grains__):
+        partitions = {
+            "devices": {
+                "/dev/sda": {
+                    "partitions": [
+                        {"number": 1, "size": "20MB", "type": "raid"},
+                        {"number": 2, "size": "rest", "type": "lvm"},
+                    ],
+                },
+                "/dev/sdb": {},
+                "/dev/md0": {
+                    "partitions": [{"number": 1, "size": "rest", "type": "linux"}],
+                },
+            },
+        }
+        __grains__.__getitem__.return_value = False
+        __salt__.__getitem__.return_value = filters.is_raid
+        self.assertEqual(
+            partmod.partition_owners(partitions),
+            {
+                "/dev/sda": "/dev/sda",
+                "/dev/sda1": "/dev/sda",
+                "/dev/sda2": "/dev/sda",
+                "/dev/sdb": "/dev/sdb",
+                "/dev/md0": "/dev/md0",
+                "/dev/md0p1": "/dev/md0",
+            },
+        )
+
 
 if __name__ == "__main__":
     unittest.main()
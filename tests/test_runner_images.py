@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Alberto Planas <aplanas@suse.com>
+#
+# Copyright 2019 SUSE LLC.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import unittest
+from unittest.mock import patch
+
+from salt.exceptions import SaltInvocationError, CommandExecutionError
+
+from runners import images
+
+
+class RunnerImagesTestCase(unittest.TestCase):
+    @patch("runners.images.multicast.send")
+    def test_multicast(self, send):
+        """Test images.multicast runner"""
+        send.return_value = {
+            "sent": 10,
+            "repaired": 1,
+            "seconds": 1.0,
+            "throughput": 1.0,
+        }
+        self.assertEqual(
+            images.multicast_("/srv/image.xz", receivers=4, rate=50),
+            send.return_value,
+        )
+        send.assert_called_with(
+            "/srv/image.xz",
+            "239.255.42.1",
+            9000,
+            packet_size=1400,
+            rate=50 * 1000**2,
+            ttl=1,
+            interface=None,
+            receivers=4,
+            linger=10,
+        )
+
+    def test_multicast_invalid(self):
+        """Test images.multicast runner with invalid parameters"""
+        with self.assertRaises(SaltInvocationError):
+            images.multicast_("/srv/image.xz", receivers=0)
+        with self.assertRaises(SaltInvocationError):
+            images.multicast_("/srv/image.xz", rate=-1)
+
+    @patch("runners.images.multicast.send")
+    def test_multicast_fail(self, send):
+        """Test images.multicast runner when the image cannot be sent"""
+        send.side_effect = OSError("error")
+        with self.assertRaises(CommandExecutionError):
+            images.multicast_("/srv/image.xz")
+
+    @patch("runners.images.time.sleep")
+    @patch("runners.images.swarm.Tracker")
+    def test_tracker(self, Tracker, sleep):
+        """Test images.tracker runner"""
+        server = Tracker.return_value
+        server.port = 6969
+        server.swarms = {"md5-checksum": {}}
+        self.assertEqual(images.tracker(duration=60), {"port": 6969, "swarms": 1})
+        Tracker.assert_called_with("", 6969)
+        server.start.assert_called_once()
+        sleep.assert_called_with(60)
+        server.close.assert_called_once()
+
+    @patch("runners.images.time.sleep")
+    @patch("runners.images.downloads.SlotServer")
+    def test_slots(self, SlotServer, sleep):
+        """Test images.slots runner"""
+        server = SlotServer.return_value
+        server.port = 6970
+        server.granted = 4
+        self.assertEqual(images.slots(2, duration=60), {"port": 6970, "granted": 4})
+        SlotServer.assert_called_with(2, "", 6970, ttl=60)
+        server.start.assert_called_once()
+        sleep.assert_called_with(60)
+        server.close.assert_called_once()
+
+    def test_slots_invalid(self):
+        """Test images.slots runner with an invalid budget"""
+        with self.assertRaises(SaltInvocationError):
+            images.slots(0)
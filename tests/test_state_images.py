@@ -0,0 +1,427 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Alberto Planas <aplanas@suse.com>
+#
+# Copyright 2019 SUSE LLC.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+from salt.exceptions import CommandExecutionError
+
+from states import images
+
+from test_superblock import make_btrfs, make_ext, make_xfs, UUID
+
+
+class ImagesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.device = os.path.join(self.tmpdir.name, "device")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _record(self):
+        with open(self.device, "rb") as f:
+            f.seek(images.RECORD_OFFSET)
+            return f.read(images.RECORD_SIZE)
+
+    def test__write_device_record(self):
+        """Test images._write_device_record function"""
+        make_ext(self.device)
+        self.assertTrue(images._write_device_record(self.device, {"md5": "check"}))
+        record = self._record()
+        self.assertTrue(record.startswith(images.RECORD_MAGIC))
+        self.assertEqual(
+            json.loads(record[len(images.RECORD_MAGIC) :].rstrip(b"\0")),
+            {"uuid": UUID, "checksums": {"md5": "check"}},
+        )
+        # The superblock is not touched
+        self.assertEqual(images.superblock.read(self.device)["uuid"], UUID)
+
+    def test__write_device_record_many(self):
+        """Test images._write_device_record function with many checksums"""
+        make_ext(self.device)
+        checksums = {
+            "sha256": "a" * 64,
+            "md5": "b" * 32,
+            "sha512": "c" * 128,
+            "sha384": "d" * 96,
+            "sha224": "e" * 56,
+            "sha1": "f" * 40,
+        }
+        self.assertTrue(images._write_device_record(self.device, checksums))
+        record = images._read_device_record(self.device)
+        # Only the first ones that fit are stored
+        self.assertEqual(
+            list(record["checksums"]), ["sha256", "md5", "sha512", "sha384", "sha1"]
+        )
+
+    def test__write_device_record_xfs(self):
+        """Test images._write_device_record function with xfs"""
+        make_xfs(self.device)
+        self.assertFalse(images._write_device_record(self.device, {"md5": "check"}))
+
+    def test__write_device_record_btrfs(self):
+        """Test images._write_device_record function with btrfs"""
+        make_btrfs(self.device)
+        # GRUB2 embeds the core image after the first sector of btrfs
+        core = os.urandom(images.RECORD_SIZE)
+        with open(self.device, "r+b") as f:
+            f.seek(images.RECORD_OFFSET)
+            f.write(core)
+        self.assertFalse(images._write_device_record(self.device, {"md5": "check"}))
+        self.assertEqual(self._record(), core)
+        self.assertEqual(images._read_device_record(self.device), None)
+
+    def test__read_device_record(self):
+        """Test images._read_device_record function"""
+        make_ext(self.device)
+        self.assertEqual(images._read_device_record(self.device), None)
+
+        images._write_device_record(self.device, {"md5": "check"})
+        self.assertEqual(
+            images._read_device_record(self.device),
+            {"uuid": UUID, "checksums": {"md5": "check"}},
+        )
+
+    @patch("states.images.superblock.read")
+    def test__read_device_record_other_uuid(self, read):
+        """Test images._read_device_record function after a format"""
+        make_ext(self.device)
+        images._write_device_record(self.device, {"md5": "check"})
+        read.return_value = {"type": "ext4", "uuid": "other"}
+        self.assertEqual(images._read_device_record(self.device), None)
+
+    def test__is_dump_needed(self):
+        """Test images._is_dump_needed function"""
+        make_ext(self.device)
+        self.assertEqual(images._is_dump_needed(self.device, "md5", "check"), None)
+
+        images._write_device_record(self.device, {"md5": "check"})
+        self.assertFalse(images._is_dump_needed(self.device, "md5", "check"))
+        self.assertTrue(images._is_dump_needed(self.device, "md5", "other"))
+        self.assertEqual(images._is_dump_needed(self.device, "sha1", "check"), None)
+
+    @patch("states.images._read_current_checksum")
+    def test_dumped_not_needed(self, _read_current_checksum):
+        """Test images.dumped state when the record match"""
+        make_ext(self.device)
+        images._write_device_record(self.device, {"md5": "check"})
+        salt_mock = {
+            "images.dump": MagicMock(),
+        }
+        opts_mock = {"test": False}
+
+        with patch.dict(images.__salt__, salt_mock), patch.dict(
+            images.__opts__, opts_mock
+        ):
+            self.assertEqual(
+                images.dumped(
+                    "http://example.org/image.ext4",
+                    self.device,
+                    checksum_type="md5",
+                    checksum="check",
+                ),
+                {
+                    "name": "http://example.org/image.ext4",
+                    "result": True,
+                    "changes": {},
+                    "comment": [],
+                },
+            )
+            _read_current_checksum.assert_not_called()
+            salt_mock["images.dump"].assert_not_called()
+
+    @patch("states.images._read_current_checksum")
+    @patch("states.images._save_current_checksum")
+    def test_dumped_multicast(self, _save_current_checksum, _read_current_checksum):
+        """Test images.dumped state with a multicast URL"""
+        make_ext(self.device)
+        _save_current_checksum.return_value = True
+        _read_current_checksum.return_value = None
+        salt_mock = {
+            "images.dump": MagicMock(return_value={"checksum": "check"}),
+        }
+        opts_mock = {"test": False}
+
+        url = "multicast://239.255.42.1:9000"
+        with patch.dict(images.__salt__, salt_mock), patch.dict(
+            images.__opts__, opts_mock
+        ):
+            result = images.dumped(
+                url, self.device, checksum_type="md5", checksum="check", native=True
+            )
+            self.assertTrue(result["result"])
+            self.assertEqual(salt_mock["images.dump"].call_args[0][0], url)
+
+    def test_dumped_multicast_no_checksum(self):
+        """Test images.dumped state with a multicast URL without checksum"""
+        salt_mock = {
+            "images.fetch_checksum": MagicMock(),
+            "images.dump": MagicMock(),
+        }
+
+        with patch.dict(images.__salt__, salt_mock):
+            result = images.dumped(
+                "multicast://239.255.42.1:9000",
+                self.device,
+                checksum_type="md5",
+                native=True,
+            )
+            self.assertFalse(result["result"])
+            self.assertIn("multicast", result["comment"][0])
+            salt_mock["images.fetch_checksum"].assert_not_called()
+            salt_mock["images.dump"].assert_not_called()
+
+    def test_dumped_checksum_error(self):
+        """Test images.dumped state when the checksum cannot be fetched"""
+        salt_mock = {
+            "images.fetch_checksum": MagicMock(
+                side_effect=CommandExecutionError("error")
+            ),
+        }
+
+        with patch.dict(images.__salt__, salt_mock):
+            self.assertEqual(
+                images.dumped(
+                    "http://example.org/image.ext4", self.device, checksum_type="md5"
+                ),
+                {
+                    "name": "http://example.org/image.ext4",
+                    "result": False,
+                    "changes": {},
+                    "comment": ["Error fetching the checksum: error"],
+                },
+            )
+
+    @patch("states.images._save_current_checksum")
+    def test_dumped_devices(self, _save_current_checksum):
+        """Test images.dumped state with many devices"""
+        devices = [self.device + "-a", self.device + "-b", self.device + "-c"]
+        for device in devices:
+            make_ext(device)
+        images._write_device_record(devices[0], {"md5": "check"})
+        _save_current_checksum.return_value = True
+        salt_mock = {
+            "images.dump": MagicMock(
+                return_value={
+                    "checksum": "check",
+                    "devices": {
+                        devices[1]: {
+                            "checksum": "check",
+                            "checksums": {"md5": "check", "sha1": "sha1"},
+                        },
+                        devices[2]: {"error": "error"},
+                    },
+                }
+            ),
+        }
+        opts_mock = {"test": False}
+
+        with patch.dict(images.__salt__, salt_mock), patch.dict(
+            images.__opts__, opts_mock
+        ), patch("states.images._read_current_checksum") as _read_current_checksum:
+            _read_current_checksum.return_value = None
+            self.assertEqual(
+                images.dumped(
+                    "http://example.org/image.ext4",
+                    devices,
+                    checksum_type="md5",
+                    checksum="check",
+                ),
+                {
+                    "name": "http://example.org/image.ext4",
+                    "result": False,
+                    "changes": {
+                        devices[1]: {"image": True, "checksum cache": True},
+                        devices[2]: {},
+                    },
+                    "comment": ["{}: Failed writing the image".format(devices[2])],
+                },
+            )
+            self.assertEqual(
+                salt_mock["images.dump"].call_args[0][:2],
+                ("http://example.org/image.ext4", devices[1:]),
+            )
+            _save_current_checksum.assert_called_once_with(
+                devices[1], "md5", "check", {"md5": "check", "sha1": "sha1"}
+            )
+
+    @patch("states.images._save_current_checksum")
+    def test_dumped_whole_disk(self, _save_current_checksum):
+        """Test images.dumped state with a whole disk image"""
+        _save_current_checksum.return_value = True
+        salt_mock = {
+            "partition.list": MagicMock(side_effect=CommandExecutionError("error")),
+            "images.dump": MagicMock(
+                return_value={"checksum": "check", "partition": "/dev/sda3"}
+            ),
+        }
+        opts_mock = {"test": False}
+
+        with patch.dict(images.__salt__, salt_mock), patch.dict(
+            images.__opts__, opts_mock
+        ):
+            self.assertEqual(
+                images.dumped(
+                    "http://example.org/image.raw",
+                    "/dev/sda",
+                    checksum_type="md5",
+                    checksum="check",
+                    whole_disk=True,
+                ),
+                {
+                    "name": "http://example.org/image.raw",
+                    "result": True,
+                    "changes": {"image": True, "checksum cache": True},
+                    "comment": [],
+                },
+            )
+            self.assertTrue(salt_mock["images.dump"].call_args[1]["whole_disk"])
+            _save_current_checksum.assert_called_once_with(
+                "/dev/sda3", "md5", "check", None
+            )
+
+    @patch("states.images._dump_needed")
+    def test_dumped_whole_disk_same(self, _dump_needed):
+        """Test images.dumped state with the same whole disk image"""
+        _dump_needed.return_value = False
+        salt_mock = {
+            "partition.list": MagicMock(
+                return_value={
+                    "partitions": {
+                        "1": {"start": "4096s", "end": "8191s"},
+                        "2": {"start": "8192s", "end": "16383s"},
+                        "10": {"start": "2048s", "end": "4095s"},
+                    }
+                }
+            ),
+            "images.dump": MagicMock(),
+        }
+        opts_mock = {"test": False}
+
+        with patch.dict(images.__salt__, salt_mock), patch.dict(
+            images.__opts__, opts_mock
+        ):
+            self.assertTrue(
+                images.dumped(
+                    "http://example.org/image.raw",
+                    "/dev/nvme0n1",
+                    checksum_type="md5",
+                    checksum="check",
+                    whole_disk=True,
+                )["result"]
+            )
+            _dump_needed.assert_called_once_with("/dev/nvme0n1p2", "md5", "check")
+            salt_mock["images.dump"].assert_not_called()
+
+    @patch("states.images._read_current_checksum")
+    def test_dumped_test(self, _read_current_checksum):
+        """Test images.dumped state in test mode without record"""
+        make_xfs(self.device)
+        _read_current_checksum.return_value = "old"
+        opts_mock = {"test": True}
+
+        with patch.dict(images.__opts__, opts_mock):
+            self.assertEqual(
+                images.dumped(
+                    "http://example.org/image.xfs",
+                    self.device,
+                    checksum_type="md5",
+                    checksum="check",
+                ),
+                {
+                    "name": "http://example.org/image.xfs",
+                    "result": None,
+                    "changes": {"image": True, "checksum cache": True},
+                    "comment": [],
+                },
+            )
+            _read_current_checksum.assert_called_with(self.device, "md5")
+
+    def test_golden_created_present(self):
+        """Test images.golden_created state when the golden root exists"""
+        salt_mock = {
+            "images.golden_exists": MagicMock(return_value=True),
+            "images.golden_create": MagicMock(),
+        }
+
+        with patch.dict(images.__salt__, salt_mock):
+            self.assertEqual(
+                images.golden_created("/mnt", "golden-key", "/srv/golden"),
+                {
+                    "name": "/mnt",
+                    "result": True,
+                    "changes": {},
+                    "comment": ["Golden root golden-key already present"],
+                },
+            )
+            salt_mock["images.golden_create"].assert_not_called()
+
+    def test_golden_created(self):
+        """Test images.golden_created state"""
+        salt_mock = {
+            "images.golden_exists": MagicMock(return_value=False),
+            "images.golden_create": MagicMock(return_value={"seconds": 1.0}),
+        }
+        opts_mock = {"test": False}
+
+        with patch.dict(images.__salt__, salt_mock), patch.dict(
+            images.__opts__, opts_mock
+        ):
+            self.assertEqual(
+                images.golden_created("/mnt", "golden-key", "/srv/golden"),
+                {
+                    "name": "/mnt",
+                    "result": True,
+                    "changes": {"golden": "golden-key"},
+                    "comment": ["Golden root golden-key created in 1.0 seconds"],
+                },
+            )
+            salt_mock["images.golden_create"].assert_called_with(
+                "/mnt", "/srv/golden", "golden-key"
+            )
+
+    def test_golden_applied_fail(self):
+        """Test images.golden_applied state when fails"""
+        salt_mock = {
+            "images.golden_apply": MagicMock(
+                side_effect=CommandExecutionError("error")
+            ),
+        }
+        opts_mock = {"test": False}
+
+        with patch.dict(images.__salt__, salt_mock), patch.dict(
+            images.__opts__, opts_mock
+        ):
+            self.assertEqual(
+                images.golden_applied("/mnt", "golden-key", url="http://x/golden"),
+                {
+                    "name": "/mnt",
+                    "result": False,
+                    "changes": {},
+                    "comment": ["error"],
+                },
+            )
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Alberto Planas <aplanas@suse.com>
+#
+# Copyright 2019 SUSE LLC.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import os
+import struct
+import tempfile
+import unittest
+import uuid
+
+from utils import superblock
+
+UUID = "6a1f0b8e-7c3d-4e6f-9a2b-1c0d3e4f5a6b"
+
+
+def make_ext(path, state=1, mtime=10, lastcheck=20, compat=4, incompat=0x40):
+    """Create a file with a minimal ext superblock"""
+    data = bytearray(4096)
+    sb = 1024
+    struct.pack_into("<II", data, sb + 44, mtime, mtime)
+    struct.pack_into("<HH", data, sb + 56, 0xEF53, state)
+    struct.pack_into("<I", data, sb + 64, lastcheck)
+    struct.pack_into("<II", data, sb + 92, compat, incompat)
+    data[sb + 104 : sb + 120] = uuid.UUID(UUID).bytes
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def make_btrfs(path):
+    """Create a file with a minimal btrfs superblock"""
+    data = bytearray(0x11000)
+    sb = 0x10000
+    data[sb + 32 : sb + 48] = uuid.UUID(UUID).bytes
+    data[sb + 64 : sb + 72] = b"_BHRfS_M"
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def make_xfs(path):
+    """Create a file with a minimal xfs superblock"""
+    data = bytearray(4096)
+    data[:4] = b"XFSB"
+    data[32:48] = uuid.UUID(UUID).bytes
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+class SuperblockTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.device = os.path.join(self.tmpdir.name, "device")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_read_ext(self):
+        """Test superblock.read function with ext2/3/4"""
+        make_ext(self.device)
+        self.assertEqual(
+            superblock.read(self.device),
+            {
+                "type": "ext4",
+                "uuid": UUID,
+                "clean": True,
+                "needs_recovery": False,
+                "mtime": 10,
+                "wtime": 10,
+                "lastcheck": 20,
+            },
+        )
+
+        make_ext(self.device, state=3, incompat=0)
+        info = superblock.read(self.device)
+        self.assertEqual(info["type"], "ext3")
+        self.assertFalse(info["clean"])
+
+        make_ext(self.device, incompat=0x44)
+        self.assertTrue(superblock.read(self.device)["needs_recovery"])
+
+        make_ext(self.device, compat=0, incompat=0)
+        self.assertEqual(superblock.read(self.device)["type"], "ext2")
+
+    def test_read_btrfs(self):
+        """Test superblock.read function with btrfs"""
+        make_btrfs(self.device)
+        self.assertEqual(superblock.read(self.device), {"type": "btrfs", "uuid": UUID})
+
+    def test_read_xfs(self):
+        """Test superblock.read function with xfs"""
+        make_xfs(self.device)
+        self.assertEqual(superblock.read(self.device), {"type": "xfs", "uuid": UUID})
+
+    def test_read_unknown(self):
+        """Test superblock.read function with unknown data"""
+        with open(self.device, "wb") as f:
+            f.write(bytes(0x20000))
+        self.assertEqual(superblock.read(self.device), None)
+        self.assertEqual(superblock.read(self.device + "-missing"), None)
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Alberto Planas <aplanas@suse.com>
+#
+# Copyright 2019 SUSE LLC.
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import hashlib
+import http.server
+import json
+import os
+import pathlib
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch, MagicMock
+
+from utils import imagestream
+from utils import swarm
+
+
+class _OriginHandler(http.server.BaseHTTPRequestHandler):
+    """HTTP handler that serves ranges of the image, and counts them"""
+
+    def do_GET(self):
+        data = self.server.data
+        start, end = self.headers["Range"][len("bytes=") :].split("-")
+        start, end = int(start), int(end)
+        body = data[start : end + 1]
+        with self.server.lock:
+            self.server.requests += 1
+        self.send_response(206)
+        self.send_header(
+            "Content-Range", "bytes {}-{}/{}".format(start, end, len(data))
+        )
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@patch("utils.swarm.REFRESH_INTERVAL", 0.05)
+@patch("utils.swarm.POLL_INTERVAL", 0.05)
+class SwarmTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self.tmpdir.name)
+        self.data = os.urandom(20 * 1000 + 123)
+        image = self.path / "image"
+        image.write_bytes(self.data)
+        self.manifest = swarm.create_manifest(str(image), 1000)
+
+        self.origin = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _OriginHandler)
+        self.origin.data = self.data
+        self.origin.requests = 0
+        self.origin.lock = threading.Lock()
+        threading.Thread(
+            target=self.origin.serve_forever, args=(0.05,), daemon=True
+        ).start()
+        self.url = "http://127.0.0.1:{}/image".format(self.origin.server_address[1])
+
+        self.tracker = swarm.Tracker("127.0.0.1")
+        self.tracker.start()
+        self.tracker_url = "http://127.0.0.1:{}".format(self.tracker.port)
+
+    def tearDown(self):
+        self.tracker.close()
+        self.origin.shutdown()
+        self.origin.server_close()
+        self.tmpdir.cleanup()
+
+    def _peer(self):
+        peer = swarm.Peer("md5-checksum", self.manifest, self.tracker_url)
+        self.addCleanup(peer.close)
+        return peer
+
+    def _read(self, peer):
+        return b"".join(imagestream.read_chunks(peer.open(self.url), 4096))
+
+    def test_manifest(self):
+        """Test swarm.create_manifest and swarm.parse_manifest"""
+        self.assertEqual(self.manifest["size"], len(self.data))
+        self.assertEqual(len(self.manifest["hashes"]), 21)
+        self.assertEqual(
+            self.manifest["hashes"][0], hashlib.sha256(self.data[:1000]).hexdigest()
+        )
+        self.assertEqual(swarm.parse_manifest(json.dumps(self.manifest)), self.manifest)
+
+        manifest = dict(self.manifest, size=1)
+        with self.assertRaises(swarm.imagestream.StreamException):
+            swarm.parse_manifest(json.dumps(manifest))
+        with self.assertRaises(swarm.imagestream.StreamException):
+            swarm.parse_manifest("not a manifest")
+
+    def test_tracker(self):
+        """Test swarm.Tracker"""
+        tracker = swarm.Tracker(ttl=10)
+        self.addCleanup(tracker.close)
+        self.assertEqual(tracker.announce("a", "http://peer1"), [])
+        self.assertEqual(tracker.announce("a", "http://peer2"), ["http://peer1"])
+        self.assertEqual(tracker.announce("b", "http://peer3"), [])
+        self.assertEqual(
+            tracker.announce("a", "http://peer2", leave=True), ["http://peer1"]
+        )
+        self.assertEqual(tracker.announce("a", "http://peer3"), ["http://peer1"])
+
+        tracker.ttl = -1
+        self.assertEqual(tracker.announce("a", "http://peer3"), [])
+
+    def test_announce(self):
+        """Test swarm.announce using the tracker server"""
+        self.assertEqual(swarm.announce(self.tracker_url, "key", 1000), [])
+        self.assertEqual(
+            swarm.announce(self.tracker_url, "key", 2000), ["http://127.0.0.1:1000"]
+        )
+        self.assertIsNone(swarm.announce("http://127.0.0.1:1", "key", 1000))
+
+    def test_swarm(self):
+        """Test swarm.Peer sharing the chunks with a new peer"""
+        first = self._peer()
+        self.assertEqual(self._read(first), self.data)
+        self.assertEqual(first.stats["origin"], 21)
+        self.assertEqual(self.origin.requests, 21)
+
+        # The new peers fetch all the chunks from the first one
+        for _ in range(2):
+            peer = self._peer()
+            self.assertEqual(self._read(peer), self.data)
+            self.assertEqual(peer.stats["origin"], 0)
+        self.assertEqual(self.origin.requests, 21)
+        self.assertGreater(first.stats["served"], 0)
+
+    def test_swarm_limiter(self):
+        """Test swarm.Peer pacing the chunks fetched from the origin"""
+        limiter = MagicMock(wraps=imagestream.RateLimiter(1000**3, adaptive=True))
+        peer = swarm.Peer(
+            "md5-checksum", self.manifest, self.tracker_url, limiter=limiter
+        )
+        self.addCleanup(peer.close)
+        self.assertEqual(self._read(peer), self.data)
+        self.assertEqual(
+            sum(call[0][0] for call in limiter.consume.call_args_list), len(self.data)
+        )
+        self.assertEqual(limiter.observe.call_count, 21)
+
+    def test_swarm_concurrent(self):
+        """Test swarm.Peer with many peers copying at the same time"""
+        peers = [self._peer() for _ in range(3)]
+        results = [None] * len(peers)
+
+        def _run(i):
+            results[i] = self._read(peers[i])
+
+        threads = [threading.Thread(target=_run, args=(i,)) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(results, [self.data] * 3)
+        self.assertEqual(
+            sum(peer.stats["origin"] + peer.stats["peers"] for peer in peers), 3 * 21
+        )
+
+    def _stopped_peer(self):
+        """Return a peer that does not update the other peers"""
+        peer = self._peer()
+        peer.stop.set()
+        for thread in peer.threads:
+            thread.join()
+        return peer
+
+    def test_next(self):
+        """Test swarm.Peer selecting the next chunk"""
+        peer = self._stopped_peer()
+        peer.offset = 10
+        peer.peers = {}
+
+        # The next chunk in order goes first, the rest from the offset
+        self.assertEqual(peer._next(), (0, []))
+        peer.state[0] = swarm.PENDING
+        self.assertEqual(peer._next(), (10, []))
+
+        # The chunks that other peer is fetching are waited
+        peer.state[0] = swarm.MISSING
+        peer.peers = {"http://a": bytes([swarm.PENDING] * 21)}
+        self.assertIsNone(peer._next())
+        peer.waiting[0] -= swarm.PEER_WAIT
+        self.assertEqual(peer._next(), (0, []))
+
+        have = bytearray([swarm.PENDING] * 21)
+        have[5] = have[1] = swarm.PRESENT
+        peer.peers = {"http://a": bytes(have)}
+        peer.state[0] = swarm.PRESENT
+        self.assertEqual(peer._next(), (1, ["http://a"]))
+        peer.state[1] = swarm.PRESENT
+        self.assertEqual(peer._next(), (5, ["http://a"]))
+
+    def test_sample(self):
+        """Test swarm.Peer asking only some peers for their chunks"""
+        peer = self._stopped_peer()
+        peer.peers = {"http://{}".format(i): b"" for i in range(20)}
+        sample = peer._sample()
+        self.assertEqual(len(sample), swarm.REFRESH_PEERS)
+        self.assertTrue(set(sample) <= set(peer.peers))
+
+        peer.peers = {"http://a": b""}
+        self.assertEqual(peer._sample(), ["http://a"])
+
+    def test_swarm_bad_peer(self):
+        """Test swarm.Peer when a peer serves a wrong chunk"""
+        first = self._peer()
+        self._read(first)
+        first.chunk = lambda index: b"x" * 1000
+
+        peer = self._peer()
+        self.assertEqual(self._read(peer), self.data)
+        self.assertEqual(peer.stats["peers"], 0)
+        self.assertEqual(peer.stats["origin"], 21)
+
+    def test_swarm_bad_origin(self):
+        """Test swarm.Peer when the origin does not match the manifest"""
+        self.origin.data = os.urandom(len(self.data))
+        peer = self._peer()
+        with self.assertRaises(swarm.imagestream.StreamException):
+            self._read(peer)